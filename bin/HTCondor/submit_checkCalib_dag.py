@@ -123,7 +123,7 @@ def submit_all_checkCalib_dags(pairs_files, max_l1_pt, log_dir, append,
     cc.update_hadd_setup_script(hadd_setup_script, os.environ['CMSSW_VERSION'])
 
     # Additional files to copy across - other modules. etc
-    common_input_files = ['checkCalibration.py', 'binning.py', 'common_utils.py']
+    common_input_files = ['checkCalibration.py', 'binning.py', 'common_utils.py', 'profiling.py']
     common_input_files = [os.path.join(os.path.dirname(os.getcwd()), f) for f in common_input_files]
 
     status_files = []
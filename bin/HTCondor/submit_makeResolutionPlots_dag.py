@@ -91,7 +91,8 @@ def submit_all_resolution_dags(pairs_files, max_l1_pt, log_dir, append,
     cc.update_hadd_setup_script(hadd_setup_script, os.environ['CMSSW_VERSION'])
 
     # Additional files to copy across - other modules. etc
-    common_input_files = ['makeResolutionPlots.py', 'binning.py', 'common_utils.py']
+    common_input_files = ['makeResolutionPlots.py', 'binning.py', 'common_utils.py', 'profiling.py',
+                          'response_fits.py']
     common_input_files = [os.path.join(os.path.dirname(os.getcwd()), f) for f in common_input_files]
 
     # Submit a DAG for each pairs file
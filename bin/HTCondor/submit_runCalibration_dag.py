@@ -112,7 +112,10 @@ def submit_all_runCalib_dags(pairs_files, log_dir, append, pu_bins, eta_bins, fo
     cc.update_hadd_setup_script(hadd_setup_script, os.environ['CMSSW_VERSION'])
 
     # Additional files to copy across - other modules. etc
-    common_input_files = ['runCalibration.py', 'binning.py', 'common_utils.py']
+    common_input_files = ['runCalibration.py', 'binning.py', 'common_utils.py',
+                          'response_fits.py', 'pair_summaries.py', 'result_cache.py',
+                          'profiling.py', 'correction_fits.py', 'fit_ranges.py',
+                          'multifunc.py']
     common_input_files = [os.path.join(os.path.dirname(os.getcwd()), f) for f in common_input_files]
 
     status_files = []
@@ -175,102 +178,120 @@ def submit_runCalib_dag(pairs_file, log_dir, append, pu_bins, eta_bins, common_i
     out_stem = os.path.splitext(os.path.basename(pairs_file))[0]
     out_stem = out_stem.replace("pairs_", "output_")
 
-    # Loop over PU bins
+    # Setup PU bins
     # ---------------------------------------------------------------------
     pu_bins = pu_bins or [[-99, 999]]  # set ridiculous limits if no cut on PU
+    # runCalibration.py --PUbins does all PU bins in one job, and adds
+    # _PU{min}to{max} to the output filename itself
+    pu_label = "_PU{puMin}to{puMax}"
+    multi_pu = append.endswith(pu_label)
     status_files = []
-    for (pu_min, pu_max) in pu_bins:
-        log.info('**** Doing PU bin %g - %g', pu_min, pu_max)
-
-        log_stem = 'runCalib.$(cluster).$(process)'
-        runCalib_jobs = ht.JobSet(exe='python',
-                                  copy_exe=False,
-                                  filename='submit_runCalib.condor',
-                                  setup_script='worker_setup.sh',
-                                  share_exe_setup=True,
-                                  out_dir=log_dir, out_file=log_stem + '.out',
-                                  err_dir=log_dir, err_file=log_stem + '.err',
-                                  log_dir=log_dir, log_file=log_stem + '.log',
-                                  cpus=1, memory='100MB', disk='100MB',
-                                  transfer_hdfs_input=False,
-                                  common_input_files=common_input_files,
-                                  hdfs_store=out_dir)
-
-        # For creating filenames later
-        fmt_dict = dict(puMin=pu_min, puMax=pu_max)
-
-        # Hold all output filenames
-        calib_output_files = []
-
-        # Add exclusive eta bins to this JobSet
-        for ind, (eta_min, eta_max) in enumerate(pairwise(eta_bins)):
-            out_file = out_stem + "_%d" % ind + append.format(**fmt_dict) + '.root'
-            out_file = os.path.join(out_dir, out_file)
-            calib_output_files.append(out_file)
-
-            job_args = ['runCalibration.py', pairs_file, out_file,
-                        "--no-genjet-plots", '--stage2',
-                        '--no-correction-fit',
-                        '--PUmin', pu_min, '--PUmax', pu_max,
-                        '--etaInd', ind]
-
-            calib_job = ht.Job(name='calib_%d' % ind,
-                               args=job_args,
-                               input_files=[pairs_file],
-                               output_files=[out_file])
-
-            runCalib_jobs.add_job(calib_job)
 
-        # Add hadd jobs
-        # ---------------------------------------------------------------------
-        log_stem = 'runCalibHadd.$(cluster).$(process)'
-
-        hadd_jobs = ht.JobSet(exe='hadd',
+    log_stem = 'runCalib.$(cluster).$(process)'
+    runCalib_jobs = ht.JobSet(exe='python',
                               copy_exe=False,
+                              filename='submit_runCalib.condor',
+                              setup_script='worker_setup.sh',
                               share_exe_setup=True,
-                              filename='haddSmall.condor',
-                              setup_script="cmssw_setup.sh",
                               out_dir=log_dir, out_file=log_stem + '.out',
                               err_dir=log_dir, err_file=log_stem + '.err',
                               log_dir=log_dir, log_file=log_stem + '.log',
-                              cpus=1, memory='100MB', disk='20MB',
+                              cpus=1, memory='100MB', disk='100MB',
                               transfer_hdfs_input=False,
+                              common_input_files=common_input_files,
                               hdfs_store=out_dir)
 
+    # Hold all output filenames, for each PU bin
+    calib_output_files = [[] for _ in pu_bins]
+
+    # Add exclusive eta bins to this JobSet, each job doing all PU bins
+    for ind, (eta_min, eta_max) in enumerate(pairwise(eta_bins)):
+        job_output_files = []
+        for pu_ind, (pu_min, pu_max) in enumerate(pu_bins):
+            # For creating filenames
+            fmt_dict = dict(puMin=pu_min, puMax=pu_max)
+            out_file = out_stem + "_%d" % ind + append.format(**fmt_dict) + '.root'
+            out_file = os.path.join(out_dir, out_file)
+            calib_output_files[pu_ind].append(out_file)
+            job_output_files.append(out_file)
+
+        if multi_pu:
+            job_out_file = os.path.join(out_dir,
+                                        out_stem + "_%d" % ind + append[:-len(pu_label)] + '.root')
+            pu_args = ['--PUbins', ','.join('%g:%g' % (pu_min, pu_max)
+                                            for pu_min, pu_max in pu_bins)]
+        else:
+            job_out_file = job_output_files[0]
+            pu_args = ['--PUmin', pu_bins[0][0], '--PUmax', pu_bins[0][1]]
+
+        job_args = ['runCalibration.py', pairs_file, job_out_file,
+                    "--no-genjet-plots", '--stage2',
+                    '--no-correction-fit'] + pu_args + ['--etaInd', ind]
+
+        calib_job = ht.Job(name='calib_%d' % ind,
+                           args=job_args,
+                           input_files=[pairs_file],
+                           output_files=job_output_files)
+
+        runCalib_jobs.add_job(calib_job)
+
+    # Add hadd jobs, one per PU bin
+    # ---------------------------------------------------------------------
+    log_stem = 'runCalibHadd.$(cluster).$(process)'
+
+    hadd_jobs = ht.JobSet(exe='hadd',
+                          copy_exe=False,
+                          share_exe_setup=True,
+                          filename='haddSmall.condor',
+                          setup_script="cmssw_setup.sh",
+                          out_dir=log_dir, out_file=log_stem + '.out',
+                          err_dir=log_dir, err_file=log_stem + '.err',
+                          log_dir=log_dir, log_file=log_stem + '.log',
+                          cpus=1, memory='100MB', disk='20MB',
+                          transfer_hdfs_input=False,
+                          hdfs_store=out_dir)
+
+    final_files = []
+    for pu_ind, (pu_min, pu_max) in enumerate(pu_bins):
+        log.info('**** Doing PU bin %g - %g', pu_min, pu_max)
+        fmt_dict = dict(puMin=pu_min, puMax=pu_max)
+
         # Construct final hadded file name
         final_file = os.path.join(out_dir, out_stem + append.format(**fmt_dict) + '.root')
+        final_files.append(final_file)
         hadd_output = [final_file]
-        hadd_args = hadd_output + calib_output_files
+        hadd_args = hadd_output + calib_output_files[pu_ind]
 
-        hadder = ht.Job(name='haddRunCalib',
+        hadder = ht.Job(name='haddRunCalib_%d' % pu_ind,
                         args=hadd_args,
-                        input_files=calib_output_files,
+                        input_files=calib_output_files[pu_ind],
                         output_files=hadd_output)
 
         hadd_jobs.add_job(hadder)
 
-        # Add all jobs to DAG, with necessary dependencies
-        # ---------------------------------------------------------------------
-        stem = 'runCalib_%s_%s' % (strftime("%H%M%S"), cc.rand_str(3))
-        calib_dag = ht.DAGMan(filename=os.path.join(log_dir, '%s.dag' % stem),
-                              status_file=os.path.join(log_dir, '%s.status' % stem))
-        for job in runCalib_jobs:
-            calib_dag.add_job(job)
+    # Add all jobs to DAG, with necessary dependencies
+    # ---------------------------------------------------------------------
+    stem = 'runCalib_%s_%s' % (strftime("%H%M%S"), cc.rand_str(3))
+    calib_dag = ht.DAGMan(filename=os.path.join(log_dir, '%s.dag' % stem),
+                          status_file=os.path.join(log_dir, '%s.status' % stem))
+    for job in runCalib_jobs:
+        calib_dag.add_job(job)
 
+    for hadder in hadd_jobs:
         calib_dag.add_job(hadder, requires=[j for j in runCalib_jobs])
 
-        # Check if any of the output files already exists - maybe we mucked up?
-        # ---------------------------------------------------------------------
-        if not force_submit:
-            for f in [final_file] + calib_output_files:
-                if os.path.isfile(f):
-                    print 'ERROR: output file already exists - not submitting'
-                    print 'FILE:', f
-                    return 1
-
-        # calib_dag.write()
-        calib_dag.submit()
-        status_files.append(calib_dag.status_file)
+    # Check if any of the output files already exists - maybe we mucked up?
+    # ---------------------------------------------------------------------
+    if not force_submit:
+        for f in final_files + list(chain.from_iterable(calib_output_files)):
+            if os.path.isfile(f):
+                print 'ERROR: output file already exists - not submitting'
+                print 'FILE:', f
+                return 1
+
+    # calib_dag.write()
+    calib_dag.submit()
+    status_files.append(calib_dag.status_file)
 
     print 'For all statuses:'
     print 'DAGstatus.py', ' '.join(status_files)
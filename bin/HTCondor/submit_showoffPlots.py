@@ -80,7 +80,11 @@ LOG_DIR = '/storage/%s/L1JEC/%s/L1JetEnergyCorrections/jobs/showoff/%s' % (os.en
 
 
 def submit_all_showoff_jobs(configs, log_dir):
-    common_input_files = ['../showoffPlots.py', '../binning.py', '../common_utils.py', '../runCalibration.py']
+    common_input_files = ['../showoffPlots.py', '../binning.py', '../common_utils.py',
+                          '../runCalibration.py',
+                          '../response_fits.py', '../pair_summaries.py', '../result_cache.py',
+                          '../profiling.py', '../correction_fits.py', '../fit_ranges.py',
+                          '../multifunc.py']
 
     for config in configs:
         # auto-generate output dir
@@ -0,0 +1,297 @@
+"""
+Compact binary format for LUTs, so they can be loaded with numpy.memmap
+instead of parsing the human-readable text files line by line.
+
+One file holds one or more named tables, e.g. the eta compression,
+pt compression & addend + multiplier LUTs from
+correction_LUT_stage2.print_Stage2_lut_files. The layout is:
+
+- 8 byte magic string, BINARY_LUT_MAGIC
+- header length in bytes, as a little-endian uint32
+- JSON header:
+  {"version": 1,
+   "metadata": {...},  # e.g. right_shift, num_add_bits, num_eta_bins
+   "tables": [{"name", "offset", "num_entries", "num_address_bits",
+               "num_data_bits", "signed", "dtype"}, ...]}
+- each table, starting at its offset (a multiple of TABLE_ALIGNMENT bytes):
+  one little-endian unsigned int per address, using the smallest of
+  uint8/16/32/64 that holds num_data_bits. Signed values (e.g. the addend LUT)
+  are stored as num_data_bits two's complement.
+
+Tables are handled as dicts with keys values, num_address_bits & num_data_bits
+(and raw & signed when read from a binary file), where values is a numpy
+array indexed by address. This is the same for text LUTs (read_text_lut),
+so code doesn't need to care which format a LUT came from.
+
+See lut_converter.py to convert to/from the text, MIF & XML formats.
+"""
+
+
+import os
+import re
+import json
+import struct
+import numpy as np
+from collections import OrderedDict
+
+
+BINARY_LUT_MAGIC = "L1JLUT\x00\x01"
+
+BINARY_LUT_VERSION = 1
+
+# so each table can be memory-mapped on its own
+TABLE_ALIGNMENT = 64
+
+
+def get_storage_dtype(num_data_bits):
+    """Get the smallest little-endian unsigned dtype that holds num_data_bits"""
+    for dtype in ["<u1", "<u2", "<u4", "<u8"]:
+        if num_data_bits <= np.dtype(dtype).itemsize * 8:
+            return np.dtype(dtype)
+    raise ValueError("Can't store %d bit data" % num_data_bits)
+
+
+def calc_num_bits(values):
+    """Number of bits needed to hold values, including a sign bit
+    if any are negative"""
+    values = np.atleast_1d(np.asarray(values, dtype=np.int64))
+    if not len(values):
+        return 1
+    if values.min() < 0:
+        return int(max(values.max(), -values.min() - 1)).bit_length() + 1
+    return max(int(values.max()).bit_length(), 1)
+
+
+def to_unsigned(values, num_data_bits):
+    """Convert values to num_data_bits two's complement"""
+    return np.asarray(values, dtype=np.int64) & (2**num_data_bits - 1)
+
+
+def to_signed(raw, num_data_bits):
+    """Convert num_data_bits two's complement raw values to signed ints.
+    If num_data_bits fills the dtype, this is a view of raw, not a copy."""
+    if raw.dtype.itemsize * 8 == num_data_bits:
+        return raw.view(raw.dtype.str.replace('u', 'i'))
+    raw = raw.astype(np.int64)
+    return np.where(raw >= 2**(num_data_bits - 1), raw - 2**num_data_bits, raw)
+
+
+def is_binary_lut(lut_filename):
+    """Check if a file is a binary LUT"""
+    with open(lut_filename, "rb") as f:
+        return f.read(len(BINARY_LUT_MAGIC)) == BINARY_LUT_MAGIC
+
+
+def read_text_lut(lut_filename):
+    """Read a human-readable LUT, as made by correction_LUT_stage2,
+    into an array of values indexed by address.
+
+    The array has 2^nrBitsAddress entries if the LUT has a header, otherwise
+    enough for the largest address. Missing addresses are 0. If an address
+    is in the LUT more than once (e.g. the dummy padding written by
+    write_stage2_addend_multiplicative_lut when there are fewer than
+    16 pt bins), the first value is used.
+
+    Returns
+    -------
+    dict
+        values, num_address_bits & num_data_bits (from the header, or
+        None & enough for the values if there isn't one).
+
+    Raises
+    ------
+    ValueError
+        If an address doesn't fit in nrBitsAddress.
+    """
+    num_address_bits, num_data_bits = None, None
+    entries = []
+    with open(lut_filename) as f:
+        for line in f:
+            if line.startswith('#'):
+                header = re.search(r"<header>\s*\S+\s+(\d+)\s+(\d+)\s*</header>", line)
+                if header and num_address_bits is None:
+                    num_address_bits, num_data_bits = int(header.group(1)), int(header.group(2))
+                continue
+            line = line.split('#')[0].strip()
+            if line:
+                address, value = line.split()
+                entries.append((int(address), int(value)))
+    addresses = np.array([e[0] for e in entries], dtype=np.int64)
+    values = np.array([e[1] for e in entries], dtype=np.int64)
+    size = 2**num_address_bits if num_address_bits is not None else addresses.max() + 1
+    if len(addresses) and addresses.max() >= size:
+        raise ValueError("Address %d too big for %d address bits in %s"
+                         % (addresses.max(), num_address_bits, lut_filename))
+    lut = np.zeros(size, dtype=np.int64)
+    unique_addresses, first = np.unique(addresses, return_index=True)
+    lut[unique_addresses] = values[first]
+    if num_data_bits is None:
+        num_data_bits = calc_num_bits(lut)
+    return dict(values=lut, num_address_bits=num_address_bits, num_data_bits=num_data_bits)
+
+
+def write_text_lut(lut_filename, table, description=None):
+    """Write a table as a human-readable LUT, one 'address value' line
+    per address, with the header used by correction_LUT_stage2"""
+    with open(lut_filename, 'w') as lut:
+        if description:
+            lut.write('# %s\n' % description)
+        lut.write("# anything after # is ignored with the exception of the header\n")
+        lut.write("# the header is first valid line starting with ")
+        lut.write("#<header> versionStr nrBitsAddress nrBitsData </header>\n")
+        num_address_bits = table['num_address_bits']
+        if num_address_bits is None:
+            num_address_bits = calc_num_bits(len(table['values']) - 1)
+        lut.write("#<header> v1 %d %d </header>\n" % (num_address_bits, table['num_data_bits']))
+        for address, value in enumerate(table['values']):
+            lut.write('%d %d\n' % (address, value))
+
+
+def write_binary_lut(lut_filename, tables, metadata=None):
+    """Write tables to a binary LUT file.
+
+    Parameters
+    ----------
+    lut_filename : str
+        Output filename.
+    tables : OrderedDict{str: dict}
+        Table name: dict with values (indexed by address), num_address_bits
+        (can be None) & num_data_bits. Tables with negative values, or
+        signed=True, are stored as signed.
+    metadata : dict, optional
+        Anything else to store in the header, must be JSON-able.
+
+    Raises
+    ------
+    ValueError
+        If any values don't fit in num_data_bits.
+    """
+    header = dict(version=BINARY_LUT_VERSION, metadata=metadata or {}, tables=[])
+    arrays = []
+    for name, table in tables.iteritems():
+        values = np.asarray(table['values'], dtype=np.int64)
+        num_data_bits = table['num_data_bits']
+        signed = bool(table.get('signed') or (len(values) and values.min() < 0))
+        num_bits_needed = calc_num_bits(values)
+        if signed and len(values) and values.min() >= 0:
+            # make room for the sign bit
+            num_bits_needed += 1
+        if num_bits_needed > num_data_bits:
+            raise ValueError("Values in table %s don't fit in %d bits" % (name, num_data_bits))
+        dtype = get_storage_dtype(num_data_bits)
+        arrays.append(to_unsigned(values, num_data_bits).astype(dtype))
+        header['tables'].append(dict(name=name, num_entries=len(values),
+                                     num_address_bits=table['num_address_bits'],
+                                     num_data_bits=num_data_bits, signed=signed,
+                                     dtype=dtype.str))
+
+    # offsets depend on the header length, which depends on the offsets,
+    # so use fixed width offsets
+    for table_info in header['tables']:
+        table_info['offset'] = 10**12
+    header_length = len(json.dumps(header))
+    offset = len(BINARY_LUT_MAGIC) + 4 + header_length
+    for table_info, arr in zip(header['tables'], arrays):
+        offset = int(np.ceil(offset / float(TABLE_ALIGNMENT))) * TABLE_ALIGNMENT
+        table_info['offset'] = offset
+        offset += arr.nbytes
+    header_str = json.dumps(header).ljust(header_length)
+
+    with open(lut_filename, "wb") as f:
+        f.write(BINARY_LUT_MAGIC)
+        f.write(struct.pack("<I", len(header_str)))
+        f.write(header_str)
+        for table_info, arr in zip(header['tables'], arrays):
+            f.write("\0" * (table_info['offset'] - f.tell()))
+            f.write(arr.tobytes())
+
+
+def read_binary_lut_header(lut_filename):
+    """Read the JSON header of a binary LUT file
+
+    Raises
+    ------
+    IOError
+        If the file isn't a binary LUT.
+    """
+    with open(lut_filename, "rb") as f:
+        if f.read(len(BINARY_LUT_MAGIC)) != BINARY_LUT_MAGIC:
+            raise IOError("%s is not a binary LUT file" % lut_filename)
+        header_length, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_length))
+    if header['version'] > BINARY_LUT_VERSION:
+        raise IOError("Binary LUT %s is version %d, can only read up to %d"
+                      % (lut_filename, header['version'], BINARY_LUT_VERSION))
+    return header
+
+
+def read_binary_lut(lut_filename):
+    """Read all the tables in a binary LUT file, without copying them
+    into memory.
+
+    Returns
+    -------
+    OrderedDict{str: dict}
+        Table name: dict with raw (read-only numpy.memmap of the stored
+        unsigned values), values (signed if the table is signed, otherwise
+        the same as raw), num_address_bits, num_data_bits & signed
+    dict
+        Metadata from the header.
+    """
+    header = read_binary_lut_header(lut_filename)
+    tables = OrderedDict()
+    for table_info in header['tables']:
+        if table_info['num_entries']:
+            raw = np.memmap(lut_filename, dtype=np.dtype(str(table_info['dtype'])), mode='r',
+                            offset=table_info['offset'], shape=(table_info['num_entries'], ))
+        else:
+            raw = np.zeros(0, dtype=np.dtype(str(table_info['dtype'])))
+        values = to_signed(raw, table_info['num_data_bits']) if table_info['signed'] else raw
+        tables[str(table_info['name'])] = dict(raw=raw, values=values,
+                                               num_address_bits=table_info['num_address_bits'],
+                                               num_data_bits=table_info['num_data_bits'],
+                                               signed=table_info['signed'])
+    return tables, header['metadata']
+
+
+def read_lut(lut_filename, name=None):
+    """Read one table from a text or binary LUT file.
+
+    Parameters
+    ----------
+    lut_filename : str
+        Text or binary LUT file.
+    name : str, optional
+        Table name, needed for binary files with more than one table.
+
+    Returns
+    -------
+    dict
+        See read_text_lut & read_binary_lut.
+
+    Raises
+    ------
+    KeyError
+        If there's no table called name, or no name is given & the
+        binary file has more than one table.
+    """
+    if not is_binary_lut(lut_filename):
+        return read_text_lut(lut_filename)
+    tables, _ = read_binary_lut(lut_filename)
+    if name is None:
+        if len(tables) != 1:
+            raise KeyError("Need a table name for %s, one of %s" % (lut_filename, tables.keys()))
+        return tables.values()[0]
+    if name not in tables:
+        raise KeyError("No table %s in %s, only %s" % (name, lut_filename, tables.keys()))
+    return tables[name]
+
+
+def get_table_name(lut_filename, names=("add_mult", "mult", "add", "eta", "pt")):
+    """Get the table name for a LUT file, e.g. my_lut_add_mult.txt -> add_mult
+    for the LUTs from correction_LUT_plot.py --stage2, otherwise the filename stem"""
+    stem = os.path.splitext(os.path.basename(lut_filename))[0]
+    for name in names:
+        if stem.endswith("_" + name):
+            return name
+    return stem
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Unit tests for the binary LUT format & converters."""
+
+
+import binary_lut
+import lut_converter
+import unittest
+import numpy as np
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+
+class TestBinaryLUT(unittest.TestCase):
+    def setUp(self):
+        """Write text LUTs like the Stage 2 pt compression (unsigned, with a header)
+        & addend (signed) LUTs"""
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(5)
+        self.pt = np.minimum(np.arange(256) // 16, 15)
+        self.add = rng.randint(-128, 128, size=256)
+        self.pt_filename = os.path.join(self.tmp_dir, "lut_pt.txt")
+        self.add_filename = os.path.join(self.tmp_dir, "lut_add.txt")
+        for filename, values, num_data_bits in [(self.pt_filename, self.pt, 4),
+                                                (self.add_filename, self.add, 8)]:
+            with open(filename, "w") as f:
+                f.write("# comment\n#<header> v1 8 %d </header>\n" % num_data_bits)
+                for address, value in enumerate(values):
+                    f.write("%d %d  # eta_bin\n" % (address, value))
+        self.binary_filename = os.path.join(self.tmp_dir, "lut.lut")
+        lut_converter.pack(self.binary_filename, [self.pt_filename, self.add_filename],
+                           right_shift=9, num_add_bits=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        """Check the tables & metadata are the same when read back,
+        and that they are memory-mapped"""
+        self.assertTrue(binary_lut.is_binary_lut(self.binary_filename))
+        self.assertFalse(binary_lut.is_binary_lut(self.pt_filename))
+        tables, metadata = binary_lut.read_binary_lut(self.binary_filename)
+        self.assertEqual(tables.keys(), ["pt", "add"])
+        self.assertEqual(metadata, dict(num_pt_bins=16, right_shift=9, num_add_bits=8))
+        np.testing.assert_array_equal(tables["pt"]["values"], self.pt)
+        np.testing.assert_array_equal(tables["add"]["values"], self.add)
+        np.testing.assert_array_equal(tables["add"]["raw"], self.add & 0xFF)
+        self.assertIsInstance(tables["pt"]["raw"], np.memmap)
+        self.assertEqual(tables["pt"]["raw"].dtype.itemsize, 1)
+        self.assertTrue(tables["add"]["signed"])
+        self.assertFalse(tables["pt"]["signed"])
+        self.assertEqual((tables["pt"]["num_address_bits"], tables["pt"]["num_data_bits"]), (8, 4))
+        for table in tables.values():
+            self.assertEqual(table["raw"].offset % binary_lut.TABLE_ALIGNMENT, 0)
+
+    def test_signed(self):
+        """Check signed values that don't fill the storage dtype"""
+        filename = os.path.join(self.tmp_dir, "signed.lut")
+        values = np.array([-16, -1, 0, 15, 3])
+        table = dict(values=values, num_address_bits=None, num_data_bits=5)
+        binary_lut.write_binary_lut(filename, OrderedDict(a=table))
+        np.testing.assert_array_equal(binary_lut.read_lut(filename)["values"], values)
+        with self.assertRaises(ValueError):
+            binary_lut.write_binary_lut(filename, OrderedDict(a=dict(table, num_data_bits=4)))
+        with self.assertRaises(ValueError):
+            binary_lut.write_binary_lut(filename, OrderedDict(a=dict(table, values=[0, 16],
+                                                                     signed=True)))
+
+    def test_unpack(self):
+        """Check unpacking to text, MIF & XML gives the same values"""
+        base = os.path.join(self.tmp_dir, "unpacked")
+        lut_converter.unpack(self.binary_filename, base, "txt")
+        lut_converter.unpack(self.binary_filename, base, "mif")
+        for name, values in [("pt", self.pt), ("add", self.add)]:
+            text_filename = getattr(self, name + "_filename")
+            self.assertEqual(lut_converter.diff("%s_%s.txt" % (base, name), text_filename), 0)
+            mif_filename = "%s_%s.mif" % (base, name)
+            np.testing.assert_array_equal(lut_converter.read_any_lut(mif_filename)["values"],
+                                          values & 0xFF)
+            self.assertEqual(lut_converter.diff(mif_filename, text_filename), 0)
+        # only the add_mult table (or the only table) is written to XML
+        lut_converter.unpack(self.binary_filename, base, "xml")
+        self.assertFalse(os.path.exists(base + "_pt.xml"))
+        pt_only = os.path.join(self.tmp_dir, "pt_only.lut")
+        lut_converter.pack(pt_only, [self.pt_filename])
+        lut_converter.unpack(pt_only, base, "xml")
+        np.testing.assert_array_equal(lut_converter.read_any_lut(base + "_pt.xml")["values"],
+                                      self.pt)
+
+    def test_diff(self):
+        other = os.path.join(self.tmp_dir, "other.lut")
+        pt_filename = os.path.join(self.tmp_dir, "other_pt.txt")
+        shutil.copy(self.pt_filename, pt_filename)
+        with open(pt_filename, "a") as f:
+            f.write("20 3\n")  # duplicate address, so ignored
+        lut_converter.pack(other, [pt_filename, self.add_filename])
+        self.assertEqual(lut_converter.diff(self.binary_filename, other), 0)
+        add = self.add.copy()
+        add[[3, 100]] += 1
+        tables = OrderedDict(pt=binary_lut.read_text_lut(self.pt_filename),
+                             add=dict(values=add, num_address_bits=8, num_data_bits=9))
+        binary_lut.write_binary_lut(other, tables)
+        self.assertEqual(lut_converter.diff(self.binary_filename, other), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
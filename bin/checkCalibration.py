@@ -11,13 +11,20 @@ python checkCalibration.py -h
 
 
 import ROOT
+import os
 import sys
+import glob
+import shutil
+import tempfile
+import multiprocessing
 from array import array
 import numpy as np
 import argparse
 import binning
 from binning import pairwise
 import common_utils as cu
+import profiling
+from profiling import PROFILER
 
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -27,25 +34,342 @@ ROOT.gStyle.SetOptFit(1111)
 ROOT.TH1.SetDefaultSumw2(True)
 
 
-def plot_checks(inputfile, outputfile, absetamin, absetamax, max_pt, pu_min, pu_max):
+def get_entry_ranges(inputfile, absetamin, absetamax, pu_min, pu_max):
+    """Get the entry ranges for an eta bin & PU range if the pairs file has been
+    indexed by indexPairs.py, otherwise None (i.e. use all entries)"""
+    index = cu.get_pairs_index(inputfile)
+    if index is None:
+        return None
+    return cu.get_index_entry_ranges(index, absetamin, absetamax, pu_min, pu_max)
+
+
+# Branches needed to do all the plots from numpy arrays
+PAIRS_COLUMNS = ["rsp", "pt", "ptRef", "eta", "numPUVertices"]
+
+
+def intersect_entry_ranges(entry_ranges, first, n_entries):
+    """Restrict (first entry, number of entries) ranges to entries
+    first to first + n_entries. entry_ranges of None means all entries."""
+    if entry_ranges is None:
+        return [(first, n_entries)]
+    ranges = []
+    for range_first, range_n in entry_ranges:
+        start = max(range_first, first)
+        end = min(range_first + range_n, first + n_entries)
+        if end > start:
+            ranges.append((start, end - start))
+    return ranges
+
+
+@PROFILER.timed("read_pairs")
+def get_pu_bin_pairs(inputfile, eta_bins, pu_bins, shard=None):
+    """Get the pairs for several PU bins, reading the pairs tree only once.
+
+    Parameters
+    ----------
+    inputfile : ROOT.TFile
+        Pairs file.
+    eta_bins : list[float]
+        Eta bin edges. Only pairs with eta_bins[0] < |eta| < eta_bins[-1] are kept.
+    pu_bins : list[(float, float)]
+        (min, max) number of PU vertices for each PU bin, inclusive.
+    shard : (int, int), optional
+        Only read these (first entry, number of entries) of the tree.
+
+    Returns
+    -------
+    list[dict{str : numpy.ndarray}]
+        Columns of the pairs for each PU bin, to pass as pairs to the
+        plotting functions.
+    """
+    tree_raw = inputfile.Get("valid")
+    pu_lo = min(pu_min for pu_min, _ in pu_bins)
+    pu_hi = max(pu_max for _, pu_max in pu_bins)
+    cutStr = " && ".join([make_eta_cut_str(eta_bins[0], eta_bins[-1]),
+                          "numPUVertices <= %f && numPUVertices >= %f" % (pu_hi, pu_lo)])
+    entry_ranges = get_entry_ranges(inputfile, eta_bins[0], eta_bins[-1], pu_lo, pu_hi)
+    if shard is not None:
+        entry_ranges = intersect_entry_ranges(entry_ranges, *shard)
+    arrays = cu.get_tree_arrays(tree_raw, PAIRS_COLUMNS, cutStr, entry_ranges)
+    arrays["abs_eta"] = np.abs(arrays["eta"])
+    pu = arrays["numPUVertices"]
+    pu_bin_pairs = []
+    for pu_min, pu_max in pu_bins:
+        # same precision as the %f in the cut strings
+        mask = (pu <= float("%f" % pu_max)) & (pu >= float("%f" % pu_min))
+        pu_bin_pairs.append({var: arr[mask] for var, arr in arrays.iteritems()})
+    return pu_bin_pairs
+
+
+def make_eta_cut_str(absetamin, absetamax):
+    """Cut string for absetamin < |eta| < absetamax. The edges are written
+    exactly (repr), so the numpy masks can use the same float edges."""
+    return "TMath::Abs(eta) < %r && TMath::Abs(eta) > %r" % (float(absetamax), float(absetamin))
+
+
+def get_pairs_mask(pairs, absetamin, absetamax, pt_cuts):
+    """Get mask of pairs passing the same cuts as the cut strings in the
+    plotting functions (PU is already cut on in get_pu_bin_pairs).
+
+    Parameters
+    ----------
+    pairs : dict{str : numpy.ndarray}
+        Columns of the pairs.
+    absetamin, absetamax : float
+        Eta bin edges, exclusive.
+    pt_cuts : list[(str, float, float)]
+        (variable, min, max) exclusive cuts, use None for no cut.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    # same edges as make_eta_cut_str
+    mask = (pairs["abs_eta"] < float(absetamax)) & (pairs["abs_eta"] > float(absetamin))
+    for var, var_min, var_max in pt_cuts:
+        if var_min is not None:
+            mask &= pairs[var] > var_min
+        if var_max is not None:
+            mask &= pairs[var] < var_max
+    # Avoid L1 saturated jets cut
+    mask &= pairs["pt"] < 1023.1
+    return mask
+
+
+# Binning of the response hists in plot_rsp_eta
+RSP_ETA_HIST_BINNING = (100, 0., 5.)
+
+
+def find_fix_bins(values, binning):
+    """Get the bin number of each value for an axis with fixed size bins,
+    the same as TAxis::FindFixBin (0 for underflow, nbins + 1 for overflow)"""
+    nbins, xmin, xmax = binning
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.full(len(values), nbins + 1, dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        bins[values < xmin] = 0
+        in_range = (values >= xmin) & (values < xmax)
+    bins[in_range] = 1 + (nbins * (values[in_range] - xmin) / (xmax - xmin)).astype(np.int64)
+    return bins
+
+
+def find_open_cells(values, edges):
+    """Put values in cells defined by sorted edges: the edges themselves,
+    and the open intervals between & beyond them.
+
+    Cell 2i + 1 is values equal to edges[i], and cell 2i is values strictly
+    between edges[i-1] & edges[i], so the values in the open interval
+    (edges[a], edges[b]) are those in cells 2a + 2 to 2b inclusive.
+    NaN is put in the last cell, 2 * len(edges).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    ind = np.searchsorted(edges, values, side='left')
+    on_edge = np.zeros(len(values), dtype=bool)
+    has_edge = ind < len(edges)
+    on_edge[has_edge] = edges[ind[has_edge]] == values[has_edge]
+    return 2 * ind + on_edge
+
+
+class ResponseCube(object):
+    """Response hists for every eta bin & pt_var range in plot_rsp_eta,
+    from one pass over the pairs.
+
+    The pairs are counted in (|eta| cell, pt_var cell, response bin), where the
+    cells are the edges & the open intervals between them (see find_open_cells),
+    so the hist for any eta & pt_var range between edges is a sum of cells,
+    with exactly the same pairs as the exclusive cuts in the cut strings.
+    The sums of response & response^2 are kept too, so the hist mean & RMS
+    are from the unbinned values, as when drawn from the tree.
+    """
+
+    def __init__(self, pairs, eta_bins, pt_var, pt_ranges):
+        """
+        Parameters
+        ----------
+        pairs : dict{str : numpy.ndarray}
+            Columns of the pairs, from get_pu_bin_pairs.
+        eta_bins : list[float]
+            Eta bin edges.
+        pt_var : str
+            Variable to cut on (pt or ptRef).
+        pt_ranges : list[(float, float)]
+            All the (min, max) ranges of pt_var that hists will be made for.
+        """
+        # same edges as the cut strings: exact for eta (make_eta_cut_str), %g for pt
+        self.eta_edges = np.unique([float(eta) for eta in eta_bins])
+        self.pt_edges = np.unique([float("%g" % pt) for pt_range in pt_ranges for pt in pt_range])
+        # Avoid L1 saturated jets cut
+        mask = pairs["pt"] < 1023.1
+        rsp = pairs["rsp"][mask]
+        rsp_bins = find_fix_bins(rsp, RSP_ETA_HIST_BINNING)
+        cells = (find_open_cells(pairs["abs_eta"][mask], self.eta_edges),
+                 find_open_cells(pairs[pt_var][mask], self.pt_edges))
+        shape = (2 * len(self.eta_edges) + 1, 2 * len(self.pt_edges) + 1)
+        n_bins = RSP_ETA_HIST_BINNING[0] + 2
+        index = np.ravel_multi_index(cells + (rsp_bins,), shape + (n_bins,))
+        self.counts = np.bincount(index, minlength=np.prod(shape) * n_bins)
+        self.counts = self.counts.reshape(shape + (n_bins,))
+        # TH1::Fill only adds in-range values to the stats
+        in_range = (rsp_bins > 0) & (rsp_bins < n_bins - 1)
+        index = np.ravel_multi_index(cells, shape)[in_range]
+        n_cells = np.prod(shape)
+        self.sum_rsp = np.bincount(index, weights=rsp[in_range], minlength=n_cells).reshape(shape)
+        self.sum_rsp2 = np.bincount(index, weights=rsp[in_range]**2,
+                                    minlength=n_cells).reshape(shape)
+
+    @staticmethod
+    def _cells(edges, low, high, fmt):
+        """Slice of cells for the open interval (low, high)"""
+        a, b = [np.flatnonzero(edges == float(fmt % x)) for x in (low, high)]
+        if len(a) != 1 or len(b) != 1:
+            raise ValueError("Range %g - %g isn't between edges %s" % (low, high, list(edges)))
+        return slice(2 * a[0] + 2, 2 * b[0] + 1)
+
+    def project(self, absetamin, absetamax, pt_min, pt_max):
+        """Get the response hist contents for absetamin < |eta| < absetamax &
+        pt_min < pt_var < pt_max.
+
+        Returns
+        -------
+        numpy.ndarray, float, float
+            Bin contents, including under/overflow, and the sums of
+            response & response^2 for the in-range pairs.
+
+        Raises
+        ------
+        ValueError
+            If the eta or pt range isn't between edges of the cube.
+        """
+        cells = (self._cells(self.eta_edges, absetamin, absetamax, "%r"),
+                 self._cells(self.pt_edges, pt_min, pt_max, "%g"))
+        contents = self.counts[cells].sum(axis=(0, 1)).astype(np.float64)
+        return contents, self.sum_rsp[cells].sum(), self.sum_rsp2[cells].sum()
+
+    def make_hist(self, name, absetamin, absetamax, pt_min, pt_max):
+        """Make the response hist for absetamin < |eta| < absetamax &
+        pt_min < pt_var < pt_max, like draw_hist(..., ["rsp"], RSP_ETA_HIST_BINNING, ...)
+
+        Raises
+        ------
+        ValueError
+            If the eta or pt range isn't between edges of the cube.
+        """
+        contents, sum_rsp, sum_rsp2 = self.project(absetamin, absetamax, pt_min, pt_max)
+        hist = ROOT.TH1F(name, "", *RSP_ETA_HIST_BINNING)
+        hist.SetDirectory(0)
+        cu.set_hist_contents(hist, contents, contents)
+        n_in_range = contents[1:-1].sum()
+        if n_in_range > 0:
+            hist.PutStats(np.array([n_in_range, n_in_range, sum_rsp, sum_rsp2]))
+        hist.SetEntries(contents.sum())
+        return hist
+
+
+def draw_hist(tree, pairs, mask, name, variables, hist_binning, cutStr, entry_ranges, filled=None):
+    """Make a hist of variables for pairs passing cutStr,
+    like TTree::Draw("y:x>>name(hist_binning)").
+
+    If pairs is set, the hist is filled from those columns instead of the tree,
+    with mask the numpy equivalent of cutStr.
+
+    If filled is set, the hist is taken from there instead, see get_filled_hist.
+
+    Parameters
+    ----------
+    tree : ROOT.TTree
+        Pairs tree.
+    pairs : dict{str : numpy.ndarray} or None
+        Columns of the pairs.
+    mask : numpy.ndarray
+        Mask of pairs to use, if pairs is set.
+    name : str
+        Hist name.
+    variables : list[str]
+        [x] for a 1D hist, [x, y] for a 2D hist.
+    hist_binning : list
+        nbins, min, max for each axis.
+    cutStr : str
+        Cut string.
+    entry_ranges : list[(int, int)] or None
+        Tree entry ranges to draw from, see common_utils.draw_tree.
+    filled : ROOT.TDirectory, optional
+        Directory with the hist already filled.
+
+    Returns
+    -------
+    ROOT.TH1F or ROOT.TH2F
+    """
+    if filled is not None:
+        return get_filled_hist(filled, name)
+    varexp = ":".join(reversed(variables))
+    if pairs is None:
+        binning_str = ",".join("%g" % b for b in hist_binning)
+        cu.draw_tree(tree, "%s>>%s(%s)" % (varexp, name, binning_str), cutStr, "", entry_ranges)
+        return ROOT.gROOT.FindObject(name)
+    hist_type = ROOT.TH1F if len(variables) == 1 else ROOT.TH2F
+    hist = hist_type(name, "%s {%s}" % (varexp, cutStr), *hist_binning)
+    hist.SetDirectory(0)
+    cu.fill_hist(hist, *[pairs[var][mask] for var in variables])
+    return hist
+
+
+def get_filled_hist(filled, name):
+    """Get a hist filled already (e.g. merged from shards, see run_sharded_checks),
+    detached from its file so it can be fitted & written elsewhere.
+
+    Raises
+    ------
+    IOError
+        If filled doesn't have the hist.
+    """
+    hist = filled.Get(name)
+    if not hist:
+        raise IOError("No hist %s in %s" % (name, filled.GetPath()))
+    hist.SetDirectory(0)
+    return hist
+
+
+def get_filled_dir(filled, absetamin, absetamax):
+    """Get the Histograms directory for an eta bin from a file of filled hists,
+    or None if filled is None"""
+    if filled is None:
+        return None
+    filled_dir = filled.GetDirectory('eta_%g_%g/Histograms' % (absetamin, absetamax))
+    if not filled_dir:
+        raise IOError("No hists for eta bin %g - %g in %s"
+                      % (absetamin, absetamax, filled.GetName()))
+    return filled_dir
+
+
+@PROFILER.timed("plot_checks")
+def plot_checks(inputfile, outputfile, absetamin, absetamax, max_pt, pu_min, pu_max, pairs=None,
+                fill_only=False, filled=None):
     """
     Do all the relevant response 1D and 2D hists, for one eta bin.
 
     Can optionally impose maximum pt cut on L1 jets (to avoid problems with saturation),
     and on number of PU vertices.
+
+    If pairs is set (from get_pu_bin_pairs), the hists are filled from those
+    instead of the tree.
+
+    If fill_only, only the filled hists are written (no fits or normalised hists),
+    so they can be merged with others. If filled is set (a file with the same
+    layout as from fill_only), the hists are taken from there instead of filled.
     """
 
     print "Doing eta bin: %g - %g, max L1 jet pt: %g" % (absetamin, absetamax, max_pt)
 
     # Input tree
-    tree_raw = inputfile.Get("valid")
+    tree_raw = inputfile.Get("valid") if inputfile else None
+    filled_dir = get_filled_dir(filled, absetamin, absetamax)
 
     # Output folders
     output_f = outputfile.mkdir('eta_%g_%g' % (absetamin, absetamax))
     output_f_hists = output_f.mkdir("Histograms")
 
     # Eta cut string
-    eta_cutStr = " TMath::Abs(eta)<%g && TMath::Abs(eta) > %g " % (absetamax, absetamin)
+    eta_cutStr = make_eta_cut_str(absetamin, absetamax)
     # Pt cut string
     pt_cutStr = "pt < %g" % max_pt
     # PU cut string
@@ -54,10 +378,48 @@ def plot_checks(inputfile, outputfile, absetamin, absetamax, max_pt, pu_min, pu_
     avoidSaturation_cut = "pt < 1023.1"
     cutStr = " && ".join([eta_cutStr, pt_cutStr, pu_cutStr, avoidSaturation_cut])
 
+    # if the pairs file is indexed by indexPairs.py, only read the entries
+    # for this eta bin & PU range
+    entry_ranges = None
+    mask = None
+    if pairs is not None:
+        mask = get_pairs_mask(pairs, absetamin, absetamax, [("pt", None, max_pt)])
+    elif filled is None:
+        entry_ranges = get_entry_ranges(inputfile, absetamin, absetamax, pu_min, pu_max)
+
+    # nb_pt, pt_min, pt_max = 63, 0, 252  # for GCT/Stage 1
+    nb_pt, pt_min, pt_max = 512, 0, 1024  # for Stage 2
+    nb_rsp, rsp_min, rsp_max = 100, 0, 5
+
     # Draw response (pT^L1/pT^Gen) for all pt bins
-    tree_raw.Draw("rsp>>hrsp_eta_%g_%g(100,0,5)" % (absetamin, absetamax), cutStr)
-    hrsp_eta = ROOT.gROOT.FindObject("hrsp_eta_%g_%g" % (absetamin, absetamax))
+    hrsp_eta = draw_hist(tree_raw, pairs, mask, "hrsp_eta_%g_%g" % (absetamin, absetamax),
+                         ["rsp"], [100, 0, 5], cutStr, entry_ranges, filled_dir)
     hrsp_eta.SetTitle(";response (p_{T}^{L1}/p_{T}^{Ref});")
+
+    # Draw rsp (pT^L1/pT^Gen) Vs GenJet pT
+    h2d_rsp_gen = draw_hist(tree_raw, pairs, mask, "h2d_rsp_gen", ["ptRef", "rsp"],
+                            [nb_pt, pt_min, pt_max, nb_rsp, rsp_min, rsp_max], cutStr, entry_ranges,
+                            filled_dir)
+    h2d_rsp_gen.SetTitle(";p_{T}^{Ref} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
+
+    # Draw rsp (pT^L1/pT^Gen) Vs L1 pT
+    h2d_rsp_l1 = draw_hist(tree_raw, pairs, mask, "h2d_rsp_l1", ["pt", "rsp"],
+                           [nb_pt, pt_min, pt_max, nb_rsp, rsp_min, rsp_max], cutStr, entry_ranges,
+                           filled_dir)
+    h2d_rsp_l1.SetTitle(";p_{T}^{L1} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
+
+    # Draw pT^Gen Vs pT^L1
+    h2d_gen_l1 = draw_hist(tree_raw, pairs, mask, "h2d_gen_l1", ["ptRef", "pt"],
+                           [nb_pt, pt_min, pt_max, nb_pt, pt_min, pt_max], cutStr, entry_ranges,
+                           filled_dir)
+    h2d_gen_l1.SetTitle(";p_{T}^{Ref} [GeV];p_{T}^{L1} [GeV]")
+
+    if fill_only:
+        for hist in [hrsp_eta, h2d_rsp_gen, h2d_rsp_l1, h2d_gen_l1]:
+            output_f_hists.WriteTObject(hist)
+        return
+
+    PROFILER.count("rsp_fit_attempts")
     if absetamin < 2.9:
         fit_result = hrsp_eta.Fit("gaus", "QER", "",
                                   hrsp_eta.GetMean() - hrsp_eta.GetRMS(),
@@ -72,36 +434,20 @@ def plot_checks(inputfile, outputfile, absetamin, absetamax, max_pt, pu_min, pu_
     # err = hrsp_eta.GetFunction("gaus").GetParError(1)
     output_f_hists.WriteTObject(hrsp_eta)
 
-    # nb_pt, pt_min, pt_max = 63, 0, 252  # for GCT/Stage 1
-    nb_pt, pt_min, pt_max = 512, 0, 1024  # for Stage 2
-    nb_rsp, rsp_min, rsp_max = 100, 0, 5
-
-    # Draw rsp (pT^L1/pT^Gen) Vs GenJet pT
-    tree_raw.Draw("rsp:ptRef>>h2d_rsp_gen(%d,%g,%g,%d,%g,%g)" % (nb_pt, pt_min, pt_max, nb_rsp, rsp_min, rsp_max), cutStr)
-    h2d_rsp_gen = ROOT.gROOT.FindObject("h2d_rsp_gen")
-    h2d_rsp_gen.SetTitle(";p_{T}^{Ref} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
     output_f_hists.WriteTObject(h2d_rsp_gen)
-
     h2d_rsp_gen_norm = cu.norm_vertical_bins(h2d_rsp_gen)
     output_f_hists.WriteTObject(h2d_rsp_gen_norm)
 
-    # Draw rsp (pT^L1/pT^Gen) Vs L1 pT
-    tree_raw.Draw("rsp:pt>>h2d_rsp_l1(%d,%g,%g,%d,%g,%g)" % (nb_pt, pt_min, pt_max, nb_rsp, rsp_min, rsp_max), cutStr)
-    h2d_rsp_l1 = ROOT.gROOT.FindObject("h2d_rsp_l1")
-    h2d_rsp_l1.SetTitle(";p_{T}^{L1} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
     output_f_hists.WriteTObject(h2d_rsp_l1)
-
     h2d_rsp_l1_norm = cu.norm_vertical_bins(h2d_rsp_l1)
     output_f_hists.WriteTObject(h2d_rsp_l1_norm)
 
-    # Draw pT^Gen Vs pT^L1
-    tree_raw.Draw("pt:ptRef>>h2d_gen_l1(%d,%g,%g,%d,%g,%g)" % (nb_pt, pt_min, pt_max, nb_pt, pt_min, pt_max), cutStr)
-    h2d_gen_l1 = ROOT.gROOT.FindObject("h2d_gen_l1")
-    h2d_gen_l1.SetTitle(";p_{T}^{Ref} [GeV];p_{T}^{L1} [GeV]")
     output_f_hists.WriteTObject(h2d_gen_l1)
 
 
-def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min, pu_max):
+@PROFILER.timed("plot_rsp_eta")
+def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min, pu_max,
+                 pairs=None, cube=None, fill_only=False, filled=None):
     """Plot graph of response in bins of eta
 
     If the response hist for each bin exists already, then we use that.
@@ -109,12 +455,17 @@ def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min
 
     pt_min and pt_max are so that the graph can be made for a given pt interval
     pt_var is the variable to bin on (pt or ptRef)
+    If pairs is set (from get_pu_bin_pairs), the hists are filled from those
+    instead of the tree.
+    If cube is set (a ResponseCube for pt_var), the hists are taken from that
+    instead, so no pass over the pairs is needed at all.
+    fill_only & filled are as for plot_checks.
     """
 
     gr_rsp_eta = ROOT.TGraphErrors()
 
     # Input tree
-    tree_raw = inputfile.Get("valid")
+    tree_raw = inputfile.Get("valid") if inputfile else None
 
     # Output folders
     output_f = outputfile.GetDirectory('eta_%g_%g' % (eta_bins[0], eta_bins[-1]))
@@ -132,20 +483,33 @@ def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min
         absetamax = eta_bins[i + 1] # Eta cut string
 
         # Cut strings
-        eta_cutStr = "TMath::Abs(eta) < %f && TMath::Abs(eta) > %f" % (absetamax, absetamin)
+        eta_cutStr = make_eta_cut_str(absetamin, absetamax)
         pt_cutStr = "%s < %g && %s > %g" % (pt_var, pt_max, pt_var, pt_min)
         pu_cutStr = "numPUVertices <= %f && numPUVertices >= %f" % (pu_max, pu_min)
         avoidSaturation_cut = "pt < 1023.1"
         cutStr = " && ".join([eta_cutStr, pt_cutStr, pu_cutStr, avoidSaturation_cut])
         print cutStr
-
-        nb_rsp = 100
-        rsp_min, rsp_max = 0, 5
         rsp_name = 'hrsp_eta_%g_%g_%s_%g_%g' % (absetamin, absetamax, pt_var, pt_min, pt_max)
-        tree_raw.Draw("rsp>>%s(%d,%g,%g)" % (rsp_name, nb_rsp, rsp_min, rsp_max), cutStr)
-        h_rsp = ROOT.gROOT.FindObject(rsp_name)
+        if filled is not None:
+            h_rsp = get_filled_hist(get_filled_dir(filled, eta_bins[0], eta_bins[-1]), rsp_name)
+        elif cube is not None:
+            h_rsp = cube.make_hist(rsp_name, absetamin, absetamax, pt_min, pt_max)
+        else:
+            entry_ranges = None
+            mask = None
+            if pairs is None:
+                entry_ranges = get_entry_ranges(inputfile, absetamin, absetamax, pu_min, pu_max)
+            else:
+                mask = get_pairs_mask(pairs, absetamin, absetamax, [(pt_var, pt_min, pt_max)])
+            h_rsp = draw_hist(tree_raw, pairs, mask, rsp_name, ["rsp"],
+                              list(RSP_ETA_HIST_BINNING), cutStr, entry_ranges)
         h_rsp.SetTitle(";response (p_{T}^{L1}/p_{T}^{Ref});")
 
+        if fill_only:
+            # keep empty hists too, so every shard has the same hists to merge
+            output_f_hists.WriteTObject(h_rsp)
+            continue
+
         print 'Integral', h_rsp.Integral()
 
         if h_rsp.Integral() <= 0:
@@ -154,6 +518,7 @@ def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min
 
         # Fit with Gaussian
         peak = h_rsp.GetBinCenter(h_rsp.GetMaximumBin())
+        PROFILER.count("rsp_fit_attempts")
         if absetamin < 2.9:
             fit_result = h_rsp.Fit("gaus", "QER", "",
                                    h_rsp.GetMean() - h_rsp.GetRMS(),
@@ -182,6 +547,9 @@ def plot_rsp_eta(inputfile, outputfile, eta_bins, pt_min, pt_max, pt_var, pu_min
         gr_rsp_eta.SetPoint(N, 0.5 * (absetamin + absetamax), mean)
         gr_rsp_eta.SetPointError(N, 0.5 * (absetamax - absetamin), err)
 
+    if fill_only:
+        return
+
     gr_rsp_eta.SetTitle(";|#eta^{L1}|; <response> = <p_{T}^{L1}/p_{T}^{Ref}>")
     gr_rsp_eta.SetName("gr_rsp_eta_%g_%g_%s_%g_%g" % (eta_bins[0], eta_bins[-1], pt_var, pt_min, pt_max))
     output_f.WriteTObject(gr_rsp_eta)
@@ -197,17 +565,22 @@ def check_gaus_fit(hist):
     return (abs(hist.GetFunction('gaus').GetParameter(1) - x_peak) / abs(x_peak)) < 0.1
 
 
-def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt_max, pu_min, pu_max):
+@PROFILER.timed("plot_rsp_pt")
+def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt_max,
+                pu_min, pu_max, pairs=None, fill_only=False, filled=None):
     """Make a graph of response Vs pt for given eta bin
 
     pt_var allows the user to specify which pT to bin in & plot against.
     Should be the name of a variable in the tree
     pt_max is a cut on maxmimum value of pt (applied to l1 pt to
         avoid including saturation effects)
+    If pairs is set (from get_pu_bin_pairs), the hists are filled from those
+    instead of the tree.
+    fill_only & filled are as for plot_checks.
     """
 
     # Input tree
-    tree_raw = inputfile.Get("valid")
+    tree_raw = inputfile.Get("valid") if inputfile else None
 
     # Output folders
     output_f = outputfile.GetDirectory('eta_%g_%g' % (absetamin, absetamax))
@@ -221,7 +594,7 @@ def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt
     gr_rsp_pt = ROOT.TGraphErrors()
 
     # Cut strings
-    eta_cutStr = "TMath::Abs(eta) < %f && TMath::Abs(eta) > %f" % (absetamax, absetamin)
+    eta_cutStr = make_eta_cut_str(absetamin, absetamax)
     # keep the pt < pt_max to safeguard against staurated L1 jets
     pt_cutStr = "%s < %g && pt < %g" % (pt_var, pt_bins[-1], pt_max)
     pu_cutStr = "numPUVertices <= %f && numPUVertices >= %f" % (pu_max, pu_min)
@@ -235,13 +608,26 @@ def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt
     pt_array = array('d', pt_bins)
 
     # First make a 2D plot
-    h2d_rsp_pt = ROOT.TH2D("h2d_rsp_%s_%g_%g" % (pt_var, absetamin, absetamax),
-                           "%g < |#eta| < %g;p_{T};response" % (absetamin, absetamax),
-                           len(pt_bins) - 1, pt_array,
-                           n_rsp_bins, rsp_min, rsp_max)
-    tree_raw.Draw("rsp:%s>>h2d_rsp_%s_%g_%g" % (pt_var, pt_var, absetamin, absetamax), cutStr)
+    h2d_name = "h2d_rsp_%s_%g_%g" % (pt_var, absetamin, absetamax)
+    if filled is not None:
+        h2d_rsp_pt = get_filled_hist(get_filled_dir(filled, absetamin, absetamax), h2d_name)
+    else:
+        h2d_rsp_pt = ROOT.TH2D(h2d_name,
+                               "%g < |#eta| < %g;p_{T};response" % (absetamin, absetamax),
+                               len(pt_bins) - 1, pt_array,
+                               n_rsp_bins, rsp_min, rsp_max)
+        if pairs is None:
+            entry_ranges = get_entry_ranges(inputfile, absetamin, absetamax, pu_min, pu_max)
+            cu.draw_tree(tree_raw, "rsp:%s>>%s" % (pt_var, h2d_name), cutStr, "", entry_ranges)
+        else:
+            h2d_rsp_pt.SetDirectory(0)
+            mask = get_pairs_mask(pairs, absetamin, absetamax,
+                                  [(pt_var, None, pt_bins[-1]), ("pt", None, pt_max)])
+            cu.fill_hist(h2d_rsp_pt, pairs[pt_var][mask], pairs["rsp"][mask])
 
     output_f_hists.WriteTObject(h2d_rsp_pt)
+    if fill_only:
+        return
 
     # Now for each pt bin, do a projection on 1D hist of response and fit a Gaussian
     print pt_bins
@@ -262,6 +648,7 @@ def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt
         #    fit_result = h_rsp.Fit("gaus", "QER", "", peak - h_rsp.GetRMS(), peak + h_rsp.GetRMS())
         # else:
         # fit_result = h_rsp.Fit("gaus", "QER", "", peak - 0.5*h_rsp.GetRMS(), peak + 0.5*h_rsp.GetRMS())
+        PROFILER.count("rsp_fit_attempts")
         fit_result = h_rsp.Fit("gaus", "QER", "", peak - h_rsp.GetRMS(), peak + h_rsp.GetRMS())
         # fit_result = h_rsp.Fit("gaus", "QER", "", mean - h_rsp.GetRMS(), mean + h_rsp.GetRMS())
 
@@ -286,10 +673,202 @@ def plot_rsp_pt(inputfile, outputfile, absetamin, absetamax, pt_bins, pt_var, pt
     output_f.WriteTObject(gr_rsp_pt)
 
 
+def run_checks(input_file, output_file, args, etaBins, ptBins, pu_min, pu_max, pairs=None,
+               fill_only=False, filled=None):
+    """Make all the plots requested in args for one PU bin.
+
+    If pairs is set (from get_pu_bin_pairs), the hists are filled from those
+    instead of the tree.
+
+    If fill_only, only the filled hists are written, to be merged with those
+    from other shards. If filled is set (merged fill_only output), the hists
+    are taken from there, and input_file isn't used.
+    """
+    opts = dict(fill_only=fill_only, filled=filled)
+
+    # Do plots for each eta bin
+    if args.excl:
+        for i, eta in enumerate(etaBins[:-1]):
+            eta_min = eta
+            eta_max = etaBins[i + 1]
+
+            with PROFILER.stage("eta_bin", group="eta_%g_%g" % (eta_min, eta_max)):
+                plot_checks(input_file, output_file, eta_min, eta_max, args.maxPt, pu_min, pu_max,
+                            pairs, **opts)
+                # Do a response vs pt graph
+                plot_rsp_pt(input_file, output_file, eta_min, eta_max, ptBins, "pt", args.maxPt,
+                            pu_min, pu_max, pairs, **opts)
+                plot_rsp_pt(input_file, output_file, eta_min, eta_max, ptBins, "ptRef", args.maxPt,
+                            pu_min, pu_max, pairs, **opts)
+
+    # Do an inclusive plot for all eta bins
+    if args.incl and len(etaBins) > 2:
+        # The response vs eta graphs need a hist for every eta bin & pt range,
+        # so read the pairs once, and make them all from a ResponseCube
+        cubes = {'pt': None, 'ptRef': None}
+        if filled is None:
+            if pairs is None:
+                pairs = get_pu_bin_pairs(input_file, etaBins, [(pu_min, pu_max)])[0]
+            with PROFILER.stage("rsp_cube"):
+                cubes = {
+                    'pt': ResponseCube(pairs, etaBins, 'pt', [(0, 1000)] + binning.check_pt_bins),
+                    'ptRef': ResponseCube(pairs, etaBins, 'ptRef', binning.check_pt_bins),
+                }
+
+        plot_checks(input_file, output_file, etaBins[0], etaBins[-1], args.maxPt, pu_min, pu_max,
+                    pairs, **opts)
+        # Do a response vs pt graph
+        # ptBins_wide = list(np.arange(10, 250, 8))
+        plot_rsp_pt(input_file, output_file, etaBins[0], etaBins[-1], ptBins, "pt", args.maxPt,
+                    pu_min, pu_max, pairs, **opts)
+        plot_rsp_pt(input_file, output_file, etaBins[0], etaBins[-1], ptBins, "ptRef", args.maxPt,
+                    pu_min, pu_max, pairs, **opts)
+        # Do a response vs eta graph, inclusive over all pt
+        plot_rsp_eta(input_file, output_file, etaBins, 0, 1000, 'pt', pu_min, pu_max,
+                     cube=cubes['pt'], **opts)
+
+        # Sub-binned by pt
+        for pt_min, pt_max in binning.check_pt_bins:
+            plot_rsp_eta(input_file, output_file, etaBins, pt_min, pt_max, 'pt', pu_min, pu_max,
+                         cube=cubes['pt'], **opts)
+            plot_rsp_eta(input_file, output_file, etaBins, pt_min, pt_max, 'ptRef', pu_min, pu_max,
+                         cube=cubes['ptRef'], **opts)
+
+
+def get_input_filenames(inputs):
+    """Expand any wildcards in the input filenames, keeping the order given,
+    with the files matching each wildcard sorted.
+
+    Raises
+    ------
+    IOError
+        If a wildcard doesn't match any files.
+    """
+    filenames = []
+    for pattern in inputs:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise IOError("No input files match %s" % pattern)
+            filenames.extend(matches)
+        else:
+            filenames.append(pattern)
+    return filenames
+
+
+def get_shards(input_filenames, shard_entries):
+    """Split the input files into shards to run over separately.
+
+    Parameters
+    ----------
+    input_filenames : list[str]
+        Pairs files.
+    shard_entries : int
+        Maximum number of tree entries in a shard. If <= 0, each file is
+        one shard.
+
+    Returns
+    -------
+    list[(str, (int, int) or None)]
+        Filename & (first entry, number of entries) for each shard,
+        None for the whole file.
+    """
+    if shard_entries <= 0:
+        return [(filename, None) for filename in input_filenames]
+    shards = []
+    for filename in input_filenames:
+        input_file = cu.open_root_file(filename, "READ")
+        n_entries = int(cu.get_from_file(input_file, "valid").GetEntries())
+        input_file.Close()
+        shards.extend((filename, (first, min(shard_entries, n_entries - first)))
+                      for first in xrange(0, n_entries, shard_entries))
+    return shards
+
+
+def run_check_shard(job):
+    """Fill the hists for one shard of the pairs, one output file per PU bin.
+
+    This is the worker for --jobs, so it opens its own input & output files
+    rather than sharing any with the parent process.
+
+    Parameters
+    ----------
+    job : tuple
+        (args, input_filename, shard, etaBins, ptBins, pu_bins, output_filenames),
+        where args are the parsed command line args, shard is as from get_shards,
+        and output_filenames has one output filename per PU bin.
+    """
+    args, input_filename, shard, etaBins, ptBins, pu_bins, output_filenames = job
+    print "Doing shard:", input_filename, shard if shard else ""
+    if args.profile:
+        # don't count anything the parent process did before forking
+        PROFILER.reset()
+    input_file = cu.open_root_file(input_filename, "READ")
+    pu_bin_pairs = get_pu_bin_pairs(input_file, etaBins, pu_bins, shard)
+    for (pu_min, pu_max), output_filename, pairs in zip(pu_bins, output_filenames, pu_bin_pairs):
+        output_file = cu.open_root_file(output_filename, "RECREATE")
+        run_checks(input_file, output_file, args, etaBins, ptBins, pu_min, pu_max, pairs,
+                   fill_only=True)
+        with PROFILER.stage("write"):
+            output_file.Close()
+    if args.profile:
+        # the parent process merges these, see run_sharded_checks
+        PROFILER.finish()
+        PROFILER.save(profiling.get_profile_filename(output_filenames[0]))
+    input_file.Close()
+
+
+def run_sharded_checks(args, input_filenames, output_filenames, etaBins, ptBins, pu_bins):
+    """Fill the hists for each shard of the inputs in a pool of args.jobs processes,
+    then merge them and do the fits & graphs, one output file per PU bin.
+
+    Merging just adds up the hist contents, errors & stats, so the results
+    are the same as running over all the inputs in one go.
+    """
+    shards = get_shards(input_filenames, args.shard_entries)
+    print "Running over %d shards in %d processes" % (len(shards), args.jobs)
+    tmp_dir = tempfile.mkdtemp(prefix="checkCalibration_", dir=cu.get_full_path(args.output))
+    try:
+        jobs = [(args, input_filename, shard, etaBins, ptBins, pu_bins,
+                 [os.path.join(tmp_dir, "shard_%d_%d.root" % (shard_ind, pu_ind))
+                  for pu_ind in range(len(pu_bins))])
+                for shard_ind, (input_filename, shard) in enumerate(shards)]
+        # maxtasksperchild=1 so each shard starts with a fresh ROOT state
+        pool = multiprocessing.Pool(processes=args.jobs, maxtasksperchild=1)
+        try:
+            pool.map(run_check_shard, jobs, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if args.profile:
+            for job in jobs:
+                PROFILER.load(profiling.get_profile_filename(job[6][0]))
+
+        for pu_ind, (pu_bin, output_filename) in enumerate(zip(pu_bins, output_filenames)):
+            pu_min, pu_max = pu_bin
+            print "Doing PU range: %g - %g" % (pu_min, pu_max)
+            filled_filename = os.path.join(tmp_dir, "filled_%d.root" % pu_ind)
+            with PROFILER.stage("merge"):
+                cu.merge_root_files([job[6][pu_ind] for job in jobs], filled_filename)
+            filled = cu.open_root_file(filled_filename, "READ")
+            output_file = cu.open_root_file(output_filename, "RECREATE")
+            run_checks(None, output_file, args, etaBins, ptBins, pu_min, pu_max, filled=filled)
+            with PROFILER.stage("write"):
+                output_file.Close()
+            filled.Close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 def main(in_args=sys.argv[1:]):
     print in_args
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input", help="input ROOT filename")
+    parser.add_argument("input", nargs="+",
+                        help="input ROOT filename(s). Wildcards are allowed, "
+                             "e.g. 'pairs_*.root' (use quotes).")
     parser.add_argument("output", help="output ROOT filename")
     parser.add_argument("--incl", action="store_true", help="Do inclusive eta plots")
     parser.add_argument("--excl", action="store_true", help="Do exclusive eta plots")
@@ -313,15 +892,40 @@ def main(in_args=sys.argv[1:]):
                         help="Maximum number of PU vertices (refers to *actual* "
                              "number of PU vertices in the event, not the centre "
                              "of of the distribution)")
+    parser.add_argument("--PUbins",
+                        help="Do several PU bins at once, reading the pairs only once, "
+                             "e.g. 25:35,40:50,55:65 (min:max, inclusive). Each PU bin "
+                             "gets its own output file, with _PU{min}to{max} added to "
+                             "the output filename. Overrides --PUmin/--PUmax.")
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the wall & CPU time and bytes read for each stage & "
+                             "eta bin. Prints a summary at the end, and saves it all to "
+                             "<output>_profile.json")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes to fill the hists in parallel, "
+                             "one input file (or --shard-entries entries) at a time. "
+                             "The hists are merged before any fitting, so the "
+                             "output is the same as for --jobs 1.")
+    parser.add_argument("--shard-entries", type=int, default=0,
+                        help="Split each input file into shards of this many "
+                             "tree entries for --jobs. Default is one shard per file.")
     args = parser.parse_args(args=in_args)
 
-    # Open input & output files, check
-    input_file = cu.open_root_file(args.input, "READ")
-    output_file = cu.open_root_file(args.output, "RECREATE")
-    print "IN:", args.input
-    print "OUT:", args.output
-    if not input_file or not output_file:
-        raise Exception("Input or output files cannot be opened")
+    if args.profile:
+        PROFILER.enable()
+
+    if args.PUbins:
+        pu_bins = [tuple(float(x) for x in pu_bin.split(":")) for pu_bin in args.PUbins.split(",")]
+        stem, ext = os.path.splitext(args.output)
+        output_filenames = ["%s_PU%gto%g%s" % (stem, pu_min, pu_max, ext)
+                            for pu_min, pu_max in pu_bins]
+    else:
+        pu_bins = [(args.PUmin, args.PUmax)]
+        output_filenames = [args.output]
+
+    input_filenames = get_input_filenames(args.input)
+    print "IN:", ", ".join(input_filenames)
+    print "OUT:", ", ".join(output_filenames)
 
     etaBins = binning.eta_bins
     if args.etaInd:
@@ -337,34 +941,34 @@ def main(in_args=sys.argv[1:]):
     ptBins = binning.pt_bins
     ptBins = binning.pt_bins_stage2
 
-    # Do plots for each eta bin
-    if args.excl:
-        for i, eta in enumerate(etaBins[:-1]):
-            eta_min = eta
-            eta_max = etaBins[i + 1]
-
-            plot_checks(input_file, output_file, eta_min, eta_max, args.maxPt, args.PUmin, args.PUmax)
-            # Do a response vs pt graph
-            plot_rsp_pt(input_file, output_file, eta_min, eta_max, ptBins, "pt", args.maxPt, args.PUmin, args.PUmax)
-            plot_rsp_pt(input_file, output_file, eta_min, eta_max, ptBins, "ptRef", args.maxPt, args.PUmin, args.PUmax)
-
-    # Do an inclusive plot for all eta bins
-    if args.incl and len(etaBins) > 2:
-        plot_checks(input_file, output_file, etaBins[0], etaBins[-1], args.maxPt, args.PUmin, args.PUmax)
-        # Do a response vs pt graph
-        # ptBins_wide = list(np.arange(10, 250, 8))
-        plot_rsp_pt(input_file, output_file, etaBins[0], etaBins[-1], ptBins, "pt", args.maxPt, args.PUmin, args.PUmax)
-        plot_rsp_pt(input_file, output_file, etaBins[0], etaBins[-1], ptBins, "ptRef", args.maxPt, args.PUmin, args.PUmax)
-        # Do a response vs eta graph, inclusive over all pt
-        plot_rsp_eta(input_file, output_file, etaBins, 0, 1000, 'pt', args.PUmin, args.PUmax)
+    if len(input_filenames) > 1 or args.jobs > 1:
+        run_sharded_checks(args, input_filenames, output_filenames, etaBins, ptBins, pu_bins)
+        if args.profile:
+            profiling.report(args.output)
+        return 0
 
-        # Sub-binned by pt
-        for pt_min, pt_max in binning.check_pt_bins:
-            plot_rsp_eta(input_file, output_file, etaBins, pt_min, pt_max, 'pt', args.PUmin, args.PUmax)
-            plot_rsp_eta(input_file, output_file, etaBins, pt_min, pt_max, 'ptRef', args.PUmin, args.PUmax)
+    # Open input & output files, check
+    input_file = cu.open_root_file(input_filenames[0], "READ")
+    if not input_file:
+        raise Exception("Input or output files cannot be opened")
 
+    # Read the pairs for all PU bins in one go
+    pu_bin_pairs = [None]
+    if args.PUbins:
+        pu_bin_pairs = get_pu_bin_pairs(input_file, etaBins, pu_bins)
+
+    for (pu_min, pu_max), output_filename, pairs in zip(pu_bins, output_filenames, pu_bin_pairs):
+        print "Doing PU range: %g - %g" % (pu_min, pu_max)
+        output_file = cu.open_root_file(output_filename, "RECREATE")
+        if not output_file:
+            raise Exception("Input or output files cannot be opened")
+        run_checks(input_file, output_file, args, etaBins, ptBins, pu_min, pu_max, pairs)
+        with PROFILER.stage("write"):
+            output_file.Close()
+
+    if args.profile:
+        profiling.report(args.output)
     input_file.Close()
-    output_file.Close()
     return 0
 
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Unit tests for making the checkCalibration response hists from numpy arrays.
+
+The ResponseCube projections are compared with numpy histograms of the pairs
+passing the same exclusive cuts as the cut strings.
+"""
+
+
+import checkCalibration as cc
+import unittest
+import numpy as np
+
+
+class TestResponseCube(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        n = 50000
+        # 2.9640001 is the same as 2.964 with %f
+        self.eta_bins = [0, 0.435, 1.305, 2.9640001, 3.0, 5.191]
+        self.pt_ranges = [(0, 1000), (14, 50), (50, 100), (100, 300)]
+        pt = rng.uniform(0, 1100, n)
+        abs_eta = rng.uniform(0, 5.5, n)
+        # some pairs exactly on the edges, which are in no bin
+        pt[:500] = rng.choice([14., 50., 100., 300.], 500)
+        abs_eta[500:1000] = rng.choice(self.eta_bins, 500)
+        abs_eta[1000:1100] = 2.96400005
+        self.pairs = dict(pt=pt, ptRef=pt * rng.uniform(0.5, 1.5, n), abs_eta=abs_eta,
+                          rsp=rng.normal(1.5, 1.2, n))
+        self.edges = np.linspace(*cc.RSP_ETA_HIST_BINNING[1:], num=cc.RSP_ETA_HIST_BINNING[0] + 1)
+
+    def check_projection(self, cube, pt_var, absetamin, absetamax, pt_min, pt_max):
+        contents, sum_rsp, sum_rsp2 = cube.project(absetamin, absetamax, pt_min, pt_max)
+        pairs = self.pairs
+        mask = ((pairs["abs_eta"] > absetamin) & (pairs["abs_eta"] < absetamax) &
+                (pairs[pt_var] > pt_min) & (pairs[pt_var] < pt_max) & (pairs["pt"] < 1023.1))
+        pairs_mask = cc.get_pairs_mask(pairs, absetamin, absetamax, [(pt_var, pt_min, pt_max)])
+        self.assertTrue(np.array_equal(pairs_mask, mask))
+        rsp = pairs["rsp"][mask]
+        # np.histogram includes the upper edge in the last bin, TH1 doesn't
+        in_range = (rsp >= self.edges[0]) & (rsp < self.edges[-1])
+        expected, _ = np.histogram(rsp[in_range], self.edges)
+        self.assertTrue(np.array_equal(contents[1:-1], expected))
+        self.assertEqual(contents[0], np.sum(rsp < self.edges[0]))
+        self.assertEqual(contents[-1], np.sum(rsp >= self.edges[-1]))
+        self.assertAlmostEqual(sum_rsp, rsp[in_range].sum(), delta=1E-9 * len(rsp))
+        self.assertAlmostEqual(sum_rsp2, (rsp[in_range]**2).sum(), delta=1E-8 * len(rsp))
+
+    def test_projections(self):
+        for pt_var in ["pt", "ptRef"]:
+            cube = cc.ResponseCube(self.pairs, self.eta_bins, pt_var, self.pt_ranges)
+            for absetamin, absetamax in zip(self.eta_bins[:-1], self.eta_bins[1:]):
+                for pt_min, pt_max in self.pt_ranges:
+                    self.check_projection(cube, pt_var, absetamin, absetamax, pt_min, pt_max)
+            # inclusive eta ranges are sums over several eta bins
+            self.check_projection(cube, pt_var, 0, 3.0, 14, 50)
+            self.check_projection(cube, pt_var, 0.435, 5.191, 0, 1000)
+
+    def test_bad_range(self):
+        cube = cc.ResponseCube(self.pairs, self.eta_bins, "pt", self.pt_ranges)
+        with self.assertRaises(ValueError):
+            cube.project(0, 0.5, 14, 50)
+        with self.assertRaises(ValueError):
+            cube.project(0, 0.435, 15, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
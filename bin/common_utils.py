@@ -8,6 +8,12 @@ from sys import platform as _platform
 import numpy as np
 import math
 import argparse
+import json
+from profiling import PROFILER
+try:
+    import root_numpy
+except ImportError:
+    root_numpy = None
 
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -101,6 +107,552 @@ def get_from_file(tfile, obj_name, info=False):
         return tfile.Get(obj_name)
 
 
+def merge_root_files(input_filenames, output_filename):
+    """Merge ROOT files into one, like hadd.
+
+    Objects are added in the order of input_filenames, so the output layout is
+    reproducible. Objects with the same name & path are added together.
+
+    Parameters
+    ----------
+    input_filenames : list[str]
+        Files to merge.
+    output_filename : str
+        Output file, will be overwritten if it exists.
+    """
+    merger = ROOT.TFileMerger(False)
+    if not merger.OutputFile(output_filename, "RECREATE"):
+        raise IOError("Can't open output file %s for merging" % output_filename)
+    for filename in input_filenames:
+        if not merger.AddFile(filename):
+            raise IOError("Can't add %s for merging" % filename)
+    if not merger.Merge():
+        raise RuntimeError("Failed to merge files into %s" % output_filename)
+
+
+@PROFILER.timed("read_tree")
+def get_branch_names(tree):
+    """Get the names of the branches in a tree & its friends.
+    Friend branches with the same name as one in the tree are skipped,
+    as TTree::GetBranch & TTree::Draw use the tree's own."""
+    names = [b.GetName() for b in tree.GetListOfBranches()]
+    friends = tree.GetListOfFriends()
+    for friend in (friends if friends else []):
+        names.extend(name for name in get_branch_names(friend.GetTree()) if name not in names)
+    return names
+
+
+def get_tree_arrays(tree, variables, cut="", entry_ranges=None):
+    """Get the values of several expressions from a TTree as numpy arrays,
+    using only one pass over the tree.
+
+    Uses TTree::Draw() with "goff", and grabs the values from its internal
+    buffers, so any expression TTree::Draw() understands can be used.
+    Values are in tree order, and are doubles whatever the branch type.
+
+    Parameters
+    ----------
+    tree : ROOT.TTree
+        Tree to get values from.
+    variables : list[str]
+        Expressions to evaluate for each entry, e.g. ["pt", "TMath::Abs(eta)"]
+    cut : str or ROOT.TCut, optional
+        Selection to apply.
+    entry_ranges : list[(int, int)], optional
+        Only look at these (first entry, number of entries) ranges,
+        e.g. from get_index_entry_ranges(). Default is all entries.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        One array per expression in variables.
+
+    Raises
+    ------
+    RuntimeError
+        If TTree::Draw() fails, e.g. due to a bad expression.
+    """
+    PROFILER.watch_tree(tree)
+    if entry_ranges is None:
+        entry_ranges = [(0, tree.GetEntries())]
+    varexp = ":".join(variables)
+    parts = {var: [] for var in variables}
+    for first, n_entries in entry_ranges:
+        if n_entries <= 0:
+            continue
+        # make sure the buffers are big enough to hold every entry,
+        # otherwise we only get the last chunk of entries
+        tree.SetEstimate(n_entries + 1)
+        n_sel = tree.Draw(varexp, cut, "goff", n_entries, first)
+        if n_sel < 0:
+            raise RuntimeError("Couldn't draw %s from %s" % (varexp, tree.GetName()))
+        n_rows = tree.GetSelectedRows()
+        if n_rows <= 0:
+            continue
+        for ind, var in enumerate(variables):
+            # copy as the buffer gets reused by the next Draw()
+            parts[var].append(np.array(np.ndarray(n_rows, 'd', tree.GetVal(ind))))
+    arrays = {}
+    for var in variables:
+        if len(parts[var]) == 1:
+            arrays[var] = parts[var][0]
+        elif parts[var]:
+            arrays[var] = np.concatenate(parts[var])
+        else:
+            arrays[var] = np.array([], dtype=float)
+    return arrays
+
+
+def make_tree_from_arrays(name, title, arrays, chunk_size=1000000):
+    """Make a TTree in the current directory with a float branch for each
+    array, i.e. the reverse of get_tree_arrays.
+
+    The arrays are written chunk_size entries at a time, so only one chunk
+    is ever copied. With root_numpy, each chunk is written by array2tree.
+    Otherwise each branch is bound to a one element numpy buffer, which is
+    set from the chunk for each TTree::Fill, so it still loops over entries.
+
+    Parameters
+    ----------
+    name, title : str
+        Tree name & title.
+    arrays : OrderedDict{str : numpy.ndarray}
+        Branch name : values, all the same length.
+    chunk_size : int, optional
+        Number of entries to write at once.
+
+    Returns
+    -------
+    ROOT.TTree
+    """
+    names = list(arrays.keys())
+    n_entries = len(arrays[names[0]]) if names else 0
+    dtype = [(branch, np.float32) for branch in names]
+    tree = None
+    if root_numpy is None:
+        tree = ROOT.TTree(name, title)
+        buffers = [np.zeros(1, dtype=np.float32) for _ in names]
+        for branch, buff in zip(names, buffers):
+            tree.Branch(branch, buff, branch + "/F")
+    for first in xrange(0, max(n_entries, 1), chunk_size):
+        last = min(first + chunk_size, n_entries)
+        if root_numpy is not None:
+            chunk = np.empty(last - first, dtype=dtype)
+            for branch in names:
+                chunk[branch] = arrays[branch][first:last]
+            tree = root_numpy.array2tree(chunk, name=name, tree=tree)
+            continue
+        columns = [arrays[branch][first:last].astype(np.float32) for branch in names]
+        for entry in xrange(last - first):
+            for buff, column in zip(buffers, columns):
+                buff[0] = column[entry]
+            tree.Fill()
+    tree.SetTitle(title)
+    return tree
+
+
+@PROFILER.timed("draw_tree")
+def draw_tree(tree, varexp, cut="", option="", entry_ranges=None):
+    """Do TTree::Draw(varexp, cut, option) into a histogram, optionally only
+    over some entry ranges, e.g. from get_index_entry_ranges().
+
+    For several ranges, the first Draw() makes the histogram as usual, and the
+    following ones add to it (i.e. ">>+hist_name").
+
+    Parameters
+    ----------
+    tree : ROOT.TTree
+        Tree to draw from.
+    varexp : str
+        Expression to draw, must include the output hist, e.g. "pt>>h(10,0,10)".
+    cut : str or ROOT.TCut, optional
+        Selection to apply.
+    option : str, optional
+        Draw option.
+    entry_ranges : list[(int, int)], optional
+        (first entry, number of entries) ranges to draw.
+        Default is all entries.
+
+    Returns
+    -------
+    int
+        Total number of selected entries.
+    """
+    PROFILER.watch_tree(tree)
+    if entry_ranges is None:
+        return tree.Draw(varexp, cut, option)
+    if ">>" not in varexp:
+        raise ValueError("draw_tree needs an output histogram in %s" % varexp)
+    entry_ranges = [(first, n) for first, n in entry_ranges if n > 0]
+    if not entry_ranges:
+        # still need to make the (empty) hist, so draw 1 entry with a cut that
+        # always fails
+        tree.Draw(varexp, "0", option, 1, 0)
+        return 0
+    expr, hist_spec = varexp.split(">>", 1)
+    hist_name = hist_spec.lstrip("+").split("(")[0].strip()
+    n_sel = 0
+    for ind, (first, n_entries) in enumerate(entry_ranges):
+        this_varexp = varexp if ind == 0 else "%s>>+%s" % (expr, hist_name)
+        n_sel += tree.Draw(this_varexp, cut, option, n_entries, first)
+    return n_sel
+
+
+PAIRS_INDEX_NAME = "valid_index"
+
+
+def get_pairs_index(tfile, index_name=PAIRS_INDEX_NAME):
+    """Get the (|eta|, PU) index table from a pairs file made by indexPairs.py
+
+    Parameters
+    ----------
+    tfile : ROOT.TFile
+        Pairs file.
+    index_name : str, optional
+        Name of index tree.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray} or None
+        Index columns (eta_min, eta_max, pu, first, n), one row per
+        (|eta| bin, PU value). None if the file has no index.
+    """
+    if not exists_in_file(tfile, index_name):
+        return None
+    index_tree = get_from_file(tfile, index_name)
+    return get_tree_arrays(index_tree, ["eta_min", "eta_max", "pu", "first", "n"])
+
+
+def get_index_entry_ranges(index, absetamin, absetamax, pu_min=None, pu_max=None):
+    """Get the entry ranges of an indexed pairs tree that can contain pairs
+    with absetamin < |eta| < absetamax, and pu_min <= numPUVertices <= pu_max.
+
+    The ranges are a superset of the selection (they can include pairs just
+    outside the eta range), so the full cut must still be applied.
+
+    Parameters
+    ----------
+    index : dict{str : numpy.ndarray}
+        Index table from get_pairs_index().
+    absetamin, absetamax : float
+        |eta| range.
+    pu_min, pu_max : float, optional
+        numPUVertices range. If None, no cut on PU.
+
+    Returns
+    -------
+    list[(int, int)]
+        (first entry, number of entries) for each contiguous range, in order.
+    """
+    mask = (index["eta_min"] < absetamax) & (index["eta_max"] > absetamin)
+    if pu_min is not None:
+        mask &= index["pu"] >= pu_min
+    if pu_max is not None:
+        mask &= index["pu"] <= pu_max
+    firsts = index["first"][mask].astype(np.int64)
+    ns = index["n"][mask].astype(np.int64)
+    order = np.argsort(firsts)
+    firsts, ns = firsts[order], ns[order]
+    # merge neighbouring rows into one range, so fewer Draw() calls
+    ranges = []
+    for first, n in zip(firsts, ns):
+        if ranges and ranges[-1][0] + ranges[-1][1] == first:
+            ranges[-1][1] += n
+        else:
+            ranges.append([first, n])
+    return [(int(first), int(n)) for first, n in ranges]
+
+
+@PROFILER.timed("fill_hist")
+def fill_hist(hist, x, y=None):
+    """Fill a 1D or 2D histogram with arrays of values, all in one go.
+
+    Uses TH1::FillN, which is also what TTree::Draw() uses, so the result
+    (contents, errors, stats) is the same as drawing from the tree.
+
+    Parameters
+    ----------
+    hist : ROOT.TH1 or ROOT.TH2
+        Histogram to fill.
+    x : numpy.ndarray
+        Values for the x axis.
+    y : numpy.ndarray, optional
+        Values for the y axis, for 2D hists.
+
+    Returns
+    -------
+    ROOT.TH1 or ROOT.TH2
+        The filled histogram.
+    """
+    n = len(x)
+    if n == 0:
+        return hist
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    weights = np.ones(n, dtype=np.float64)
+    if y is None:
+        hist.FillN(n, x, weights)
+    else:
+        hist.FillN(n, x, np.ascontiguousarray(y, dtype=np.float64), weights)
+    return hist
+
+
+class PairsColumns(object):
+    """Columnar numpy cache of a pairs tree, e.g. "valid" from RunMatcher.
+
+    Each branch is read from the tree once, and stored as a .npy file in a
+    directory next to the ROOT file. After that, columns are loaded lazily
+    (memory-mapped), one at a time as they are asked for, so re-running over
+    the same pairs file doesn't touch ROOT at all.
+
+    The cache is tied to the size & modification time of the ROOT file,
+    and is remade if either changes. If the cache directory can't be written
+    to, columns are just kept in memory.
+
+    Usage:
+    >>> pairs = PairsColumns("pairs.root")
+    >>> pairs.preload(["pt", "eta"])  # read all missing columns in one go
+    >>> pt = pairs["pt"]
+
+    Parameters
+    ----------
+    filename : str
+        Pairs ROOT file.
+    tree_name : str, optional
+        Name of tree in file.
+    cache_dir : str, optional
+        Where to store cache. Default is <filename stem>_<tree_name>_cache
+    """
+
+    # numpy types to store each ROOT leaf type as
+    _DTYPES = {
+        "Float_t": np.float32,
+        "Double_t": np.float64,
+        "Int_t": np.int32,
+        "UInt_t": np.uint32,
+        "Long64_t": np.int64,
+        "Bool_t": np.bool_
+    }
+
+    def __init__(self, filename, tree_name="valid", cache_dir=None):
+        self.filename = cleanup_filepath(filename)
+        if not os.path.isfile(self.filename):
+            raise IOError("No such file %s" % self.filename)
+        self.tree_name = tree_name
+        self.cache_dir = cache_dir or "%s_%s_cache" % (os.path.splitext(self.filename)[0],
+                                                        tree_name)
+        self._tfile = None
+        self._tree = None
+        self._columns = {}
+        self._meta = None
+        self.writable = self._setup_cache()
+
+    def _fingerprint(self):
+        stat = os.stat(self.filename)
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "tree": self.tree_name}
+
+    def _meta_filename(self):
+        return os.path.join(self.cache_dir, "meta.json")
+
+    def _column_filename(self, name):
+        return os.path.join(self.cache_dir, "%s.npy" % name)
+
+    def _setup_cache(self):
+        """Check the cache matches the ROOT file, remaking it if not.
+
+        Returns whether the cache dir can be used.
+        """
+        fingerprint = self._fingerprint()
+        try:
+            if os.path.isfile(self._meta_filename()):
+                with open(self._meta_filename()) as f:
+                    meta = json.load(f)
+                if all(meta.get(k) == v for k, v in fingerprint.iteritems()):
+                    self._meta = meta
+                    return True
+                print "Cache %s is out of date, remaking" % self.cache_dir
+                for col_filename in os.listdir(self.cache_dir):
+                    if col_filename.endswith(".npy"):
+                        os.remove(os.path.join(self.cache_dir, col_filename))
+            check_dir_exists_create(self.cache_dir)
+            self._meta = self._make_meta(fingerprint)
+            self._atomic_write(self._meta_filename(),
+                               lambda f: json.dump(self._meta, f, indent=2))
+            return True
+        except (IOError, OSError) as err:
+            print "Can't use cache dir %s (%s), keeping columns in memory" % (self.cache_dir, err)
+            if self._meta is None:
+                self._meta = self._make_meta(fingerprint)
+            return False
+
+    def _make_meta(self, fingerprint):
+        meta = dict(fingerprint)
+        tree = self._get_tree()
+        meta["entries"] = tree.GetEntries()
+        meta["branches"] = get_branch_names(tree)
+        return meta
+
+    def _atomic_write(self, filename, write_fn):
+        """Write to a temp file, then move into place, so several processes
+        using the same cache never see half-written files."""
+        tmp_filename = "%s.tmp%d" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            write_fn(f)
+        os.rename(tmp_filename, filename)
+
+    def _get_tree(self):
+        if self._tree is None:
+            self._tfile = open_root_file(self.filename)
+            self._tree = get_from_file(self._tfile, self.tree_name)
+        return self._tree
+
+    @property
+    def entries(self):
+        """Number of entries in the tree."""
+        return self._meta["entries"]
+
+    @property
+    def branches(self):
+        """Names of all branches in the tree."""
+        return self._meta["branches"]
+
+    def __contains__(self, name):
+        return name in self._meta["branches"]
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            self.preload([name])
+        return self._columns[name]
+
+    def get(self, names):
+        """Get several columns, as a dict of {name: numpy.ndarray}"""
+        self.preload(names)
+        return {name: self._columns[name] for name in names}
+
+    def preload(self, names):
+        """Make sure columns are loaded, reading any not in the cache from the
+        tree in one pass.
+
+        Parameters
+        ----------
+        names : list[str]
+            Branch names.
+
+        Raises
+        ------
+        KeyError
+            If a name isn't a branch in the tree.
+        """
+        missing = []
+        for name in names:
+            if name in self._columns:
+                continue
+            if name not in self:
+                raise KeyError("No branch named %s in %s" % (name, self.filename))
+            if self.writable and os.path.isfile(self._column_filename(name)):
+                self._columns[name] = np.load(self._column_filename(name), mmap_mode='r')
+            else:
+                missing.append(name)
+        if not missing:
+            return
+
+        print "Reading %s from %s" % (", ".join(missing), self.filename)
+        tree = self._get_tree()
+        arrays = get_tree_arrays(tree, missing)
+        for name in missing:
+            leaf_type = tree.GetLeaf(name).GetTypeName()
+            arr = arrays[name].astype(self._DTYPES.get(leaf_type, np.float64))
+            self._columns[name] = arr
+            if self.writable:
+                try:
+                    self._atomic_write(self._column_filename(name), lambda f: np.save(f, arr))
+                except (IOError, OSError) as err:
+                    print "Can't write %s to cache (%s)" % (name, err)
+
+    def close(self):
+        """Close the ROOT file, if it was opened."""
+        if self._tfile:
+            self._tfile.Close()
+            self._tfile = None
+            self._tree = None
+
+
+def get_hist_arrays(hist):
+    """Get bin contents & sum of squared weights of a histogram as numpy arrays,
+    without looping over bins.
+
+    Includes the underflow & overflow bins. For a 2D hist, the arrays have
+    shape (nbins y + 2, nbins x + 2), so arr[j, i] is bin (i, j).
+
+    Parameters
+    ----------
+    hist : ROOT.TH1 or ROOT.TH2
+        TH1F/D/I or TH2F/D/I.
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Bin contents, sum of squared weights (= contents if not stored).
+    """
+    dtypes = {'F': 'f', 'D': 'd', 'I': 'i'}
+    dtype = dtypes.get(hist.ClassName()[-1])
+    if dtype is None:
+        raise TypeError("Can't get arrays for a %s" % hist.ClassName())
+    size = hist.GetSize()
+    contents = np.array(np.ndarray(size, dtype, hist.GetArray()), dtype=np.float64)
+    if hist.GetSumw2N() > 0:
+        sumw2 = np.array(np.ndarray(size, 'd', hist.GetSumw2().GetArray()))
+    else:
+        sumw2 = contents.copy()
+    if hist.GetDimension() == 2:
+        shape = (hist.GetNbinsY() + 2, hist.GetNbinsX() + 2)
+        contents, sumw2 = contents.reshape(shape), sumw2.reshape(shape)
+    return contents, sumw2
+
+
+def set_hist_contents(hist, contents, sumw2=None):
+    """Set all bin contents (& sum of squared weights) of a histogram from
+    numpy arrays, in the same layout as get_hist_arrays().
+
+    The hist stats are recalculated from the bin contents, and the number of
+    entries is set to the sum of the contents. Use TH1::PutStats() afterwards
+    if you know the unbinned stats.
+
+    Parameters
+    ----------
+    hist : ROOT.TH1 or ROOT.TH2
+        TH1F/D/I or TH2F/D/I.
+    contents : numpy.ndarray
+        Bin contents.
+    sumw2 : numpy.ndarray, optional
+        Sum of squared weights.
+
+    Raises
+    ------
+    ValueError
+        If the arrays don't have the right number of bins.
+    """
+    dtypes = {'F': 'f', 'D': 'd', 'I': 'i'}
+    dtype = dtypes.get(hist.ClassName()[-1])
+    if dtype is None:
+        raise TypeError("Can't set arrays for a %s" % hist.ClassName())
+    size = hist.GetSize()
+    flat_contents = np.ascontiguousarray(contents, dtype=dtype).ravel()
+    if flat_contents.size != size:
+        raise ValueError("%s has %d bins, got %d contents"
+                         % (hist.GetName(), size, flat_contents.size))
+    hist.Set(size, flat_contents)
+    if sumw2 is not None:
+        flat_sumw2 = np.ascontiguousarray(sumw2, dtype=np.float64).ravel()
+        if flat_sumw2.size != size:
+            raise ValueError("%s has %d bins, got %d sumw2"
+                             % (hist.GetName(), size, flat_sumw2.size))
+        if hist.GetSumw2N() == 0:
+            hist.Sumw2()
+        hist.GetSumw2().Set(size, flat_sumw2)
+    hist.ResetStats()
+    hist.SetEntries(float(np.sum(contents)))
+
+
 def check_exp(n):
     """
     Checks if number has stupidly larger exponent
@@ -24,7 +24,7 @@ from runCalibration import generate_eta_graph_name, set_fit_params
 from correction_LUT_GCT import print_GCT_lut_file
 from correction_LUT_stage1 import print_Stage1_lut_file
 from correction_LUT_stage2 import print_Stage2_lut_files, print_Stage2_func_file
-from multifunc import MultiFunc
+from multifunc import MultiFunc, eval_array
 import csv
 from pprint import pprint
 
@@ -148,7 +148,7 @@ def plot_correction_map(corr_fn, filename="correction_map.pdf"):
     jet_pt_pre = np.arange(min_pre, max_pre, 0.5)
 
     # Post calibration
-    jet_pt_post = np.array([pt * corr_fn.Eval(pt) for pt in jet_pt_pre])
+    jet_pt_post = jet_pt_pre * eval_array(corr_fn, jet_pt_pre)
 
     # Make coloured blocks to show the L1 pT bins
     blocks = []  # for persistence otherwise garbabe collected
@@ -550,6 +550,33 @@ def do_low_pt_plateau_fit(fit, graph, condition=0.1, look_ahead=4):
     return total_fit
 
 
+def get_stage2_fits(fits, graphs, low_pt_plateau, constant_hf, plot_dir):
+    """Do the fancy fits for Stage 2: low Pt cap, and/or constant HF.
+
+    Parameters
+    ----------
+    fits : list[TF1]
+        List of fit functions, one per eta bin.
+    graphs : list[TGraph]
+        List of graphs, one per eta bin.
+    low_pt_plateau : bool
+        Cap the correction below the low pt turnover, see do_low_pt_plateau_fits
+    constant_hf : bool
+        Use constant corrections for HF, see do_constant_hf_fits
+    plot_dir : str
+        Directory to put plots
+
+    Returns
+    -------
+    list[MultiFunc, TF1]
+    """
+    if low_pt_plateau:
+        fits = do_low_pt_plateau_fits(fits, graphs, ignore_hf=False, condition=0.075, look_ahead=5)
+    if constant_hf:
+        fits = do_constant_hf_fits(fits, graphs, plot_dir=plot_dir)
+    return fits
+
+
 def plot_all_functions(functions, filename, eta_bins, et_min=0, et_max=30):
     """Draw all corrections functions on one big canvas"""
     nrows = 4
@@ -627,6 +654,19 @@ def main(in_args=sys.argv[1:]):
     parser.add_argument("--ptCompressionFile",
                         help="Human-readable pT compression LUT to use instead of deriving one  (Stage 2 only)",
                         default=None)
+    parser.add_argument("--ptMergeAlgorithm",
+                        help="Algorithm to derive the pT compression (Stage 2 only)",
+                        choices=['greedy', 'kmeans', 'optimal'],
+                        default='greedy')
+    parser.add_argument("--ptMergeCost",
+                        help="For --ptMergeAlgorithm optimal, minimise the total squared "
+                        "error or the max spread of correction factors in each pT bin",
+                        choices=['squared', 'max'],
+                        default='squared')
+    parser.add_argument("--corrMatrixCache",
+                        help="Directory to save the HW correction matrix in, "
+                        "so later runs with the same bits can reuse it (Stage 2 only)",
+                        default=None)
     args = parser.parse_args(args=in_args)
 
     print args
@@ -685,12 +725,7 @@ def main(in_args=sys.argv[1:]):
         print_Stage1_lut_file(fits, args.lut, args.plots)
 
     elif args.stage2 or args.stage2Func:
-        # do fancy fits: low Pt cap, and/or constant HF
-        fits = all_fits
-        if args.lowPtPlateau:
-            fits = do_low_pt_plateau_fits(fits, all_graphs, ignore_hf=False, condition=0.075, look_ahead=5)
-        if args.constantHF:
-            fits = do_constant_hf_fits(fits, all_graphs, plot_dir=out_dir)
+        fits = get_stage2_fits(all_fits, all_graphs, args.lowPtPlateau, args.constantHF, out_dir)
         if args.plots:
             # plot the fancy fits
             if not args.text:
@@ -722,7 +757,9 @@ def main(in_args=sys.argv[1:]):
                                    read_pt_compression=args.ptCompressionFile,
                                    target_num_pt_bins=2**4,
                                    merge_criterion=1.05,
-                                   merge_algorithm='greedy')  # greedy or kmeans
+                                   merge_algorithm=args.ptMergeAlgorithm,
+                                   merge_cost=args.ptMergeCost,
+                                   corr_matrix_cache_dir=args.corrMatrixCache)
         else:
             print_Stage2_func_file(fits, args.lut)
 
@@ -22,7 +22,7 @@ import os
 import common_utils as cu
 from collections import OrderedDict
 from bisect import bisect_left
-from multifunc import MultiFunc
+from multifunc import MultiFunc, eval_array
 from binning import pairwise, eta_bin_colors
 from itertools import izip, ifilterfalse
 from math import ceil, floor
@@ -120,8 +120,51 @@ def complete_pt_mapping(compressed_map, hw_pt):
     return full_map
 
 
+def calc_corr_orig(func, pt_orig):
+    """Evaluate a correction function for all pt_orig,
+    with a correction factor of 0 for pt = 0"""
+    return np.concatenate(([0.], eval_array(func, pt_orig[pt_orig > 0.])))
+
+
+def get_pt_compression_inputs(fit_functions, pt_orig):
+    """Get the correction factors & merge limits used to figure out the
+    pT compression, from the correction functions.
+
+    Parameters
+    ----------
+    fit_functions : list[MultiFunc]
+        List of correction functions, one per compressed eta bin
+    pt_orig : numpy.array
+        Array of physical PT values to consider for compression
+
+    Returns
+    -------
+    corr_orig : numpy.array
+        Correction factors for pt_orig, from the eta bin whose curve starts
+        at the lowest pT
+    merge_above : float
+        pT of the minimum of that curve
+    merge_below : float
+        pT of the end of the low pT plateau for that curve
+    """
+    # decide which fit func to use for binning based on which has the curve start at the lowest pT
+    eta_ind_lowest = determine_lowest_curve_start(fit_functions)
+
+    # find min of curve and merge above that
+    merge_above = fit_functions[eta_ind_lowest].functions_dict.values()[1].GetMinimumX()
+    print 'Merge above', merge_above
+
+    # find end of plateau and merge below that
+    merge_below = fit_functions[eta_ind_lowest].functions_dict.keys()[0][1]
+    print 'Merge below', merge_below
+
+    # do 0 separately as it should have 0 correction factor
+    corr_orig = calc_corr_orig(fit_functions[eta_ind_lowest], pt_orig)
+    return corr_orig, merge_above, merge_below
+
+
 def do_pt_compression(fit_functions, pt_orig, target_num_pt_bins,
-                      merge_algorithm, merge_criterion):
+                      merge_algorithm, merge_criterion, merge_cost='squared'):
     """Mega function to figure out the optimal PT compression scheme using the correction curves
 
     Parameters
@@ -133,9 +176,12 @@ def do_pt_compression(fit_functions, pt_orig, target_num_pt_bins,
     target_num_pt_bins : int
         NUmber of bins to compress PT range into
     merge_algorithm : str
-        "greedy" or "kmeans"
+        "greedy", "kmeans" or "optimal"
     merge_criterion : float
         For greedy algorithm, specifies maximum size of a bin
+    merge_cost : str
+        For optimal algorithm, "squared" or "max",
+        see calc_compressed_pt_mapping_optimal
 
     Returns
     -------
@@ -145,24 +191,22 @@ def do_pt_compression(fit_functions, pt_orig, target_num_pt_bins,
     pt_index : list[int]
         Index of integers to assign a given HW PT to a compression bin.
     """
-    # decide which fit func to use for binning based on which has the curve start at the lowest pT
-    eta_ind_lowest = determine_lowest_curve_start(fit_functions)
+    corr_orig, merge_above, merge_below = get_pt_compression_inputs(fit_functions, pt_orig)
 
-    # find min of curve and merge above that
-    merge_above = fit_functions[eta_ind_lowest].functions_dict.values()[1].GetMinimumX()
-    print 'Merge above', merge_above
+    with open('corr_dump.txt', 'w') as dump:
+        dump.write(','.join(((str(x) for x in corr_orig))))
 
-    # find end of plateau and merge below that
-    merge_below = fit_functions[eta_ind_lowest].functions_dict.keys()[0][1]
-    print 'Merge below', merge_below
+    return compress_pt(pt_orig, corr_orig, target_num_pt_bins, merge_algorithm,
+                       merge_criterion, merge_above, merge_below, merge_cost)
 
-    # do 0 separately as it should have 0 correction factor
-    corr_orig = np.array([0.] + [fit_functions[eta_ind_lowest].Eval(pt)
-                                 for pt in pt_orig if pt > 0])
 
-    with open('corr_dump.txt', 'w') as dump:
-        dump.write(','.join(((str(x) for x in corr_orig))))
+def compress_pt(pt_orig, corr_orig, target_num_pt_bins, merge_algorithm,
+                merge_criterion, merge_above, merge_below, merge_cost='squared'):
+    """Find the compressed pt binning for a set of correction factors,
+    see do_pt_compression for the parameters & returns
 
+    merge_above & merge_below are from get_pt_compression_inputs.
+    """
     # Find the optimal compressed pt binning
     if merge_algorithm == 'greedy':
         new_pt_mapping = calc_compressed_pt_mapping_greedy(pt_orig, corr_orig,
@@ -173,6 +217,11 @@ def do_pt_compression(fit_functions, pt_orig, target_num_pt_bins,
         new_pt_mapping = calc_compressed_pt_mapping_kmeans(pt_orig, corr_orig,
                                                            target_num_pt_bins,
                                                            merge_above, merge_below)
+    elif merge_algorithm == 'optimal':
+        new_pt_mapping = calc_compressed_pt_mapping_optimal(pt_orig, corr_orig,
+                                                            target_num_pt_bins,
+                                                            merge_above, merge_below,
+                                                            merge_cost)
     else:
         raise RuntimeError('merge_algorithm argument incorrect')
 
@@ -188,38 +237,32 @@ def do_pt_compression(fit_functions, pt_orig, target_num_pt_bins,
     return new_pt_mapping, pt_index
 
 
-def calc_compressed_pt_mapping_greedy(pt_orig, corr_orig, target_num_bins,
-                                      merge_criterion, merge_above=None, merge_below=None):
-    """Calculate new compressed pt mapping. Uses corrections
-    to decide how to merge bins via "greedy" method.
-
-    Returns a dicts for original:quantised pt mapping, where the quantised pT
-    is the centre of the pT bin (for lack of anything better)
+def init_pt_mapping(pt_orig, merge_above=None, merge_below=None):
+    """Start a compressed pt mapping, merging all pt above merge_above & below
+    merge_below into one bin each. Other pt are mapped to themselves, except
+    0 which is always mapped to 0.
 
     Parameters
     ----------
     pt_orig: numpy.array
-        Array of original pt bin edges (physical pT, not HW)
-
-    corr_orig: numpy.array
-        Array of original correction factors (floats, not ints)
-
-    target_num_bins: int
-        Target number of pT bins
-
-    merge_criterion: float
-        Bins will be merged if min(bins) * merge_crit > max(bins)
+        Array of original pt values (physical pT, not HW), starting from 0
 
     merge_above: float
-        Bins above this value will be merged, ignoring merge_criterion
+        Bins above this value will be merged. Overridden to 254.5 if not set or
+        above that, since we only use bits 1:8
 
     merge_below: float
-        Bins below this value will be merged, ignoring merge_criterion
+        Bins below this value will be merged. Rounded to the nearest X.5,
+        so the bin above is for an even HW pT.
 
     Returns
     -------
     new_pt_mapping: OrderedDict
         Dict of {original pt: compressed pt}, both physical pT.
+    start_ind: int
+        Index in pt_orig of the merge_below pt (or 2 if no merge_below)
+    end_ind: int
+        Index in pt_orig of the first pt merged by merge_above
     """
     print 'Calculating new mapping for compressed ET'
 
@@ -244,7 +287,7 @@ def calc_compressed_pt_mapping_greedy(pt_orig, corr_orig, target_num_bins,
                 new_pt_mapping[pt] = mean_merge
         end_ind = merge_above_ind
 
-    orig_start_ind = 2
+    start_ind = 2
 
     if merge_below:
         # round to nearest 0.5
@@ -263,7 +306,45 @@ def calc_compressed_pt_mapping_greedy(pt_orig, corr_orig, target_num_bins,
                 continue
             if pt <= merge_below:
                 new_pt_mapping[pt] = mean_merge
-        orig_start_ind = merge_below_ind
+        start_ind = merge_below_ind
+
+    return new_pt_mapping, start_ind, end_ind
+
+
+def calc_compressed_pt_mapping_greedy(pt_orig, corr_orig, target_num_bins,
+                                      merge_criterion, merge_above=None, merge_below=None):
+    """Calculate new compressed pt mapping. Uses corrections
+    to decide how to merge bins via "greedy" method.
+
+    Returns a dicts for original:quantised pt mapping, where the quantised pT
+    is the centre of the pT bin (for lack of anything better)
+
+    Parameters
+    ----------
+    pt_orig: numpy.array
+        Array of original pt bin edges (physical pT, not HW)
+
+    corr_orig: numpy.array
+        Array of original correction factors (floats, not ints)
+
+    target_num_bins: int
+        Target number of pT bins
+
+    merge_criterion: float
+        Bins will be merged if min(bins) * merge_crit > max(bins)
+
+    merge_above: float
+        Bins above this value will be merged, ignoring merge_criterion
+
+    merge_below: float
+        Bins below this value will be merged, ignoring merge_criterion
+
+    Returns
+    -------
+    new_pt_mapping: OrderedDict
+        Dict of {original pt: compressed pt}, both physical pT.
+    """
+    new_pt_mapping, orig_start_ind, end_ind = init_pt_mapping(pt_orig, merge_above, merge_below)
 
     last_num_bins = 111111111
 
@@ -346,49 +427,7 @@ def calc_compressed_pt_mapping_kmeans(pt_orig, corr_orig, target_num_bins,
     WARNING: it doesn not respect the position in the list, so if the function
     turns over it will group them together
     """
-    print 'Calculating new mapping for compressed ET'
-
-    # hold pt mapping
-    new_pt_mapping = {p: p for p in pt_orig}
-    new_pt_mapping[0] = 0.
-    new_pt_mapping = OrderedDict(sorted(new_pt_mapping.items(), key=lambda t: t))
-
-    end_ind = len(pt_orig) - 1
-
-    # enforce truncation at 8 bits, since we only use bits 1:8
-    if not merge_above or merge_above >= 255.:
-        merge_above = 254.5
-        print 'Overriding merge_above to', merge_above
-
-    if merge_above:
-        # set all bins above this value to merge, and set to mean pt
-        merge_above_ind = bisect_left(new_pt_mapping.keys(), merge_above)
-        mean_merge = round_to_half(np.array(new_pt_mapping.keys()[merge_above_ind:]).mean())
-        for ind, pt in enumerate(new_pt_mapping.iterkeys()):
-            if pt >= merge_above:
-                new_pt_mapping[pt] = mean_merge
-        end_ind = merge_above_ind
-
-    start_ind = 2
-
-    if merge_below:
-        # round to nearest 0.5
-        merge_below = round_to_half(merge_below)
-        # check it's a half number, then the bin above is for even number
-        if float(merge_below).is_integer():
-            merge_below += 0.5
-        print 'Overriding merge_below to', merge_below
-
-        # set all bins below this value to merge, and set to mean pt
-        merge_below_ind = bisect_left(new_pt_mapping.keys(), merge_below)
-        mean_merge = round_to_half(np.array(new_pt_mapping.keys()[1:merge_below_ind]).mean())
-        for ind, pt in enumerate(new_pt_mapping.iterkeys()):
-            # keep pt = 0 set to 0
-            if ind == 0:
-                continue
-            if pt <= merge_below:
-                new_pt_mapping[pt] = mean_merge
-        start_ind = merge_below_ind
+    new_pt_mapping, start_ind, end_ind = init_pt_mapping(pt_orig, merge_above, merge_below)
 
     # actually do the clustering
     corr_data = corr_orig[start_ind: end_ind + 1]
@@ -427,6 +466,151 @@ def calc_compressed_pt_mapping_kmeans(pt_orig, corr_orig, target_num_bins,
     return new_pt_mapping
 
 
+def calc_segment_costs(values, merge_cost='squared'):
+    """Calculate the cost of merging each contiguous segment of values into one bin.
+
+    Parameters
+    ----------
+    values: numpy.array
+        Values to merge, e.g. correction factors.
+
+    merge_cost: str {'squared', 'max'}
+        squared: sum of squared differences from the segment mean.
+        max: difference between the largest & smallest values in the segment.
+
+    Returns
+    -------
+    numpy.array
+        Matrix of costs, where [i, j] is the cost of merging values[i:j].
+        Invalid segments (j <= i) are infinite.
+    """
+    values = np.asarray(values, dtype=float)
+    n_values = len(values)
+    start, end = np.meshgrid(np.arange(n_values + 1), np.arange(n_values + 1), indexing='ij')
+    valid = end > start
+    costs = np.full((n_values + 1, n_values + 1), np.inf)
+    if merge_cost == 'squared':
+        # from prefix sums of the values & their squares
+        sums = np.concatenate(([0.], np.cumsum(values)))
+        sums_sq = np.concatenate(([0.], np.cumsum(values * values)))
+        seg_sum = sums[end] - sums[start]
+        seg_sum_sq = sums_sq[end] - sums_sq[start]
+        lengths = np.where(valid, end - start, 1)
+        costs[valid] = np.maximum(seg_sum_sq - seg_sum * seg_sum / lengths, 0.)[valid]
+    elif merge_cost == 'max':
+        # running max & min of values[i:j] along each row
+        last = end[:-1, 1:] - 1
+        in_seg = last >= start[:-1, 1:]
+        seg_max = np.maximum.accumulate(np.where(in_seg, values[last], -np.inf), axis=1)
+        seg_min = np.minimum.accumulate(np.where(in_seg, values[last], np.inf), axis=1)
+        costs[:-1, 1:] = np.where(in_seg, seg_max - seg_min, np.inf)
+    else:
+        raise ValueError("merge_cost should be 'squared' or 'max', not %s" % merge_cost)
+    return costs
+
+
+def calc_optimal_segments(values, num_segments, merge_cost='squared'):
+    """Split values into num_segments contiguous segments, minimising the
+    total (squared) or largest (max) cost of the segments, see calc_segment_costs.
+
+    Uses dynamic programming, where each step finds the best way to split
+    values[:j] into one more segment, for all j at once.
+
+    Returns
+    -------
+    list[int]
+        Start index of each segment. If there are fewer values than
+        num_segments, each value is its own segment.
+    """
+    n_values = len(values)
+    num_segments = min(num_segments, n_values)
+    if num_segments < 1:
+        return []
+    # [j, i] is the cost of values[i:j], so the minimum over i is along rows
+    costs = np.ascontiguousarray(calc_segment_costs(values, merge_cost).T)
+    # best cost for values[:j] with the current number of segments
+    best = np.full(n_values + 1, np.inf)
+    best[0] = 0.
+    # start of the last segment in the best split of values[:j]
+    last_start = np.zeros((num_segments, n_values + 1), dtype=int)
+    combine = np.maximum if merge_cost == 'max' else np.add
+    total = np.empty_like(costs)
+    for k in xrange(num_segments):
+        combine(best[None, :], costs, out=total)
+        last_start[k] = np.argmin(total, axis=1)
+        best = total[np.arange(n_values + 1), last_start[k]]
+    # go back through the splits to find where each segment starts
+    starts = []
+    end = n_values
+    for k in reversed(xrange(num_segments)):
+        end = last_start[k][end]
+        starts.append(end)
+    return starts[::-1]
+
+
+def calc_compressed_pt_mapping_optimal(pt_orig, corr_orig, target_num_bins,
+                                       merge_above=None, merge_below=None,
+                                       merge_cost='squared'):
+    """Calculate new compressed pT binning, by splitting the correction
+    factors between merge_below & merge_above into contiguous pT bins, such
+    that the error from using one correction factor per bin is as small as possible.
+
+    Unlike the greedy method, this always gives target_num_bins, and the
+    best binning for that number. Only whole number pT (i.e. even HW pT) are
+    used, since we can only distinguish those.
+
+    Parameters
+    ----------
+    pt_orig: numpy.array
+        Array of original pt values (physical pT, not HW), starting from 0
+
+    corr_orig: numpy.array
+        Array of original correction factors (floats, not ints)
+
+    target_num_bins: int
+        Target number of pT bins, including 0 and the merge_above & merge_below bins
+
+    merge_above: float
+        Bins above this value will be merged
+
+    merge_below: float
+        Bins below this value will be merged
+
+    merge_cost: str {'squared', 'max'}
+        Minimise the total squared difference of correction factors from their
+        bin mean, or the largest spread of correction factors in a bin.
+
+    Returns
+    -------
+    new_pt_mapping: OrderedDict
+        Dict of {original pt: compressed pt}, both physical pT.
+    """
+    new_pt_mapping, start_ind, end_ind = init_pt_mapping(pt_orig, merge_above, merge_below)
+
+    # the pt in between the merged bins, whole numbers only
+    int_mask = np.equal(np.mod(pt_orig[start_ind:end_ind], 1), 0)
+    pt_int = pt_orig[start_ind:end_ind][int_mask]
+    corr_int = corr_orig[start_ind:end_ind][int_mask]
+
+    # bins already used by 0, merge_below & merge_above
+    middle = set(pt_int)
+    num_fixed_bins = len({v for k, v in new_pt_mapping.iteritems()
+                          if float(k).is_integer() and k not in middle})
+
+    starts = calc_optimal_segments(corr_int, target_num_bins - num_fixed_bins, merge_cost)
+    for seg_start, seg_end in pairwise(starts + [len(pt_int)]):
+        pt_mean = round_to_half(pt_int[seg_start:seg_end].mean())
+        for pt in pt_int[seg_start:seg_end]:
+            new_pt_mapping[pt] = pt_mean
+
+    # now go back and set all the half integers to have same correction as whole integers
+    for i in range(len(pt_orig) / 2):
+        if new_pt_mapping[i + 0.5] != new_pt_mapping[i]:
+            new_pt_mapping[i + 0.5] = new_pt_mapping[i]
+
+    return new_pt_mapping
+
+
 def generate_address(iet_index, ieta_index):
     """Convert iEt, iEta indices to address. These are NOT HW values.
 
@@ -508,10 +692,103 @@ def generate_corr_matrix(max_iet, max_hw_correction, right_shift, add_factor=Non
         Correction matrix.
     """
     # corr_m[x, y] holds iet post-correction for correction factor x on iet y
-    corr_m = np.ndarray(shape=(max_hw_correction + 1, max_iet + 1), dtype=int)
-    for i in range(max_hw_correction + 1):
-        iet = np.arange(0, max_iet + 1)
-        corr_m[i] = correct_iet(iet, i, right_shift, add_factor=add_factor)
+    iet = np.arange(0, max_iet + 1)
+    corr_ints = np.arange(0, max_hw_correction + 1)[:, np.newaxis]
+    corr_m = np.empty(shape=(max_hw_correction + 1, max_iet + 1), dtype=int)
+    corr_m[:] = correct_iet(iet, corr_ints, right_shift, add_factor=add_factor)
+    return corr_m
+
+
+class LazyCorrMatrix(object):
+    """Correction matrix that only calculates the entries asked for,
+    e.g. corr_m[:, iet_pre] for some columns, instead of storing all
+    (max_hw_correction + 1) x (max_iet + 1) of them.
+
+    Indexing with [rows, columns] gives the same as indexing the matrix
+    from generate_corr_matrix, for ints, slices & int arrays.
+    """
+
+    def __init__(self, max_iet, max_hw_correction, right_shift, add_factor=None):
+        self.shape = (max_hw_correction + 1, max_iet + 1)
+        self.right_shift = right_shift
+        self.add_factor = add_factor
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        corr_ints = np.asarray(np.arange(self.shape[0])[rows])
+        iet = np.asarray(np.arange(self.shape[1])[cols])
+        if isinstance(rows, slice):
+            # one row per correction int, with the columns after
+            corr_ints = corr_ints.reshape(corr_ints.shape + (1, ) * iet.ndim)
+        elif isinstance(cols, slice):
+            corr_ints = corr_ints[..., np.newaxis]
+        return correct_iet(iet, corr_ints, self.right_shift, add_factor=self.add_factor)
+
+
+# correction matrices already made/loaded by this process, see get_corr_matrix
+_CORR_MATRIX_CACHE = {}
+
+
+def get_corr_matrix_filename(cache_dir, max_iet, max_hw_correction, right_shift, add_factor=None):
+    """Get the .npy filename used to store a correction matrix in cache_dir"""
+    return os.path.join(cache_dir, "corr_matrix_iet%d_corr%d_rs%d_add%s.npy"
+                        % (max_iet, max_hw_correction, right_shift, add_factor))
+
+
+def get_corr_matrix(max_iet, max_hw_correction, right_shift, add_factor=None,
+                    cache_dir=None, lazy=False):
+    """Get a correction matrix (see generate_corr_matrix), only making it if
+    it hasn't already been made by this process (or saved in cache_dir).
+
+    Parameters
+    ----------
+    max_iet, max_hw_correction, right_shift, add_factor
+        See generate_corr_matrix
+    cache_dir : str, optional
+        If set, directory to save the matrix to as a .npy file, which is then
+        memory-mapped (read-only) by any later process wanting the same matrix.
+    lazy : bool, optional
+        If True, return a LazyCorrMatrix that only calculates the entries
+        that are used, instead of making the whole matrix.
+        Useful for large numbers of bits.
+
+    Returns
+    -------
+    numpy.ndarray or LazyCorrMatrix
+        Correction matrix. This is shared, so don't modify it.
+    """
+    if lazy:
+        return LazyCorrMatrix(max_iet, max_hw_correction, right_shift, add_factor)
+
+    key = (max_iet, max_hw_correction, right_shift, add_factor)
+    if key in _CORR_MATRIX_CACHE:
+        return _CORR_MATRIX_CACHE[key]
+
+    corr_m = None
+    if cache_dir:
+        filename = get_corr_matrix_filename(cache_dir, *key)
+        try:
+            if not os.path.isfile(filename):
+                cu.check_dir_exists_create(cache_dir)
+                # write to a temp file, then move into place, so other
+                # processes never see a half-written matrix
+                tmp_filename = "%s.tmp%d" % (filename, os.getpid())
+                with open(tmp_filename, "wb") as f:
+                    np.save(f, generate_corr_matrix(*key))
+                os.rename(tmp_filename, filename)
+            corr_m = np.load(filename, mmap_mode='r')
+        except (IOError, OSError) as err:
+            print ("Can't use correction matrix cache %s (%s), keeping it in memory"
+                   % (cache_dir, err))
+
+    if corr_m is None:
+        corr_m = generate_corr_matrix(*key)
+        corr_m.flags.writeable = False
+
+    _CORR_MATRIX_CACHE[key] = corr_m
     return corr_m
 
 
@@ -675,6 +952,160 @@ def calc_hw_correction_addition_ints(map_info, corr_matrix, right_shift,
     return np.array(hw_corrections), np.array(hw_additions)
 
 
+def round_half_away(values):
+    """Round like the builtin round(), i.e. halves away from zero
+    (unlike numpy.round, which rounds halves to even), for arrays of values."""
+    values = np.asarray(values, dtype=float)
+    abs_values = np.abs(values)
+    floored = np.floor(abs_values)
+    # abs_values - floored is exact, so no rounding errors at the halves
+    rounded = floored + (abs_values - floored >= 0.5)
+    return (np.sign(values) * rounded).astype(int)
+
+
+def calc_hw_corr_factors(corr_matrix, iet_pre, iet_post):
+    """Vectorised calc_hw_corr_factor, for arrays of iet_pre & iet_post.
+
+    Each column of corr_matrix is sorted (for add_factor=0), so the first
+    exact match, or the bisect position if there isn't one, is the number
+    of entries less than iet_post.
+
+    Parameters
+    ----------
+    corr_matrix: numpy.ndarray
+
+    iet_pre: numpy.ndarray
+        HW pt before calibration
+
+    iet_post: numpy.ndarray
+        Target HW pt post calibration, same shape as iet_pre
+
+    Returns
+    -------
+    numpy.ndarray:
+        Correction factors that give the closest iet_post
+    """
+    iet_pre = round_half_away(iet_pre)
+    iet_post = round_half_away(iet_post)
+    num_corr = np.size(corr_matrix, 0)
+    ind = (corr_matrix[:, iet_pre] < iet_post).sum(axis=0)
+    above = corr_matrix[np.minimum(ind, num_corr - 1), iet_pre]
+    # ind - 1 = -1 means the last row, as in calc_hw_corr_factor
+    below = corr_matrix[(ind - 1) % num_corr, iet_pre]
+    closest = np.where(np.abs(above - iet_post) < np.abs(below - iet_post), ind, ind - 1)
+    exact = (ind < num_corr) & (above == iet_post)
+    factors = np.where(exact, ind, np.where(ind == num_corr, num_corr - 1, closest))
+    # always return factor 0 when input pt = 0
+    return np.where(iet_pre == 0, 0, factors)
+
+
+def calc_hw_correction_addition_ints_all(hw_pt_orig, hw_pt_post, pt_index, corr_matrix,
+                                         right_shift, num_add_bits, max_hw_pt):
+    """Vectorised calc_hw_correction_addition_ints, for all eta bins at once.
+
+    Gives identical integers, but does every (eta, compressed pt) bin
+    in a few array operations instead of looping over them.
+
+    Parameters
+    ----------
+    hw_pt_orig : numpy.ndarray
+        HW pt before correction
+
+    hw_pt_post : numpy.ndarray
+        Target HW pt after correction, shape (number of eta bins, len(hw_pt_orig))
+
+    pt_index : list[int]
+        Compressed pt index for each hw_pt_orig
+
+    corr_matrix : numpy.ndarray
+        Pre-filled matrix of {corr int, iet} => (iet*corr int) >> X
+
+    right_shift : int
+        Number of bits for right shift
+
+    num_add_bits : int
+        Num of bits for the addend
+
+    max_hw_pt : int
+        Maximum HW PT
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        HW correction integers & HW correction additions,
+        each shape (number of eta bins, number of pt entries)
+    """
+    print 'Assigning HW correction factors'
+
+    hw_pt_orig = np.asarray(hw_pt_orig)
+    hw_pt_post = np.atleast_2d(hw_pt_post)
+
+    # Figure out indices for the start & end of each compressed pt bin
+    _, lo = np.unique(pt_index, return_index=True)
+    hi = np.append(lo[1:], len(pt_index))
+
+    # we use the edges of the bin to ensure continuity between bins,
+    # capping the upper edge at max_hw_pt
+    hw_pt_post_lo = hw_pt_post[:, lo]
+    hw_pt_post_hi = hw_pt_post[:, hi - 1]
+    over_max = hw_pt_post_hi > max_hw_pt
+    hw_pt_post_hi = np.where(over_max, max_hw_pt, hw_pt_post_hi)
+    # entry that is closest to max_hw_pt, for bins over it
+    hi_max = np.argmin(np.abs(hw_pt_post - max_hw_pt), axis=1) + 1
+    hw_pt_pre_lo = hw_pt_orig[lo]
+    hw_pt_pre_hi = hw_pt_orig[np.where(over_max, hi_max[:, None], hi) - 1]
+
+    # average correction factor for each bin i.e. gradient, & y-intercept
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr_factor = (hw_pt_post_hi - hw_pt_post_lo) / (1. * hw_pt_pre_hi - hw_pt_pre_lo)
+    intercept = round_half_away(hw_pt_post_lo - (corr_factor * hw_pt_pre_lo))
+
+    # get pre/post centers to get integer for each bin
+    mean_hw_pt_pre = round_half_away(0.5 * (hw_pt_pre_hi + hw_pt_pre_lo))
+    mean_hw_pt_post = round_half_away(0.5 * (hw_pt_post_hi + hw_pt_post_lo))
+
+    # subtract intercept as want factor just for gradient
+    corr_factor_int = calc_hw_corr_factors(corr_matrix, mean_hw_pt_pre, mean_hw_pt_post - intercept)
+
+    # if corr_factor_int is the maximum it can be, increase the intercept
+    # so the bin centre is still corrected to the right place
+    at_max = corr_factor_int == np.size(corr_matrix, 0) - 1
+    intercept = np.where(at_max,
+                         mean_hw_pt_post - correct_iet(mean_hw_pt_pre, corr_factor_int,
+                                                       right_shift),
+                         intercept)
+
+    # saturate addend if it doesn't fit into specified num of bits
+    max_add = 2**(num_add_bits - 1) - 1
+    saturated = np.abs(intercept) > max_add
+    if saturated.any():
+        print 'WARNING: having to saturate addend for %d bins' % saturated.sum()
+    intercept = np.where(saturated, max_add * np.sign(intercept), intercept)
+
+    # one entry per pt, from the bin it is in
+    bin_inds = np.repeat(np.arange(len(lo)), np.maximum(hi - lo, 0))
+    return corr_factor_int[:, bin_inds], intercept[:, bin_inds]
+
+
+def calc_lut_corrections(hw_pt_orig, hw_pt_post, pt_index, corr_matrix,
+                         right_shift, num_add_bits, max_hw_pt):
+    """Calculate the HW correction integers for all eta bins, and the HW pt
+    you get from applying them. See calc_hw_correction_addition_ints_all
+    for the parameters.
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray, numpy.ndarray
+        HW correction integers, HW correction additions, and HW pt after
+        correction, each shape (number of eta bins, number of pt entries)
+    """
+    corr_ints, add_ints = calc_hw_correction_addition_ints_all(hw_pt_orig, hw_pt_post, pt_index,
+                                                               corr_matrix, right_shift,
+                                                               num_add_bits, max_hw_pt)
+    hw_pt_post_hw = correct_iet(np.asarray(hw_pt_orig), corr_ints, right_shift, add_factor=add_ints)
+    return corr_ints, add_ints, hw_pt_post_hw
+
+
 def generate_add_mult(add, mult, num_add_bits, num_mult_bits):
     """Convert addition and multiplication factors into one integer.
 
@@ -952,7 +1383,9 @@ def print_Stage2_lut_files(fit_functions,
                            read_pt_compression=None,
                            target_num_pt_bins=2**4,
                            merge_criterion=1.05,
-                           merge_algorithm='greedy' # or 'kmeans'
+                           merge_algorithm='greedy', # or 'kmeans' or 'optimal'
+                           merge_cost='squared',
+                           corr_matrix_cache_dir=None
                            ):
     """Make LUTs for Stage 2.
 
@@ -1007,7 +1440,7 @@ def print_Stage2_lut_files(fit_functions,
         be combined if the maximum correction factor = merge_criterion * minimum
         correction factor for those pt values.
 
-    merge_algorithm : str {'greedy' , 'kmeans'}
+    merge_algorithm : str {'greedy' , 'kmeans', 'optimal'}
         Merge algorithm to use to decide upon compressed ET binning.
 
         greedy: my own algo, that merges bins within a certain tolerance until
@@ -1015,6 +1448,17 @@ def print_Stage2_lut_files(fit_functions,
 
         kmeans: use k-means algorithm in scikit-learn
 
+        optimal: find the contiguous pt bins that best fit the correction
+            factors, using dynamic programming
+
+    merge_cost : str {'squared', 'max'}
+        For the optimal algorithm, whether to minimise the total squared error
+        or the maximum spread of correction factors in each compressed bin.
+
+    corr_matrix_cache_dir : str, optional
+        Directory to save the correction matrix in, so later runs with the
+        same right_shift & num_corr_bits can reuse it, see get_corr_matrix.
+
     Raises
     ------
     IndexError
@@ -1038,6 +1482,8 @@ def print_Stage2_lut_files(fit_functions,
         print ' - target num pt bins (per eta bin):', target_num_pt_bins
         print ' - merge criterion:', merge_criterion
         print ' - merge algorithm:', merge_algorithm
+        if merge_algorithm == 'optimal':
+            print ' - merge cost:', merge_cost
     print ' - # corr bits:', num_corr_bits
     print ' - # addend bits:', num_add_bits
     print ' - right shift:', right_shift
@@ -1059,7 +1505,8 @@ def print_Stage2_lut_files(fit_functions,
                                                      pt_orig,
                                                      target_num_pt_bins,
                                                      merge_algorithm,
-                                                     merge_criterion)
+                                                     merge_criterion,
+                                                     merge_cost)
 
         write_pt_compress_lut(pt_lut_filename, hw_pt_orig, pt_index)
 
@@ -1068,14 +1515,14 @@ def print_Stage2_lut_files(fit_functions,
 
     # Generate matrix of iet pre/post for different correction integers
     # Only need to do it once beforehand, can be used for all eta bins
-    corr_matrix_add_none = generate_corr_matrix(max_iet=int(max_pt * 2),
-                                                max_hw_correction=(2**num_corr_bits) - 1,
-                                                right_shift=right_shift,
-                                                add_factor=0)
+    corr_matrix_add_none = get_corr_matrix(max_iet=int(max_pt * 2),
+                                           max_hw_correction=(2**num_corr_bits) - 1,
+                                           right_shift=right_shift,
+                                           add_factor=0,
+                                           cache_dir=corr_matrix_cache_dir)
 
     # figure out new correction mappings for each eta bin
     for eta_ind, func in enumerate(fit_functions):
-        print ' *** Doing eta bin', eta_ind, '***'
         # if eta_ind not in [13]:
         #     continue
         # Dict to hold ALL info for this eta bin
@@ -1090,32 +1537,36 @@ def print_Stage2_lut_files(fit_functions,
                         pt_post_hw_corr_compressed=None  # phys pt post HW correction factor
                         )
 
-        corr_orig = np.array([0.] + [func.Eval(pt) for pt in pt_orig if pt > 0.])
+        corr_orig = calc_corr_orig(func, pt_orig)
         map_info['corr_orig'] = corr_orig
 
         map_info['pt_post_corr_orig'] = pt_orig * corr_orig
         map_info['hw_pt_post_corr_orig'] = (map_info['pt_post_corr_orig'] * 2.).astype(int)
 
-        # then we calculate all the necessary correction mult/add integers
-        corr_ints_new, add_ints = calc_hw_correction_addition_ints(map_info,
-                                                                   corr_matrix_add_none,
-                                                                   right_shift,
-                                                                   num_add_bits,
-                                                                   max_hw_pt)
-        map_info['hw_corr_compressed'], map_info['hw_corr_compressed_add'] = corr_ints_new, add_ints
+        all_mapping_info[eta_ind] = map_info
 
-        # Store the result of applying the HW correction ints
-        hw_pt_post = [correct_iet(iet, cf, right_shift, add_factor=af) for iet, cf, af
-                      in izip(map_info['hw_pt_orig'],
-                              map_info['hw_corr_compressed'],
-                              map_info['hw_corr_compressed_add'])]
+    # then we calculate all the necessary correction mult/add integers,
+    # for all eta bins at once
+    all_hw_pt_post_corr_orig = np.array([eta_map_info['hw_pt_post_corr_orig']
+                                         for eta_map_info in all_mapping_info.itervalues()])
+    all_corr_ints, all_add_ints, all_hw_pt_post = calc_lut_corrections(hw_pt_orig,
+                                                                       all_hw_pt_post_corr_orig,
+                                                                       pt_index,
+                                                                       corr_matrix_add_none,
+                                                                       right_shift,
+                                                                       num_add_bits,
+                                                                       max_hw_pt)
+
+    for eta_ind, map_info in all_mapping_info.iteritems():
+        print ' *** Doing eta bin', eta_ind, '***'
+        map_info['hw_corr_compressed'] = all_corr_ints[eta_ind]
+        map_info['hw_corr_compressed_add'] = all_add_ints[eta_ind]
 
-        hw_pt_post = np.array(hw_pt_post)
+        # Store the result of applying the HW correction ints
+        hw_pt_post = all_hw_pt_post[eta_ind]
         map_info['hw_pt_post_hw_corr_compressed'] = hw_pt_post
         map_info['pt_post_hw_corr_compressed'] = hw_pt_post * 0.5
 
-        all_mapping_info[eta_ind] = map_info
-
         if eta_ind in [13, 14]:
             print_map_info(map_info)  # for debugging dict contents
 
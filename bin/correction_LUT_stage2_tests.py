@@ -6,6 +6,9 @@
 import correction_LUT_stage2 as cls
 import unittest
 import numpy as np
+import os
+import shutil
+import tempfile
 from collections import OrderedDict
 
 
@@ -126,5 +129,158 @@ class TestLUTMethods(unittest.TestCase):
     # def test_(self):
 
 
+class TestOptimalPtCompression(unittest.TestCase):
+    def setUp(self):
+        p0, p1, p2 = 3.18556244, 25.56760298, 2.51677342
+        p3, p4, p5 = -103.26529010, 0.00678420, -18.73657857
+        self.func = TestFunc(p0, p1, p2, p3, p4, p5)
+        self.pt_orig = np.arange(0, 1023.5 + 0.5, 0.5)
+        self.corr_orig = np.array([0.] + [self.func.Eval(pt) for pt in self.pt_orig[1:]])
+        self.target_num_bins = 16
+
+    def test_segments_brute_force(self):
+        """Check the DP segmentation against trying all splits"""
+        from itertools import combinations
+        values = self.corr_orig[10:30:2]
+        for merge_cost in ['squared', 'max']:
+            costs = cls.calc_segment_costs(values, merge_cost)
+            combine = max if merge_cost == 'max' else sum
+            best = min(combine(costs[i, j] for i, j in cls.pairwise((0,) + splits + (len(values),)))
+                       for splits in combinations(range(1, len(values)), 3))
+            starts = cls.calc_optimal_segments(values, 4, merge_cost)
+            result = combine(costs[i, j] for i, j in cls.pairwise(starts + [len(values)]))
+            self.assertAlmostEqual(result, best)
+
+    def test_mapping(self):
+        """Check number of bins, pt = 0 & merged pt, and that bins are contiguous"""
+        for merge_cost in ['squared', 'max']:
+            mapping = cls.calc_compressed_pt_mapping_optimal(self.pt_orig, self.corr_orig,
+                                                             self.target_num_bins,
+                                                             merge_above=100.3, merge_below=5.2,
+                                                             merge_cost=merge_cost)
+            self.assertEqual(mapping.keys(), list(self.pt_orig))
+            self.assertEqual(mapping[0], 0)
+            self.assertEqual(len(set(mapping.values())), self.target_num_bins)
+            self.assertTrue(check_sorted(mapping.values()))
+            self.assertEqual(len({mapping[pt] for pt in self.pt_orig if pt >= 101}), 1)
+            self.assertEqual(len({mapping[pt] for pt in self.pt_orig if 1 <= pt <= 5.5}), 1)
+            # half pt follow the whole numbers below
+            for pt in self.pt_orig[1::2]:
+                self.assertEqual(mapping[pt], mapping[pt - 0.5])
+
+
+class TestVectorisedHWCorrections(unittest.TestCase):
+    def setUp(self):
+        """Several eta bins, with corrections big enough to saturate the
+        multiplier & addend, and to go over the maximum HW pt"""
+        p0, p1, p2 = 3.18556244, 25.56760298, 2.51677342
+        p3, p4, p5 = -103.26529010, 0.00678420, -18.73657857
+        self.right_shift = 9
+        self.num_add_bits = 8
+        self.max_hw_pt = 2**11 - 1
+        self.pt_orig = np.arange(0, self.max_hw_pt * 0.5 + 0.5, 0.5)
+        self.hw_pt_orig = (self.pt_orig * 2).astype(int)
+        self.corr_matrix = cls.generate_corr_matrix(max_iet=self.max_hw_pt,
+                                                    max_hw_correction=2**10 - 1,
+                                                    right_shift=self.right_shift,
+                                                    add_factor=0)
+        self.hw_pt_post = []
+        for scale in [0.4, 0.8, 1., 1.3, 2.5]:
+            func = TestFunc(p0 * scale, p1 * scale, p2, p3 * scale, p4, p5)
+            corr_orig = np.array([0.] + [func.Eval(pt) for pt in self.pt_orig[1:]])
+            self.hw_pt_post.append((self.pt_orig * corr_orig * 2.).astype(int))
+        self.hw_pt_post = np.array(self.hw_pt_post)
+
+    def check_parity(self, pt_index):
+        corr_ints, add_ints = cls.calc_hw_correction_addition_ints_all(
+            self.hw_pt_orig, self.hw_pt_post, pt_index, self.corr_matrix,
+            self.right_shift, self.num_add_bits, self.max_hw_pt)
+        for eta_ind, hw_pt_post in enumerate(self.hw_pt_post):
+            map_info = dict(hw_pt_orig=self.hw_pt_orig, hw_pt_post_corr_orig=hw_pt_post,
+                            pt_index=pt_index)
+            corr_ints_loop, add_ints_loop = cls.calc_hw_correction_addition_ints(
+                map_info, self.corr_matrix, self.right_shift, self.num_add_bits, self.max_hw_pt)
+            np.testing.assert_array_equal(corr_ints[eta_ind], corr_ints_loop)
+            np.testing.assert_array_equal(add_ints[eta_ind], add_ints_loop)
+
+    def test_parity_uniform_bins(self):
+        """Check same ints as one bin at a time, for simple pt bins"""
+        self.check_parity(np.minimum(self.hw_pt_orig // 40, 12))
+
+    def test_parity_optimal_bins(self):
+        """Check same ints as one bin at a time, for a derived pt compression"""
+        corr_orig = self.hw_pt_post[2] / (2. * np.maximum(self.pt_orig, 0.5))
+        mapping = cls.calc_compressed_pt_mapping_optimal(self.pt_orig, corr_orig, 16,
+                                                         merge_above=120., merge_below=6.)
+        hw_pt_mapped = (np.array(mapping.values()) * 2).astype(int)
+        self.check_parity(np.array(cls.assign_pt_index(hw_pt_mapped)))
+
+    def test_corr_factor_parity(self):
+        """Check vectorised calc_hw_corr_factors against calc_hw_corr_factor"""
+        rng = np.random.RandomState(11)
+        iet_pre = rng.randint(0, self.max_hw_pt + 1, size=500)
+        iet_post = rng.randint(-300, 4 * self.max_hw_pt, size=500)
+        factors = cls.calc_hw_corr_factors(self.corr_matrix, iet_pre, iet_post)
+        for pre, post, factor in zip(iet_pre, iet_post, factors):
+            self.assertEqual(factor, cls.calc_hw_corr_factor(self.corr_matrix, pre, post))
+
+    def test_round_half_away(self):
+        values = np.array([-2.5, -1.5, -0.5, -0.49999999999999994, 0., 0.5, 1.5, 2.5, 2.4999999,
+                           7.])
+        np.testing.assert_array_equal(cls.round_half_away(values), [int(round(v)) for v in values])
+
+
+class TestCorrMatrix(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.key = dict(max_iet=300, max_hw_correction=2**7 - 1, right_shift=6, add_factor=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        cls._CORR_MATRIX_CACHE.clear()
+
+    def test_matches_loop(self):
+        """Check the matrix is the same as applying correct_iet row by row"""
+        corr_m = cls.generate_corr_matrix(**self.key)
+        iet = np.arange(0, self.key['max_iet'] + 1)
+        for corr_int in range(self.key['max_hw_correction'] + 1):
+            expected = cls.correct_iet(iet, corr_int, self.key['right_shift'], 0)
+            np.testing.assert_array_equal(corr_m[corr_int], expected)
+
+    def test_cache(self):
+        """Check the matrix is only made once, and is the same when read back from file"""
+        corr_m = cls.get_corr_matrix(cache_dir=self.tmp_dir, **self.key)
+        self.assertTrue(os.path.isfile(cls.get_corr_matrix_filename(self.tmp_dir, **self.key)))
+        self.assertIs(cls.get_corr_matrix(cache_dir=self.tmp_dir, **self.key), corr_m)
+        cls._CORR_MATRIX_CACHE.clear()
+        np.testing.assert_array_equal(cls.get_corr_matrix(cache_dir=self.tmp_dir, **self.key),
+                                      cls.generate_corr_matrix(**self.key))
+        self.assertFalse(cls.get_corr_matrix(**dict(self.key, right_shift=5)).flags.writeable)
+
+    def test_lazy(self):
+        """Check the lazy matrix gives the same entries for the ways it gets indexed"""
+        corr_m = cls.generate_corr_matrix(**self.key)
+        lazy = cls.get_corr_matrix(lazy=True, **self.key)
+        self.assertEqual(np.size(lazy, 0), np.size(corr_m, 0))
+        iet_pre = np.array([[1, 5, 300], [20, 0, 7]])
+        rows = np.array([[0, 127, 3], [64, 5, 1]])
+        for key in [(slice(None), 7), (slice(None), iet_pre), (rows, iet_pre),
+                    (3, slice(None)), (rows, slice(10, 20)), (slice(5, 9), slice(None))]:
+            np.testing.assert_array_equal(lazy[key], corr_m[key])
+
+    def test_lazy_hw_corrections(self):
+        """Check the vectorised solver gives the same with the lazy matrix"""
+        hw_pt_orig = np.arange(0, 301)
+        hw_pt_post = np.array([(hw_pt_orig * 1.3).astype(int), (hw_pt_orig * 0.9).astype(int)])
+        pt_index = np.minimum(hw_pt_orig // 20, 12)
+        args = (hw_pt_orig, hw_pt_post, pt_index)
+        corr_m = cls.generate_corr_matrix(**self.key)
+        lazy = cls.get_corr_matrix(lazy=True, **self.key)
+        expected = cls.calc_hw_correction_addition_ints_all(*(args + (corr_m, 6, 8, 300)))
+        result = cls.calc_hw_correction_addition_ints_all(*(args + (lazy, 6, 8, 300)))
+        for exp, res in zip(expected, result):
+            np.testing.assert_array_equal(exp, res)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Scan the settings for making Stage 2 LUTs (see
+correction_LUT_stage2.print_Stage2_lut_files) to help choose them, without
+writing any LUTs or plots.
+
+For each combination of target number of pt bins, merge algorithm,
+merge criterion/cost, right shift, and number of multiplier & addend bits,
+this works out the pt compression & HW integers as for the real LUTs, and
+reports per eta bin:
+
+- the max & RMS of |pT post HW correction - pT post correction function|
+- the number of compressed pt bins used
+- the number of bits the multipliers & addends actually need
+
+One pt compression is shared by all the HW integer settings, and each
+correction matrix is only made once per process (or once overall, with
+--corrMatrixCache). Settings are evaluated in a pool of --jobs processes.
+The results are saved as a CSV table, and a summary of the best settings
+is printed.
+
+Usage: see
+python correction_LUT_sweep.py -h
+"""
+
+import ROOT
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
+from itertools import product
+import numpy as np
+import common_utils as cu
+import correction_LUT_stage2 as cls
+from correction_LUT_plot import (get_functions_graphs_params_rootfile,
+                                 get_functions_params_textfile, get_stage2_fits)
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(1)
+
+
+# As in print_Stage2_lut_files
+MAX_HW_PT = 2**11 - 1
+
+COLUMNS = ["target_num_pt_bins", "merge_algorithm", "merge_criterion", "merge_cost",
+           "right_shift", "num_corr_bits", "num_add_bits", "eta_bin", "status",
+           "num_pt_bins", "max_abs_diff", "rms_diff", "mult_bits_used", "add_bits_used"]
+
+
+def get_compression_settings(target_num_pt_bins, merge_algorithms, merge_criteria, merge_costs):
+    """Get all the different pt compression settings. The merge criterion is
+    only used by the greedy algorithm, and the merge cost by the optimal one,
+    so they are None otherwise to avoid repeating the same compression."""
+    settings = []
+    for target, algo in product(target_num_pt_bins, merge_algorithms):
+        criteria = merge_criteria if algo == 'greedy' else [None]
+        costs = merge_costs if algo == 'optimal' else [None]
+        for criterion, cost in product(criteria, costs):
+            settings.append(dict(target_num_pt_bins=target, merge_algorithm=algo,
+                                 merge_criterion=criterion, merge_cost=cost))
+    return settings
+
+
+def calc_bits_used(values, signed=False):
+    """Number of bits needed to hold all values"""
+    values = np.asarray(values, dtype=np.int64)
+    if signed:
+        largest = max(values.max(), -values.min() - 1, 0)
+        return int(largest).bit_length() + 1
+    return int(max(values.max(), 0)).bit_length()
+
+
+def calc_metrics(pt_orig, pt_post_func, hw_pt_post, corr_ints, add_ints, pt_index, pt_mask):
+    """Calculate the quantisation metrics for each eta bin, and all eta bins
+    together (eta_bin 'all').
+
+    Parameters
+    ----------
+    pt_orig : numpy.ndarray
+        Physical pt before correction.
+    pt_post_func : numpy.ndarray
+        Physical pt after the correction functions, shape (number of eta bins, len(pt_orig))
+    hw_pt_post : numpy.ndarray
+        HW pt after the HW correction, same shape as pt_post_func
+    corr_ints, add_ints : numpy.ndarray
+        HW multiplier & addend for each pt, same shape as pt_post_func
+    pt_index : numpy.ndarray
+        Compressed pt index for each pt.
+    pt_mask : numpy.ndarray
+        Which pt_orig to use for the differences.
+
+    Returns
+    -------
+    list[dict]
+    """
+    # ignore where the correction function goes beyond the max HW pt,
+    # as the HW pt saturates there anyway
+    mask = pt_mask[np.newaxis, :] & (pt_post_func <= MAX_HW_PT * 0.5)
+    abs_diff = np.abs(0.5 * hw_pt_post - pt_post_func)
+    metrics = []
+    num_pt_bins = len(np.unique(pt_index))
+    for eta_ind in range(len(pt_post_func)):
+        eta_diff = abs_diff[eta_ind][mask[eta_ind]]
+        metrics.append(dict(eta_bin=eta_ind, num_pt_bins=num_pt_bins,
+                            max_abs_diff=eta_diff.max(),
+                            rms_diff=np.sqrt(np.mean(eta_diff**2)),
+                            mult_bits_used=calc_bits_used(corr_ints[eta_ind]),
+                            add_bits_used=calc_bits_used(add_ints[eta_ind], signed=True)))
+    metrics.append(dict(eta_bin='all', num_pt_bins=num_pt_bins,
+                        max_abs_diff=abs_diff[mask].max(),
+                        rms_diff=np.sqrt(np.mean(abs_diff[mask]**2)),
+                        mult_bits_used=max(m['mult_bits_used'] for m in metrics),
+                        add_bits_used=max(m['add_bits_used'] for m in metrics)))
+    return metrics
+
+
+def evaluate_compression(job):
+    """Evaluate one pt compression setting, with all the HW integer settings.
+    This is the worker for the process pool.
+
+    Parameters
+    ----------
+    job : tuple
+        (compression settings dict, list of (right shift, # multiplier bits,
+        # addend bits), dict of inputs from get_sweep_inputs, pt mask,
+        correction matrix cache dir)
+
+    Returns
+    -------
+    list[dict]
+        One row per HW integer setting & eta bin, with COLUMNS.
+    """
+    compression, hw_settings, inputs, pt_mask, corr_matrix_cache_dir = job
+    pt_orig, hw_pt_orig = inputs['pt_orig'], inputs['hw_pt_orig']
+    rows = []
+    try:
+        _, pt_index = cls.compress_pt(pt_orig, inputs['compression_corr'],
+                                      compression['target_num_pt_bins'],
+                                      compression['merge_algorithm'],
+                                      compression['merge_criterion'],
+                                      inputs['merge_above'], inputs['merge_below'],
+                                      compression['merge_cost'])
+    except (SystemExit, ValueError, IndexError) as e:
+        # greedy can get stuck, or not find enough bins
+        print 'Failed pt compression', compression, repr(e)
+        for right_shift, num_corr_bits, num_add_bits in hw_settings:
+            rows.append(dict(compression, right_shift=right_shift, num_corr_bits=num_corr_bits,
+                             num_add_bits=num_add_bits, eta_bin='all', status='compression failed'))
+        return rows
+
+    for right_shift, num_corr_bits, num_add_bits in hw_settings:
+        # as in print_Stage2_lut_files
+        corr_matrix = cls.get_corr_matrix(max_iet=MAX_HW_PT,
+                                          max_hw_correction=(2**num_corr_bits) - 1,
+                                          right_shift=right_shift,
+                                          add_factor=0,
+                                          cache_dir=corr_matrix_cache_dir)
+        corr_ints, add_ints, hw_pt_post = cls.calc_lut_corrections(hw_pt_orig,
+                                                                   inputs['hw_pt_post_func'],
+                                                                   pt_index, corr_matrix,
+                                                                   right_shift, num_add_bits,
+                                                                   MAX_HW_PT)
+        for metric in calc_metrics(pt_orig, inputs['pt_post_func'], hw_pt_post,
+                                   corr_ints, add_ints, pt_index, pt_mask):
+            rows.append(dict(compression, right_shift=right_shift, num_corr_bits=num_corr_bits,
+                             num_add_bits=num_add_bits, status='ok', **metric))
+    return rows
+
+
+def get_sweep_inputs(fit_functions):
+    """Evaluate everything that needs the correction functions once,
+    so the workers only need numpy arrays.
+
+    Returns
+    -------
+    dict
+        pt_orig, hw_pt_orig, pt_post_func & hw_pt_post_func for all eta bins
+        (as print_Stage2_lut_files), plus the correction factors & merge limits
+        for the pt compression (see correction_LUT_stage2.get_pt_compression_inputs)
+    """
+    max_pt = MAX_HW_PT * 0.5
+    pt_orig = np.arange(0, max_pt + 0.5, 0.5)
+    hw_pt_orig = (pt_orig * 2).astype(int)
+    pt_post_func = np.array([pt_orig * cls.calc_corr_orig(func, pt_orig) for func in fit_functions])
+    compression_corr, merge_above, merge_below = cls.get_pt_compression_inputs(fit_functions,
+                                                                               pt_orig)
+    return dict(pt_orig=pt_orig, hw_pt_orig=hw_pt_orig,
+                pt_post_func=pt_post_func,
+                hw_pt_post_func=(pt_post_func * 2.).astype(int),
+                compression_corr=compression_corr,
+                merge_above=merge_above, merge_below=merge_below)
+
+
+def run_sweep(inputs, compression_settings, hw_settings, pt_mask, jobs=1,
+              corr_matrix_cache_dir=None):
+    """Evaluate all combinations of compression_settings & hw_settings,
+    in a pool of jobs processes. If corr_matrix_cache_dir is set,
+    the correction matrices are shared between processes via files there
+    (see correction_LUT_stage2.get_corr_matrix).
+
+    Returns
+    -------
+    list[dict]
+        Rows for the results table, in the order of compression_settings.
+    """
+    all_jobs = [(compression, hw_settings, inputs, pt_mask, corr_matrix_cache_dir)
+                for compression in compression_settings]
+    if jobs > 1:
+        # not maxtasksperchild=1, so each process keeps its correction matrices
+        pool = multiprocessing.Pool(processes=jobs)
+        try:
+            results = pool.map(evaluate_compression, all_jobs, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [evaluate_compression(job) for job in all_jobs]
+    return [row for rows in results for row in rows]
+
+
+def write_table(rows, output_filename):
+    """Write the results table as CSV"""
+    with open(output_filename, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row.get(k, '') for k in COLUMNS})
+
+
+def print_summary(rows, num_best):
+    """Print the settings with the smallest max difference over all eta bins"""
+    summary = sorted([row for row in rows if row['eta_bin'] == 'all' and row['status'] == 'ok'],
+                     key=lambda row: (row['max_abs_diff'], row['rms_diff']))
+    print "Best %d settings (max & RMS |pT HW - pT func| [GeV] over all eta bins):" % num_best
+    header = ["# pt bins", "algo", "criterion", "cost", "shift", "mult bits", "add bits",
+              "max diff", "RMS diff", "mult used", "add used"]
+    print " | ".join(header)
+    for row in summary[:num_best]:
+        print " | ".join([str(row['target_num_pt_bins']), row['merge_algorithm'],
+                          str(row['merge_criterion']), str(row['merge_cost']),
+                          str(row['right_shift']), str(row['num_corr_bits']),
+                          str(row['num_add_bits']),
+                          "%.3f" % row['max_abs_diff'], "%.3f" % row['rms_diff'],
+                          str(row['mult_bits_used']), str(row['add_bits_used'])])
+    num_failed = len([row for row in rows if row['status'] != 'ok'])
+    if num_failed:
+        print "%d settings failed, see the table" % num_failed
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=cu.CustomFormatter)
+    parser.add_argument("input",
+                        help="input ROOT/txt filename with correction functions")
+    parser.add_argument("output",
+                        help="output CSV filename for the table of results")
+    parser.add_argument("--text",
+                        help="Read correction functions from text file instead of ROOT file",
+                        action='store_true')
+    parser.add_argument("--lowPtPlateau",
+                        help="Cap the correction below the low pT turnover, "
+                        "as correction_LUT_plot.py --lowPtPlateau",
+                        action='store_true')
+    parser.add_argument("--constantHF",
+                        help="Use constant HF corrections, as correction_LUT_plot.py --constantHF",
+                        action='store_true')
+    parser.add_argument("--targetNumPtBins", type=int, nargs='+', default=[2**4],
+                        help="Target numbers of compressed pt bins")
+    parser.add_argument("--mergeAlgorithm", nargs='+', default=['greedy', 'optimal'],
+                        choices=['greedy', 'kmeans', 'optimal'],
+                        help="pt compression algorithms")
+    parser.add_argument("--mergeCriterion", type=float, nargs='+', default=[1.05],
+                        help="Merge criteria for the greedy algorithm")
+    parser.add_argument("--mergeCost", nargs='+', default=['squared', 'max'],
+                        choices=['squared', 'max'],
+                        help="Costs for the optimal algorithm")
+    parser.add_argument("--rightShift", type=int, nargs='+', default=[9],
+                        help="Right shifts after the multiplier")
+    parser.add_argument("--numCorrBits", type=int, nargs='+', default=[10],
+                        help="Numbers of bits for the multiplier")
+    parser.add_argument("--numAddBits", type=int, nargs='+', default=[8],
+                        help="Numbers of bits for the addend")
+    parser.add_argument("--ptMin", type=float, default=0,
+                        help="Only compare pt above this (physical pt before correction)")
+    parser.add_argument("--ptMax", type=float, default=MAX_HW_PT * 0.5,
+                        help="Only compare pt up to this (physical pt before correction)")
+    parser.add_argument("--corrMatrixCache",
+                        help="Directory to save the HW correction matrices in, "
+                        "to share them between processes & later runs")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes to use")
+    parser.add_argument("--numBest", type=int, default=10,
+                        help="Number of best settings to print")
+    args = parser.parse_args(args=in_args)
+
+    if 'kmeans' in args.mergeAlgorithm and not cls.USE_SKLEARN:
+        raise RuntimeError("Need scikit-learn for the kmeans algorithm")
+
+    if args.text:
+        all_fits, _ = get_functions_params_textfile(args.input)
+        all_graphs = []
+    else:
+        all_fits, _, all_graphs = get_functions_graphs_params_rootfile(args.input)
+    plot_dir = os.path.join(os.path.dirname(os.path.abspath(args.output)),
+                            os.path.splitext(os.path.basename(args.output))[0])
+    if args.constantHF:
+        # for the jackknife plots
+        cu.check_dir_exists_create(plot_dir)
+    fits = get_stage2_fits(all_fits, all_graphs, args.lowPtPlateau, args.constantHF, plot_dir)
+
+    inputs = get_sweep_inputs(fits)
+    pt_mask = (inputs['pt_orig'] > args.ptMin) & (inputs['pt_orig'] <= args.ptMax)
+
+    compression_settings = get_compression_settings(args.targetNumPtBins, args.mergeAlgorithm,
+                                                    args.mergeCriterion, args.mergeCost)
+    hw_settings = list(product(args.rightShift, args.numCorrBits, args.numAddBits))
+    print "Evaluating %d pt compressions x %d HW integer settings" % (
+        len(compression_settings), len(hw_settings))
+
+    rows = run_sweep(inputs, compression_settings, hw_settings, pt_mask, args.jobs,
+                     args.corrMatrixCache)
+    write_table(rows, args.output)
+    print "Written table to", args.output
+    print_summary(rows, args.numBest)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""Unit tests for the Stage 2 LUT settings sweep."""
+
+
+import correction_LUT_stage2 as cls
+import correction_LUT_sweep as sweep
+import unittest
+import numpy as np
+
+
+class TestSweep(unittest.TestCase):
+    def test_bits_used(self):
+        self.assertEqual(sweep.calc_bits_used([0, 1023, 5]), 10)
+        self.assertEqual(sweep.calc_bits_used([0, 1024]), 11)
+        self.assertEqual(sweep.calc_bits_used([-128, 127], signed=True), 8)
+        self.assertEqual(sweep.calc_bits_used([-129, 0], signed=True), 9)
+        self.assertEqual(sweep.calc_bits_used([0, 128], signed=True), 9)
+
+    def test_compression_settings(self):
+        """Check the criterion & cost are only varied for the algorithm that uses them"""
+        settings = sweep.get_compression_settings([10, 16], ['greedy', 'kmeans', 'optimal'],
+                                                  [1.05, 1.1], ['squared', 'max'])
+        self.assertEqual(len(settings), 2 * (2 + 1 + 2))
+        for setting in settings:
+            if setting['merge_algorithm'] != 'greedy':
+                self.assertIsNone(setting['merge_criterion'])
+            if setting['merge_algorithm'] != 'optimal':
+                self.assertIsNone(setting['merge_cost'])
+
+    def test_metrics(self):
+        """Check the differences match the HW integers from calc_lut_corrections,
+        and that pt beyond the max HW pt after correction are ignored"""
+        pt_orig = np.arange(0, sweep.MAX_HW_PT * 0.5 + 0.5, 0.5)
+        hw_pt_orig = (pt_orig * 2).astype(int)
+        corr = np.array([1.2 + 0.5 * np.exp(-pt_orig / 30.), 1.1 + 0.1 * np.exp(-pt_orig / 50.)])
+        pt_post_func = pt_orig * corr
+        pt_index = np.minimum(hw_pt_orig // 64, 20)
+        corr_matrix = cls.generate_corr_matrix(max_iet=sweep.MAX_HW_PT, max_hw_correction=2**10 - 1,
+                                               right_shift=9, add_factor=0)
+        hw_pt_post_func = (pt_post_func * 2).astype(int)
+        corr_ints, add_ints, hw_pt_post = cls.calc_lut_corrections(hw_pt_orig, hw_pt_post_func,
+                                                                   pt_index, corr_matrix, 9, 8,
+                                                                   sweep.MAX_HW_PT)
+        pt_mask = pt_orig > 10
+        metrics = sweep.calc_metrics(pt_orig, pt_post_func, hw_pt_post, corr_ints, add_ints,
+                                     pt_index, pt_mask)
+        self.assertEqual([m['eta_bin'] for m in metrics], [0, 1, 'all'])
+        for eta_ind in range(2):
+            use = pt_mask & (pt_post_func[eta_ind] <= sweep.MAX_HW_PT * 0.5)
+            diff = np.abs(0.5 * hw_pt_post[eta_ind][use] - pt_post_func[eta_ind][use])
+            self.assertAlmostEqual(metrics[eta_ind]['max_abs_diff'], diff.max())
+            self.assertAlmostEqual(metrics[eta_ind]['rms_diff'], np.sqrt(np.mean(diff**2)))
+            self.assertEqual(metrics[eta_ind]['num_pt_bins'], 21)
+            self.assertLessEqual(metrics[eta_ind]['mult_bits_used'], 10)
+            self.assertLessEqual(metrics[eta_ind]['add_bits_used'], 8)
+        self.assertEqual(metrics[2]['max_abs_diff'], max(m['max_abs_diff'] for m in metrics[:2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
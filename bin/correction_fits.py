@@ -0,0 +1,194 @@
+"""
+Vectorised multi-start fitting of the correction function, without ROOT.
+
+The correction function (e.g. runCalibration.central_fit_JetMetErr) is
+evaluated in numpy by translating its ROOT formula, so any of the functions
+in runCalibration can be used. Many starting points (a Latin hypercube around
+the usual starting parameters) are then fitted to the 1/<rsp> Vs <pt L1>
+graph at once, using the batched Levenberg-Marquardt minimisation from
+response_fits. The results are ordered by chi2, and checked with the same
+criteria as runCalibration.check_sensible_function, so that the caller can
+pick the best sensible one and hand it to ROOT as the starting point of
+the final fit.
+"""
+
+
+import re
+import numpy as np
+import response_fits as rf
+
+try:
+    from scipy.special import erf
+except ImportError:
+    def erf(x):
+        """Error function, with fractional error < 1.2E-7
+        (Numerical Recipes erfc Chebyshev approximation)"""
+        z = np.abs(x)
+        t = 1. / (1. + 0.5 * z)
+        poly = (-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 +
+                t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 +
+                t * (-0.82215223 + t * 0.17087277)))))))))
+        return np.sign(x) * (1. - t * np.exp(poly))
+
+
+# Functions allowed in a formula, and their numpy equivalents
+FORMULA_FUNCTIONS = {
+    "exp": np.exp,
+    "log": np.log,
+    "log10": np.log10,
+    "pow": np.power,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "erf": erf,
+}
+
+# Same limits as runCalibration.check_sensible_function
+SENSIBLE_RANGE = (3, 1000)
+SENSIBLE_SPACING = 0.05
+SENSIBLE_LIMITS = (0.5, 10)
+
+
+def formula_to_numpy(formula):
+    """Convert a ROOT TFormula expression (e.g. a TF1 title) into a numpy function.
+
+    Parameters
+    ----------
+    formula : str
+        e.g. "[0]+[1]*TMath::Erf([2]*(log10(x)-[3]))", or "polN"
+
+    Returns
+    -------
+    callable
+        func(params, x) with params shape (number of functions, number of
+        parameters) & x shape (number of points), returning values with shape
+        (number of functions, number of points).
+
+    Raises
+    ------
+    ValueError
+        If the formula uses something not in FORMULA_FUNCTIONS.
+    """
+    formula = formula.strip()
+    pol = re.match(r"^pol(\d+)$", formula)
+    if pol:
+        expr = "+".join("p[%d]*x**%d" % (i, i) for i in range(int(pol.group(1)) + 1))
+    else:
+        expr = re.sub(r"TMath::(Erf|Exp|Log10|Log|Sqrt|Abs|Power)\b",
+                      lambda m: "pow" if m.group(1) == "Power" else m.group(1).lower(), formula)
+        expr = re.sub(r"\[p?(\d+)\]", r"p[\1]", expr)
+    unknown = set(re.findall(r"[A-Za-z_][\w:]*", expr)) - set(FORMULA_FUNCTIONS) - {"p", "x"}
+    if unknown:
+        raise ValueError("Can't convert formula %s to numpy, unknown: %s"
+                         % (formula, sorted(unknown)))
+    code = compile(expr, formula, "eval")
+
+    def func(params, x):
+        params = np.asarray(params, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        namespace = dict(FORMULA_FUNCTIONS, p=params.T[:, :, None], x=x)
+        with np.errstate(all='ignore'):
+            vals = eval(code, {"__builtins__": {}}, namespace)
+        return vals + np.zeros((len(params), len(x)))
+    return func
+
+
+def with_jacobian(values_func):
+    """Make func(params, x) returning values & numerical jacobian wrt params,
+    as needed by response_fits.levenberg_marquardt, from a values-only function"""
+    def func(params, x):
+        vals = values_func(params, x)
+        jac = np.empty(vals.shape + (params.shape[1],))
+        for i in range(params.shape[1]):
+            step = 1E-6 * np.maximum(np.abs(params[:, i]), 1E-6)
+            up, down = params.copy(), params.copy()
+            up[:, i] += step
+            down[:, i] -= step
+            with np.errstate(invalid='ignore'):
+                jac[:, :, i] = (values_func(up, x) - values_func(down, x)) / (2 * step[:, None])
+        return vals, jac
+    return func
+
+
+def make_latin_hypercube_starts(centre, n_starts, rel_width=0.5, abs_width=1., seed=0):
+    """Make starting parameters on a Latin hypercube around centre.
+
+    Each parameter is sampled in centre +/- max(rel_width * |centre|, abs_width),
+    with one sample in each of n_starts equal strata. The first start is
+    centre itself.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (n_starts, number of parameters)
+    """
+    centre = np.asarray(centre, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    n_params = len(centre)
+    strata = np.array([rng.permutation(n_starts) for _ in range(n_params)]).T
+    u = (strata + rng.uniform(size=(n_starts, n_params))) / n_starts
+    width = np.maximum(rel_width * np.abs(centre), abs_width)
+    starts = centre + (2 * u - 1) * width
+    starts[0] = centre
+    return starts
+
+
+def check_sensible_batch(func, params, lim=SENSIBLE_RANGE, spacing=SENSIBLE_SPACING,
+                         limits=SENSIBLE_LIMITS, chunk_size=50):
+    """Vectorised runCalibration.check_sensible_function: check each function
+    stays within limits (no large jumps or poles) over lim.
+
+    Returns
+    -------
+    numpy.ndarray
+        bool for each row of params
+    """
+    x = np.linspace(lim[0], lim[1], int((lim[1] - lim[0]) / spacing) + 1)
+    sensible = np.zeros(len(params), dtype=bool)
+    for start in range(0, len(params), chunk_size):
+        vals = func(params[start:start + chunk_size], x)
+        with np.errstate(invalid='ignore'):
+            # NaN is never sensible
+            sensible[start:start + chunk_size] = np.all((vals >= limits[0]) & (vals <= limits[1]),
+                                                        axis=1)
+    return sensible
+
+
+def fit_multistart(formula, x, y, errors, start_params, n_starts, seed=0, max_iter=500):
+    """Fit the correction function from many starting points at once.
+
+    Parameters
+    ----------
+    formula : str
+        ROOT formula of the function, see formula_to_numpy()
+    x, y, errors : numpy.ndarray
+        Graph points to fit, and their y errors.
+    start_params : list[float]
+        Centre of the starting points, see make_latin_hypercube_starts()
+    n_starts : int
+        Number of starting points.
+    seed : int, optional
+        Seed for the starting points.
+    max_iter : int, optional
+        Maximum number of iterations for each fit.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        params, errors, chi2, status (see response_fits) & sensible for each
+        start, ordered by chi2 (fits with status -1 or 1 last).
+    """
+    values_func = formula_to_numpy(formula)
+    x = np.asarray(x, dtype=np.float64)
+    starts = make_latin_hypercube_starts(start_params, n_starts, seed=seed)
+    y = np.tile(np.asarray(y, dtype=np.float64), (n_starts, 1))
+    errors = np.tile(np.asarray(errors, dtype=np.float64), (n_starts, 1))
+    good = np.ones((n_starts, len(x)), dtype=bool)
+    params, param_errors, chi2, status = rf.levenberg_marquardt(with_jacobian(values_func), starts,
+                                                                x, y, errors, good,
+                                                                max_iter=max_iter)
+    failed = (status == -1) | (status == 1) | ~np.isfinite(chi2)
+    order = np.lexsort((np.where(failed, np.inf, chi2), failed))
+    params, param_errors = params[order], param_errors[order]
+    chi2, status = chi2[order], status[order]
+    return dict(params=params, errors=param_errors, chi2=chi2, status=status,
+                sensible=check_sensible_batch(values_func, params))
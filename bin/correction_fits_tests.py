@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Unit tests for the numpy multi-start correction function fitting."""
+
+
+import correction_fits as cf
+import unittest
+import numpy as np
+
+
+JETMETERR = "[0]+[1]*TMath::Erf([2]*(log10(x)-[3])+[4]*exp([5]*(log10(x)-[6])*(log10(x)-[6])))"
+
+
+class TestFormula(unittest.TestCase):
+    def test_jetmeterr(self):
+        """Check the converted formula matches writing it out by hand"""
+        params = np.array([[1.3, -0.25, 1.5, 1.8, 0.1, -2., 1.5], [1.1, -0.1, 1., 1.5, 0., 0., 0.]])
+        x = np.linspace(5, 500, 50)
+        vals = cf.formula_to_numpy(JETMETERR)(params, x)
+        for p, v in zip(params, vals):
+            logx = np.log10(x)
+            expected = p[0] + p[1] * cf.erf(p[2] * (logx - p[3]) +
+                                            p[4] * np.exp(p[5] * (logx - p[6])**2))
+            np.testing.assert_allclose(v, expected)
+
+    def test_pol(self):
+        x = np.array([1., 2., 3.])
+        np.testing.assert_allclose(cf.formula_to_numpy("pol0")(np.array([[1.2]]), x), [[1.2] * 3])
+        np.testing.assert_allclose(cf.formula_to_numpy("pol1")(np.array([[1., 2.]]), x),
+                                   [[3., 5., 7.]])
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            cf.formula_to_numpy("[0]+TMath::Landau(x,[1],[2])")
+
+
+class TestMultistart(unittest.TestCase):
+    def test_latin_hypercube(self):
+        """Check one start per stratum for each parameter, and first start is the centre"""
+        centre = [1., -100., 0.]
+        starts = cf.make_latin_hypercube_starts(centre, 20, rel_width=0.5, abs_width=1.)
+        np.testing.assert_array_equal(starts[0], centre)
+        for i, width in enumerate([0.5, 50., 1.]):
+            strata = np.floor((starts[1:, i] - centre[i] + width) / (2 * width) * 20)
+            self.assertEqual(len(np.unique(strata)), 19)
+
+    def test_fit(self):
+        """Check the best fit is sensible & close to the true curve, from bad starting params"""
+        true = np.array([[1.3, -0.25, 1.5, 1.8, 0.1, -2., 1.5]])
+        func = cf.formula_to_numpy(JETMETERR)
+        x = np.logspace(np.log10(30), np.log10(600), 40)
+        y = func(true, x)[0] + np.random.RandomState(1).normal(0, 0.01, len(x))
+        results = cf.fit_multistart(JETMETERR, x, y, np.full(len(x), 0.01),
+                                    [1.4036, -1398000, 0, 0.2249, 0, -2.926, 1.175], 50)
+        self.assertEqual(results["status"][0], 0)
+        self.assertTrue(results["sensible"][0])
+        self.assertTrue(np.all(np.diff(results["chi2"][results["status"] == 0]) >= 0))
+        self.assertLess(results["chi2"][0], 2 * len(x))
+        np.testing.assert_allclose(func(results["params"][:1], x)[0], func(true, x)[0], atol=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
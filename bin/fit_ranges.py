@@ -0,0 +1,234 @@
+"""
+Choice of the range to fit the correction function over, for many
+1/<rsp> Vs <pt L1> graphs (e.g. all eta bins) at once.
+
+The lower end of the range is at the maximum correction value in the first
+half of the graph, to avoid the turnover at low pT (& the 'flick' at high pT
+in HF). The upper end is where the gradient of the graph goes from -ve to +ve,
+smoothed with a moving average over more & more points until one crossing
+is found, or at the minimum correction value if there's no crossing.
+
+The ranges for a set of graphs are stored as a table, one row per eta bin:
+eta_min, eta_max, min_ind & max_ind (indices of the first & last graph
+points used), fit_min, fit_max, n_sample (moving average size used, None
+if no crossing found), found_minimum & override (if set by hand).
+Tables are saved as JSON, so they can be reused (or edited by hand),
+e.g. by runCalibration.py --redo-correction-fit.
+
+A table row can also have only some of RANGE_KEYS, to override part of
+the range found automatically for a troublesome eta bin, e.g.
+{"eta_min": 2.5, "eta_max": 2.964, "min_ind": 0, "fit_min": 40.0, "max_ind": 80}
+(see merge_table_row & fit_range_overrides.json).
+"""
+
+
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+
+# Moving average sizes to try, in order, to find the gradient crossing
+N_SAMPLE_RANGE = (5, 12)
+
+# Table row keys that set the fit range
+RANGE_KEYS = ("min_ind", "max_ind", "fit_min", "fit_max")
+
+
+def get_table_filename(output_filename):
+    """Default JSON filename for the fit ranges table of a runCalibration output file"""
+    return os.path.splitext(output_filename)[0] + "_fit_ranges.json"
+
+
+def table_key(eta_min, eta_max):
+    return "%g_%g" % (eta_min, eta_max)
+
+
+def _pad(arrays, fill=np.nan):
+    """Stack 1D arrays of different lengths into a 2D array, padded with fill"""
+    lengths = np.array([len(arr) for arr in arrays])
+    padded = np.full((len(arrays), lengths.max()), fill)
+    for row, arr in zip(padded, arrays):
+        row[:len(arr)] = arr
+    return padded, lengths
+
+
+def moving_average(arr, n):
+    """Moving averages of n consecutive points along the last axis,
+    so the last axis has length arr.shape[-1] + 1 - n"""
+    width = arr.shape[-1] - n + 1
+    total = arr[..., :width].copy()
+    for i in range(1, n):
+        total += arr[..., i:i + width]
+    return total / n
+
+
+def calc_gradient(y, lengths):
+    """np.gradient(row, 1) of the first lengths[i] points in each row of y,
+    NaN after that"""
+    rows = np.arange(len(y))
+    grad = np.full_like(y, np.nan)
+    grad[:, 1:-1] = 0.5 * (y[:, 2:] - y[:, :-2])
+    grad[:, 0] = y[:, 1] - y[:, 0]
+    grad[rows, lengths - 1] = y[rows, lengths - 1] - y[rows, lengths - 2]
+    grad[np.arange(y.shape[1]) >= lengths[:, None]] = np.nan
+    return grad
+
+
+def calc_crossings(arr, lengths):
+    """Find where each row crosses 0 from -ve to +ve, ignoring single point peaks.
+
+    Looks at points in groups of 4, and finds the first group where the first
+    2 points < 0, and the next 2 points > 0 (just the next 1 at the end of
+    the row).
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray, numpy.ndarray
+        Whether a crossing was found in each row, index of the point in the
+        group closest to 0, and its absolute value.
+    """
+    n_rows, width = arr.shape
+    if width < 3:
+        return np.zeros(n_rows, dtype=bool), np.zeros(n_rows, dtype=int), np.zeros(n_rows)
+    # group for index i is (-arr[i-2], -arr[i-1], arr[i], arr[i+1])
+    ind = np.arange(2, width)
+    padded = np.append(arr, np.full((n_rows, 1), np.inf), axis=1)
+    nxt = np.where(ind + 1 < lengths[:, None], padded[:, 3:], np.inf)
+    groups = np.stack([-arr[:, :-2], -arr[:, 1:-1], arr[:, 2:], nxt], axis=-1)
+    with np.errstate(invalid='ignore'):
+        crossing = np.all(groups > 0, axis=-1) & (ind < lengths[:, None])
+    found = crossing.any(axis=1)
+    first = np.argmax(crossing, axis=1)
+    group = groups[np.arange(n_rows), first]
+    closest = np.argmin(group, axis=1)
+    return found, first + closest, group[np.arange(n_rows), closest]
+
+
+def find_fit_ranges(xs, ys, n_sample_range=N_SAMPLE_RANGE):
+    """Find the correction function fit range for many graphs at once.
+
+    Parameters
+    ----------
+    xs, ys : list[numpy.ndarray]
+        x & y values of each graph, in increasing x.
+    n_sample_range : (int, int), optional
+        Moving average sizes to try, as range() arguments.
+
+    Returns
+    -------
+    list[OrderedDict]
+        min_ind, max_ind, fit_min, fit_max, n_sample & found_minimum
+        for each graph, see module docstring.
+
+    Raises
+    ------
+    ValueError
+        If a graph has fewer than 2 points.
+    """
+    x, lengths = _pad([np.asarray(arr, dtype=np.float64) for arr in xs])
+    y, _ = _pad([np.asarray(arr, dtype=np.float64) for arr in ys])
+    if np.any(lengths < 2):
+        raise ValueError("Need at least 2 points in each graph to find the fit range")
+    rows = np.arange(len(x))
+    cols = np.arange(x.shape[1])
+    in_graph = cols < lengths[:, None]
+
+    # Lower bound: the maximum correction in the first half of the graph,
+    # unless it's the last point (i.e. no turnover)
+    first_half = np.where(cols < (lengths // 2)[:, None], y, -np.inf)
+    max_corr_pt = x[rows, np.argmax(first_half, axis=1)]
+    x_min = np.where(in_graph, x, np.inf).min(axis=1)
+    fit_min = np.where(max_corr_pt != x[rows, lengths - 1], np.maximum(x_min, max_corr_pt), x_min)
+    with np.errstate(invalid='ignore'):
+        min_ind = np.argmax(in_graph & (x >= fit_min[:, None]), axis=1)
+
+    # Upper bound: the first crossing of the smoothed gradient, trying larger
+    # moving averages until one is found
+    grad = calc_gradient(y, lengths)
+    n_sample = np.zeros(len(x), dtype=int)
+    intercept_ind = np.zeros(len(x), dtype=int)
+    x_intercept = np.zeros(len(x))
+    for n in range(*n_sample_range):
+        todo = n_sample == 0
+        if not todo.any() or x.shape[1] < n:
+            break
+        found, ind, _ = calc_crossings(moving_average(grad[todo], n), lengths[todo] - n + 1)
+        new = np.flatnonzero(todo)[found]
+        n_sample[new] = n
+        intercept_ind[new] = ind[found]
+        x_intercept[new] = moving_average(x[new], n)[np.arange(len(new)), ind[found]]
+
+    # A crossing at the very first point isn't used
+    found_minimum = (n_sample > 0) & (intercept_ind > 0)
+    with np.errstate(invalid='ignore'):
+        closest_ind = np.argmin(np.where(in_graph, np.abs(x - x_intercept[:, None]), np.inf),
+                                axis=1)
+        min_corr_ind = np.argmin(np.where(in_graph, y, np.inf), axis=1)
+    max_ind = np.where(found_minimum, closest_ind, min_corr_ind)
+    fit_max = x[rows, max_ind]
+
+    return [OrderedDict([("min_ind", int(min_ind[i])), ("max_ind", int(max_ind[i])),
+                         ("fit_min", float(fit_min[i])), ("fit_max", float(fit_max[i])),
+                         ("n_sample", int(n_sample[i]) if n_sample[i] else None),
+                         ("found_minimum", bool(found_minimum[i]))])
+            for i in rows]
+
+
+def apply_override(fit_range, x, override):
+    """Update a fit range with values set by hand.
+
+    If max_ind (min_ind) is set but not fit_max (fit_min), fit_max (fit_min)
+    is set to the x value of that point.
+    """
+    fit_range.update(override)
+    if "max_ind" in override and "fit_max" not in override:
+        fit_range["fit_max"] = float(x[override["max_ind"]])
+    if "min_ind" in override and "fit_min" not in override:
+        fit_range["fit_min"] = float(x[override["min_ind"]])
+    fit_range["override"] = True
+    return fit_range
+
+
+def is_complete(row):
+    """Check if a fit range table row sets the whole range, rather than
+    overriding part of it"""
+    return all(key in row for key in RANGE_KEYS)
+
+
+def merge_table_row(fit_range, x, row):
+    """Get the fit range to use for a graph, from the one found by
+    find_fit_ranges & the graph's fit range table row (None if not in the table).
+
+    A complete row is used as it is, otherwise the RANGE_KEYS in it
+    override the found range, see apply_override.
+    """
+    if row is None:
+        return fit_range
+    if is_complete(row):
+        return OrderedDict(row)
+    return apply_override(fit_range, x, OrderedDict((key, row[key]) for key in RANGE_KEYS
+                                                    if key in row))
+
+
+def save_table(rows, filename):
+    """Save fit range table rows (each with eta_min & eta_max) as JSON"""
+    with open(filename, "w") as f:
+        json.dump(rows, f, indent=2)
+
+
+def index_table(rows):
+    """Index fit range table rows by table_key(eta_min, eta_max)"""
+    return OrderedDict((table_key(row["eta_min"], row["eta_max"]), row) for row in rows)
+
+
+def load_table(filename):
+    """Load fit range table saved by save_table
+
+    Returns
+    -------
+    OrderedDict
+        table_key(eta_min, eta_max) : row
+    """
+    with open(filename) as f:
+        return index_table(json.load(f, object_pairs_hook=OrderedDict))
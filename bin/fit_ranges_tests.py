@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Unit tests for the vectorised correction fit range finding.
+
+Compares against the original one graph at a time version from
+runCalibration.setup_fit.
+"""
+
+
+import os
+import fit_ranges as fr
+import unittest
+import numpy as np
+from collections import OrderedDict
+
+
+def find_fit_range_loop(xarr, yarr):
+    """Original fit range finding from runCalibration.setup_fit"""
+    xarr, yarr = list(xarr), list(yarr)
+    fit_min = min(xarr)
+    max_corr = max(yarr[:len(yarr) / 2])
+    max_corr_pt = xarr[yarr.index(max_corr)]
+    fit_min = max(fit_min, max_corr_pt) if max_corr_pt != xarr[-1] else fit_min
+    min_ind = next(i for i, x in enumerate(xarr) if x >= fit_min)
+
+    def moving_average(arr, n):
+        return np.array([np.mean(arr[i:i + n]) for i in range(0, len(arr) - n + 1)])
+
+    def calc_crossing(arr):
+        for i in range(2, len(arr)):
+            group = np.concatenate((-1 * arr[i - 2: i], arr[i: i + 2]))
+            if np.all(group > 0):
+                return i - 2 + list(group).index(np.min(group)), np.min(group)
+        return None, None
+
+    grad = np.gradient(yarr, 1)
+    n_sample = 5
+    intercept_ind, intercept = None, None
+    while not intercept_ind and not intercept:
+        x_ave = moving_average(xarr, n_sample)
+        intercept_ind, intercept = calc_crossing(moving_average(grad, n_sample))
+        n_sample += 1
+        if n_sample == 12:
+            break
+
+    if intercept and intercept_ind:
+        max_ind = int(np.argmin(np.abs(np.array(xarr) - x_ave[intercept_ind])))
+    else:
+        max_ind = yarr.index(min(yarr))
+    return min_ind, max_ind, fit_min, xarr[max_ind]
+
+
+class TestFitRanges(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.xs, self.ys = [], []
+        for i in range(400):
+            n = rng.randint(6, 60)
+            x = np.sort(rng.uniform(10, 1000, n))
+            if i % 3 == 0:
+                # turnover at low & high pt
+                y = 1.2 + 0.3 * np.cos(np.log(x) * 2) + rng.normal(0, 0.01, n)
+            elif i % 3 == 1:
+                y = 1 + 0.5 * np.exp(-x / 100.) + rng.normal(0, 0.05, n)
+            else:
+                y = rng.normal(1, 0.1, n)
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def test_matches_loop(self):
+        """Check same ranges as the original version, for graphs of different lengths at once"""
+        results = fr.find_fit_ranges(self.xs, self.ys)
+        self.assertTrue(any(r["found_minimum"] for r in results))
+        self.assertFalse(all(r["found_minimum"] for r in results))
+        for x, y, result in zip(self.xs, self.ys, results):
+            expected = (result["min_ind"], result["max_ind"], result["fit_min"], result["fit_max"])
+            self.assertEqual(find_fit_range_loop(x, y), expected)
+
+    def test_override(self):
+        x = self.xs[0]
+        found = fr.find_fit_ranges([x], [self.ys[0]])[0]
+        fit_range = fr.apply_override(found, x, dict(min_ind=0, max_ind=3))
+        self.assertEqual((fit_range["fit_min"], fit_range["fit_max"]), (x[0], x[3]))
+        self.assertTrue(fit_range["override"])
+
+    def test_merge_table_row(self):
+        """Check complete table rows are used as they are, & partial ones override"""
+        x = self.xs[0]
+        found = fr.find_fit_ranges([x], [self.ys[0]])[0]
+        self.assertEqual(fr.merge_table_row(found, x, None), found)
+        complete = OrderedDict([("min_ind", 1), ("max_ind", 2), ("fit_min", 5.), ("fit_max", 6.)])
+        self.assertEqual(fr.merge_table_row(OrderedDict(found), x, complete), complete)
+        partial = OrderedDict([("eta_min", 2.5), ("eta_max", 2.964), ("min_ind", 0),
+                               ("fit_min", 4.), ("max_ind", 3)])
+        merged = fr.merge_table_row(OrderedDict(found), x, partial)
+        self.assertEqual((merged["min_ind"], merged["max_ind"]), (0, 3))
+        self.assertEqual((merged["fit_min"], merged["fit_max"]), (4., x[3]))
+        self.assertEqual(merged["n_sample"], found["n_sample"])
+        self.assertTrue(merged["override"])
+
+    def test_overrides_file(self):
+        """Check the overrides shipped for troublesome eta bins are partial rows"""
+        table = fr.load_table(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           "fit_range_overrides.json"))
+        self.assertIn(fr.table_key(2.5, 2.964), table)
+        self.assertFalse(any(fr.is_complete(row) for row in table.values()))
+
+    def test_too_short(self):
+        with self.assertRaises(ValueError):
+            fr.find_fit_ranges([[1., 2.], [1.]], [[1., 2.], [1.]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+This script takes as input the output file from RunMatcher, and makes a copy
+of the pairs tree with the entries sorted by |eta| bin, then numPUVertices.
+It also stores a small index tree (valid_index), with the first entry and
+number of entries for each (|eta| bin, PU value) cell.
+
+This way, selecting an eta bin (& PU range) only needs to read a few
+contiguous entry ranges, instead of the whole tree. runCalibration.py,
+checkCalibration.py and makeResolutionPlots.py automatically use the index
+if the input file has one. Note that the index eta bins don't have to match
+the ones used in those scripts - it is just slower if they don't.
+
+Only the pairs tree is copied to the output file.
+
+Usage: see
+python indexPairs.py -h
+"""
+
+import ROOT
+import os
+import sys
+import argparse
+from array import array
+import numpy as np
+import binning
+import common_utils as cu
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(1)
+
+
+def make_index(abs_eta, pu, eta_edges):
+    """Work out the new entry order, and the index for it.
+
+    Cell i holds pairs with eta_edges[i] <= |eta| < eta_edges[i+1],
+    with an extra cell for |eta| >= eta_edges[-1]. Within a cell, pairs are
+    sorted by PU, keeping the original order for pairs with the same PU.
+
+    Parameters
+    ----------
+    abs_eta : numpy.ndarray
+        |eta| of each pair.
+    pu : numpy.ndarray
+        Number of PU vertices for each pair.
+    eta_edges : list[float]
+        |eta| bin edges.
+
+    Returns
+    -------
+    numpy.ndarray, dict{str : numpy.ndarray}
+        Original entry number for each new entry, and the index columns
+        (eta_min, eta_max, pu, first, n), one row per (eta cell, PU value).
+    """
+    eta_edges = np.asarray(eta_edges, dtype=np.float64)
+    cells = np.digitize(abs_eta, eta_edges) - 1
+    # lexsort uses last key as primary, and is stable
+    order = np.lexsort((pu, cells))
+    sorted_cells, sorted_pu = cells[order], pu[order]
+
+    n_pairs = len(order)
+    if n_pairs == 0:
+        starts = np.array([], dtype=np.int64)
+    else:
+        changes = np.flatnonzero((np.diff(sorted_cells) != 0) | (np.diff(sorted_pu) != 0)) + 1
+        starts = np.concatenate(([0], changes)).astype(np.int64)
+    ns = np.diff(np.append(starts, n_pairs))
+
+    cell_lows = np.append(eta_edges, eta_edges[-1])
+    cell_highs = np.append(eta_edges[1:], [np.inf, np.inf])
+    start_cells = sorted_cells[starts]
+    index = {
+        "eta_min": cell_lows[start_cells],
+        "eta_max": cell_highs[start_cells],
+        "pu": sorted_pu[starts],
+        "first": starts,
+        "n": ns
+    }
+    return order, index
+
+
+def write_index_tree(index, index_name=cu.PAIRS_INDEX_NAME):
+    """Write the index columns as a TTree into the current directory."""
+    index_tree = ROOT.TTree(index_name, "Entry ranges for each (|eta| bin, PU) cell")
+    eta_min = array('d', [0])
+    eta_max = array('d', [0])
+    pu = array('d', [0])
+    first = array('l', [0])
+    n = array('l', [0])
+    index_tree.Branch("eta_min", eta_min, "eta_min/D")
+    index_tree.Branch("eta_max", eta_max, "eta_max/D")
+    index_tree.Branch("pu", pu, "pu/D")
+    index_tree.Branch("first", first, "first/L")
+    index_tree.Branch("n", n, "n/L")
+    for row in xrange(len(index["first"])):
+        eta_min[0] = index["eta_min"][row]
+        # can't store inf nicely, so use something big instead
+        eta_max[0] = min(index["eta_max"][row], 1E30)
+        pu[0] = index["pu"][row]
+        first[0] = int(index["first"][row])
+        n[0] = int(index["n"][row])
+        index_tree.Fill()
+    index_tree.Write()
+
+
+def index_pairs(input_filename, output_filename, eta_edges, tree_name="valid", max_memory=2000):
+    """Make a copy of the pairs tree sorted by (|eta| bin, PU), plus index tree.
+
+    Parameters
+    ----------
+    input_filename : str
+        Pairs file from RunMatcher.
+    output_filename : str
+        Output file for sorted tree & index.
+    eta_edges : list[float]
+        |eta| bin edges for the index.
+    tree_name : str, optional
+        Name of pairs tree.
+    max_memory : int, optional
+        Max memory (in MB) to use for holding the input tree in memory,
+        since it is read in a random order.
+    """
+    input_file = cu.open_root_file(input_filename, "READ")
+    tree = cu.get_from_file(input_file, tree_name)
+
+    has_pu = hasattr(tree, "numPUVertices")
+    variables = ["TMath::Abs(eta)", "numPUVertices"] if has_pu else ["TMath::Abs(eta)"]
+    arrays = cu.get_tree_arrays(tree, variables)
+    abs_eta = arrays["TMath::Abs(eta)"]
+    if has_pu:
+        pu = arrays["numPUVertices"]
+    else:
+        print "No numPUVertices branch, only indexing in |eta|"
+        pu = np.zeros_like(abs_eta)
+
+    order, index = make_index(abs_eta, pu, eta_edges)
+    print "Made index with %d cells" % len(index["first"])
+
+    output_file = cu.open_root_file(output_filename, "RECREATE")
+    output_file.cd()
+    new_tree = tree.CloneTree(0)
+    tree.LoadBaskets(max_memory * 1024 * 1024)
+    n_pairs = len(order)
+    for ind, entry in enumerate(order):
+        if ind % 1000000 == 0:
+            print "Copying pair %d / %d" % (ind, n_pairs)
+        tree.GetEntry(int(entry))
+        new_tree.Fill()
+    new_tree.Write()
+    write_index_tree(index)
+
+    output_file.Close()
+    input_file.Close()
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=cu.CustomFormatter)
+    parser.add_argument("input", help="input ROOT filename, from RunMatcher")
+    parser.add_argument("output", nargs="?",
+                        help="output ROOT filename. Default is input filename with _indexed")
+    parser.add_argument("--maxMemory", type=int, default=2000,
+                        help="Max memory (in MB) to use to hold the input tree")
+    args = parser.parse_args(args=in_args)
+
+    if not args.output:
+        args.output = os.path.splitext(args.input)[0] + "_indexed.root"
+    if os.path.realpath(args.input) == os.path.realpath(args.output):
+        raise RuntimeError("Output file must be different to input file")
+    print "IN:", args.input
+    print "OUT:", args.output
+
+    index_pairs(args.input, args.output, binning.eta_bins, max_memory=args.maxMemory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
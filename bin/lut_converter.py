@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Convert LUTs between the human-readable text, binary (see binary_lut.py),
+MIF (see mif_maker.py) & programmable XML (see programmable_lut_maker.py)
+formats, and compare them.
+
+1) pack LUTs into one binary file, e.g. the ones made by
+correction_LUT_plot.py --stage2 (the table names are taken from the filenames,
+e.g. my_lut_add_mult.txt -> add_mult):
+python lut_converter.py pack my_lut.lut my_lut/my_lut_*.txt \\
+    --rightShift 9 --numAddBits 8 --numMultBits 10
+
+2) unpack the tables in a binary file into another format, e.g. to make
+my_lut_eta.mif, my_lut_pt.mif, ...:
+python lut_converter.py unpack my_lut.lut my_lut --format mif
+
+3) compare the values of 2 LUTs (any format, or all the tables in 2 binary files):
+python lut_converter.py diff my_lut.lut other_lut.lut
+
+MIF & XML files only store the values, so the address & data bits are
+worked out from the number & size of values when packing them.
+MIF, XML & binary files have the values in address order, with signed values
+(e.g. the addend LUT) as two's complement, whereas text LUTs are written
+as signed ints.
+
+Usage: see
+python lut_converter.py -h
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+from collections import OrderedDict
+import binary_lut
+import mif_maker
+import programmable_lut_maker as plm
+
+
+def read_any_lut(lut_filename):
+    """Read a LUT table from a text, single-table binary, MIF or XML file,
+    see binary_lut.read_lut"""
+    ext = os.path.splitext(lut_filename)[1].lower()
+    if ext == ".mif":
+        values = mif_maker.read_mif(lut_filename)
+    elif ext == ".xml":
+        values = plm.read_xml_lut(lut_filename)
+    else:
+        return binary_lut.read_lut(lut_filename)
+    return dict(values=np.array(values, dtype=np.int64),
+                num_address_bits=binary_lut.calc_num_bits(len(values) - 1),
+                num_data_bits=binary_lut.calc_num_bits(values))
+
+
+def get_stage2_metadata(tables, right_shift=None, num_add_bits=None, num_mult_bits=None):
+    """Get the metadata to store with a set of Stage 2 LUTs:
+    the number of compressed eta & pt bins, and the HW integer settings"""
+    metadata = OrderedDict()
+    if 'eta' in tables:
+        metadata['num_eta_bins'] = len(np.unique(tables['eta']['values']))
+    if 'pt' in tables:
+        metadata['num_pt_bins'] = len(np.unique(tables['pt']['values']))
+    for key, value in [('right_shift', right_shift), ('num_add_bits', num_add_bits),
+                       ('num_mult_bits', num_mult_bits)]:
+        if value is not None:
+            metadata[key] = value
+    return metadata
+
+
+def pack(output_filename, input_filenames, names=None, **kwargs):
+    """Pack text/MIF/XML LUTs into one binary LUT file.
+    kwargs are passed to get_stage2_metadata"""
+    names = names or [binary_lut.get_table_name(f) for f in input_filenames]
+    if len(names) != len(input_filenames) or len(set(names)) != len(names):
+        raise RuntimeError("Need a different name for each input LUT, not %s" % names)
+    tables = OrderedDict()
+    for name, input_filename in zip(names, input_filenames):
+        print "Adding", input_filename, "as", name
+        tables[name] = read_any_lut(input_filename)
+    binary_lut.write_binary_lut(output_filename, tables, get_stage2_metadata(tables, **kwargs))
+
+
+def unpack(input_filename, output_base, output_format):
+    """Write each table in a binary LUT file to <output_base>_<table name>.<output_format>"""
+    tables, metadata = binary_lut.read_binary_lut(input_filename)
+    print "Metadata:", metadata
+    for name, table in tables.iteritems():
+        if output_format == "xml" and name != "add_mult" and len(tables) > 1:
+            # only the addend + multiplier LUT is programmable
+            print "Skipping table", name, "for XML"
+            continue
+        output_filename = "%s_%s.%s" % (output_base, name, output_format)
+        print "Writing", output_filename
+        if output_format == "txt":
+            binary_lut.write_text_lut(output_filename, table,
+                                      description="%s LUT from %s" % (name, input_filename))
+        elif output_format == "mif":
+            mif_maker.write_mif(table['raw'], output_filename)
+        else:
+            settings = OrderedDict(plm.SETTINGS)
+            settings['jetEnergyCalibLUT'] = [int(x) for x in table['raw']]
+            plm.write_xml(settings, output_filename)
+
+
+def diff_tables(table_a, table_b, max_print=10):
+    """Print the addresses where 2 LUT tables differ.
+
+    Returns
+    -------
+    int
+        Number of addresses that differ. Addresses in only one table count
+        as different.
+    """
+    values_a, values_b = np.asarray(table_a['values']), np.asarray(table_b['values'])
+    # MIF & XML only have two's complement, so compare signed tables that way
+    if (values_a < 0).any() and not (values_b < 0).any():
+        values_a = binary_lut.to_unsigned(values_a, table_a['num_data_bits'])
+    elif (values_b < 0).any() and not (values_a < 0).any():
+        values_b = binary_lut.to_unsigned(values_b, table_b['num_data_bits'])
+    size = min(len(values_a), len(values_b))
+    different = np.flatnonzero(values_a[:size] != values_b[:size])
+    num_different = len(different) + abs(len(values_a) - len(values_b))
+    if len(values_a) != len(values_b):
+        print "  Different sizes: %d vs %d" % (len(values_a), len(values_b))
+    for address in different[:max_print]:
+        print "  address %d: %d vs %d" % (address, values_a[address], values_b[address])
+    if len(different) > max_print:
+        print "  ..."
+    return num_different
+
+
+def diff(filename_a, filename_b, max_print=10):
+    """Compare the values in 2 LUT files. If both are binary files, all
+    the tables with the same names are compared.
+
+    Returns
+    -------
+    int
+        Total number of addresses that differ.
+    """
+    if binary_lut.is_binary_lut(filename_a) and binary_lut.is_binary_lut(filename_b):
+        tables_a, _ = binary_lut.read_binary_lut(filename_a)
+        tables_b, _ = binary_lut.read_binary_lut(filename_b)
+        for name in set(tables_a.keys()) ^ set(tables_b.keys()):
+            print "Table %s only in %s" % (name, filename_a if name in tables_a else filename_b)
+        names = [name for name in tables_a if name in tables_b]
+    else:
+        tables_a = {None: read_any_lut(filename_a)}
+        tables_b = {None: read_any_lut(filename_b)}
+        names = [None]
+    total = 0
+    for name in names:
+        print "Table %s:" % name if name else "Values:"
+        num_different = diff_tables(tables_a[name], tables_b[name], max_print)
+        print "  %d different" % num_different
+        total += num_different
+    return total
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    pack_parser = subparsers.add_parser("pack", help="Pack LUTs into a binary LUT file")
+    pack_parser.add_argument("output", help="output binary LUT filename")
+    pack_parser.add_argument("input", nargs="+", help="input LUT filenames (text, .mif or .xml)")
+    pack_parser.add_argument("--names", nargs="+",
+                             help="Table name for each input LUT (default from the filenames)")
+    pack_parser.add_argument("--rightShift", type=int,
+                             help="Right shift after the LUT multiplier, to store with the LUTs")
+    pack_parser.add_argument("--numAddBits", type=int,
+                             help="Number of bits for the LUT addend, to store with the LUTs")
+    pack_parser.add_argument("--numMultBits", type=int,
+                             help="Number of bits for the LUT multiplier, to store with the LUTs")
+
+    unpack_parser = subparsers.add_parser(
+        "unpack", help="Write the tables in a binary LUT file to another format")
+    unpack_parser.add_argument("input", help="input binary LUT filename")
+    unpack_parser.add_argument("output",
+                               help="output base filename, <output>_<table name>.<format>")
+    unpack_parser.add_argument("--format", choices=["txt", "mif", "xml"], default="txt",
+                               help="output format")
+
+    diff_parser = subparsers.add_parser("diff", help="Compare the values in 2 LUTs")
+    diff_parser.add_argument("input", nargs=2, help="LUT filenames (text, binary, .mif or .xml)")
+    diff_parser.add_argument("--maxPrint", type=int, default=10,
+                             help="Max number of different addresses to print per table")
+
+    args = parser.parse_args(args=in_args)
+
+    if args.command == "pack":
+        if os.path.realpath(args.output) in [os.path.realpath(f) for f in args.input]:
+            raise RuntimeError("Output file must be different to input files")
+        pack(args.output, args.input, args.names, right_shift=args.rightShift,
+             num_add_bits=args.numAddBits, num_mult_bits=args.numMultBits)
+        print "OUT:", args.output
+    elif args.command == "unpack":
+        unpack(args.input, args.output, args.format)
+    else:
+        return 1 if diff(args.input[0], args.input[1], args.maxPrint) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,8 +35,13 @@ from pprint import pprint
 from itertools import izip
 import os
 import argparse
+from collections import OrderedDict
 import binning
 from binning import pairwise
+import common_utils as cu
+import response_fits as rf
+import profiling
+from profiling import PROFILER
 
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -55,6 +60,156 @@ def check_var_stored(tree, var):
     """Check to see if TTree has branch with name var"""
     return tree.GetListOfBranches().FindObject(var)
 
+def get_resolution_expressions(tree):
+    """Get the TTree::Draw expression for each quantity used in the resolution
+    plots. Old pairs files don't store ptRef, ptDiff, resL1 or resRef,
+    so these are constructed from pt & rsp instead."""
+    def stored_or(var, expr):
+        return var if check_var_stored(tree, var) else expr
+
+    exprs = OrderedDict()
+    exprs["pt"] = "pt"
+    # - or should it be pt * rsp for old style rsp?
+    exprs["ptRef"] = ptRef = stored_or("ptRef", "(pt/rsp)")
+    exprs["ptDiff"] = stored_or("ptDiff", "(pt-%s)" % ptRef)
+    exprs["resL1"] = stored_or("resL1", "(pt-%s)/pt" % ptRef)
+    exprs["resRef"] = stored_or("resRef", "(pt-%s)/%s" % (ptRef, ptRef))
+    return exprs
+
+
+def get_cut_string(absetamin, absetamax, pt_max):
+    """Get the eta bin & pt cut string for the 2D resolution plots"""
+    eta_cut = " TMath::Abs(eta)<%g && TMath::Abs(eta) > %g " % (absetamax, absetamin)
+    pt_cut_all = "pt < %g" % (pt_max)
+    return eta_cut + "&&" + pt_cut_all
+
+
+def get_entry_ranges(inputfile, absetamin, absetamax):
+    """If the pairs file is indexed by indexPairs.py, get the entry ranges
+    for this eta bin, otherwise None (i.e. use all entries)"""
+    index = cu.get_pairs_index(inputfile)
+    if index is None:
+        return None
+    return cu.get_index_entry_ranges(index, absetamin, absetamax)
+
+
+@PROFILER.timed("read_pairs")
+def get_resolution_pairs(inputfile, absetamin, absetamax, pt_max):
+    """Get the quantities for all the resolution plots, for all pairs in an
+    eta range, in one pass over the pairs tree.
+
+    Parameters
+    ----------
+    inputfile : ROOT.TFile
+        Pairs file.
+    absetamin, absetamax : float
+        Eta range, should cover all the eta bins to plot.
+    pt_max : float
+        Maximum L1 pt, should be at least the largest pt bin edge.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        Values of each quantity in get_resolution_expressions, and abs_eta,
+        to pass as pairs to plot_resolution.
+    """
+    tree_raw = inputfile.Get("valid")
+    exprs = get_resolution_expressions(tree_raw)
+    abs_eta_expr = "TMath::Abs(eta)"
+    arrays = cu.get_tree_arrays(tree_raw, exprs.values() + [abs_eta_expr],
+                                get_cut_string(absetamin, absetamax, pt_max),
+                                get_entry_ranges(inputfile, absetamin, absetamax))
+    pairs = {quantity: arrays[expr] for quantity, expr in exprs.iteritems()}
+    pairs["abs_eta"] = arrays[abs_eta_expr]
+    return pairs
+
+
+def get_pairs_mask(pairs, absetamin, absetamax, pt_max):
+    """Get mask of pairs passing the same cuts as get_cut_string"""
+    # the cut string uses %g, so do the same rounding
+    abs_eta = pairs["abs_eta"]
+    return ((abs_eta < float("%g" % absetamax)) & (abs_eta > float("%g" % absetamin)) &
+            (pairs["pt"] < float("%g" % pt_max)))
+
+
+def make_2d_hist(name, xvar, yvar, hist_binning, tree_raw, exprs, cutStr, entry_ranges,
+                 pairs=None, mask=None):
+    """Make a 2D hist of yvar Vs xvar, by drawing from the pairs tree,
+    or if pairs is set, by filling from the arrays instead.
+
+    Parameters
+    ----------
+    name : str
+        Hist name.
+    xvar, yvar : str
+        Quantities to plot, see get_resolution_expressions.
+    hist_binning : list
+        nbins, min, max for x then y.
+    tree_raw : ROOT.TTree
+        Pairs tree, if pairs is None.
+    exprs : dict{str : str}
+        Expression for each quantity, from get_resolution_expressions.
+    cutStr : str
+        Cut string.
+    entry_ranges : list[(int, int)] or None
+        Tree entry ranges to draw from, see common_utils.draw_tree.
+    pairs : dict{str : numpy.ndarray}, optional
+        Quantities for the pairs, from get_resolution_pairs.
+    mask : numpy.ndarray, optional
+        Mask of pairs to use, if pairs is set.
+
+    Returns
+    -------
+    ROOT.TH2F
+    """
+    if pairs is None:
+        varexp = "%s:%s>>%s(%d, %g, %g, %d, %g, %g)" % ((exprs[yvar], exprs[xvar], name) +
+                                                       tuple(hist_binning))
+        cu.draw_tree(tree_raw, varexp, cutStr, "", entry_ranges)
+        return ROOT.gROOT.FindObject(name)
+    nbins_x, x_min, x_max, nbins_y, y_min, y_max = hist_binning
+    hist = ROOT.TH2F(name, "", int(nbins_x), x_min, x_max, int(nbins_y), y_min, y_max)
+    hist.SetDirectory(0)
+    cu.fill_hist(hist, pairs[xvar][mask], pairs[yvar][mask])
+    return hist
+
+
+@PROFILER.timed("batch_fits")
+def do_batch_bin_fits(res_2d, ptBins):
+    """Fit the resolution hists for all pt bins at once, using the numpy
+    backend in response_fits, over the same range as plot_bin_fit.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        Fit results, one entry per pt bin, see response_fits.fit_gaus_batch
+    """
+    xaxis = res_2d.GetXaxis()
+    bin_indices = [(xaxis.FindBin(ptmin), xaxis.FindBin(ptmax) - 1)
+                   for ptmin, ptmax in pairwise(ptBins)]
+    contents_2d, sumw2_2d = cu.get_hist_arrays(res_2d)
+    # same as ProjectionY for each pt bin, without under/overflow
+    contents = numpy.array([contents_2d[1:-1, bin1:bin2 + 1].sum(axis=1)
+                            for bin1, bin2 in bin_indices])
+    sumw2 = numpy.array([sumw2_2d[1:-1, bin1:bin2 + 1].sum(axis=1) for bin1, bin2 in bin_indices])
+    yaxis = res_2d.GetYaxis()
+    edges = numpy.array([yaxis.GetBinLowEdge(i) for i in range(1, res_2d.GetNbinsY() + 2)])
+    return rf.fit_gaus_batch(contents, sumw2, edges, min_entries=1, fit_centre="peak")
+
+
+def add_batch_fit_function(h_res, fit_results, ind):
+    """Store the Gaussian from a batch fit in the hist, like TH1::Fit does,
+    so it gets saved with the hist."""
+    fit_min, fit_max = fit_results["fit_range"][ind]
+    func = ROOT.TF1("gaus", "gaus", fit_min, fit_max)
+    params, param_errors = fit_results["params"][ind], fit_results["param_errors"][ind]
+    for i, (val, err) in enumerate(zip(params, param_errors)):
+        func.SetParameter(i, val)
+        func.SetParError(i, err)
+    ROOT.SetOwnership(func, False)  # the hist owns it now
+    h_res.GetListOfFunctions().Add(func)
+
+
 def check_fit_mean(fit_res, hist):
     """Check fit ok by comparing means - ASSUMES GAUSSIAN"""
     pass
@@ -69,7 +224,9 @@ def check_fit_width(fit_res, hist):
     rms = hist.GetRMS()
     return abs(rms - fit_res.Parameters()[2]) < 0.2 * abs(rms)
 
-def plot_bin_fit(res_2d, ptmin, ptmax, hist_title, hist_name, graph, output, divide=False):
+@PROFILER.timed("bin_fit")
+def plot_bin_fit(res_2d, ptmin, ptmax, hist_title, hist_name, graph, output, divide=False,
+                 fit_results=None, fit_ind=None):
     """
     Does a resolution plot for one pt bin, and fits a Gaussian to it.
 
@@ -81,6 +238,8 @@ def plot_bin_fit(res_2d, ptmin, ptmax, hist_title, hist_name, graph, output, div
     graph is TGraphErrors object to add point to, adds new point at (pt, width)
     output is where you want to write hist + fit to
     divide is flag, whether to divide the width by the mean pt (default is False)
+    fit_results & fit_ind are the results from do_batch_bin_fits, and the index of this
+    pt bin in them, to use instead of fitting with ROOT
     """
 
     # Get average pt value - could be lazy and use midpoint of bin,
@@ -102,19 +261,32 @@ def plot_bin_fit(res_2d, ptmin, ptmax, hist_title, hist_name, graph, output, div
     h_res.SetTitle(hist_title)
 
     if h_res.GetEntries() > 0:
-        peak = h_res.GetBinCenter(h_res.GetMaximumBin())
-        fit_res = h_res.Fit("gaus", "QESR", "R", peak - (1. * h_res.GetRMS()), peak + (1. * h_res.GetRMS()))
-        # fit_res = h_res.Fit("gaus", "QESR", "R", h_res.GetMean() - 1. * h_res.GetRMS(), h_res.GetMean() + 1. * h_res.GetRMS())
-        # fit_res = h_res.Fit("gaus", "QMS")
-        print "gaus prob:", fit_res.Prob(), hist_name
+        PROFILER.count("res_fit_attempts")
         # default values for the width & its error - safe if the fit went wrong
         width = h_res.GetRMS()
         width_err = h_res.GetRMSError()
 
-        # check fit converged, and is sensible
-        if fit_res and int(fit_res) == 0: # and check_fit_width(fit_res, h_res):
-            width =  fit_res.Parameters()[2]
-            width_err = fit_res.Errors()[2]
+        if fit_results is None:
+            peak = h_res.GetBinCenter(h_res.GetMaximumBin())
+            fit_res = h_res.Fit("gaus", "QESR", "R",
+                                peak - (1. * h_res.GetRMS()), peak + (1. * h_res.GetRMS()))
+            # fit_res = h_res.Fit("gaus", "QESR", "R", h_res.GetMean() - 1. * h_res.GetRMS(),
+            #                     h_res.GetMean() + 1. * h_res.GetRMS())
+            # fit_res = h_res.Fit("gaus", "QMS")
+            print "gaus prob:", fit_res.Prob(), hist_name
+            # check fit converged, and is sensible
+            fit_ok = fit_res and int(fit_res) == 0 # and check_fit_width(fit_res, h_res)
+            if fit_ok:
+                width = fit_res.Parameters()[2]
+                width_err = fit_res.Errors()[2]
+        else:
+            fit_ok = fit_results["status"][fit_ind] == 0
+            if fit_ok:
+                width = fit_results["params"][fit_ind][2]
+                width_err = fit_results["param_errors"][fit_ind][2]
+                add_batch_fit_function(h_res, fit_results, fit_ind)
+
+        if fit_ok:
             # add point to graph
             if graph:
                 count = graph.GetN()
@@ -131,8 +303,15 @@ def plot_bin_fit(res_2d, ptmin, ptmax, hist_title, hist_name, graph, output, div
     output.WriteTObject(h_res)
 
 
-def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
-    """Do various resolution plots for given eta bin, for all pT bins"""
+def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax, pairs=None,
+                    fit_backend="root"):
+    """Do various resolution plots for given eta bin, for all pT bins
+
+    If pairs is set (from get_resolution_pairs, covering this eta bin),
+    the 2D plots are filled from it instead of drawing from the pairs tree.
+    fit_backend is "root" to fit each pt bin with ROOT, or "numpy" to fit
+    all pt bins at once (see do_batch_bin_fits).
+    """
 
     print "Doing eta bin: %g - %g" % (absetamin, absetamax)
     print "Doing pt bins:", ptBins
@@ -144,10 +323,17 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     output_f = outputfile.mkdir('eta_%g_%g' % (absetamin, absetamax))
     output_f_hists = output_f.mkdir("Histograms")
 
-    # Eta cut string
-    eta_cut = " TMath::Abs(eta)<%g && TMath::Abs(eta) > %g " % (absetamax, absetamin)
-    # pt cut string for 2D plots
-    pt_cut_all = "pt < %g" % (ptBins[-1])
+    # Eta & pt cut string for 2D plots
+    cutStr = get_cut_string(absetamin, absetamax, ptBins[-1])
+
+    # if the pairs file is indexed by indexPairs.py, only read the entries
+    # for this eta bin
+    entry_ranges = None
+    mask = None
+    if pairs is None:
+        entry_ranges = get_entry_ranges(inputfile, absetamin, absetamax)
+    else:
+        mask = get_pairs_mask(pairs, absetamin, absetamax, ptBins[-1])
 
     title = "%g < |#eta^{L1}| < %g" % (absetamin, absetamax)
 
@@ -164,17 +350,19 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     nbins_et = 4 * (pt_bin_max - pt_bin_min)
 
     # Ref jet pt from tree - old ones don't store ptRef, so construct from pt/rsp
-    # - or should it be pt * rsp for old style rsp?
-    ptRef = "ptRef" if check_var_stored(tree_raw, "ptRef") else "(pt/rsp)"
+    exprs = get_resolution_expressions(tree_raw)
+
+    def make_hist(name, xvar, yvar, nbins_y, y_min, y_max):
+        hist_binning = [nbins_et, pt_bin_min, pt_bin_max, nbins_y, y_min, y_max]
+        return make_2d_hist(name, xvar, yvar, hist_binning, tree_raw, exprs, cutStr, entry_ranges,
+                            pairs, mask)
 
     # 1D plot of ptDifference
     # tree_raw.Draw("ptDiff>>ptDiff(%d, %g, %g)" % (nbins_diff, diff_min, diff_max), eta_cut + "&&" + pt_cut_all)
     # ptDiff = ROOT.gROOT.FindObject("ptDiff")
 
     # 2d plots of pt difference vs L1 pt
-    var = "ptDiff" if check_var_stored(tree_raw, "ptDiff") else "(pt-%s)" % ptRef
-    tree_raw.Draw("%s:pt>>ptDiff_l1_2d(%d, %g, %g, %d, %g, %g)" % (var, nbins_et, pt_bin_min, pt_bin_max, nbins_diff, diff_min, diff_max), eta_cut + "&&" + pt_cut_all)
-    ptDiff_l1_2d = ROOT.gROOT.FindObject("ptDiff_l1_2d")
+    ptDiff_l1_2d = make_hist("ptDiff_l1_2d", "pt", "ptDiff", nbins_diff, diff_min, diff_max)
     ptDiff_l1_2d.SetTitle("%s;E_{T}^{L1} [GeV];E_{T}^{L1} - E_{T}^{Ref} [GeV]" % title)
     output_f_hists.WriteTObject(ptDiff_l1_2d)
 
@@ -191,8 +379,7 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     output_f_hists.WriteTObject(ptL1)
 
     # 2d plots of pt difference vs ref pt
-    tree_raw.Draw("%s:%s>>ptDiff_ref_2d(%d, %g, %g, %d, %g, %g)" % (var, ptRef, nbins_et, pt_bin_min, pt_bin_max, nbins_diff, diff_min, diff_max), eta_cut + "&&" + pt_cut_all)
-    ptDiff_ref_2d = ROOT.gROOT.FindObject("ptDiff_ref_2d")
+    ptDiff_ref_2d = make_hist("ptDiff_ref_2d", "ptRef", "ptDiff", nbins_diff, diff_min, diff_max)
     ptDiff_ref_2d.SetTitle("%s;E_{T}^{Ref} [GeV];E_{T}^{L1} - E_{T}^{Ref} [GeV]" % title)
     output_f_hists.WriteTObject(ptDiff_ref_2d)
 
@@ -201,9 +388,7 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     nbins_res = 210
 
     # 2D plot of L1-Ref/L1 VS L1
-    var = "resL1" if check_var_stored(tree_raw, "resL1") else "(pt-%s)/pt" % (ptRef)  # for old pair files
-    tree_raw.Draw("%s:pt>>res_l1_2d(%d, %g, %g, %d, %g, %g)" % (var, nbins_et, pt_bin_min, pt_bin_max, nbins_res, res_min, res_max), eta_cut + "&&" + pt_cut_all)
-    res_l1_2d = ROOT.gROOT.FindObject("res_l1_2d")
+    res_l1_2d = make_hist("res_l1_2d", "pt", "resL1", nbins_res, res_min, res_max)
     res_l1_2d.SetTitle("%s;E_{T}^{L1} [GeV];(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{L1}" % title)
     output_f_hists.WriteTObject(res_l1_2d)
 
@@ -214,11 +399,9 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     output_f_hists.WriteTObject(res_l1)
 
     # 2D plot of L1-Ref/Ref VS L1
-    var = "resRef" if check_var_stored(tree_raw, "resRef") else "(pt-%s)/%s" % (ptRef, ptRef)
     res_min = -2
     nbins_res = 120
-    tree_raw.Draw("%s:pt>>res_refVsl1_2d(%d, %g, %g, %d, %g, %g)" % (var, nbins_et, pt_bin_min, pt_bin_max, nbins_res, res_min, res_max), eta_cut + "&&" + pt_cut_all)
-    res_refVsl1_2d = ROOT.gROOT.FindObject("res_refVsl1_2d")
+    res_refVsl1_2d = make_hist("res_refVsl1_2d", "pt", "resRef", nbins_res, res_min, res_max)
     res_refVsl1_2d.SetTitle("%s;E_{T}^{L1} [GeV];(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{Ref}" % title)
     output_f_hists.WriteTObject(res_refVsl1_2d)
 
@@ -229,12 +412,16 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
     output_f_hists.WriteTObject(res_ref)
 
     # 2D plot of L1-Ref/Ref VS Ref
-    var = "resRef" if check_var_stored(tree_raw, "resRef") else "(pt-%s)/%s" % (ptRef, ptRef)
-    tree_raw.Draw("%s:%s>>res_refVsref_2d(%d, %g, %g, %d, %g, %g)" % (var, ptRef, nbins_et, pt_bin_min, pt_bin_max, nbins_res, res_min, res_max), eta_cut + "&&" + pt_cut_all)
-    res_refVsref_2d = ROOT.gROOT.FindObject("res_refVsref_2d")
+    res_refVsref_2d = make_hist("res_refVsref_2d", "ptRef", "resRef", nbins_res, res_min, res_max)
     res_refVsref_2d.SetTitle("%s;E_{T}^{Ref} [GeV];(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{Ref}" % title)
     output_f_hists.WriteTObject(res_refVsref_2d)
 
+    # Fit all the pt bins of each 2D plot at once
+    batch_fits = {}
+    if fit_backend == "numpy":
+        for res_2d in [ptDiff_l1_2d, ptDiff_ref_2d, res_l1_2d, res_refVsl1_2d, res_refVsref_2d]:
+            batch_fits[res_2d.GetName()] = do_batch_bin_fits(res_2d, ptBins)
+
     # Graphs to hold resolution for all pt bins
     res_graph_l1 = ROOT.TGraphErrors()
     res_graph_l1.SetNameTitle("resL1_%g_%g" % (absetamin, absetamax), "%s;E_{T}^{L1} [GeV];E_{T}^{L1} - E_{T}^{Ref}/E_{T}^{L1}" % title)
@@ -268,27 +455,32 @@ def plot_resolution(inputfile, outputfile, ptBins, absetamin, absetamax):
         # Plot difference in L1 pT and Ref pT (in bin of L1 pt)
         plot_bin_fit(ptDiff_l1_2d, ptmin, ptmax,
             "%s;E_{T}^{L1} - E_{T}^{Ref} [GeV];N" % l1_bin_title,
-            "ptDiff_l1_%g_%g" % (ptmin, ptmax), res_graph_l1_diff, output_f_hists, divide=True)
+            "ptDiff_l1_%g_%g" % (ptmin, ptmax), res_graph_l1_diff, output_f_hists, divide=True,
+            fit_results=batch_fits.get("ptDiff_l1_2d"), fit_ind=i)
 
         # Plot difference in L1 pT and Ref pT (in bin of ref pt)
         plot_bin_fit(ptDiff_ref_2d, ptmin, ptmax,
             "%s;E_{T}^{L1} - E_{T}^{Ref} [GeV];N" % ref_bin_title,
-            "ptDiff_ref_%g_%g" % (ptmin, ptmax), res_graph_refVsref_diff, output_f_hists, divide=True)
+            "ptDiff_ref_%g_%g" % (ptmin, ptmax), res_graph_refVsref_diff, output_f_hists,
+            divide=True, fit_results=batch_fits.get("ptDiff_ref_2d"), fit_ind=i)
 
         # Plot resolution wrt L1 pT & fit
         plot_bin_fit(res_l1_2d, ptmin, ptmax,
             "%s;(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{L1};N" % l1_bin_title,
-            "res_l1_%g_%g" % (ptmin, ptmax), res_graph_l1, output_f_hists)
+            "res_l1_%g_%g" % (ptmin, ptmax), res_graph_l1, output_f_hists,
+            fit_results=batch_fits.get("res_l1_2d"), fit_ind=i)
 
         # Plot ref resolution wrt L1 pT & fit
         plot_bin_fit(res_refVsl1_2d, ptmin, ptmax,
             "%s;(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{Ref};N" % l1_bin_title,
-            "res_ref_l1_%g_%g" % (ptmin, ptmax), res_graph_refVsl1, output_f_hists)
+            "res_ref_l1_%g_%g" % (ptmin, ptmax), res_graph_refVsl1, output_f_hists,
+            fit_results=batch_fits.get("res_refVsl1_2d"), fit_ind=i)
 
         # Plot ref resolution Vs ref pt
         plot_bin_fit(res_refVsref_2d, ptmin, ptmax,
             "%s;(E_{T}^{L1} - E_{T}^{Ref})/E_{T}^{Ref};N" % ref_bin_title,
-            "res_ref_ref_%g_%g" % (ptmin, ptmax), res_graph_refVsref, output_f_hists)
+            "res_ref_ref_%g_%g" % (ptmin, ptmax), res_graph_refVsref, output_f_hists,
+            fit_results=batch_fits.get("res_refVsref_2d"), fit_ind=i)
 
     output_f.WriteTObject(res_graph_l1)
     output_f.WriteTObject(res_graph_l1_diff)
@@ -315,8 +507,18 @@ def main(in_args=sys.argv[1:]):
                         "This overrides --central/--forward. " \
                         "Handy for batch mode. " \
                         "IMPORTANT: MUST PUT AT VERY END")
+    parser.add_argument("--fit-backend", choices=["root", "numpy"], default="root",
+                        help="How to fit the resolution hists: one at a time with ROOT, "
+                        "or all pt bins at once with numpy")
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the wall & CPU time and bytes read for each stage & "
+                        "eta bin. Prints a summary at the end, and saves it all to "
+                        "<output>_profile.json")
     args = parser.parse_args(args=in_args)
 
+    if args.profile:
+        PROFILER.enable()
+
     inputf = ROOT.TFile(args.input, "READ")
     outputf = ROOT.TFile(args.output, "RECREATE")
     print "Reading from", args.input
@@ -337,6 +539,11 @@ def main(in_args=sys.argv[1:]):
         etaBins = binning.eta_bins_forward
     print "Running over eta bins:", etaBins
 
+    # Read the pairs for all eta bins in one go, then fill the plots
+    # for each eta bin from them
+    pt_max = max(binning.pt_bins[-1], binning.pt_bins_wide[-1])
+    pairs = get_resolution_pairs(inputf, etaBins[0], etaBins[-1], pt_max)
+
     # Do plots for individual eta bins
     if args.excl:
         print "Doing individual eta bins"
@@ -349,19 +556,25 @@ def main(in_args=sys.argv[1:]):
             # ptBins = binning.pt_bins_8 if not forward_bin else binning.pt_bins_8_wide
             ptBins = binning.pt_bins if not forward_bin else binning.pt_bins_wide
 
-            plot_resolution(inputf, outputf, ptBins[4:], eta_min, eta_max)
+            with PROFILER.stage("eta_bin", group="eta_%g_%g" % (eta_min, eta_max)):
+                plot_resolution(inputf, outputf, ptBins[4:], eta_min, eta_max,
+                                pairs, args.fit_backend)
 
     # Do plots for inclusive eta
     # Skip if doing exlcusive and only 2 bins, or if only 1 bin
     if args.incl and ((not args.excl and len(etaBins) >= 2) or (args.excl and len(etaBins)>2)):
         print "Doing inclusive eta"
         # ptBins = binning.pt_bins if not etaBins[0] > 2.9 else binning.pt_bins_wide
-        plot_resolution(inputf, outputf, binning.pt_bins[4:], etaBins[0], etaBins[-1])
+        with PROFILER.stage("eta_bin", group="eta_%g_%g" % (etaBins[0], etaBins[-1])):
+            plot_resolution(inputf, outputf, binning.pt_bins[4:], etaBins[0], etaBins[-1],
+                            pairs, args.fit_backend)
 
     if not args.incl and not args.excl:
         print "Not doing inclusive or exclusive - you must specify at least one!"
         return 1
 
+    if args.profile:
+        profiling.report(args.output)
     inputf.Close()
     outputf.Close()
     return 0
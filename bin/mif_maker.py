@@ -5,21 +5,45 @@ Convert human-readable LUT to machine-readable MIF format.
 
 Adapted from code by Thomas Strebler/Olivier Davignon
 
+The input can also be a binary LUT (see binary_lut.py) with one table,
+in which case the values are written in address order, with signed
+values as two's complement.
+
 Usage:
     python mif_maker.py <lut.txt> <output.mif>
 """
 
 
 import sys
+import binary_lut
+
+
+def int_to_mif(x):
+    """Convert integer to MIF hex string, at least 5 chars long (not incl. 0x)"""
+    return '0x' + hex(x).lstrip('0x').rstrip('L').upper().rjust(5, '0')
+
+
+def write_mif(values, mif_filename):
+    """Write a MIF file, one hex value per line"""
+    with open(mif_filename, 'w') as mif:
+        for x in values:
+            mif.write(int_to_mif(int(x)) + '\n')
+
+
+def read_mif(mif_filename):
+    """Read a MIF file into a list of ints"""
+    with open(mif_filename) as mif:
+        return [int(line.strip(), 16) for line in mif if line.strip()]
 
 
 def lut_to_mif(args=sys.argv[1:]):
-    with open(args[0]) as lut, open(args[1], 'w') as mif:
+    if binary_lut.is_binary_lut(args[0]):
+        write_mif(binary_lut.read_lut(args[0])['raw'], args[1])
+        return
+    with open(args[0]) as lut:
         lines = (line for line in lut if not line.startswith('#') and line != '')
         ints = (int(line.split()[1].strip()) for line in lines)
-        hexs = (hex(x).lstrip('0x').upper() for x in ints)
-        for h in hexs:
-            mif.write('0x' + h.rjust(5, '0') + '\n')  # ensure 5 chars long
+        write_mif(ints, args[1])
 
 
 if __name__ == "__main__":
@@ -1,6 +1,56 @@
 import ROOT
 from collections import OrderedDict
+from bisect import bisect_right
 import numpy as np
+from correction_fits import formula_to_numpy
+
+
+# numpy versions of TF1 formulas, see get_numpy_formula
+_NUMPY_FORMULAS = {}
+
+
+def get_numpy_formula(func):
+    """Get the numpy version of a TF1's formula (see
+    correction_fits.formula_to_numpy), or None if it can't be converted.
+    Each formula is only converted once."""
+    try:
+        formula = str(func.GetExpFormula())
+    except AttributeError:
+        return None
+    if formula not in _NUMPY_FORMULAS:
+        try:
+            _NUMPY_FORMULAS[formula] = formula_to_numpy(formula)
+        except ValueError:
+            _NUMPY_FORMULAS[formula] = None
+    return _NUMPY_FORMULAS[formula]
+
+
+def eval_array(func, x):
+    """Evaluate a TF1 or MultiFunc for all values in a numpy array.
+
+    The TF1 formula is evaluated with numpy where possible, using the current
+    parameters, otherwise this falls back to calling Eval() for each value.
+
+    Parameters
+    ----------
+    func : TF1 or MultiFunc
+        Function to evaluate.
+    x : numpy.ndarray
+        Values to evaluate func at.
+
+    Returns
+    -------
+    numpy.ndarray
+        func(x), same shape as x.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if hasattr(func, "EvalArray"):
+        return func.EvalArray(x)
+    formula = get_numpy_formula(func)
+    if formula is None:
+        return np.vectorize(func.Eval, otypes=[np.float64])(x)
+    params = np.array([[func.GetParameter(i) for i in range(func.GetNpar())]])
+    return formula(params, x.ravel())[0].reshape(x.shape)
 
 
 class MultiFunc(object):
@@ -30,16 +80,58 @@ class MultiFunc(object):
         f = c.MultiFunc(functions_dict)
         f.Eval(0.5) # 0.5
         f.Eval(3) # 9
+        f.EvalArray(np.array([0.5, 3])) # [0.5, 9]
         """
         # Need a OrderedDict to keep ordered by application range
         self.functions_dict = OrderedDict(sorted(functions_dict.items(), key=lambda x: x[0][0]))
+        self._setup_edges()
+
+    def _setup_edges(self):
+        """Split the x range at all the function limits, and store which function
+        applies in each piece (-1 if none), so the function for any x can be
+        found with a binary search.
+
+        Where ranges overlap, the function with the lowest lower limit is used.
+        """
+        self._functions = self.functions_dict.values()
+        self._edges = np.array(sorted(set(lim for lims in self.functions_dict.keys()
+                                          for lim in lims)))
+        self._edge_func_index = np.full(len(self._edges), -1, dtype=int)
+        for i, lower in enumerate(self._edges):
+            for j, lim in enumerate(self.functions_dict.keys()):
+                if lim[0] <= lower < lim[1]:
+                    self._edge_func_index[i] = j
+                    break
+
+    def _get_func_index(self, x):
+        """Get index of the function to use for each value of x"""
+        x = np.asarray(x)
+        func_index = np.full(x.shape, -1, dtype=int)
+        piece = np.searchsorted(self._edges, x, side='right') - 1
+        in_range = piece >= 0
+        func_index[in_range] = self._edge_func_index[piece[in_range]]
+        if (func_index < 0).any():
+            raise RuntimeError('x is beyond the limit of your MultiFunc range')
+        return func_index
 
     def Eval(self, x):
         """Emulate TF1.Eval() but will call the correct function,
         depending on which function is applicable for the value of x."""
-        if x >= self.functions_dict.keys()[-1][1] or x < self.functions_dict.keys()[0][0]:
+        piece = bisect_right(self._edges, x) - 1
+        if piece < 0 or self._edge_func_index[piece] < 0:
             raise RuntimeError('x is beyond the limit of your MultiFunc range')
-        return [func for lim, func in self.functions_dict.iteritems() if lim[0] <= x < lim[1]][0].Eval(x)
+        return self._functions[self._edge_func_index[piece]].Eval(x)
+
+    def EvalArray(self, x):
+        """Like Eval(), but for all values in a numpy array, using the
+        numpy version of each function where possible (see eval_array)."""
+        x = np.asarray(x, dtype=np.float64)
+        func_index = self._get_func_index(x)
+        result = np.empty(x.shape)
+        for j in np.unique(func_index):
+            mask = func_index == j
+            result[mask] = eval_array(self._functions[j], x[mask])
+        return result
 
     def Draw(self, draw_args=None, draw_range=None):
         """Draw the complete function.
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""Unit tests for MultiFunc & evaluating functions on numpy arrays."""
+
+
+from multifunc import MultiFunc, eval_array
+import unittest
+import numpy as np
+
+
+CONVENTIONAL = "[0]+[1]/(pow(log10(x),2)+[2])+[3]*exp(-[4]*(log10(x)-[5])*(log10(x)-[5]))"
+
+
+class StandInTF1(object):
+    """Stand in for a TF1, with Eval() written out by hand for each formula"""
+
+    def __init__(self, formula, params):
+        self.formula = formula
+        self.params = params
+
+    def GetExpFormula(self):
+        return self.formula
+
+    def GetNpar(self):
+        return len(self.params)
+
+    def GetParameter(self, i):
+        return self.params[i]
+
+    def Eval(self, x):
+        p = self.params
+        if self.formula == CONVENTIONAL:
+            return (p[0] + p[1] / (np.log10(x)**2 + p[2]) +
+                    p[3] * np.exp(-p[4] * (np.log10(x) - p[5])**2))
+        if self.formula == "[0]":
+            return p[0]
+        if self.formula == "[0]+TMath::Landau(x,[1],[2])":
+            # not really Landau
+            return p[0] + p[1] * x + p[2]
+        raise ValueError(self.formula)
+
+
+class TestMultiFunc(unittest.TestCase):
+    def setUp(self):
+        """Same as correction_LUT_plot.do_low_pt_plateau_fit, including
+        the overlapping ranges at 1023.4 - 1023.5"""
+        self.curve = StandInTF1(CONVENTIONAL, [1.1, 2.5, 2.5, -100., 0.01, -18.])
+        self.func = MultiFunc({(0, 20.5): StandInTF1("[0]", [2.2]),
+                               (20.5, 1023.5): self.curve,
+                               (1023.4, np.inf): StandInTF1("[0]", [1.1])})
+
+    def test_eval_array(self):
+        """Check the same as Eval() for each point"""
+        x = np.concatenate((np.arange(0, 1100, 0.5), [20.4999, 20.5, 1023.4, 1023.45, 1e6]))
+        np.testing.assert_allclose(self.func.EvalArray(x), [self.func.Eval(v) for v in x])
+        self.assertEqual(self.func.Eval(1023.45), self.curve.Eval(1023.45))
+        self.assertEqual(self.func.EvalArray(np.array([[1, 2], [3, 2000]])).shape, (2, 2))
+
+    def test_out_of_range(self):
+        for x in [-1, np.inf]:
+            self.assertRaises(RuntimeError, self.func.Eval, x)
+            self.assertRaises(RuntimeError, self.func.EvalArray, np.array([5, x]))
+
+    def test_gap(self):
+        func = MultiFunc({(0, 1): StandInTF1("[0]", [1.]), (2, 3): StandInTF1("[0]", [2.])})
+        self.assertEqual(func.Eval(2.5), 2.)
+        self.assertRaises(RuntimeError, func.Eval, 1.5)
+        self.assertRaises(RuntimeError, func.EvalArray, np.array([0.5, 1.5]))
+
+    def test_unknown_formula(self):
+        """Check falls back to Eval() if the formula can't be done in numpy,
+        and that the current parameters are used"""
+        func = StandInTF1("[0]+TMath::Landau(x,[1],[2])", [1., 2., 3.])
+        x = np.array([1., 5.])
+        np.testing.assert_allclose(eval_array(func, x), [6., 14.])
+        self.curve.params = [1.2, 2.5, 2.5, -100., 0.01, -18.]
+        np.testing.assert_allclose(eval_array(self.curve, x[1:]), [self.curve.Eval(5.)])
+
+
+if __name__ == '__main__':
+    unittest.main()
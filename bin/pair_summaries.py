@@ -0,0 +1,540 @@
+"""
+Compact, mergeable summaries of pairs files (output from RunMatcher),
+so that calibrations can be done map-reduce style.
+
+Each pairs file is summarised once into sparse histograms, binned in
+(|eta| bin, number of PU vertices, ...) with exactly the binning that
+runCalibration.make_correction_curves uses, plus the sums needed for the
+mean L1 (& ref) jet pT in each ref jet pT cell. Summaries from different files
+can be added together in any order (reduce), and make_correction_curves can
+run directly from the reduced summary instead of a merged pairs tree.
+
+Differences wrt running over the pairs tree:
+- the pT bins are made of whole ref jet pT cells (PT_BINNING), so a pair with
+  ref jet pT exactly on a pT bin edge goes in the upper bin, instead of
+  being dropped.
+- numPUVertices is assumed to be integer valued.
+- the ref jet pT hists (for --no-genjet-plots) are binned in the ref jet pT
+  cells, though their mean is exact.
+
+Summaries can also be stored in a ROOT file (write_root/read_root), which is
+how runCalibration.py stores its hists compactly with --store minimal/summary.
+Those are made with compact(), which only keeps what is needed to remake the
+1D hists for each pT bin (see runCalibration.get_calib_hist).
+
+Usage:
+>>> summary = PairsSummary.from_tree(tree, binning.eta_bins)
+>>> summary.save("summary.npz")
+>>> total = PairsSummary.merge([PairsSummary.load(f) for f in filenames])
+"""
+
+
+import ROOT
+import json
+import numpy as np
+from collections import OrderedDict
+import common_utils as cu
+
+
+SUMMARY_VERSION = 1
+
+# (nbins, min, max) for each axis, these must match make_correction_curves
+RSP_ETA_BINNING = (50, 0., 2.)
+PT_BINNING = (2048, 0., 1024.)
+RSP_BINNING = (150, 0., 5.)
+L1_PT_BINNING = (4000, 0., 2000.)
+
+# Avoid L1 saturated jets cut (from 2017 any l1 jet with a saturated tower is auto given pt=1024GeV)
+MAX_L1_PT = 1023.1
+
+# For each hist in the summary, (x variable, x binning, y variable, y binning),
+# with x = None for 1D hists
+HIST_AXES = OrderedDict([
+    ("rsp_eta", (None, None, "rsp", RSP_ETA_BINNING)),
+    ("rsp_gen", ("ptRef", PT_BINNING, "rsp", RSP_BINNING)),
+    ("rsp_l1", ("pt", PT_BINNING, "rsp", RSP_BINNING)),
+    ("gen_l1", ("ptRef", PT_BINNING, "pt", PT_BINNING)),
+    ("l1_pt", ("ptRef", PT_BINNING, "pt", L1_PT_BINNING)),
+])
+
+# Sums stored for each (eta, PU, ref jet pT cell)
+MOMENTS = ["sumw", "sumw2", "sum_pt", "sum_pt2", "sum_ptRef", "sum_ptRef2"]
+
+# 2D hists kept in compact summaries, merged into pT bins, see PairsSummary.compact
+COMPACT_HISTS = ["rsp_gen", "l1_pt"]
+
+# bit layout of the keys: | eta | PU + 1 | x bin | y bin |
+_BITS_BIN = 12
+_BITS_PU = 12
+_MAX_PU = (1 << _BITS_PU) - 2
+
+
+def find_bins(x, binning):
+    """Get the bin index for each value, like TAxis::FindBin for fixed-width bins,
+    i.e. 0 for underflow, nbins + 1 for overflow.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Values.
+    binning : (int, float, float)
+        nbins, min, max
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    nbins, xmin, xmax = binning
+    x = np.asarray(x, dtype=np.float64)
+    inside = (x >= xmin) & (x < xmax)
+    bins = np.full(x.shape, nbins + 1, dtype=np.int64)
+    bins[x < xmin] = 0
+    bins[inside] = 1 + (nbins * (x[inside] - xmin) / (xmax - xmin)).astype(np.int64)
+    return bins
+
+
+def encode_keys(eta, pu, x, y):
+    """Pack (eta cell, PU, x bin, y bin) into one int64 key"""
+    pu = np.clip(pu, -1, _MAX_PU) + 1
+    return ((eta.astype(np.int64) << (_BITS_PU + 2 * _BITS_BIN)) |
+            (pu.astype(np.int64) << (2 * _BITS_BIN)) |
+            (x.astype(np.int64) << _BITS_BIN) |
+            y.astype(np.int64))
+
+
+def decode_keys(keys):
+    """Unpack int64 keys into (eta cell, PU, x bin, y bin) arrays"""
+    mask = (1 << _BITS_BIN) - 1
+    eta = keys >> (_BITS_PU + 2 * _BITS_BIN)
+    pu = ((keys >> (2 * _BITS_BIN)) & ((1 << _BITS_PU) - 1)) - 1
+    x = (keys >> _BITS_BIN) & mask
+    y = keys & mask
+    return eta, pu, x, y
+
+
+def _to_tvector(arr):
+    """Copy a 1D numpy array into a TVectorD"""
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+    vec = ROOT.TVectorD(len(arr))
+    if len(arr):
+        vec.SetElements(arr)
+    return vec
+
+
+def _from_tvector(vec):
+    """Copy a TVectorD into a numpy array"""
+    n = vec.GetNoElements()
+    if n == 0:
+        return np.array([], dtype=np.float64)
+    return np.array(np.ndarray(n, 'd', vec.GetMatrixArray()))
+
+
+def aggregate(keys, values):
+    """Sum values with the same key.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        int64 keys, shape (N)
+    values : numpy.ndarray
+        Shape (N, number of values)
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Unique keys (sorted), summed values for each.
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    summed = np.empty((len(unique_keys), values.shape[1]))
+    for i in range(values.shape[1]):
+        summed[:, i] = np.bincount(inverse, weights=values[:, i], minlength=len(unique_keys))
+    return unique_keys, summed
+
+
+class PairsSummary(object):
+    """Sparse histograms & moments summarising a pairs file. See module docstring.
+
+    Parameters
+    ----------
+    eta_edges : list[float]
+        |eta| bin edges.
+    has_pu : bool
+        Whether the pairs had numPUVertices. If not, all pairs have PU = 0.
+    data : dict{str : (numpy.ndarray, numpy.ndarray)}, optional
+        (keys, values) for each hist in HIST_AXES, and "moments".
+    pt_bins : list[[int, int]], optional
+        For compact summaries (see compact()), the first & last ref jet pT
+        cell of each pT bin.
+    """
+
+    def __init__(self, eta_edges, has_pu=True, data=None, pt_bins=None):
+        self.eta_edges = [float(e) for e in eta_edges]
+        self.has_pu = bool(has_pu)
+        self.pt_bins = None if pt_bins is None else [[int(b) for b in bins] for bins in pt_bins]
+        self.data = data or {}
+        for name in list(HIST_AXES.keys()) + ["moments"]:
+            n_values = len(MOMENTS) if name == "moments" else 2
+            self.data.setdefault(name, (np.array([], dtype=np.int64), np.zeros((0, n_values))))
+
+    @classmethod
+    def from_arrays(cls, arrays, eta_edges, has_pu=True):
+        """Make summary from arrays of rsp, pt, ptRef, eta (& numPUVertices)."""
+        eta_edges_arr = np.asarray(eta_edges, dtype=np.float64)
+        abs_eta = np.abs(np.asarray(arrays["eta"], dtype=np.float64))
+        pt = np.asarray(arrays["pt"], dtype=np.float64)
+        # eta cut is absetamin < |eta| < absetamax, so pairs on an edge are in no bin
+        eta_cell = np.searchsorted(eta_edges_arr, abs_eta, side='right') - 1
+        n_cells = len(eta_edges_arr) - 1
+        good = (eta_cell >= 0) & (eta_cell < n_cells) & (pt < MAX_L1_PT)
+        good[good] &= abs_eta[good] > eta_edges_arr[eta_cell[good]]
+
+        eta_cell = eta_cell[good]
+        if has_pu:
+            pu = np.asarray(arrays["numPUVertices"], dtype=np.float64)[good]
+            pu = np.floor(pu).astype(np.int64)
+        else:
+            pu = np.zeros(len(eta_cell), dtype=np.int64)
+        values = {var: np.asarray(arrays[var], dtype=np.float64)[good]
+                  for var in ["rsp", "pt", "ptRef"]}
+        ones = np.ones(len(eta_cell))
+        zeros = np.zeros(len(eta_cell), dtype=np.int64)
+
+        data = {}
+        for name, (xvar, xbinning, yvar, ybinning) in HIST_AXES.iteritems():
+            xbins = zeros if xvar is None else find_bins(values[xvar], xbinning)
+            ybins = find_bins(values[yvar], ybinning)
+            keys = encode_keys(eta_cell, pu, xbins, ybins)
+            data[name] = aggregate(keys, np.column_stack([ones, ones]))
+
+        keys = encode_keys(eta_cell, pu, find_bins(values["ptRef"], PT_BINNING), zeros)
+        moments = np.column_stack([ones, ones,
+                                   values["pt"], values["pt"]**2,
+                                   values["ptRef"], values["ptRef"]**2])
+        data["moments"] = aggregate(keys, moments)
+        return cls(eta_edges, has_pu, data)
+
+    @classmethod
+    def from_eta_bin_arrays(cls, arrays, absetamin, absetamax):
+        """Make summary of one eta bin from arrays of rsp, pt & ptRef for pairs
+        already selected for that eta bin (& PU range). The summary has no PU info."""
+        eta = np.full(len(arrays["rsp"]), 0.5 * (absetamin + absetamax))
+        return cls.from_arrays(dict(arrays, eta=eta), [absetamin, absetamax], has_pu=False)
+
+    @classmethod
+    def from_tree(cls, tree, eta_edges, chunk_size=5000000):
+        """Make summary from a pairs tree, reading chunk_size entries at a time."""
+        has_pu = hasattr(tree, "numPUVertices")
+        variables = ["rsp", "pt", "ptRef", "eta"] + (["numPUVertices"] if has_pu else [])
+        n_entries = tree.GetEntries()
+        parts = []
+        for first in xrange(0, n_entries, chunk_size):
+            print "Summarising entries %d - %d" % (first, min(first + chunk_size, n_entries))
+            arrays = cu.get_tree_arrays(tree, variables, "", [(first, chunk_size)])
+            parts.append(cls.from_arrays(arrays, eta_edges, has_pu))
+        if not parts:
+            return cls(eta_edges, has_pu)
+        return cls.merge(parts)
+
+    @classmethod
+    def merge(cls, summaries):
+        """Add summaries together (order doesn't matter).
+
+        Raises
+        ------
+        ValueError
+            If the summaries have different eta bins, PU settings or pT bins.
+        """
+        summaries = list(summaries)
+        first = summaries[0]
+        for summary in summaries[1:]:
+            if summary.eta_edges != first.eta_edges or summary.has_pu != first.has_pu:
+                raise ValueError("Can't merge summaries with different eta bins or PU info")
+            if summary.pt_bins != first.pt_bins:
+                raise ValueError("Can't merge compact summaries with different pT bins")
+        data = {}
+        for name in first.data:
+            keys = np.concatenate([s.data[name][0] for s in summaries])
+            values = np.concatenate([s.data[name][1] for s in summaries])
+            data[name] = aggregate(keys, values)
+        return cls(first.eta_edges, first.has_pu, data, first.pt_bins)
+
+    def _meta(self):
+        return dict(version=SUMMARY_VERSION, eta_edges=self.eta_edges, has_pu=self.has_pu,
+                    hist_axes=HIST_AXES, moments=MOMENTS, pt_bins=self.pt_bins)
+
+    @staticmethod
+    def _check_meta(meta, source):
+        """Check metadata from save()/write_root() matches this version, raise ValueError if not"""
+        if meta["version"] != SUMMARY_VERSION:
+            raise ValueError("%s has summary version %s, need %s"
+                             % (source, meta["version"], SUMMARY_VERSION))
+        if json.loads(json.dumps(HIST_AXES)) != meta["hist_axes"]:
+            raise ValueError("%s has different binning to this version of pair_summaries" % source)
+
+    def save(self, filename):
+        """Save to a compressed numpy .npz file"""
+        arrays = {"meta": np.array(json.dumps(self._meta()))}
+        for name, (keys, values) in self.data.iteritems():
+            arrays[name + "_keys"] = keys
+            arrays[name + "_values"] = values
+        np.savez_compressed(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load summary saved with save()
+
+        Raises
+        ------
+        ValueError
+            If the file was made with a different binning or version.
+        """
+        contents = np.load(filename)
+        meta = json.loads(str(contents["meta"]))
+        cls._check_meta(meta, filename)
+        data = {}
+        for name in list(HIST_AXES.keys()) + ["moments"]:
+            data[name] = (contents[name + "_keys"], contents[name + "_values"])
+        return cls(meta["eta_edges"], meta["has_pu"], data, meta.get("pt_bins"))
+
+    def write_root(self, directory):
+        """Write to a ROOT directory, as a TVectorD for each array plus the
+        metadata as JSON in a TNamed. Keys are stored exactly, as they are < 2^53.
+
+        Parameters
+        ----------
+        directory : ROOT.TDirectory
+        """
+        directory.WriteTObject(ROOT.TNamed("meta", json.dumps(self._meta())))
+        for name, (keys, values) in self.data.iteritems():
+            directory.WriteTObject(_to_tvector(keys), name + "_keys")
+            directory.WriteTObject(_to_tvector(values.ravel()), name + "_values")
+
+    @classmethod
+    def read_root(cls, directory):
+        """Read summary written with write_root()
+
+        Raises
+        ------
+        ValueError
+            If it was made with a different binning or version.
+        """
+        meta = json.loads(directory.Get("meta").GetTitle())
+        cls._check_meta(meta, directory.GetPath())
+        data = {}
+        for name in list(HIST_AXES.keys()) + ["moments"]:
+            keys = _from_tvector(directory.Get(name + "_keys")).astype(np.int64)
+            n_values = len(MOMENTS) if name == "moments" else 2
+            values = _from_tvector(directory.Get(name + "_values")).reshape(len(keys), n_values)
+            data[name] = (keys, values)
+        return cls(meta["eta_edges"], meta["has_pu"], data, meta.get("pt_bins"))
+
+    def eta_cells(self, absetamin, absetamax):
+        """Get indices of the eta cells that make up absetamin - absetamax.
+
+        Raises
+        ------
+        ValueError
+            If absetamin or absetamax isn't an edge of the summary eta bins.
+        """
+        edges = np.asarray(self.eta_edges)
+        lo = np.flatnonzero(np.isclose(edges, absetamin, rtol=0, atol=1E-6))
+        hi = np.flatnonzero(np.isclose(edges, absetamax, rtol=0, atol=1E-6))
+        if len(lo) != 1 or len(hi) != 1 or hi[0] <= lo[0]:
+            raise ValueError("Eta range %g - %g doesn't match summary eta bins %s" %
+                             (absetamin, absetamax, self.eta_edges))
+        return np.arange(lo[0], hi[0])
+
+    def select(self, name, absetamin, absetamax, pu_min=None, pu_max=None):
+        """Get the contents of one hist (or the moments) for an eta range & PU range,
+        summed over all eta cells & PU values in range.
+
+        Parameters
+        ----------
+        name : str
+            Key in HIST_AXES, or "moments"
+        absetamin, absetamax : float
+            Eta range, must be edges of the summary eta bins.
+        pu_min, pu_max : float, optional
+            PU range, inclusive. Ignored if summary has no PU info.
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray, numpy.ndarray
+            x bin, y bin, values for each non-empty (x, y) bin.
+            Values are (sumw, sumw2) for hists, or MOMENTS.
+        """
+        keys, values = self.data[name]
+        eta, pu, x, y = decode_keys(keys)
+        mask = np.in1d(eta, self.eta_cells(absetamin, absetamax))
+        if self.has_pu:
+            if pu_min is not None:
+                mask &= pu >= pu_min
+            if pu_max is not None:
+                mask &= pu <= pu_max
+        new_keys, summed = aggregate(encode_keys(np.zeros_like(x[mask]), np.zeros_like(x[mask]),
+                                                 x[mask], y[mask]),
+                                     values[mask])
+        _, _, new_x, new_y = decode_keys(new_keys)
+        return new_x, new_y, summed
+
+    def dense(self, name, absetamin, absetamax, pu_min=None, pu_max=None):
+        """Like select(), but as dense arrays of (sumw, sumw2) in the same layout
+        as common_utils.get_hist_arrays(), i.e. shape (nbins y + 2, nbins x + 2)
+        for 2D hists, or (nbins + 2) for 1D.
+        """
+        xvar, xbinning, yvar, ybinning = HIST_AXES[name]
+        x, y, values = self.select(name, absetamin, absetamax, pu_min, pu_max)
+        n_x = 1 if xbinning is None else xbinning[0] + 2
+        shape = (ybinning[0] + 2, n_x)
+        sumw, sumw2 = np.zeros(shape), np.zeros(shape)
+        sumw[y, x] = values[:, 0]
+        sumw2[y, x] = values[:, 1]
+        if xbinning is None:
+            return sumw[:, 0], sumw2[:, 0]
+        return sumw, sumw2
+
+    def restrict(self, absetamin, absetamax, pu_min=None, pu_max=None):
+        """Get a summary of just one eta bin & PU range, with no PU info."""
+        data = {}
+        for name in self.data:
+            x, y, values = self.select(name, absetamin, absetamax, pu_min, pu_max)
+            zeros = np.zeros_like(x)
+            data[name] = (encode_keys(zeros, zeros, x, y), values)
+        return PairsSummary([absetamin, absetamax], False, data, self.pt_bins)
+
+    def compact(self, pt_bins):
+        """Get a compact copy of a one eta bin summary (e.g. from restrict()),
+        to store with the calibration. Only the rsp_eta hist & moments are kept
+        as they are. The rsp_gen & l1_pt cells are summed over the ref jet pT
+        cells of each pT bin, and stored in its first cell, as only the
+        1D projections for each pT bin are remade from them. The other 2D
+        hists are dropped.
+
+        Parameters
+        ----------
+        pt_bins : list[[int, int]]
+            First & last ref jet pT cell (inclusive) of each pT bin.
+
+        Raises
+        ------
+        ValueError
+            If the summary has more than one eta bin, or the pT bins overlap.
+        """
+        if len(self.eta_edges) != 2:
+            raise ValueError("Can only make a compact summary of one eta bin")
+        pt_bins = [[int(bin1), int(bin2)] for bin1, bin2 in pt_bins]
+        firsts = np.array([bins[0] for bins in pt_bins])
+        lasts = np.array([bins[1] for bins in pt_bins])
+        order = np.argsort(firsts)
+        if np.any(firsts[order][1:] <= lasts[order][:-1]):
+            raise ValueError("pT bins overlap: %s" % pt_bins)
+        data = {}
+        for name, (keys, values) in self.data.iteritems():
+            if name in ["rsp_eta", "moments"]:
+                data[name] = (keys, values)
+                continue
+            if name not in COMPACT_HISTS:
+                continue
+            eta, pu, x, y = decode_keys(keys)
+            # first cell of the pT bin each cell is in, if any
+            ind = np.searchsorted(firsts[order], x, side='right') - 1
+            in_bin = (ind >= 0) & (x <= lasts[order][np.maximum(ind, 0)])
+            new_x = firsts[order][ind[in_bin]]
+            data[name] = aggregate(encode_keys(eta[in_bin], pu[in_bin], new_x, y[in_bin]),
+                                   values[in_bin])
+        return PairsSummary(self.eta_edges, self.has_pu, data, pt_bins)
+
+    def for_eta_bin(self, absetamin, absetamax, pu_min=None, pu_max=None):
+        """Get an EtaBinSummary for one eta bin & PU range."""
+        return EtaBinSummary(self, absetamin, absetamax, pu_min, pu_max)
+
+
+class EtaBinSummary(object):
+    """Summary for one eta bin & PU range, to fill the hists in
+    runCalibration.make_correction_curves. Get one from PairsSummary.for_eta_bin().
+    """
+
+    def __init__(self, summary, absetamin, absetamax, pu_min=None, pu_max=None):
+        self.summary = summary
+        self.selection = (absetamin, absetamax, pu_min, pu_max)
+        self.moments_x, _, self.moments = summary.select("moments", *self.selection)
+        self.l1_pt_x, self.l1_pt_y, self.l1_pt = summary.select("l1_pt", *self.selection)
+        self.n_pairs = self.moments[:, 0].sum()
+
+    def _check_pt_bin(self, bin1, bin2):
+        """Check ref jet pT cells bin1 - bin2 can be used, i.e. are one of the
+        pT bins for a compact summary, raise ValueError if not"""
+        pt_bins = self.summary.pt_bins
+        if pt_bins is not None and [bin1, bin2] not in pt_bins:
+            raise ValueError("Compact summary only has pT bins %s, not %s"
+                             % (pt_bins, [bin1, bin2]))
+
+    def fill_hist(self, hist, name):
+        """Set the contents of hist from the summary hist name.
+
+        Raises
+        ------
+        ValueError
+            If the hist binning doesn't match the summary, or it's a 2D hist
+            and the summary is compact.
+        """
+        xvar, xbinning, yvar, ybinning = HIST_AXES[name]
+        if xbinning is not None and self.summary.pt_bins is not None:
+            raise ValueError("Can't make 2D hist %s from a compact summary" % name)
+        axes = [ybinning] if xbinning is None else [xbinning, ybinning]
+        hist_axes = [hist.GetXaxis(), hist.GetYaxis()][:hist.GetDimension()]
+        for axis, binning in zip(hist_axes, axes):
+            if (axis.GetNbins(), axis.GetXmin(), axis.GetXmax()) != binning:
+                raise ValueError("Binning of %s doesn't match summary %s" % (hist.GetName(), name))
+        sumw, sumw2 = self.summary.dense(name, *self.selection)
+        cu.set_hist_contents(hist, sumw, sumw2)
+
+    def get_moments(self, bin1, bin2):
+        """Sum MOMENTS over ref jet pT cells bin1 - bin2 (inclusive)"""
+        mask = (self.moments_x >= bin1) & (self.moments_x <= bin2)
+        return self.moments[mask].sum(axis=0)
+
+    def fill_rsp_hist(self, hist, bin1, bin2):
+        """Fill hist (binned as RSP_BINNING) with the response for ref jet pT
+        cells bin1 - bin2 (inclusive), i.e. the rsp_gen ProjectionY"""
+        self._check_pt_bin(bin1, bin2)
+        x, y, values = self.summary.select("rsp_gen", *self.selection)
+        mask = (x >= bin1) & (x <= bin2)
+        size = RSP_BINNING[0] + 2
+        sumw = np.bincount(y[mask], weights=values[mask, 0], minlength=size)
+        sumw2 = np.bincount(y[mask], weights=values[mask, 1], minlength=size)
+        cu.set_hist_contents(hist, sumw, sumw2)
+
+    def fill_l1_pt_hist(self, hist, bin1, bin2):
+        """Fill hist (binned as L1_PT_BINNING) with L1 jet pT for ref jet pT cells
+        bin1 - bin2 (inclusive). Hist mean & its error are exact."""
+        self._check_pt_bin(bin1, bin2)
+        mask = (self.l1_pt_x >= bin1) & (self.l1_pt_x <= bin2)
+        size = L1_PT_BINNING[0] + 2
+        sumw = np.bincount(self.l1_pt_y[mask], weights=self.l1_pt[mask, 0], minlength=size)
+        sumw2 = np.bincount(self.l1_pt_y[mask], weights=self.l1_pt[mask, 1], minlength=size)
+        cu.set_hist_contents(hist, sumw, sumw2)
+        moments = self.get_moments(bin1, bin2)
+        if moments[0] > 0:
+            hist.PutStats(np.array(moments[:4], dtype=np.float64))
+            hist.SetEntries(moments[0])
+
+    def make_ref_pt_hist(self, name, title, bin1, bin2):
+        """Make hist of ref jet pT for ref jet pT cells bin1 - bin2 (inclusive),
+        with one bin per cell. Hist mean & its error are exact."""
+        nbins, xmin, xmax = PT_BINNING
+        width = (xmax - xmin) / nbins
+        hist = ROOT.TH1F(name, title, bin2 - bin1 + 1,
+                         xmin + (bin1 - 1) * width, xmin + bin2 * width)
+        hist.SetDirectory(0)
+        sumw = np.zeros(bin2 - bin1 + 3)
+        sumw2 = np.zeros(bin2 - bin1 + 3)
+        mask = (self.moments_x >= bin1) & (self.moments_x <= bin2)
+        sumw[self.moments_x[mask] - bin1 + 1] = self.moments[mask, 0]
+        sumw2[self.moments_x[mask] - bin1 + 1] = self.moments[mask, 1]
+        cu.set_hist_contents(hist, sumw, sumw2)
+        moments = self.get_moments(bin1, bin2)
+        if moments[0] > 0:
+            hist.PutStats(np.array([moments[0], moments[1], moments[4], moments[5]]))
+            hist.SetEntries(moments[0])
+        return hist
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""Unit tests for the sparse pairs file summaries.
+
+The summary hists are compared with numpy histograms of the same pairs.
+"""
+
+
+import pair_summaries as ps
+import unittest
+import numpy as np
+
+
+class StandInTree(object):
+    """Stand in for a pairs TTree, holding arrays of each branch.
+    Records the entry ranges read by get_tree_arrays."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.entry_ranges = []
+        if "numPUVertices" in arrays:
+            self.numPUVertices = None
+
+    def GetEntries(self):
+        return len(self.arrays["rsp"])
+
+
+def get_tree_arrays(tree, variables, cut="", entry_ranges=None):
+    """Stand in for common_utils.get_tree_arrays, for a StandInTree"""
+    tree.entry_ranges.extend(entry_ranges)
+    inds = np.concatenate([np.arange(first, min(first + n, tree.GetEntries()))
+                           for first, n in entry_ranges])
+    return {var: tree.arrays[var][inds] for var in variables}
+
+
+def make_pairs(n, seed=1):
+    rng = np.random.RandomState(seed)
+    pt_ref = rng.uniform(10, 300, n)
+    rsp = rng.normal(1, 0.2, n)
+    return dict(ptRef=pt_ref, rsp=rsp, pt=rsp * pt_ref,
+                eta=rng.uniform(-3, 3, n), numPUVertices=rng.uniform(0, 40, n))
+
+
+def hist_edges(binning):
+    return np.linspace(binning[1], binning[2], binning[0] + 1)
+
+
+class StandInHist(object):
+    """Stand in for a TH1, holding the arrays from set_hist_contents"""
+    def PutStats(self, stats):
+        self.stats = stats
+
+    def SetEntries(self, entries):
+        self.entries = entries
+
+
+def set_hist_contents(hist, contents, sumw2=None):
+    """Stand in for common_utils.set_hist_contents, for a StandInHist"""
+    hist.contents = contents
+    hist.sumw2 = sumw2
+
+
+class TestPairsSummary(unittest.TestCase):
+    def setUp(self):
+        self.eta_edges = [0, 0.783, 1.479, 3.0]
+        self.pairs = make_pairs(20000)
+        self.get_tree_arrays = ps.cu.get_tree_arrays
+        ps.cu.get_tree_arrays = get_tree_arrays
+        self.set_hist_contents = ps.cu.set_hist_contents
+        ps.cu.set_hist_contents = set_hist_contents
+
+    def tearDown(self):
+        ps.cu.get_tree_arrays = self.get_tree_arrays
+        ps.cu.set_hist_contents = self.set_hist_contents
+
+    def check_same_summary(self, summary, other):
+        for name in summary.data:
+            self.assertTrue(np.array_equal(summary.data[name][0], other.data[name][0]))
+            self.assertTrue(np.allclose(summary.data[name][1], other.data[name][1]))
+
+    def test_from_tree_chunks(self):
+        """Check summarising a tree in chunks gives the same as all at once"""
+        tree = StandInTree(self.pairs)
+        summary = ps.PairsSummary.from_tree(tree, self.eta_edges, chunk_size=3001)
+        self.assertEqual(len(tree.entry_ranges), 7)
+        self.assertTrue(summary.has_pu)
+        self.check_same_summary(summary, ps.PairsSummary.from_arrays(self.pairs, self.eta_edges))
+        self.assertEqual(summary.data["moments"][1][:, 0].sum(),
+                         np.sum(np.abs(self.pairs["eta"]) < self.eta_edges[-1]))
+
+    def test_from_tree_no_pu(self):
+        pairs = {k: v for k, v in self.pairs.iteritems() if k != "numPUVertices"}
+        summary = ps.PairsSummary.from_tree(StandInTree(pairs), self.eta_edges, chunk_size=5000)
+        self.assertFalse(summary.has_pu)
+        self.check_same_summary(summary, ps.PairsSummary.from_arrays(pairs, self.eta_edges, False))
+
+    def test_dense_matches_numpy(self):
+        """Check the dense response Vs ref pT hist for an eta & PU range
+        is the same as a numpy histogram of those pairs"""
+        summary = ps.PairsSummary.from_tree(StandInTree(self.pairs), self.eta_edges,
+                                            chunk_size=7000)
+        abs_eta = np.abs(self.pairs["eta"])
+        pu = self.pairs["numPUVertices"]
+        mask = (abs_eta > 0.783) & (abs_eta < 3.0) & (pu >= 10) & (pu < 21)
+        edges = [hist_edges(ps.RSP_BINNING), hist_edges(ps.PT_BINNING)]
+        expected, _, _ = np.histogram2d(self.pairs["rsp"][mask], self.pairs["ptRef"][mask], edges)
+        sumw, sumw2 = summary.dense("rsp_gen", 0.783, 3.0, 10, 20)
+        self.assertTrue(np.array_equal(sumw[1:-1, 1:-1], expected))
+        self.assertTrue(np.array_equal(sumw2, sumw))
+        # responses outside the hist range go in under/overflow
+        self.assertEqual(sumw.sum(), mask.sum())
+
+        expected, _ = np.histogram(self.pairs["rsp"][mask], hist_edges(ps.RSP_ETA_BINNING))
+        sumw, _ = summary.dense("rsp_eta", 0.783, 3.0, 10, 20)
+        self.assertTrue(np.array_equal(sumw[1:-1], expected))
+
+    def test_edge_pt_upper_bin(self):
+        """Check ref jet pT on a bin edge goes in the upper bin, & PU is floored"""
+        pairs = dict(ptRef=np.array([20., 20., 30.5]), rsp=np.array([1., 1., 1.]),
+                     pt=np.array([20., 20., 30.5]), eta=np.array([0.5, 0.5, 0.5]),
+                     numPUVertices=np.array([12., 12.9, 13.]))
+        summary = ps.PairsSummary.from_arrays(pairs, self.eta_edges)
+        cell_width = (ps.PT_BINNING[2] - ps.PT_BINNING[1]) / ps.PT_BINNING[0]
+        x, _, values = summary.select("rsp_gen", 0, 0.783, 12, 12)
+        self.assertEqual(list(x), [1 + int(round(20. / cell_width))])
+        self.assertEqual(values[0, 0], 2)
+        x, _, values = summary.select("rsp_gen", 0, 0.783, 13, 13)
+        self.assertEqual(list(x), [1 + int(round(30.5 / cell_width))])
+        self.assertEqual(values[0, 0], 1)
+        self.assertEqual(ps.find_bins(np.array([20.]), ps.PT_BINNING)[0],
+                         np.searchsorted(hist_edges(ps.PT_BINNING), 20., side='right'))
+
+    def test_merge(self):
+        """Check merging summaries of parts of the pairs, in any order,
+        gives the same as summarising them all"""
+        first = {k: v[:5000] for k, v in self.pairs.iteritems()}
+        second = {k: v[5000:] for k, v in self.pairs.iteritems()}
+        merged = ps.PairsSummary.merge([ps.PairsSummary.from_arrays(second, self.eta_edges),
+                                        ps.PairsSummary.from_arrays(first, self.eta_edges)])
+        self.check_same_summary(merged, ps.PairsSummary.from_arrays(self.pairs, self.eta_edges))
+
+    def test_compact(self):
+        """Check a compact summary gives the same 1D hists for each pT bin
+        as the full summary, & is smaller"""
+        pairs = dict(self.pairs, eta=np.abs(self.pairs["eta"]) % 0.783)
+        full = ps.PairsSummary.from_eta_bin_arrays(pairs, 0, 0.783)
+        pt_bins = [[2, 5], [6, 6], [7, 6], [7, 20], [40, 100]]
+        compact = full.compact(pt_bins)
+        self.assertEqual(len(compact.data["gen_l1"][0]), 0)
+        self.assertLess(sum(v.nbytes for _, v in compact.data.values()),
+                        sum(v.nbytes for _, v in full.data.values()) / 2)
+        self.check_same_summary(compact.merge([compact]), compact)
+
+        full_bin = full.for_eta_bin(0, 0.783)
+        compact_bin = compact.for_eta_bin(0, 0.783)
+        for bin1, bin2 in pt_bins:
+            for method in ["fill_rsp_hist", "fill_l1_pt_hist"]:
+                expected, hist = StandInHist(), StandInHist()
+                getattr(full_bin, method)(expected, bin1, bin2)
+                getattr(compact_bin, method)(hist, bin1, bin2)
+                self.assertTrue(np.allclose(hist.contents, expected.contents))
+                self.assertTrue(np.allclose(hist.sumw2, expected.sumw2))
+        # projection of the full rsp_gen hist
+        sumw, _ = full.dense("rsp_gen", 0, 0.783)
+        compact_bin.fill_rsp_hist(hist, 7, 20)
+        self.assertTrue(np.allclose(hist.contents, sumw[:, 7:21].sum(axis=1)))
+
+        with self.assertRaises(ValueError):
+            compact_bin.fill_rsp_hist(hist, 7, 21)
+        with self.assertRaises(ValueError):
+            compact_bin.fill_hist(hist, "rsp_gen")
+        with self.assertRaises(ValueError):
+            full.compact([[2, 5], [5, 8]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+"""
+Lightweight instrumentation for the calibration scripts, to see where the
+time goes: reading the pairs tree, filling hists, fits, writing output.
+
+There is one module-level Profiler, PROFILER, which does nothing until it is
+enabled (e.g. by a script's --profile option), so instrumented code costs
+nothing normally.
+
+Time is recorded per stage, and per group within a stage (e.g. eta bin).
+Stages can be nested, in which case the time of the inner stage is also
+counted in the outer one; the summary shows the "self" time of each stage
+as well, i.e. excluding any nested stages. Inner stages inherit the group
+of the outer one unless they set their own.
+
+Usage:
+>>> from profiling import PROFILER
+>>> PROFILER.enable()
+>>> with PROFILER.stage("eta_bin", group="eta_0_0.348"):
+...     with PROFILER.stage("read_pairs"):
+...         PROFILER.watch_tree(tree)
+...         arrays = cu.get_tree_arrays(tree, ["rsp", "pt"])
+...     PROFILER.count("fit_attempts")
+>>> PROFILER.finish()
+>>> PROFILER.save("profile.json")
+>>> PROFILER.print_summary()
+
+Functions can also be timed as a stage with a decorator:
+>>> @PROFILER.timed("fit")
+... def do_fit(hist): ...
+"""
+
+
+import os
+import json
+import time
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# group used for anything outside a grouped stage
+NO_GROUP = "all"
+
+
+def _cpu_time():
+    """User + system CPU time of this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _file_bytes_read():
+    """Total bytes read by all ROOT files in this process"""
+    try:
+        import ROOT
+    except ImportError:
+        return 0
+    return int(ROOT.TFile.GetFileBytesRead())
+
+
+class Profiler(object):
+    """Records wall & CPU time, ROOT bytes read and counters per stage & group.
+
+    Results are stored as nested dicts, stage -> group -> values,
+    so they can be saved as JSON, and merged from several processes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """Clear all results, e.g. in a forked worker process"""
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.trees = OrderedDict()
+        self._stack = []
+        self._perf_stats = []
+
+    def enable(self):
+        self.enabled = True
+
+    def _group(self):
+        return self._stack[-1][1] if self._stack else NO_GROUP
+
+    @contextmanager
+    def stage(self, name, group=None):
+        """Time the code inside the with block as stage name.
+
+        Parameters
+        ----------
+        name : str
+            Stage name.
+        group : str, optional
+            Group (e.g. eta bin) to record it under. Default is the group of
+            the enclosing stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        group = group or self._group()
+        # [name, group, time in nested stages]
+        frame = [name, group, 0.]
+        self._stack.append(frame)
+        start_wall, start_cpu, start_bytes = time.time(), _cpu_time(), _file_bytes_read()
+        try:
+            yield
+        finally:
+            wall = time.time() - start_wall
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][2] += wall
+            record = self.stages.setdefault(name, OrderedDict()).setdefault(
+                group, dict(calls=0, wall=0., self_wall=0., cpu=0., bytes_read=0))
+            record["calls"] += 1
+            record["wall"] += wall
+            record["self_wall"] += wall - frame[2]
+            record["cpu"] += _cpu_time() - start_cpu
+            record["bytes_read"] += _file_bytes_read() - start_bytes
+
+    def timed(self, name):
+        """Decorator to time each call of a function as stage name"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """Add n to counter name, for the current group"""
+        if not self.enabled:
+            return
+        counter = self.counters.setdefault(name, OrderedDict())
+        group = self._group()
+        counter[group] = counter.get(group, 0) + n
+
+    def watch_tree(self, tree):
+        """Attach a TTreePerfStats to tree to record its I/O, if it doesn't have one already"""
+        if not self.enabled or tree.GetPerfStats():
+            return
+        import ROOT
+        perf_stats = ROOT.TTreePerfStats("ioperf_%d" % len(self._perf_stats), tree)
+        self._perf_stats.append((tree.GetCurrentFile().GetName(), tree.GetName(), perf_stats))
+
+    def finish(self):
+        """Get the results from the TTreePerfStats. Call before the trees' files are closed."""
+        for filename, tree_name, perf_stats in self._perf_stats:
+            perf_stats.Finish()
+            record = self.trees.setdefault("%s:%s" % (filename, tree_name),
+                                           dict(bytes_read=0, read_calls=0, unzip_time=0.))
+            record["bytes_read"] += int(perf_stats.GetBytesRead())
+            record["read_calls"] += int(perf_stats.GetReadCalls())
+            record["unzip_time"] += perf_stats.GetUnzipTime()
+        self._perf_stats = []
+
+    def to_dict(self):
+        return OrderedDict([("stages", self.stages), ("counters", self.counters),
+                            ("trees", self.trees)])
+
+    def merge(self, results):
+        """Add results from another Profiler (e.g. from another process)
+
+        Parameters
+        ----------
+        results : dict
+            From to_dict(), or loaded from a JSON file made by save().
+        """
+        for name, groups in results["stages"].iteritems():
+            stage = self.stages.setdefault(name, OrderedDict())
+            for group, values in groups.iteritems():
+                record = stage.setdefault(group, dict.fromkeys(values, 0))
+                for key, value in values.iteritems():
+                    record[key] += value
+        for name, groups in results["counters"].iteritems():
+            counter = self.counters.setdefault(name, OrderedDict())
+            for group, value in groups.iteritems():
+                counter[group] = counter.get(group, 0) + value
+        for name, values in results["trees"].iteritems():
+            record = self.trees.setdefault(name, dict.fromkeys(values, 0))
+            for key, value in values.iteritems():
+                record[key] += value
+
+    def save(self, filename):
+        """Save results as JSON"""
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def load(self, filename):
+        """Merge in results saved to filename"""
+        with open(filename) as f:
+            self.merge(json.load(f, object_pairs_hook=OrderedDict))
+
+    def print_summary(self):
+        """Print totals per stage (slowest first), then per group, and the counters"""
+        print "=" * 80
+        print "Profile summary"
+        print "=" * 80
+        totals = []
+        for name, groups in self.stages.iteritems():
+            total = dict(calls=0, wall=0., self_wall=0., cpu=0., bytes_read=0)
+            for values in groups.itervalues():
+                for key in total:
+                    total[key] += values[key]
+            totals.append((name, total))
+        totals.sort(key=lambda x: x[1]["self_wall"], reverse=True)
+        row = "%-24s %8s %10s %10s %10s %10s"
+        print row % ("stage", "calls", "wall [s]", "self [s]", "cpu [s]", "read [MB]")
+        for name, total in totals:
+            print row % (name, total["calls"], "%.2f" % total["wall"], "%.2f" % total["self_wall"],
+                         "%.2f" % total["cpu"], "%.1f" % (total["bytes_read"] / 1024.**2))
+
+        group_names = []
+        for groups in self.stages.itervalues():
+            group_names.extend(g for g in groups if g not in group_names)
+        if group_names != [NO_GROUP]:
+            print "-" * 80
+            print "Self wall time [s] per group"
+            for group in group_names:
+                times = ["%s=%.2f" % (name, groups[group]["self_wall"])
+                         for name, groups in self.stages.iteritems() if group in groups]
+                print "%-24s %s" % (group, ", ".join(times))
+
+        if self.counters:
+            print "-" * 80
+            for name, groups in self.counters.iteritems():
+                print "%-24s %d (%s)" % (name, sum(groups.itervalues()),
+                                         ", ".join("%s=%d" % gv for gv in groups.iteritems()))
+        if self.trees:
+            print "-" * 80
+            for name, values in self.trees.iteritems():
+                print ("%s: %.1f MB in %d reads, %.2f s unzipping"
+                       % (name, values["bytes_read"] / 1024.**2, values["read_calls"],
+                          values["unzip_time"]))
+        print "=" * 80
+
+
+PROFILER = Profiler()
+
+
+def get_profile_filename(output_filename):
+    """Default JSON filename for the profile of a script writing output_filename"""
+    return os.path.splitext(output_filename)[0] + "_profile.json"
+
+
+def report(output_filename, profiler=PROFILER):
+    """Finish profiling, save the results next to output_filename, and print a summary.
+
+    Call before closing the input files, so the TTreePerfStats are still valid.
+    """
+    profiler.finish()
+    filename = get_profile_filename(output_filename)
+    profiler.save(filename)
+    profiler.print_summary()
+    print "Profile saved to", filename
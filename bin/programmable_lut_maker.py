@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 """
-Convert jet LUTs (human readable) into new programmable format
+Convert jet LUTs (human readable, or binary - see binary_lut.py) into new
+programmable format
 """
 
 
@@ -11,6 +12,7 @@ import argparse
 from collections import OrderedDict
 import xml.etree.ElementTree as XT
 from xml.dom import minidom
+import binary_lut
 
 
 SETTINGS = OrderedDict()  # is this necessary?
@@ -44,27 +46,26 @@ TYPE_DICT = {
 
 
 def get_lut_contents(lut_file):
-    """Read in human-readrable LUT, and convert values to list of ints"""
+    """Read in human-readrable LUT, and convert values to list of ints.
+    For a binary LUT with the add_mult table (or only one table),
+    use the values in address order."""
+    if binary_lut.is_binary_lut(lut_file):
+        tables, _ = binary_lut.read_binary_lut(lut_file)
+        table = tables['add_mult'] if 'add_mult' in tables else binary_lut.read_lut(lut_file)
+        return [int(x) for x in table['raw']]
     with open(lut_file) as lut:
         lines = (line for line in lut if not line.startswith('#') and line != '')
         return [int(line.split()[1].strip()) for line in lines]
 
 
-def do_lut_making(in_args=sys.argv[1:]):
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input", help="Input human readable LUT")
-    parser.add_argument("xml", help="Output XML LUT filename")
-    args = parser.parse_args(in_args)
-
-    # add JEC lut
-    SETTINGS['jetEnergyCalibLUT'] = get_lut_contents(args.input)
-
+def write_xml(settings, xml_filename):
+    """Write settings (including the LUT) as programmable XML"""
     # construct XML
     algo = XT.Element("algo", {"id": "calol2"})
     context = XT.SubElement(algo, 'context', {"id": "MainProcessor"})
 
     # add actual settings
-    for k, v in SETTINGS.iteritems():
+    for k, v in settings.iteritems():
         type_str = TYPE_DICT[type(v)]['str']
         attrib_dict = {"id": k, "type": type_str}
         param = XT.SubElement(context, 'param', attrib_dict)
@@ -74,9 +75,31 @@ def do_lut_making(in_args=sys.argv[1:]):
     # write to file
     fcontents = minidom.parseString(XT.tostring(algo)).toprettyxml(indent=2*" ")
     fcontents = fcontents.replace('<?xml version="1.0" ?>\n', "")
-    with open(args.xml, 'w') as f:
+    with open(xml_filename, 'w') as f:
         f.write(fcontents)
 
 
+def read_xml_lut(xml_filename, param_id='jetEnergyCalibLUT'):
+    """Read a LUT (or any vector:uint param) from a programmable XML file
+    into a list of ints"""
+    algo = XT.parse(xml_filename).getroot()
+    for param in algo.iter('param'):
+        if param.get('id') == param_id:
+            return [int(x.strip(), 16) for x in param.text.split(',') if x.strip()]
+    raise KeyError("No param %s in %s" % (param_id, xml_filename))
+
+
+def do_lut_making(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="Input human readable (or binary) LUT")
+    parser.add_argument("xml", help="Output XML LUT filename")
+    args = parser.parse_args(in_args)
+
+    # add JEC lut
+    SETTINGS['jetEnergyCalibLUT'] = get_lut_contents(args.input)
+
+    write_xml(SETTINGS, args.xml)
+
+
 if __name__ == "__main__":
     sys.exit(do_lut_making())
@@ -0,0 +1,696 @@
+"""
+Vectorised fitting of response histograms, without ROOT.
+
+All the response histograms for an eta bin (one per pT bin) are fitted at once,
+passed as 2D numpy arrays of bin contents & squared errors with
+shape (number of hists, number of bins). The fits are chi2 fits done with a
+batched Levenberg-Marquardt minimisation, mirroring the ROOT fits in
+runCalibration.do_gauss_response_hist_fit and do_burr_response_hist_fit,
+including using the raw mean if the fit fails.
+
+Fit status codes:
+0: fit OK
+1: fit didn't converge
+2: fit converged but parameter errors couldn't be calculated
+3: fit OK, but failed the quality checks (Burr only)
+-1: too few entries or points to fit
+
+There are also robust, fit-free estimates of the response (median,
+truncated mean & IQR-based width), from either the unbinned responses for
+a pT bin or its response histogram.
+
+For uncertainties, the response for each pT bin can be calculated in many
+Poisson bootstrap replicas at once (see calc_bootstrap_responses).
+"""
+
+
+import numpy as np
+
+
+# Starting parameters for the Burr type III fit:
+# [c, d, normalisation, location, scale] (see runCalibration.burr3_fit)
+BURR3_DEFAULT_PARAMS = [3.64850e+00, 7.06077e-01, 1.28317e+04, -1.50503e-02, 4.87032e-01]
+BURR3_HIGHER_ETA_PARAMS = [4.08877e+00, 1.40812e+00, 9.49084e+01, -2.06920e-01, 9.41943e-01]
+# Range of Burr function, used to find its maximum
+BURR3_RANGE = (0., 2.)
+# Minimum number of entries for a Burr fit, below that the hist isn't rebinned
+BURR3_MIN_ENTRIES = 10
+
+
+def calc_hist_stats(contents, sumw2, centers):
+    """Calculate the same statistics as TH1 does from its bin contents.
+
+    Parameters
+    ----------
+    contents : numpy.ndarray
+        Bin contents, shape (number of hists, number of bins).
+        No underflow/overflow bins.
+    sumw2 : numpy.ndarray
+        Sum of squared weights for each bin, same shape as contents.
+    centers : numpy.ndarray
+        Bin centers.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        entries (effective number of entries), mean, rms & mean_err for each
+        hist, equivalent to GetEntries(), GetMean(), GetRMS() & GetMeanError()
+    """
+    sumw = contents.sum(axis=1)
+    sumw2_total = sumw2.sum(axis=1)
+    sumwx = (contents * centers).sum(axis=1)
+    sumwx2 = (contents * centers * centers).sum(axis=1)
+    ok = sumw != 0
+    safe_sumw = np.where(ok, sumw, 1.)
+    mean = np.where(ok, sumwx / safe_sumw, 0.)
+    rms = np.where(ok, np.sqrt(np.abs(sumwx2 / safe_sumw - mean * mean)), 0.)
+    has_sumw2 = ok & (sumw2_total > 0)
+    entries = np.where(has_sumw2, sumw * sumw / np.where(has_sumw2, sumw2_total, 1.), np.abs(sumw))
+    mean_err = np.where(entries > 0, rms / np.sqrt(np.where(entries > 0, entries, 1.)), 0.)
+    return dict(entries=entries, mean=mean, rms=rms, mean_err=mean_err)
+
+
+def gaus(params, x):
+    """Gaussian function, same as ROOT's "gaus" = [0]*exp(-0.5*((x-[1])/[2])^2)
+
+    Returns function values & jacobian wrt params.
+
+    Parameters
+    ----------
+    params : numpy.ndarray
+        Shape (number of functions, 3)
+    x : numpy.ndarray
+        Points to evaluate at, shape (number of points)
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Shapes (number of functions, number of points) and
+        (number of functions, number of points, 3)
+    """
+    const, mean, sigma = [params[:, i:i + 1] for i in range(3)]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        arg = (x - mean) / sigma
+        expo = np.exp(-0.5 * arg * arg)
+        vals = const * expo
+        jac = np.stack([expo, vals * arg / sigma, vals * arg * arg / sigma], axis=-1)
+    return vals, jac
+
+
+def burr3_values(params, x):
+    """Burr type III function, same as runCalibration.burr3_fit.
+
+    Parameters
+    ----------
+    params : numpy.ndarray
+        Shape (number of functions, 5): c, d, normalisation, location, scale
+    x : numpy.ndarray
+        Points to evaluate at, shape (number of points) or
+        (number of functions, number of points)
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (number of functions, number of points).
+        NaN where the function isn't defined.
+    """
+    c, d, norm, loc, scale = [params[:, i:i + 1] for i in range(5)]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        z = (x - loc) / scale
+        return norm * c * d * np.power(z, -1. - c) / np.power(1 + np.power(z, -c), 1 + d)
+
+
+def burr3(params, x):
+    """Burr type III function & jacobian wrt params (numerical).
+
+    See burr3_values().
+    """
+    vals = burr3_values(params, x)
+    jac = np.empty(vals.shape + (params.shape[1],))
+    for i in range(params.shape[1]):
+        step = 1E-6 * np.maximum(np.abs(params[:, i]), 1E-6)
+        up, down = params.copy(), params.copy()
+        up[:, i] += step
+        down[:, i] -= step
+        with np.errstate(invalid='ignore'):
+            jac[:, :, i] = (burr3_values(up, x) - burr3_values(down, x)) / (2 * step[:, None])
+    return vals, jac
+
+
+def _weighted_residuals(func, params, x, y, weights):
+    """Get chi2 residuals & their jacobian.
+
+    Points where the function (or its derivative) isn't finite are ignored,
+    like ROOT does.
+    """
+    vals, jac = func(params, x)
+    good = (weights > 0) & np.isfinite(vals) & np.all(np.isfinite(jac), axis=-1)
+    w = np.where(good, weights, 0.)
+    resid = np.where(good, (y - np.where(good, vals, 0.)) * w, 0.)
+    jac_w = np.where(good[:, :, None], jac, 0.) * w[:, :, None]
+    return resid, jac_w, good
+
+
+def levenberg_marquardt(func, params, x, y, errors, mask, max_iter=200, tol=1E-10):
+    """Do a batch of chi2 fits with the Levenberg-Marquardt method.
+
+    Each row is an independent fit, but all rows are iterated together.
+
+    Parameters
+    ----------
+    func : callable
+        func(params, x) returning values & jacobian, e.g. gaus()
+    params : numpy.ndarray
+        Starting parameters, shape (number of fits, number of parameters)
+    x : numpy.ndarray
+        Bin centers, shape (number of points)
+    y : numpy.ndarray
+        Bin contents, shape (number of fits, number of points)
+    errors : numpy.ndarray
+        Bin errors, same shape as y
+    mask : numpy.ndarray
+        Which points to use for each fit, same shape as y.
+        Points with zero error are always ignored.
+    max_iter : int, optional
+        Maximum number of iterations.
+    tol : float, optional
+        Fit is converged when relative change in chi2 is below this.
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray
+        Fitted parameters, parameter errors, chi2, status (see module docstring)
+    """
+    params = np.array(params, dtype=np.float64)
+    n_fits, n_params = params.shape
+    usable = mask & (errors > 0)
+    weights = np.where(usable, 1. / np.where(usable, errors, 1.), 0.)
+    diag = np.arange(n_params)
+
+    resid, jac, good = _weighted_residuals(func, params, x, y, weights)
+    chi2 = (resid * resid).sum(axis=1)
+    lam = np.full(n_fits, 1E-3)
+    converged = np.zeros(n_fits, dtype=bool)
+    # need at least as many points as parameters
+    active = good.sum(axis=1) >= n_params
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        ind = np.flatnonzero(active)
+        jt_j = np.einsum('bni,bnj->bij', jac[ind], jac[ind])
+        jt_r = np.einsum('bni,bn->bi', jac[ind], resid[ind])
+        damped = jt_j.copy()
+        damped[:, diag, diag] += lam[ind, None] * np.maximum(jt_j[:, diag, diag], 1E-12)
+        step = np.einsum('bij,bj->bi', np.linalg.pinv(damped), jt_r)
+        trial = params[ind] + step
+        trial_resid, trial_jac, trial_good = _weighted_residuals(func, trial, x, y[ind],
+                                                                 weights[ind])
+        trial_chi2 = (trial_resid * trial_resid).sum(axis=1)
+        better = (np.isfinite(trial_chi2) & (trial_chi2 <= chi2[ind]) &
+                  (trial_good.sum(axis=1) >= n_params))
+
+        acc = ind[better]
+        change = chi2[acc] - trial_chi2[better]
+        params[acc] = trial[better]
+        resid[acc] = trial_resid[better]
+        jac[acc] = trial_jac[better]
+        good[acc] = trial_good[better]
+        lam[acc] = np.maximum(lam[acc] / 10., 1E-12)
+        done = change <= tol * (chi2[acc] + tol)
+        chi2[acc] = trial_chi2[better]
+        converged[acc[done]] = True
+        active[acc[done]] = False
+
+        rej = ind[~better]
+        lam[rej] *= 10.
+        # can't improve any more - at the minimum (to numerical precision)
+        stuck = rej[lam[rej] > 1E10]
+        converged[stuck] = True
+        active[stuck] = False
+
+    # parameter errors from the covariance matrix
+    jt_j = np.einsum('bni,bnj->bij', jac, jac)
+    cov = np.linalg.pinv(jt_j)
+    variances = cov[:, diag, diag]
+    cov_ok = np.all(variances > 0, axis=1) & np.all(np.isfinite(variances), axis=1)
+    param_errors = np.sqrt(np.where(cov_ok[:, None], variances, 0.))
+
+    status = np.where(converged, np.where(cov_ok, 0, 2), 1)
+    status[good.sum(axis=1) < n_params] = -1
+    return params, param_errors, chi2, status
+
+
+def fit_gaus_batch(contents, sumw2, edges, min_entries=3, n_tries=3, fit_centre="mean"):
+    """Fit a Gaussian to each response hist, over mean +/- 1 RMS,
+    like runCalibration.do_gauss_response_hist_fit
+    (or peak +/- 1 RMS, like makeResolutionPlots.plot_bin_fit)
+
+    Parameters
+    ----------
+    contents : numpy.ndarray
+        Bin contents, shape (number of hists, number of bins).
+        No underflow/overflow bins.
+    sumw2 : numpy.ndarray
+        Sum of squared weights for each bin, same shape as contents.
+    edges : numpy.ndarray
+        Bin edges, shape (number of bins + 1)
+    min_entries : int, optional
+        Minimum number of entries needed to try fitting.
+    n_tries : int, optional
+        Number of times to try the fit, starting from the previous result.
+    fit_centre : str {"mean", "peak"}, optional
+        Centre the fit range on the mean, or the centre of the maximum bin.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        mean, err & status for each hist, so zip(mean, err, status) gives the
+        (mean, err, status) for each. If the fit failed (status != 0) the raw
+        mean is used. Also params, param_errors and fit_range (min, max)
+        for the Gaussian.
+    """
+    contents = np.asarray(contents, dtype=np.float64)
+    sumw2 = np.asarray(sumw2, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    widths = edges[1:] - edges[:-1]
+    stats = calc_hist_stats(contents, sumw2, centers)
+
+    if fit_centre == "peak":
+        centre = centers[np.argmax(contents, axis=1)]
+    else:
+        centre = stats["mean"]
+    fit_min = centre - stats["rms"]
+    fit_max = centre + stats["rms"]
+    in_range = (centers >= fit_min[:, None]) & (centers <= fit_max[:, None])
+
+    # starting values, same as ROOT does for "gaus"
+    range_contents = np.where(in_range, contents, 0.)
+    allcha = range_contents.sum(axis=1)
+    safe_allcha = np.where(allcha > 0, allcha, 1.)
+    start_mean = (range_contents * centers).sum(axis=1) / safe_allcha
+    start_rms = np.sqrt(np.abs((range_contents * centers * centers).sum(axis=1) / safe_allcha -
+                               start_mean * start_mean))
+    n_range_bins = in_range.sum(axis=1)
+    bin_width = widths.mean()
+    start_rms = np.where(start_rms > 0, start_rms, bin_width * np.maximum(n_range_bins, 1) / 4.)
+    start_const = 0.5 * (range_contents.max(axis=1) +
+                         bin_width * allcha / (np.sqrt(2 * np.pi) * start_rms))
+    params = np.stack([start_const, start_mean, start_rms], axis=-1)
+
+    n_hists = contents.shape[0]
+    status = np.full(n_hists, -1, dtype=int)
+    param_errors = np.zeros_like(params)
+    to_fit = np.flatnonzero(stats["entries"] >= min_entries)
+    for _ in range(n_tries):
+        if len(to_fit) == 0:
+            break
+        fit_params, fit_errors, _, fit_status = levenberg_marquardt(gaus, params[to_fit], centers,
+                                                                    contents[to_fit],
+                                                                    np.sqrt(sumw2[to_fit]),
+                                                                    in_range[to_fit])
+        params[to_fit] = fit_params
+        param_errors[to_fit] = fit_errors
+        status[to_fit] = fit_status
+        to_fit = to_fit[fit_status != 0]
+
+    ok = status == 0
+    mean = np.where(ok, params[:, 1], stats["mean"])
+    err = np.where(ok, param_errors[:, 1], stats["mean_err"])
+    return dict(mean=mean, err=err, status=status,
+                params=params, param_errors=param_errors,
+                fit_range=np.stack([fit_min, fit_max], axis=-1))
+
+
+def calc_burr3_mode(params, x_range=BURR3_RANGE, n_scan=2000):
+    """Find the position & value of the maximum of Burr III functions within
+    x_range, like TF1::GetMaximumX() & GetMaximum().
+
+    Uses the analytic mode where it lies inside the range, otherwise a scan.
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Position & value of maximum for each set of params.
+    """
+    c, d, loc, scale = params[:, 0], params[:, 1], params[:, 3], params[:, 4]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        comp = (c * d - 1.) / (c + 1.)
+        mode = loc + scale * np.power(comp, 1. / c)
+        analytic_ok = (np.isfinite(mode) & (comp > 0) & (scale > 0) &
+                       (mode > x_range[0]) & (mode < x_range[1]))
+
+    # scan for the rest
+    xs = np.linspace(x_range[0], x_range[1], n_scan)
+    scan_vals = burr3_values(params, xs)
+    scan_vals = np.where(np.isfinite(scan_vals), scan_vals, -np.inf)
+    scan_mode = xs[np.argmax(scan_vals, axis=1)]
+    mode = np.where(analytic_ok, mode, scan_mode)
+    max_val = burr3_values(params, mode[:, None])[:, 0]
+    return mode, max_val
+
+
+def calc_burr3_mode_error(mode, params, param_errors):
+    """Total error on the Burr III mode from the errors on fitted params,
+    same as runCalibration.calc_burr_mode_error, for arrays of fits"""
+    c, d, loc, scale = params[:, 0], params[:, 1], params[:, 3], params[:, 4]
+    err_c, err_d = param_errors[:, 0], param_errors[:, 1]
+    err_mu, err_s = param_errors[:, 3], param_errors[:, 4]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # mu
+        diff_mu = np.ones_like(mode)
+        # s
+        comp_s = (c * d + 1.) / (c + 1.)
+        diff_s = np.where(comp_s > 0, np.power(np.abs(comp_s), 1. / c), 0.)
+        # c
+        comp_c = (c + 1.) / (c * d - 1.)
+        part2 = np.where(comp_c > 0, np.log(np.abs(comp_c)) / c**2, 0.)
+        part3 = (d + 1) / (c * (c * d - 1.) * (c + 1.))
+        diff_c = (mode - loc) * (part2 + part3)
+        # d
+        comp_d = (c * d - 1.) / (1. + c)
+        diff_d = np.where(comp_d > 0, (scale / (c * d - 1.)) * np.power(np.abs(comp_d), 1. / c), 0.)
+        total = ((diff_mu * err_mu)**2 + (diff_s * err_s)**2 +
+                 (diff_c * err_c)**2 + (diff_d * err_d)**2)
+    return np.sqrt(total)
+
+
+def fit_burr3_batch(contents, sumw2, edges, start_params=BURR3_DEFAULT_PARAMS,
+                    min_entries=BURR3_MIN_ENTRIES, n_tries=3):
+    """Fit a Burr type III function to each response hist, and get its mode,
+    like runCalibration.do_burr_response_hist_fit
+
+    Like that, hists are rebinned by 2 before fitting, and the fit is
+    rejected if the function maximum isn't within 20% of the hist maximum.
+
+    Parameters
+    ----------
+    contents : numpy.ndarray
+        Bin contents, shape (number of hists, number of bins).
+        No underflow/overflow bins.
+    sumw2 : numpy.ndarray
+        Sum of squared weights for each bin, same shape as contents.
+    edges : numpy.ndarray
+        Bin edges, shape (number of bins + 1)
+    start_params : list, optional
+        Starting parameters for the fit.
+    min_entries : int, optional
+        Minimum number of entries needed to try fitting.
+    n_tries : int, optional
+        Number of times to try the fit, starting from the previous result.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        mean (= fitted mode), err & status for each hist. If the fit failed
+        (status != 0) the raw mean is used. Also params & param_errors.
+    """
+    contents = np.asarray(contents, dtype=np.float64)
+    sumw2 = np.asarray(sumw2, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    # TH1::Rebin keeps the original stats
+    stats = calc_hist_stats(contents, sumw2, centers)
+
+    # Rebin by 2, extra bin at the end goes into overflow, like TH1::Rebin
+    n_new = contents.shape[1] // 2
+    contents = contents[:, :2 * n_new].reshape(-1, n_new, 2).sum(axis=2)
+    sumw2 = sumw2[:, :2 * n_new].reshape(-1, n_new, 2).sum(axis=2)
+    edges = edges[:2 * n_new + 1:2]
+    centers = 0.5 * (edges[1:] + edges[:-1])
+
+    n_hists = contents.shape[0]
+    params = np.tile(np.asarray(start_params, dtype=np.float64), (n_hists, 1))
+    param_errors = np.zeros_like(params)
+    status = np.full(n_hists, -1, dtype=int)
+    mask = np.ones_like(contents, dtype=bool)
+    to_fit = np.flatnonzero(stats["entries"] >= min_entries)
+    for _ in range(n_tries):
+        if len(to_fit) == 0:
+            break
+        fit_params, fit_errors, _, fit_status = levenberg_marquardt(burr3, params[to_fit], centers,
+                                                                    contents[to_fit],
+                                                                    np.sqrt(sumw2[to_fit]),
+                                                                    mask[to_fit])
+        params[to_fit] = fit_params
+        param_errors[to_fit] = fit_errors
+        status[to_fit] = fit_status
+        to_fit = to_fit[fit_status != 0]
+
+    mode, fn_max = calc_burr3_mode(params)
+    err = calc_burr3_mode_error(mode, params, param_errors)
+    hist_max = contents.max(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_ratio = fn_max / hist_max
+    good_quality = (mode > 0) & (err > 0) & (max_ratio >= 0.8) & (max_ratio <= 1.2)
+    status = np.where((status == 0) & ~good_quality, 3, status)
+
+    ok = status == 0
+    mean = np.where(ok, mode, stats["mean"])
+    err = np.where(ok, err, stats["mean_err"])
+    return dict(mean=mean, err=err, status=status, params=params, param_errors=param_errors)
+
+
+def apply_batch_fit(hist, fit_results, ind, do_burr, store_function):
+    """Update a response hist with the results of a batch fit, as
+    runCalibration.do_(burr|gauss)_response_hist_fit would.
+
+    For Burr fits, hists with at least BURR3_MIN_ENTRIES entries are rebinned
+    by 2 whatever the fit status, as the ROOT fit rebins before fitting.
+    The fit function is only stored if the fit converged.
+
+    Parameters
+    ----------
+    hist : ROOT.TH1
+        Response hist, only GetEntries & Rebin are used.
+    fit_results : dict{str : numpy.ndarray}
+        From fit_gaus_batch or fit_burr3_batch.
+    ind : int
+        Index of hist in fit_results.
+    do_burr : bool
+        If fit_results are from Burr fits.
+    store_function : callable
+        Called as store_function(hist, fit_results, ind, do_burr) to
+        store the fit function in hist.
+
+    Returns
+    -------
+    bool
+        True if the fit converged (status 0).
+    """
+    if do_burr and hist.GetEntries() >= BURR3_MIN_ENTRIES:
+        hist.Rebin(2)
+    if fit_results["status"][ind] != 0:
+        return False
+    store_function(hist, fit_results, ind, do_burr)
+    return True
+
+
+# Fraction of entries trimmed from each side for the truncated mean
+TRUNC_FRACTION = 0.1
+# Interquartile range of a Gaussian, in units of its sigma
+IQR_TO_SIGMA = 1.3489795
+
+QUANTILE_ESTIMATORS = ["median", "truncmean"]
+
+
+def _quantile_estimate_errors(n, width, winsorized_std, trunc_fraction):
+    """Errors on median (assuming Gaussian) & truncated mean (from winsorized std. dev.)"""
+    if n <= 1:
+        return 0., 0.
+    median_err = np.sqrt(np.pi / 2.) * width / np.sqrt(n)
+    truncmean_err = winsorized_std / ((1. - 2. * trunc_fraction) * np.sqrt(n))
+    return median_err, truncmean_err
+
+
+def calc_quantile_estimates(values, trunc_fraction=TRUNC_FRACTION):
+    """Calculate robust estimates of the response for one pT bin, from the
+    unbinned responses.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Response of each pair.
+    trunc_fraction : float, optional
+        Fraction of entries trimmed from each side for the truncated mean.
+
+    Returns
+    -------
+    dict{str : float}
+        median, median_err, truncmean, truncmean_err, width
+        (= IQR / 1.349, i.e. sigma for a Gaussian), entries
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n == 0:
+        return dict(median=0., median_err=0., truncmean=0., truncmean_err=0., width=0., entries=0)
+    q25, median, q75, lo, hi = np.percentile(values, [25, 50, 75,
+                                                      100. * trunc_fraction,
+                                                      100. * (1. - trunc_fraction)])
+    width = (q75 - q25) / IQR_TO_SIGMA
+    truncmean = values[(values >= lo) & (values <= hi)].mean()
+    winsorized_std = np.clip(values, lo, hi).std(ddof=1) if n > 1 else 0.
+    median_err, truncmean_err = _quantile_estimate_errors(n, width, winsorized_std, trunc_fraction)
+    return dict(median=median, median_err=median_err, truncmean=truncmean,
+                truncmean_err=truncmean_err, width=width, entries=n)
+
+
+def calc_hist_quantiles(contents, edges, quantiles):
+    """Calculate quantiles of a histogram, interpolating linearly within bins.
+
+    Parameters
+    ----------
+    contents : numpy.ndarray
+        Bin contents, no underflow/overflow.
+    edges : numpy.ndarray
+        Bin edges.
+    quantiles : list[float]
+        Quantiles to get, in [0, 1].
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    cdf = np.concatenate(([0.], np.cumsum(contents)))
+    return np.interp(np.asarray(quantiles) * cdf[-1], cdf, edges)
+
+
+def calc_hist_quantile_estimates(contents, edges, trunc_fraction=TRUNC_FRACTION):
+    """Like calc_quantile_estimates, but from a response histogram,
+    for when the unbinned responses aren't available.
+
+    Parameters
+    ----------
+    contents : numpy.ndarray
+        Bin contents, no underflow/overflow.
+    edges : numpy.ndarray
+        Bin edges.
+    trunc_fraction : float, optional
+        Fraction of entries trimmed from each side for the truncated mean.
+
+    Returns
+    -------
+    dict{str : float}
+        See calc_quantile_estimates
+    """
+    contents = np.asarray(contents, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    n = contents.sum()
+    if n <= 0:
+        return dict(median=0., median_err=0., truncmean=0., truncmean_err=0., width=0., entries=0)
+    q25, median, q75, lo, hi = calc_hist_quantiles(contents, edges, [0.25, 0.5, 0.75,
+                                                                     trunc_fraction,
+                                                                     1. - trunc_fraction])
+    width = (q75 - q25) / IQR_TO_SIGMA
+    # only count the part of each bin inside [lo, hi], assuming flat within bins
+    left, right = np.clip(edges[:-1], lo, hi), np.clip(edges[1:], lo, hi)
+    kept = contents * (right - left) / (edges[1:] - edges[:-1])
+    truncmean = (kept * 0.5 * (left + right)).sum() / kept.sum() if kept.sum() > 0 else median
+    winsorized = np.clip(0.5 * (edges[:-1] + edges[1:]), lo, hi)
+    winsorized_mean = (contents * winsorized).sum() / n
+    winsorized_var = (contents * (winsorized - winsorized_mean)**2).sum() / max(n - 1., 1.)
+    median_err, truncmean_err = _quantile_estimate_errors(n, width, np.sqrt(winsorized_var),
+                                                          trunc_fraction)
+    return dict(median=median, median_err=median_err, truncmean=truncmean,
+                truncmean_err=truncmean_err, width=width, entries=n)
+
+
+BOOTSTRAP_ESTIMATORS = QUANTILE_ESTIMATORS + ["gaus", "burr"]
+
+
+def make_poisson_weights(n_replicas, n_values, seed=None):
+    """Make Poisson(1) weights for each value in each bootstrap replica.
+
+    Weighting each value by Poisson(1) is equivalent to resampling with
+    replacement for large samples, but each replica can be made independently
+    of the others, from the same pass over the values.
+
+    Parameters
+    ----------
+    n_replicas : int
+        Number of bootstrap replicas.
+    n_values : int
+        Number of values.
+    seed : int or list[int], optional
+        Seed for the random numbers, for reproducible replicas.
+
+    Returns
+    -------
+    numpy.ndarray
+        Integer weights, shape (n_replicas, n_values)
+    """
+    rng = np.random.RandomState(seed)
+    return rng.poisson(1., size=(n_replicas, n_values)).astype(np.int32)
+
+
+def fill_weighted_hists(values, weights, edges):
+    """Make one histogram of values for each row of weights.
+
+    Values outside the edges are dropped, with the upper edge exclusive like TH1.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values to histogram, shape (n_values)
+    weights : numpy.ndarray
+        Weights, shape (n_hists, n_values)
+    edges : numpy.ndarray
+        Bin edges, shape (number of bins + 1)
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Bin contents & sum of squared weights, shape (n_hists, number of bins)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n_hists, n_bins = weights.shape[0], len(edges) - 1
+    bins = np.searchsorted(edges, values, side='right') - 1
+    in_range = (bins >= 0) & (bins < n_bins)
+    flat_bins = (np.arange(n_hists)[:, None] * n_bins + bins[in_range][None, :]).ravel()
+    weights = weights[:, in_range]
+    contents = np.bincount(flat_bins, weights=weights.ravel(), minlength=n_hists * n_bins)
+    sumw2 = np.bincount(flat_bins, weights=(weights * weights).ravel(), minlength=n_hists * n_bins)
+    return contents.reshape(n_hists, n_bins), sumw2.reshape(n_hists, n_bins)
+
+
+def calc_bootstrap_responses(values, weights, edges, estimator, start_params=BURR3_DEFAULT_PARAMS):
+    """Calculate the response for one pT bin in each bootstrap replica.
+
+    The Gaussian & Burr fits are done for all replicas at once,
+    on response hists with the given edges.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Response of each pair.
+    weights : numpy.ndarray
+        Integer weights for each replica, shape (n_replicas, n_values),
+        e.g. from make_poisson_weights
+    edges : numpy.ndarray
+        Response hist bin edges.
+    estimator : str
+        One of BOOTSTRAP_ESTIMATORS.
+    start_params : list, optional
+        Starting parameters for Burr fits.
+
+    Returns
+    -------
+    numpy.ndarray
+        Response for each replica. NaN if a replica has no entries.
+    """
+    if estimator not in BOOTSTRAP_ESTIMATORS:
+        raise ValueError("estimator must be one of %s" % BOOTSTRAP_ESTIMATORS)
+    values = np.asarray(values, dtype=np.float64)
+    if estimator in QUANTILE_ESTIMATORS:
+        responses = []
+        for replica_weights in weights:
+            estimates = calc_quantile_estimates(np.repeat(values, replica_weights))
+            responses.append(estimates[estimator] if estimates["entries"] > 0 else np.nan)
+        return np.array(responses)
+    contents, sumw2 = fill_weighted_hists(values, weights, edges)
+    if estimator == "burr":
+        fits = fit_burr3_batch(contents, sumw2, edges, start_params)
+    else:
+        fits = fit_gaus_batch(contents, sumw2, edges)
+    return np.where(contents.sum(axis=1) > 0, fits["mean"], np.nan)
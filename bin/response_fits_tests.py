@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""Unit tests for the numpy response hist fitting backend.
+
+The parity tests compare against the ROOT fits in runCalibration,
+so are skipped if ROOT isn't available.
+"""
+
+
+import response_fits as rf
+import unittest
+import numpy as np
+
+try:
+    import ROOT
+    import runCalibration as rc
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+    HAVE_ROOT = True
+except ImportError:
+    HAVE_ROOT = False
+
+
+def make_gaus_hists(means, n_entries, edges, seed=1):
+    """Make response hists of Gaussians, width 15% of mean"""
+    rng = np.random.RandomState(seed)
+    return np.array([np.histogram(rng.normal(m, 0.15 * m, n), edges)[0]
+                     for m, n in zip(means, n_entries)], dtype=float)
+
+
+def make_burr3_hists(scales, n_entries, edges, c=3.6, d=0.7, seed=1):
+    """Make response hists of Burr type III distributions"""
+    rng = np.random.RandomState(seed)
+    hists = []
+    for s, n in zip(scales, n_entries):
+        u = rng.uniform(size=n)
+        hists.append(np.histogram(s * (u**(-1. / d) - 1)**(-1. / c), edges)[0])
+    return np.array(hists, dtype=float)
+
+
+def make_root_hist(contents, edges, name):
+    hist = ROOT.TH1D(name, "", len(edges) - 1, edges[0], edges[-1])
+    hist.SetDirectory(0)
+    for i, val in enumerate(contents):
+        hist.SetBinContent(i + 1, val)
+        hist.SetBinError(i + 1, np.sqrt(val))
+    hist.ResetStats()
+    return hist
+
+
+class TestGausFit(unittest.TestCase):
+    def setUp(self):
+        self.edges = np.linspace(0, 5, 151)
+        self.means = np.linspace(0.6, 1.4, 20)
+        self.contents = make_gaus_hists(self.means, [20000] * len(self.means), self.edges)
+
+    def test_gaus_mean(self):
+        """Check fitted means are close to the true ones"""
+        results = rf.fit_gaus_batch(self.contents, self.contents, self.edges)
+        self.assertTrue(np.all(results["status"] == 0))
+        self.assertTrue(np.allclose(results["mean"], self.means, atol=0.01))
+        self.assertTrue(np.all(results["err"] > 0))
+
+    def test_gaus_too_few_entries(self):
+        """Check hists with < 3 entries use the raw mean"""
+        contents = np.zeros((1, len(self.edges) - 1))
+        contents[0, 30] = 2
+        results = rf.fit_gaus_batch(contents, contents, self.edges)
+        self.assertEqual(results["status"][0], -1)
+        self.assertAlmostEqual(results["mean"][0], 0.5 * (self.edges[30] + self.edges[31]))
+
+    def test_peak_fit_range(self):
+        """Check the fit range is centred on the maximum bin, with fit_centre of peak"""
+        results = rf.fit_gaus_batch(self.contents, self.contents, self.edges, fit_centre="peak")
+        self.assertTrue(np.all(results["status"] == 0))
+        centers = 0.5 * (self.edges[1:] + self.edges[:-1])
+        peaks = centers[np.argmax(self.contents, axis=1)]
+        self.assertTrue(np.allclose(results["fit_range"].mean(axis=1), peaks))
+        self.assertTrue(np.allclose(results["mean"], self.means, atol=0.01))
+
+    def test_empty_hist(self):
+        """Check an empty hist gives mean of 0, like TH1::GetMean()"""
+        contents = np.zeros((1, len(self.edges) - 1))
+        results = rf.fit_gaus_batch(contents, contents, self.edges)
+        self.assertEqual(results["mean"][0], 0)
+        self.assertEqual(results["err"][0], 0)
+
+
+class TestBurrFit(unittest.TestCase):
+    def setUp(self):
+        self.edges = np.linspace(0, 5, 151)
+        self.scales = np.linspace(0.5, 0.7, 10)
+        self.contents = make_burr3_hists(self.scales, [50000] * len(self.scales), self.edges)
+        c, d = 3.6, 0.7
+        self.modes = self.scales * ((c * d - 1) / (c + 1))**(1 / c)
+
+    def test_burr_mode(self):
+        """Check fitted modes are close to the true ones"""
+        results = rf.fit_burr3_batch(self.contents, self.contents, self.edges)
+        self.assertTrue(np.all(results["status"] == 0))
+        self.assertTrue(np.allclose(results["mean"], self.modes, atol=0.01))
+
+    def test_burr_too_few_entries(self):
+        """Check hists with < 10 entries use the raw mean"""
+        contents = np.zeros((1, len(self.edges) - 1))
+        contents[0, 30] = 9
+        results = rf.fit_burr3_batch(contents, contents, self.edges)
+        self.assertEqual(results["status"][0], -1)
+        self.assertAlmostEqual(results["mean"][0], 0.5 * (self.edges[30] + self.edges[31]))
+
+
+class StandInHist(object):
+    """Stand-in for a ROOT TH1 in apply_batch_fit, records rebinning"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.rebins = []
+
+    def GetEntries(self):
+        return self.entries
+
+    def Rebin(self, ngroup):
+        self.rebins.append(ngroup)
+
+
+class TestApplyBatchFit(unittest.TestCase):
+    """Check response hists are rebinned & get fit functions like the ROOT fits"""
+
+    def setUp(self):
+        self.stored = []
+        self.fit_results = dict(status=np.array([0, 3, 1, -1]))
+
+    def store_function(self, hist, fit_results, ind, do_burr):
+        self.stored.append(ind)
+
+    def test_burr_converged(self):
+        hist = StandInHist(50000)
+        self.assertTrue(rf.apply_batch_fit(hist, self.fit_results, 0, True, self.store_function))
+        self.assertEqual(hist.rebins, [2])
+        self.assertEqual(self.stored, [0])
+
+    def test_burr_failed_still_rebinned(self):
+        """Failed fits with enough entries are rebinned, but get no function"""
+        for ind in [1, 2]:
+            hist = StandInHist(rf.BURR3_MIN_ENTRIES)
+            self.assertFalse(rf.apply_batch_fit(hist, self.fit_results, ind, True,
+                                                self.store_function))
+            self.assertEqual(hist.rebins, [2])
+        self.assertEqual(self.stored, [])
+
+    def test_burr_too_few_entries(self):
+        hist = StandInHist(rf.BURR3_MIN_ENTRIES - 1)
+        self.assertFalse(rf.apply_batch_fit(hist, self.fit_results, 3, True, self.store_function))
+        self.assertEqual(hist.rebins, [])
+        self.assertEqual(self.stored, [])
+
+    def test_gaus_not_rebinned(self):
+        hist = StandInHist(50000)
+        self.assertTrue(rf.apply_batch_fit(hist, self.fit_results, 0, False, self.store_function))
+        self.assertFalse(rf.apply_batch_fit(hist, self.fit_results, 2, False, self.store_function))
+        self.assertEqual(hist.rebins, [])
+        self.assertEqual(self.stored, [0])
+
+
+class TestQuantileEstimators(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.values = rng.normal(0.9, 0.15, 100000)
+        self.edges = np.linspace(0, 5, 151)
+
+    def test_unbinned(self):
+        """Check median, truncated mean & width of a Gaussian"""
+        est = rf.calc_quantile_estimates(self.values)
+        self.assertAlmostEqual(est["median"], 0.9, delta=3 * est["median_err"])
+        self.assertAlmostEqual(est["truncmean"], 0.9, delta=3 * est["truncmean_err"])
+        self.assertAlmostEqual(est["width"], 0.15, delta=0.003)
+
+    def test_binned_matches_unbinned(self):
+        """Check hist estimates are close to the unbinned ones"""
+        est = rf.calc_quantile_estimates(self.values)
+        contents = np.histogram(self.values, self.edges)[0]
+        est_hist = rf.calc_hist_quantile_estimates(contents, self.edges)
+        for name in ["median", "truncmean", "width"]:
+            self.assertAlmostEqual(est[name], est_hist[name], delta=0.001)
+
+    def test_empty(self):
+        """Check no entries gives 0, like TH1::GetMean()"""
+        self.assertEqual(rf.calc_quantile_estimates([])["median"], 0)
+        est_hist = rf.calc_hist_quantile_estimates(np.zeros(len(self.edges) - 1), self.edges)
+        self.assertEqual(est_hist["truncmean"], 0)
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.values = rng.normal(0.9, 0.15, 20000)
+        self.edges = np.linspace(0, 5, 151)
+        self.weights = rf.make_poisson_weights(50, len(self.values), seed=3)
+
+    def test_weighted_hists(self):
+        """Check each replica hist matches a weighted np.histogram"""
+        contents, sumw2 = rf.fill_weighted_hists(self.values, self.weights[:3], self.edges)
+        for i in range(3):
+            w = self.weights[i]
+            expected, _ = np.histogram(self.values, self.edges, weights=w)
+            np.testing.assert_allclose(contents[i], expected)
+            expected, _ = np.histogram(self.values, self.edges, weights=w * w)
+            np.testing.assert_allclose(sumw2[i], expected)
+
+    def test_spread_matches_error(self):
+        """Check spread of replica responses is like the fit & median errors"""
+        contents, sumw2 = rf.fill_weighted_hists(self.values, np.ones((1, len(self.values))),
+                                                 self.edges)
+        fit = rf.fit_gaus_batch(contents, sumw2, self.edges)
+        rsp = rf.calc_bootstrap_responses(self.values, self.weights, self.edges, "gaus")
+        self.assertAlmostEqual(rsp.std(), fit["err"][0], delta=0.3 * fit["err"][0])
+        est = rf.calc_quantile_estimates(self.values)
+        rsp = rf.calc_bootstrap_responses(self.values, self.weights, self.edges, "median")
+        self.assertAlmostEqual(rsp.std(), est["median_err"], delta=0.3 * est["median_err"])
+
+    def test_bad_estimator(self):
+        with self.assertRaises(ValueError):
+            rf.calc_bootstrap_responses(self.values, self.weights, self.edges, "mode")
+
+
+@unittest.skipUnless(HAVE_ROOT, "Needs ROOT")
+class TestROOTParity(unittest.TestCase):
+    """Compare with the ROOT fits in runCalibration"""
+
+    def setUp(self):
+        self.edges = np.linspace(0, 5, 151)
+
+    def test_gaus_parity(self):
+        means = np.linspace(0.5, 1.5, 15)
+        n_entries = np.linspace(50, 50000, len(means)).astype(int)
+        contents = make_gaus_hists(means, n_entries, self.edges)
+        results = rf.fit_gaus_batch(contents, contents, self.edges)
+        for i, row in enumerate(contents):
+            hist = make_root_hist(row, self.edges, "h_gaus_%d" % i)
+            mean, err = rc.do_gauss_response_hist_fit(hist)
+            self.assertAlmostEqual(results["mean"][i], mean, delta=1E-4 * abs(mean))
+            self.assertAlmostEqual(results["err"][i], err, delta=0.02 * abs(err))
+
+    def test_burr_parity(self):
+        scales = np.linspace(0.5, 0.7, 5)
+        contents = make_burr3_hists(scales, [50000] * len(scales), self.edges)
+        results = rf.fit_burr3_batch(contents, contents, self.edges)
+        for i, row in enumerate(contents):
+            hist = make_root_hist(row, self.edges, "h_burr_%d" % i)
+            mode, err = rc.do_burr_response_hist_fit(hist, rc.setup_burr3)
+            self.assertAlmostEqual(results["mean"][i], mode, delta=1E-3 * abs(mode))
+            self.assertAlmostEqual(results["err"][i], err, delta=0.05 * abs(err))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Persistent cache of intermediate calibration results, so that reruns
+(e.g. changing some pT bin edges, or the correction fit starting values)
+only redo the parts that have changed.
+
+Each entry is a dict of numpy arrays, stored as one .npz file in the cache
+directory, named by the hash of its key. A key is any JSON-able dict, and
+should include everything that determines the result: input file fingerprint,
+cut strings, binning, fit settings, etc. Reading an entry marks it as recently
+used, and the least recently used entries are deleted when the cache is bigger
+than its disk budget.
+
+Usage:
+>>> cache = ResultCache("calib_cache", max_size=5 * 1024**3)
+>>> key = dict(input=file_fingerprint("pairs.root"), cut="pt < 1023.1")
+>>> result = cache.get(key)
+>>> if result is None:
+...     result = dict(x=np.arange(10))
+...     cache.put(key, result)
+"""
+
+
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import numpy as np
+
+
+def file_fingerprint(filename):
+    """Identify a file by its path, size & modification time,
+    which is enough to tell if it has changed without reading it all.
+
+    Returns
+    -------
+    dict
+    """
+    stat = os.stat(filename)
+    return dict(path=os.path.realpath(filename), size=stat.st_size, mtime=stat.st_mtime)
+
+
+class ResultCache(object):
+    """Cache of dicts of numpy arrays, with least-recently-used eviction.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for cache entries, made if it doesn't exist.
+    max_size : int, optional
+        Disk budget in bytes.
+    auto_evict : bool, optional
+        Evict old entries after each put(). Set False when several processes
+        share the cache, and call evict() once when they have all finished,
+        so they don't all try to delete the same entries at once.
+    """
+
+    SUFFIX = ".npz"
+
+    def __init__(self, cache_dir, max_size=20 * 1024**3, auto_evict=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.auto_evict = auto_evict
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def hash_key(key):
+        """Turn a key dict into a hash, independent of dict ordering"""
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def _entry_filename(self, key):
+        return os.path.join(self.cache_dir, self.hash_key(key) + self.SUFFIX)
+
+    def get(self, key):
+        """Get the entry for key, or None if it isn't in the cache.
+
+        Returns
+        -------
+        dict{str : numpy.ndarray} or None
+        """
+        filename = self._entry_filename(key)
+        try:
+            with open(filename, "rb") as f:
+                contents = np.load(f)
+                stored_key = json.loads(str(contents["__key__"]))
+                entry = {name: contents[name] for name in contents.files if name != "__key__"}
+        except (IOError, OSError, KeyError, ValueError):
+            # not there, or deleted/corrupted under us: treat as a miss
+            self.misses += 1
+            return None
+        if stored_key != json.loads(json.dumps(key)):
+            # hash collision
+            self.misses += 1
+            return None
+        try:
+            os.utime(filename, None)  # mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Store entry for key, then evict old entries if over budget
+        (if auto_evict).
+
+        Parameters
+        ----------
+        key : dict
+            JSON-able key.
+        entry : dict{str : numpy.ndarray}
+            Arrays to store.
+        """
+        filename = self._entry_filename(key)
+        arrays = dict(entry)
+        arrays["__key__"] = np.array(json.dumps(key, sort_keys=True))
+        # write to a temp file then rename, so other processes never see half an entry
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.rename(tmp_filename, filename)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        if self.auto_evict:
+            self.evict()
+
+    def size(self):
+        """Total size of entries in bytes"""
+        return sum(size for _, size, _ in self._list_entries())
+
+    def _list_entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.SUFFIX):
+                continue
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((filename, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until within the disk budget."""
+        entries = sorted(self._list_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for filename, size, _ in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass  # someone else got there first
+            total -= size
+
+    def clear(self):
+        """Delete all entries"""
+        for filename, _, _ in self._list_entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def print_stats(self):
+        print ("Result cache %s: %d hits, %d misses, %.1f MB"
+               % (self.cache_dir, self.hits, self.misses, self.size() / 1024.**2))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Unit tests for the persistent result cache"""
+
+
+import result_cache as rc
+import unittest
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = rc.ResultCache(os.path.join(self.cache_dir, "cache"))
+        self.key = dict(input="pairs.root", cut="pt < 1023.1", bins=[0, 10, 20])
+        self.entry = dict(x=np.arange(10), y=np.linspace(0, 1, 5).reshape(5, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        self.cache.put(self.key, self.entry)
+        # key order shouldn't matter
+        result = self.cache.get(dict(reversed(list(self.key.items()))))
+        self.assertEqual(sorted(result.keys()), ["x", "y"])
+        for name, arr in self.entry.iteritems():
+            self.assertTrue(np.array_equal(result[name], arr))
+            self.assertEqual(result[name].dtype, arr.dtype)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_changed_key_misses(self):
+        self.cache.put(self.key, self.entry)
+        changed_key = dict(self.key, bins=[0, 10, 25])
+        self.assertIsNone(self.cache.get(changed_key))
+        self.assertIsNone(self.cache.get(dict(self.key, extra=1)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_evict_by_size(self):
+        """Check least recently used entries go first when over budget"""
+        entries = [dict(x=np.full(1000, i, dtype=np.float64)) for i in range(4)]
+        keys = [dict(self.key, ind=i) for i in range(4)]
+        for i, (key, entry) in enumerate(zip(keys[:3], entries[:3])):
+            self.cache.put(key, entry)
+            filename = self.cache._entry_filename(key)
+            os.utime(filename, (1000 + i, 1000 + i))
+        entry_size = self.cache.size() / 3
+        # allow 3 entries, then use the oldest so it isn't evicted next
+        self.cache.max_size = 3 * entry_size
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.put(keys[3], entries[3])
+        self.assertLessEqual(self.cache.size(), self.cache.max_size)
+        self.assertIsNone(self.cache.get(keys[1]))
+        for key, entry in zip([keys[0], keys[2], keys[3]], [entries[0], entries[2], entries[3]]):
+            self.assertTrue(np.array_equal(self.cache.get(key)["x"], entry["x"]))
+
+    def test_no_auto_evict(self):
+        """Check put() doesn't evict without auto_evict, but evict() does"""
+        cache = rc.ResultCache(self.cache.cache_dir, max_size=0, auto_evict=False)
+        for i in range(3):
+            cache.put(dict(self.key, ind=i), self.entry)
+        self.assertEqual(len(cache._list_entries()), 3)
+        cache.evict()
+        self.assertEqual(cache.size(), 0)
+
+    def test_clear(self):
+        self.cache.put(self.key, self.entry)
+        self.cache.clear()
+        self.assertEqual(self.cache.size(), 0)
+        self.assertIsNone(self.cache.get(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
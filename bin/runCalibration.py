@@ -17,12 +17,24 @@ Originally by Nick Wardle, modified(hacked to shreds) by Robin Aggleton
 import ROOT
 import os
 import sys
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 import argparse
 import binning
 from binning import pairwise
 import common_utils as cu
+import response_fits as rf
+import correction_fits as cf
+import fit_ranges as fr
+import pair_summaries as ps
+import result_cache as rcache
+import profiling
+from profiling import PROFILER
+from multifunc import eval_array
 from math import sqrt, log
+from collections import OrderedDict, namedtuple
 
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -49,18 +61,12 @@ forward_fit = ROOT.TF1("fitfcn", "pol0")
 burr3_fit = ROOT.TF1("burr3", "[2]*[0]*[1]*pow((x-[3])/[4], -1.-[0]) / pow(1+pow((x-[3])/[4], -[0]), 1+[1] )", 0, 2)
 
 def setup_burr3():
-    burr3_fit.SetParameter(0, 3.64850e+00)
-    burr3_fit.SetParameter(1, 7.06077e-01)
-    burr3_fit.SetParameter(2, 1.28317e+04)
-    burr3_fit.SetParameter(3, -1.50503e-02)
-    burr3_fit.SetParameter(4, 4.87032e-01)
+    for ind, val in enumerate(rf.BURR3_DEFAULT_PARAMS):
+        burr3_fit.SetParameter(ind, val)
 
 def setup_burr3_higherEta():
-    burr3_fit.SetParameter(0, 4.08877e+00)
-    burr3_fit.SetParameter(1, 1.40812e+00)
-    burr3_fit.SetParameter(2, 9.49084e+01)
-    burr3_fit.SetParameter(3, -2.06920e-01)
-    burr3_fit.SetParameter(4, 9.41943e-01)
+    for ind, val in enumerate(rf.BURR3_HIGHER_ETA_PARAMS):
+        burr3_fit.SetParameter(ind, val)
 
 setup_burr3()
 
@@ -77,6 +83,13 @@ burr12_fit.SetParameter(2, 367)
 burr12_fit.SetParameter(3, 0)
 burr12_fit.SetParameter(4, 1.01)
 
+# Branches of the pairs tree used to make the correction curves
+PAIRS_COLUMNS = ["rsp", "pt", "ptRef", "eta", "numPUVertices"]
+
+# Bump this when the response hist fitting changes, to invalidate
+# fit results in the --result-cache
+RESULT_CACHE_VERSION = 1
+
 # Curve Fit defaults
 GCT_DEFAULT_PARAMS = [1, 5, 1, -25, 0.01, -20]
 STAGE1_DEFAULT_PARAMS = [1, 5, 1, -25, 0.01, -20]
@@ -97,7 +110,6 @@ STAGE2_DEFAULT_PARAMS_JETMETERR = [1.4036, -1398000, 0, 0.2249, 0, -2.926, 1.175
 central_fit_select = central_fit_JetMetErr
 STAGE2_DEFAULT_PARAMS_SELECT = STAGE2_DEFAULT_PARAMS_JETMETERR
 
-
 def set_fit_params(fitfunc, params):
     """Set function parameters.
 
@@ -120,10 +132,106 @@ def generate_eta_graph_name(absetamin, absetamax):
     return "l1corr_eta_%g_%g" % (absetamin, absetamax)
 
 
+# What to write for each eta bin, for --store:
+# - minimal: graphs & fits, plus a compact summary (pair_summaries.PairsSummary)
+#   of the pairs, from which the 1D hists can be remade with get_calib_hist
+# - summary: as minimal, plus the 1D response hists (with their fits)
+# - full: graphs & fits, plus all the 1D & 2D hists
+STORE_OPTIONS = ["minimal", "summary", "full"]
+
+# Hists made for each eta bin: (summary hist name, title),
+# binned as in pair_summaries.HIST_AXES
+ETA_BIN_HISTS = OrderedDict([
+    ("hrsp_eta", ("rsp_eta", ";response (p_{T}^{L1}/p_{T}^{Ref});")),
+    ("h2d_rsp_gen", ("rsp_gen", ";p_{T}^{Ref} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")),
+    ("h2d_rsp_l1", ("rsp_l1", ";p_{T}^{L1} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")),
+    ("h2d_gen_l1", ("gen_l1", ";p_{T}^{Ref} [GeV];p_{T}^{L1} [GeV]")),
+])
+
+
+def make_eta_bin_hist(name, absetamin, absetamax):
+    """Make an empty hist for an eta bin, see ETA_BIN_HISTS"""
+    summary_name, title = ETA_BIN_HISTS[name]
+    xvar, xbinning, yvar, ybinning = ps.HIST_AXES[summary_name]
+    if xbinning is None:
+        hist = ROOT.TH1F("%s_%g_%g" % (name, absetamin, absetamax), title, *ybinning)
+    else:
+        hist = ROOT.TH2F(name, title, *(xbinning + ybinning))
+    hist.SetDirectory(0)
+    return hist
+
+
+def get_calib_hist(calib_file, absetamin, absetamax, name):
+    """Get a hist for an eta bin from the output of runCalibration.py
+    (or anything with the same layout, e.g. from checkCalibration.py).
+
+    If the hist wasn't stored (see --store), it is remade from the summary
+    stored instead. Remade response hists don't have the fit function.
+
+    Parameters
+    ----------
+    calib_file : ROOT.TFile
+    absetamin, absetamax : float
+        Eta bin.
+    name : str
+        Name of hist in the eta bin's Histograms directory. Can be remade for
+        hrsp_eta_<eta bin>, and Rsp_genpt_<pt bin>, L1_pt_genpt_<pt bin> &
+        gen_pt_genpt_<pt bin> for any pt bin used. The 2D hists in
+        ETA_BIN_HISTS can only be remade from a full (not compact) summary.
+
+    Raises
+    ------
+    IOError
+        If the hist isn't stored and there's no summary to make it from.
+    ValueError
+        If the hist can't be made from the summary.
+    """
+    eta_dir = "eta_%g_%g" % (absetamin, absetamax)
+    hist_name = "%s/Histograms/%s" % (eta_dir, name)
+    if cu.exists_in_file(calib_file, hist_name):
+        return cu.get_from_file(calib_file, hist_name)
+    summary_dir = "%s/Summary" % eta_dir
+    if not cu.exists_in_file(calib_file, summary_dir):
+        raise IOError("Can't get %s, or a summary to make it, from %s"
+                      % (hist_name, calib_file.GetName()))
+    summary = ps.PairsSummary.read_root(calib_file.Get(summary_dir))
+    eta_summary = summary.for_eta_bin(absetamin, absetamax)
+
+    if name == "hrsp_eta_%g_%g" % (absetamin, absetamax):
+        name = "hrsp_eta"
+    if name in ETA_BIN_HISTS:
+        hist = make_eta_bin_hist(name, absetamin, absetamax)
+        eta_summary.fill_hist(hist, ETA_BIN_HISTS[name][0])
+        return hist
+
+    # pt bin hists, using the same ref jet pt cells as make_correction_curves
+    if "_genpt_" not in name:
+        raise ValueError("Can't make %s from a summary" % name)
+    prefix, pt_bin = name.rsplit("_genpt_", 1)
+    xlow, xhigh = [float(x) for x in pt_bin.split("_")]
+    h2d_rsp_gen = make_eta_bin_hist("h2d_rsp_gen", absetamin, absetamax)
+    bin1 = h2d_rsp_gen.GetXaxis().FindBin(xlow)
+    bin2 = h2d_rsp_gen.GetXaxis().FindBin(xhigh) - 1
+    if prefix == "Rsp":
+        hist = ROOT.TH1F(name, "", *ps.RSP_BINNING)
+        hist.SetDirectory(0)
+        eta_summary.fill_rsp_hist(hist, bin1, bin2)
+    elif prefix == "L1_pt":
+        hist = ROOT.TH1F(name, "pt", *ps.L1_PT_BINNING)
+        hist.SetDirectory(0)
+        eta_summary.fill_l1_pt_hist(hist, bin1, bin2)
+    elif prefix == "gen_pt":
+        hist = eta_summary.make_ref_pt_hist(name, "ptRef", bin1, bin2)
+    else:
+        raise ValueError("Can't make %s from a summary" % name)
+    return hist
+
+
 def get_hist_bin_contents(hist):
     return np.array([hist.GetBinContent(i) for i in range(1, hist.GetNbinsX() + 1)])
 
 
+@PROFILER.timed("rsp_fit")
 def do_gauss_response_hist_fit(hrsp):
     """Fit Gaussian function to response histogram."""
     # but only if we have a sensible number of entries
@@ -135,6 +243,7 @@ def do_gauss_response_hist_fit(hrsp):
         # iteration but not on the 1st...
         fit_counter = 3
         while fitStatus != 0 and fit_counter > 0:
+            PROFILER.count("rsp_fit_attempts")
             fitStatus = int(hrsp.Fit("gaus", "QER", "",
                                      hrsp.GetMean() - 1. * hrsp.GetRMS(),
                                      hrsp.GetMean() + 1. * hrsp.GetRMS()))
@@ -200,6 +309,7 @@ def burr_diff_d(c, d, s):
         return 0
 
 
+@PROFILER.timed("rsp_fit")
 def do_burr_response_hist_fit(hrsp, setup_fn):
     """Fit Burr function to response histogram."""
     # but only if we have a sensible number of entries
@@ -225,6 +335,7 @@ def do_burr_response_hist_fit(hrsp, setup_fn):
         setup_fn()
         while fitStatus != 0 and fit_counter > 0:
             print 'Iterations left', fit_counter
+            PROFILER.count("rsp_fit_attempts")
             fitStatus = int(hrsp.Fit("burr3", "QE"))
             fit_counter -= 1
             if fitStatus == 0 and hrsp.GetFunction("burr3").GetMaximumX() > 0:
@@ -253,9 +364,339 @@ def do_burr_response_hist_fit(hrsp, setup_fn):
     return mode, err
 
 
+def get_eta_bin_pairs(pairs, variables, absetamin, absetamax, pu_min, pu_max, max_pt=1023.1):
+    """Get arrays of pair quantities for one eta bin from a columnar cache,
+    applying the same cuts as make_correction_curves does with TTree::Draw.
+
+    Parameters
+    ----------
+    pairs : common_utils.PairsColumns
+        Columns of the pairs tree.
+    variables : list[str]
+        Branches to get.
+    absetamin, absetamax : float
+        Eta bin edges, exclusive.
+    pu_min, pu_max : float
+        Cut on number of PU vertices, inclusive. Ignored if no numPUVertices branch.
+    max_pt : float, optional
+        Cut on L1 pt, exclusive, to avoid saturated jets.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+    """
+    # TTree::Draw evaluates cuts in double precision, so do the same
+    # (comparing float32 arrays to a float would be done in single precision)
+    abs_eta = np.abs(np.asarray(pairs["eta"], dtype=np.float64))
+    mask = (abs_eta < absetamax) & (abs_eta > absetamin)
+    if "numPUVertices" in pairs:
+        pu = np.asarray(pairs["numPUVertices"], dtype=np.float64)
+        mask &= (pu >= pu_min) & (pu <= pu_max)
+    mask &= np.asarray(pairs["pt"], dtype=np.float64) < max_pt
+    return {var: np.asarray(pairs[var], dtype=np.float64)[mask] for var in variables}
+
+
+def make_eta_bin_cuts(absetamin, absetamax, pu_min, pu_max, has_pu):
+    """Make the cuts used to select pairs for one eta bin & PU range.
+
+    Returns
+    -------
+    ROOT.TCut, ROOT.TCut, ROOT.TCut
+        Eta cut, PU cut (empty if not has_pu), cut to avoid saturated L1 jets.
+    """
+    # Eta cut string
+    eta_cut = ROOT.TCut("TMath::Abs(eta)<%g && TMath::Abs(eta) > %g" % (absetamax, absetamin))
+
+    # PU cut string
+    if has_pu:
+        pu_cut = ROOT.TCut("numPUVertices >= %g && numPUVertices <= %g" % (pu_min, pu_max))
+    else:
+        pu_cut = ROOT.TCut("")
+
+    # Avoid L1 saturated jets cut
+    # (from 2017 any l1 jet with a saturated tower is auto given pt=1024GeV)
+    avoidSaturation_cut = ROOT.TCut("pt < 1023.1")
+    return eta_cut, pu_cut, avoidSaturation_cut
+
+
+def get_eta_bin_arrays(inputfile, pairs, variables, absetamin, absetamax, pu_min, pu_max):
+    """Get arrays of pair quantities for one eta bin & PU range, in tree order.
+
+    Reads from the columnar cache if pairs is set, otherwise from the pairs
+    tree in inputfile, only reading the entries for this eta bin & PU range
+    if the file has been indexed by indexPairs.py.
+
+    Parameters
+    ----------
+    inputfile : ROOT.TFile
+        Pairs file.
+    pairs : common_utils.PairsColumns or None
+        Columns of the pairs tree.
+    variables : list[str]
+        Branches to get.
+    absetamin, absetamax : float
+        Eta bin edges, exclusive.
+    pu_min, pu_max : float
+        Cut on number of PU vertices, inclusive. Ignored if no numPUVertices branch.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+    """
+    if pairs is not None:
+        return get_eta_bin_pairs(pairs, variables, absetamin, absetamax, pu_min, pu_max)
+    tree_raw = cu.get_from_file(inputfile, "valid")
+    has_pu = hasattr(tree_raw, "numPUVertices")
+    eta_cut, pu_cut, avoidSaturation_cut = make_eta_bin_cuts(absetamin, absetamax,
+                                                             pu_min, pu_max, has_pu)
+    total_cut = ROOT.TCut(eta_cut)
+    total_cut += pu_cut
+    total_cut += avoidSaturation_cut
+    entry_ranges = None
+    index = cu.get_pairs_index(inputfile)
+    if index is not None:
+        entry_ranges = cu.get_index_entry_ranges(index, absetamin, absetamax,
+                                                 pu_min if has_pu else None,
+                                                 pu_max if has_pu else None)
+    return cu.get_tree_arrays(tree_raw, variables, total_cut, entry_ranges)
+
+
+def pairs_have_pu(inputfile, pairs=None):
+    """Whether the pairs (from the cache if set, otherwise the tree in inputfile)
+    have the number of PU vertices"""
+    if pairs is not None:
+        return "numPUVertices" in pairs
+    return hasattr(cu.get_from_file(inputfile, "valid"), "numPUVertices")
+
+
+def get_pu_bin_arrays(inputfile, pairs, variables, absetamin, absetamax, pu_bins):
+    """Get arrays of pair quantities for one eta bin, for several PU bins,
+    reading the pairs only once.
+
+    Parameters
+    ----------
+    inputfile, pairs, variables, absetamin, absetamax
+        See get_eta_bin_arrays()
+    pu_bins : list[(float, float)]
+        (min, max) number of PU vertices for each PU bin, inclusive.
+
+    Returns
+    -------
+    list[dict{str : numpy.ndarray}]
+        Arrays for each PU bin.
+    """
+    has_pu = pairs_have_pu(inputfile, pairs)
+    pu_lo = min(pu_min for pu_min, _ in pu_bins)
+    pu_hi = max(pu_max for _, pu_max in pu_bins)
+    if not has_pu or len(pu_bins) == 1:
+        arrays = get_eta_bin_arrays(inputfile, pairs, variables, absetamin, absetamax, pu_lo, pu_hi)
+        return [arrays] * len(pu_bins)
+    all_variables = variables + ["numPUVertices"] if "numPUVertices" not in variables else variables
+    arrays = get_eta_bin_arrays(inputfile, pairs, all_variables, absetamin, absetamax, pu_lo, pu_hi)
+    pu = arrays["numPUVertices"]
+    pu_bin_arrays = []
+    for pu_min, pu_max in pu_bins:
+        mask = (pu >= pu_min) & (pu <= pu_max)
+        pu_bin_arrays.append({var: arrays[var][mask] for var in variables})
+    return pu_bin_arrays
+
+
+def get_cached_pu_bin_arrays(result_cache, base_key, inputfile, pairs, variables,
+                             absetamin, absetamax, pu_bins):
+    """Like get_pu_bin_arrays(), but using the result cache, so the pairs are
+    only read for PU bins that aren't in it.
+
+    Parameters
+    ----------
+    result_cache : result_cache.ResultCache
+        Cache to use.
+    base_key : dict
+        Key identifying the input file, see result_cache.file_fingerprint().
+    Others:
+        See get_pu_bin_arrays()
+
+    Returns
+    -------
+    list[dict{str : numpy.ndarray}], list[dict]
+        Arrays for each PU bin, and the cache key for each. The keys identify
+        the selected pairs, so can be used to build keys for results from them.
+    """
+    has_pu = pairs_have_pu(inputfile, pairs)
+    keys = []
+    for pu_min, pu_max in pu_bins:
+        cuts = make_eta_bin_cuts(absetamin, absetamax, pu_min, pu_max, has_pu)
+        cut_str = " && ".join(cut.GetTitle() for cut in cuts if cut.GetTitle())
+        keys.append(dict(base_key, stage="eta_bin_pairs", cut=cut_str, variables=variables))
+    pu_bin_arrays = [result_cache.get(key) for key in keys]
+    missing = [ind for ind, arrays in enumerate(pu_bin_arrays) if arrays is None]
+    if missing:
+        new_arrays = get_pu_bin_arrays(inputfile, pairs, variables, absetamin, absetamax,
+                                       [pu_bins[ind] for ind in missing])
+        for ind, arrays in zip(missing, new_arrays):
+            # branches are mostly Float_t, so save space if we can do it exactly
+            compact = {}
+            for var, arr in arrays.iteritems():
+                arr_f = arr.astype(np.float32)
+                compact[var] = arr_f if np.array_equal(arr_f, arr) else arr
+            result_cache.put(keys[ind], compact)
+            pu_bin_arrays[ind] = arrays
+    pu_bin_arrays = [{var: np.asarray(arrays[var], dtype=np.float64) for var in variables}
+                     for arrays in pu_bin_arrays]
+    return pu_bin_arrays, keys
+
+
+@PROFILER.timed("rsp_fit_batch")
+def do_batch_response_hist_fits(h2d_rsp, bin_indices, do_burr, absetamin):
+    """Fit the response hists for all pt bins at once, using the numpy backend
+    in response_fits, instead of fitting each with ROOT.
+
+    Parameters
+    ----------
+    h2d_rsp : ROOT.TH2
+        2D hist of response (y) Vs pt (x)
+    bin_indices : list[[int, int]]
+        First & last x bin for each pt bin. The response hist for each pt bin
+        is the y projection over those.
+    do_burr : bool
+        Fit Burr type 3 instead of Gaussian.
+    absetamin : float
+        Lower edge of eta bin, to pick Burr starting params.
+
+    Returns
+    -------
+    dict{str : numpy.ndarray}
+        Fit results, one entry per pt bin, see response_fits.fit_gaus_batch
+        and fit_burr3_batch
+    """
+    contents_2d, sumw2_2d = cu.get_hist_arrays(h2d_rsp)
+    # same as ProjectionY for each pt bin, without under/overflow
+    contents = np.array([contents_2d[1:-1, bin1:bin2 + 1].sum(axis=1)
+                         for bin1, bin2 in bin_indices])
+    sumw2 = np.array([sumw2_2d[1:-1, bin1:bin2 + 1].sum(axis=1) for bin1, bin2 in bin_indices])
+    yaxis = h2d_rsp.GetYaxis()
+    edges = np.array([yaxis.GetBinLowEdge(i) for i in range(1, h2d_rsp.GetNbinsY() + 2)])
+    if do_burr:
+        start_params = rf.BURR3_DEFAULT_PARAMS if absetamin < 2 else rf.BURR3_HIGHER_ETA_PARAMS
+        return rf.fit_burr3_batch(contents, sumw2, edges, start_params)
+    else:
+        return rf.fit_gaus_batch(contents, sumw2, edges)
+
+
+def add_batch_fit_function(hrsp, fit_results, ind, do_burr):
+    """Store the function from a batch fit in the response hist,
+    like TH1::Fit does, so it gets saved with the hist."""
+    params = fit_results["params"][ind]
+    param_errors = fit_results["param_errors"][ind]
+    if do_burr:
+        func = burr3_fit.Clone("burr3")
+    else:
+        fit_min, fit_max = fit_results["fit_range"][ind]
+        func = ROOT.TF1("gaus", "gaus", fit_min, fit_max)
+    for i, (val, err) in enumerate(zip(params, param_errors)):
+        func.SetParameter(i, val)
+        func.SetParError(i, err)
+    ROOT.SetOwnership(func, False)  # the hist owns it now
+    hrsp.GetListOfFunctions().Add(func)
+
+
+def get_fit_settings(fit_backend, do_burr, absetamin, rsp_estimator=None):
+    """Everything that determines the response hist fit results, for the result cache key"""
+    if rsp_estimator is not None:
+        return dict(version=RESULT_CACHE_VERSION, estimator=rsp_estimator, trunc=rf.TRUNC_FRACTION)
+    settings = dict(version=RESULT_CACHE_VERSION, backend=fit_backend, burr=do_burr)
+    if do_burr:
+        settings["start"] = rf.BURR3_DEFAULT_PARAMS if absetamin < 2 else rf.BURR3_HIGHER_ETA_PARAMS
+    return settings
+
+
+def get_response_fit_info(hrsp, nbins_orig, mean, err, do_burr, width=None):
+    """Get the result of a response hist fit, including the fit function
+    stored in the hist, to store in the result cache.
+
+    nbins_orig is the number of bins before fitting, since Burr fits rebin the hist.
+    width is the response width, if using a quantile estimator.
+    """
+    info = dict(mean=np.array(mean), err=np.array(err),
+                rebin=np.array(nbins_orig // hrsp.GetNbinsX()))
+    if width is not None:
+        info["width"] = np.array(width)
+    func = hrsp.GetFunction("burr3" if do_burr else "gaus")
+    if func:
+        fit_min, fit_max = ROOT.Double(), ROOT.Double()
+        func.GetRange(fit_min, fit_max)
+        info["params"] = np.array([func.GetParameter(i) for i in range(func.GetNpar())])
+        info["param_errors"] = np.array([func.GetParError(i) for i in range(func.GetNpar())])
+        info["fit_range"] = np.array([fit_min, fit_max])
+    return info
+
+
+def restore_response_fit(hrsp, info, do_burr):
+    """Redo the rebinning & store the fit function in the response hist,
+    from info from get_response_fit_info(), as if the fit had just been done.
+
+    Returns
+    -------
+    float, float
+        Mean response & its error
+    """
+    if int(info["rebin"]) > 1:
+        hrsp.Rebin(int(info["rebin"]))
+    if "params" in info:
+        if do_burr:
+            func = burr3_fit.Clone("burr3")
+            func.SetRange(*info["fit_range"])
+        else:
+            func = ROOT.TF1("gaus", "gaus", *info["fit_range"])
+        for i, (val, err) in enumerate(zip(info["params"], info["param_errors"])):
+            func.SetParameter(i, val)
+            func.SetParError(i, err)
+        ROOT.SetOwnership(func, False)  # the hist owns it now
+        hrsp.GetListOfFunctions().Add(func)
+    return float(info["mean"]), float(info["err"])
+
+
+# Options for make_correction_curves that are the same for all eta & PU bins:
+# - do_genjet_plots: bool. Whether to make plots for reference jets. Not used
+#   in calculation of correction curve, but handy for debugging.
+# - do_correction_fit: bool. Whether to actually fit the correction curve.
+# - do_burr: bool. If True, use Burr fn to fit response histograms,
+#   otherwise a Gaussian.
+# - fit_backend: str. "root" to fit each response hist with TH1::Fit, or
+#   "numpy" to fit all of them at once with response_fits.
+# - rsp_estimator: str. "median" or "truncmean" to use that instead of a fit
+#   to the response hist, see response_fits.calc_quantile_estimates. The
+#   (IQR-based) response width is also stored in a graph. None to fit.
+# - n_bootstrap: int. Number of Poisson bootstrap replicas to make an
+#   uncertainty band for the correction function, see make_bootstrap_band.
+#   Each pair gets a Poisson(1) weight per replica when the pt bins are made,
+#   then the response & correction function are redone for each replica.
+#   Needs the pairs, so can't be used with a summary.
+# - bootstrap_seed: int. Seed for the bootstrap weights.
+# - store: str. Which hists to write, one of STORE_OPTIONS. The graphs &
+#   correction fits are always written.
+# - n_fit_starts: int. Number of starting points for the correction fit,
+#   see fit_correction.
+CurveSettings = namedtuple("CurveSettings", ["do_genjet_plots", "do_correction_fit", "do_burr",
+                                             "fit_backend", "rsp_estimator", "n_bootstrap",
+                                             "bootstrap_seed", "store", "n_fit_starts"])
+
+
+def get_curve_settings(args, do_correction_fit):
+    """Get the CurveSettings for make_correction_curves from the parsed args"""
+    return CurveSettings(do_genjet_plots=args.no_genjet_plots,
+                         do_correction_fit=do_correction_fit,
+                         do_burr=args.burr,
+                         fit_backend=args.fit_backend,
+                         rsp_estimator=get_quantile_estimator(args),
+                         n_bootstrap=args.bootstrap,
+                         bootstrap_seed=args.bootstrap_seed,
+                         store=args.store,
+                         n_fit_starts=args.fit_starts)
+
+
 def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetamax,
-                           fitfcn, do_genjet_plots, do_correction_fit,
-                           pu_min, pu_max, do_burr):
+                           fitfcn, pu_min, pu_max, settings, pairs=None, summary=None,
+                           arrays=None, result_cache=None, cache_key=None, fit_range=None):
     """
     Do all the relevant hists and fitting, for one eta bin.
 
@@ -280,40 +721,57 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
 
     fitfcn: TF1. Function to fit for correction curve.
 
-    do_genjet_plots: bool. Whether to make plots for reference jets. Not used
-        in calcualtion of correction curve, but handy for debugging.
-
-    do_correction_fit: bool. Whether to actually fit the correction curve.
-
     pu_min: float. Cut on minimum number of PU vertices.
 
     pu_max: float. Cut on maximum number of PU vertices.
 
-    do_burr: bool. If True, use Burr fn to fit response histograms.
-    The default is to use a Gaussian.
+    settings: CurveSettings. Options for the hists & fits, e.g. from
+    get_curve_settings.
+
+    pairs: common_utils.PairsColumns. If set, get pairs from this columnar
+    cache instead of the TTree in inputfile.
+
+    summary: pair_summaries.PairsSummary. If set, fill the hists from this
+    (reduced) summary instead of the pairs, see pair_summaries for the
+    small differences this makes.
+
+    arrays: dict. If set, use these arrays of rsp, pt & ptRef for the pairs in
+    this eta bin & PU range (e.g. from get_pu_bin_arrays), instead of getting them
+    from inputfile or pairs.
+
+    result_cache: result_cache.ResultCache. If set, reuse response hist fit
+    results from this, and store new ones.
+
+    cache_key: dict. Key identifying the pairs for this eta bin & PU range,
+    e.g. from get_cached_pu_bin_arrays. Needed if result_cache is set.
+
+    fit_range: dict. Correction fit range to use, see setup_fit.
+    If None, one is found from the graph.
     """
+    (do_genjet_plots, do_correction_fit, do_burr, fit_backend, rsp_estimator,
+     n_bootstrap, bootstrap_seed, store, n_fit_starts) = settings
 
     print "Doing PU range: %g - %g" % (pu_min, pu_max)
     print "Running over pT bins:", ptBins_in
 
     # Input tree
-    tree_raw = cu.get_from_file(inputfile, "valid")
+    if summary is not None:
+        has_pu = summary.has_pu
+    elif pairs is None:
+        tree_raw = cu.get_from_file(inputfile, "valid")
+        has_pu = hasattr(tree_raw, "numPUVertices")
+    else:
+        has_pu = "numPUVertices" in pairs
 
     # Output folders
     output_f = outputfile.mkdir('eta_%g_%g' % (absetamin, absetamax))
     output_f_hists = output_f.mkdir("Histograms")
+    # so --profile can time the writing separately
+    write_hist = PROFILER.timed("write")(output_f_hists.WriteTObject)
+    write_output = PROFILER.timed("write")(outputfile.WriteTObject)
 
-    # Eta cut string
-    eta_cut = ROOT.TCut("TMath::Abs(eta)<%g && TMath::Abs(eta) > %g" % (absetamax, absetamin))
-
-    # PU cut string
-    if hasattr(tree_raw, "numPUVertices"):
-        pu_cut = ROOT.TCut("numPUVertices >= %g && numPUVertices <= %g" % (pu_min, pu_max))
-    else:
-        pu_cut = ROOT.TCut("")
-
-    # Avoid L1 saturated jets cut (from 2017 any l1 jet with a saturated tower is auto given pt=1024GeV)
-    avoidSaturation_cut = ROOT.TCut("pt < 1023.1")
+    eta_cut, pu_cut, avoidSaturation_cut = make_eta_bin_cuts(absetamin, absetamax,
+                                                             pu_min, pu_max, has_pu)
 
     # Total cut
     total_cut = ROOT.TCut(eta_cut)
@@ -321,31 +779,57 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
     total_cut += avoidSaturation_cut
     print total_cut
 
-    # Draw response (pT^L1/pT^Gen) for all pt bins
-    tree_raw.Draw("rsp>>hrsp_eta_%g_%g(50,0,2)" % (absetamin, absetamax), total_cut, "goff")
-    hrsp_eta = ROOT.gROOT.FindObject("hrsp_eta_%g_%g" % (absetamin, absetamax))
-    hrsp_eta.SetTitle(";response (p_{T}^{L1}/p_{T}^{Ref});")
-    output_f_hists.WriteTObject(hrsp_eta)
+    # Get all the pairs we need for this eta bin in one pass over the tree,
+    # then fill all the hists from those, rather than doing a TTree::Draw()
+    # (and therefore a whole pass over the tree) for every hist & pt bin.
+    if summary is not None:
+        eta_summary = summary.for_eta_bin(absetamin, absetamax,
+                                          pu_min if has_pu else None,
+                                          pu_max if has_pu else None)
+        print "Got %d pairs" % eta_summary.n_pairs
+    elif arrays is None:
+        arrays = get_eta_bin_arrays(inputfile, pairs, ["rsp", "pt", "ptRef"],
+                                    absetamin, absetamax, pu_min, pu_max)
+    if summary is None:
+        rsp, pt, ptRef = arrays["rsp"], arrays["pt"], arrays["ptRef"]
+        print "Got %d pairs" % len(rsp)
 
-    nb, pt_min, pt_max = 2048, 0, 1024
+    # Draw response (pT^L1/pT^Gen) for all pt bins
+    hrsp_eta = make_eta_bin_hist("hrsp_eta", absetamin, absetamax)
+    if summary is None:
+        cu.fill_hist(hrsp_eta, rsp)
+    else:
+        eta_summary.fill_hist(hrsp_eta, "rsp_eta")
+    if store != "minimal":
+        write_hist(hrsp_eta)
 
     # Draw rsp (pT^L1/pT^Gen) Vs GenJet pT
-    tree_raw.Draw("rsp:ptRef>>h2d_rsp_gen(%d,%g,%g,150,0,5)" % (nb, pt_min, pt_max), total_cut, "goff")
-    h2d_rsp_gen = ROOT.gROOT.FindObject("h2d_rsp_gen")
-    h2d_rsp_gen.SetTitle(";p_{T}^{Ref} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
-    output_f_hists.WriteTObject(h2d_rsp_gen)
-
-    # Draw rsp (pT^L1/pT^Gen) Vs L1 pT
-    tree_raw.Draw("rsp:pt>>h2d_rsp_l1(%d,%g,%g,150,0,5)" % (nb, pt_min, pt_max), total_cut, "goff")
-    h2d_rsp_l1 = ROOT.gROOT.FindObject("h2d_rsp_l1")
-    h2d_rsp_l1.SetTitle(";p_{T}^{L1} [GeV];response (p_{T}^{L1}/p_{T}^{Ref})")
-    output_f_hists.WriteTObject(h2d_rsp_l1)
-
-    # draw pT^L1 Vs pT^Gen
-    tree_raw.Draw("pt:ptRef>>h2d_gen_l1(%d,%g,%g,%d,%g,%g)" % (nb, pt_min, pt_max, nb, pt_min, pt_max), total_cut, "goff")
-    h2d_gen_l1 = ROOT.gROOT.FindObject("h2d_gen_l1")
-    h2d_gen_l1.SetTitle(";p_{T}^{Ref} [GeV];p_{T}^{L1} [GeV]")
-    output_f_hists.WriteTObject(h2d_gen_l1)
+    h2d_rsp_gen = make_eta_bin_hist("h2d_rsp_gen", absetamin, absetamax)
+    if summary is None:
+        cu.fill_hist(h2d_rsp_gen, ptRef, rsp)
+    else:
+        eta_summary.fill_hist(h2d_rsp_gen, "rsp_gen")
+    if store == "full":
+        write_hist(h2d_rsp_gen)
+
+    # These are only for the output, otherwise they can be remade from the
+    # summary stored instead, see get_calib_hist
+    if store == "full":
+        # Draw rsp (pT^L1/pT^Gen) Vs L1 pT
+        h2d_rsp_l1 = make_eta_bin_hist("h2d_rsp_l1", absetamin, absetamax)
+        if summary is None:
+            cu.fill_hist(h2d_rsp_l1, pt, rsp)
+        else:
+            eta_summary.fill_hist(h2d_rsp_l1, "rsp_l1")
+        write_hist(h2d_rsp_l1)
+
+        # draw pT^L1 Vs pT^Gen
+        h2d_gen_l1 = make_eta_bin_hist("h2d_gen_l1", absetamin, absetamax)
+        if summary is None:
+            cu.fill_hist(h2d_gen_l1, ptRef, pt)
+        else:
+            eta_summary.fill_hist(h2d_gen_l1, "gen_l1")
+        write_hist(h2d_gen_l1)
 
     # Go through and find histogram bin edges that are closest to the input pt
     # bin edges, and store for future use
@@ -360,10 +844,54 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
         ptBins.append(xlow)
     ptBins.append(xup)  # only need this last one
 
+    if store != "full":
+        # only keep what's needed to remake the 1D hists for these pt bins
+        if summary is None:
+            stored_summary = ps.PairsSummary.from_eta_bin_arrays(arrays, absetamin, absetamax)
+        else:
+            stored_summary = summary.restrict(absetamin, absetamax,
+                                              pu_min if has_pu else None,
+                                              pu_max if has_pu else None)
+        with PROFILER.stage("write"):
+            stored_summary.compact(bin_indices).write_root(output_f.mkdir("Summary"))
+
+    # Get any response hist fits we've done before
+    fit_keys = [None] * len(bin_indices)
+    cached_fits = [None] * len(bin_indices)
+    if result_cache is not None:
+        fit_settings = get_fit_settings(fit_backend, do_burr, absetamin, rsp_estimator)
+        fit_keys = [dict(cache_key, stage="rsp_fit", bins=bins, fit=fit_settings)
+                    for bins in bin_indices]
+        cached_fits = [result_cache.get(key) for key in fit_keys]
+
+    if fit_backend == "numpy" and rsp_estimator is None:
+        # only fit the ones we don't have already
+        batch_inds = [i for i, cached in enumerate(cached_fits) if cached is None]
+        if batch_inds:
+            batch_fits = do_batch_response_hist_fits(h2d_rsp_gen,
+                                                     [bin_indices[i] for i in batch_inds],
+                                                     do_burr, absetamin)
+        batch_inds = {i: batch_ind for batch_ind, i in enumerate(batch_inds)}
+
+    # Sort pairs by ref jet pt, so selecting a pt bin is just a slice
+    if summary is None:
+        ptRef_order = np.argsort(ptRef, kind='mergesort')
+        ptRef_sorted = ptRef[ptRef_order]
+
     gr = ROOT.TGraphErrors()  # 1/<rsp> VS ptL1
     gr_gen = ROOT.TGraphErrors()  # 1/<rsp> VS ptGen
+    gr_width = ROOT.TGraphErrors()  # rsp width VS ptL1, for quantile estimators
     grc = 0
 
+    # <ptL1> & 1/<rsp> in each bootstrap replica, one entry per graph point
+    replica_x, replica_y = [], []
+    if n_bootstrap > 0:
+        yaxis = h2d_rsp_gen.GetYaxis()
+        rsp_edges = np.array([yaxis.GetBinLowEdge(j)
+                              for j in range(1, h2d_rsp_gen.GetNbinsY() + 2)])
+        bootstrap_estimator = rsp_estimator or ("burr" if do_burr else "gaus")
+        burr_start = rf.BURR3_DEFAULT_PARAMS if absetamin < 2 else rf.BURR3_HIGHER_ETA_PARAMS
+
     # Iterate over pT^Gen bins, and for each:
     # - Project 2D hist so we have a plot of response for given pT^Gen range
     # - Fit a Gaussian (if possible) to this resp histogram to get <response>
@@ -394,26 +922,71 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
         print total_cut
 
         # Plots of pT L1 for given pT Gen bin
-        tree_raw.Draw("pt>>hpt(4000, 0, 2000)", total_cut, "goff")
-        hpt = ROOT.gROOT.FindObject("hpt")
-        hpt.SetName("L1_pt_genpt_%g_%g" % (xlow, xhigh))
+        hpt = ROOT.TH1F("L1_pt_genpt_%g_%g" % (xlow, xhigh),
+                        "pt {%s}" % total_cut.GetTitle(), *ps.L1_PT_BINNING)
+        hpt.SetDirectory(0)
+        if summary is None:
+            # pairs with xlow < ptRef < xhigh, put back into tree order
+            ind_low = np.searchsorted(ptRef_sorted, xlow, side='right')
+            ind_high = max(ind_low, np.searchsorted(ptRef_sorted, xhigh, side='left'))
+            this_bin = np.sort(ptRef_order[ind_low:ind_high])
+            cu.fill_hist(hpt, pt[this_bin])
+        else:
+            eta_summary.fill_l1_pt_hist(hpt, bin1, bin2)
         # hpt = h2d_gen_l1.ProjectionX("L1_pt_genpt_%g_%g" % (xlow, xhigh))
 
         if hrsp.GetEntries() <= 0 or hpt.GetEntries() <= 0:
             print "Skipping as 0 entries"
             continue
 
-        output_f_hists.WriteTObject(hpt)
+        if store == "full":
+            write_hist(hpt)
 
         # Plots of pT Gen for given pT Gen bin
-        if do_genjet_plots:
-            tree_raw.Draw("ptRef>>hpt_gen(200)", total_cut, "goff")
-            hpt_gen = ROOT.gROOT.FindObject("hpt_gen")
-            hpt_gen.SetName("gen_pt_genpt_%g_%g" % (xlow, xhigh))
-            output_f_hists.WriteTObject(hpt_gen)
+        if do_genjet_plots and summary is not None:
+            hpt_gen = eta_summary.make_ref_pt_hist("gen_pt_genpt_%g_%g" % (xlow, xhigh),
+                                                   "ptRef {%s}" % total_cut.GetTitle(),
+                                                   bin1, bin2)
+            if store == "full":
+                write_hist(hpt_gen)
+        elif do_genjet_plots:
+            # x range auto-set from the contents, like TTree::Draw("ptRef>>h(200)")
+            hpt_gen = ROOT.TH1F("gen_pt_genpt_%g_%g" % (xlow, xhigh),
+                                "ptRef {%s}" % total_cut.GetTitle(), 200, 0, 0)
+            hpt_gen.SetDirectory(0)
+            hpt_gen.SetBuffer(len(this_bin) + 1)
+            cu.fill_hist(hpt_gen, ptRef[this_bin])
+            hpt_gen.BufferEmpty(1)
+            if store == "full":
+                write_hist(hpt_gen)
 
         # Fit to resposne hist to get mean response & error on mean
-        if do_burr:
+        nbins_orig = hrsp.GetNbinsX()
+        width = None
+        if cached_fits[i] is not None:
+            mean, err = restore_response_fit(hrsp, cached_fits[i], do_burr)
+            if "width" in cached_fits[i]:
+                width = float(cached_fits[i]["width"])
+        elif rsp_estimator is not None:
+            if summary is None:
+                estimates = rf.calc_quantile_estimates(rsp[this_bin])
+            else:
+                contents, _ = cu.get_hist_arrays(hrsp)
+                xaxis = hrsp.GetXaxis()
+                edges = np.array([xaxis.GetBinLowEdge(j) for j in range(1, hrsp.GetNbinsX() + 2)])
+                estimates = rf.calc_hist_quantile_estimates(contents[1:-1], edges)
+            if estimates["entries"] > 0:
+                mean, err = estimates[rsp_estimator], estimates[rsp_estimator + "_err"]
+                width = estimates["width"]
+            else:
+                mean, err = hrsp.GetMean(), hrsp.GetMeanError()
+        elif fit_backend == "numpy":
+            batch_ind = batch_inds[i]
+            mean, err = batch_fits["mean"][batch_ind], batch_fits["err"][batch_ind]
+            if not rf.apply_batch_fit(hrsp, batch_fits, batch_ind, do_burr,
+                                      add_batch_fit_function):
+                print "Poor Fit: raw mean:", mean, "fit status:", batch_fits["status"][batch_ind]
+        elif do_burr:
             if (absetamin > 2 and i == 0):
                 setup_burr3_higherEta()
             setup_fn = setup_burr3 if absetamin < 2 else setup_burr3_higherEta
@@ -421,7 +994,12 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
         else:
             mean, err = do_gauss_response_hist_fit(hrsp)
 
-        output_f_hists.WriteTObject(hrsp)
+        if result_cache is not None and cached_fits[i] is None:
+            result_cache.put(fit_keys[i], get_response_fit_info(hrsp, nbins_orig, mean, err,
+                                                                do_burr, width))
+
+        if store != "minimal":
+            write_hist(hrsp)
 
         print "pT Gen: ", ptR, "-", ptBins[i + 1], "<pT L1>:", hpt.GetMean(), \
               "<pT Gen>:", (hpt_gen.GetMean() if do_genjet_plots else "NA"), "<rsp>:", mean
@@ -438,6 +1016,22 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
         if do_genjet_plots:
             gr_gen.SetPoint(grc, hpt_gen.GetMean(), 1. / mean)
             # gr_gen.SetPointError(grc, hpt.GetMeanError(), err)
+        if width is not None:
+            n_width = gr_width.GetN()
+            gr_width.SetPoint(n_width, hpt.GetMean(), width)
+            gr_width.SetPointError(n_width, hpt.GetMeanError(), 0)
+        if n_bootstrap > 0:
+            # independent weights per pt bin, since each pair is only in one
+            seed = [bootstrap_seed, int(round(absetamin * 1000)), i]
+            weights = rf.make_poisson_weights(n_bootstrap, len(this_bin), seed=seed)
+            boot_rsp = rf.calc_bootstrap_responses(rsp[this_bin], weights, rsp_edges,
+                                                   bootstrap_estimator, burr_start)
+            sumw = weights.sum(axis=1)
+            boot_pt = np.where(sumw > 0, weights.dot(pt[this_bin]) / np.maximum(sumw, 1),
+                               hpt.GetMean())
+            with np.errstate(divide='ignore'):
+                replica_y.append(np.where(boot_rsp > 0, 1. / boot_rsp, np.nan))
+            replica_x.append(boot_pt)
         grc += 1
 
     # Label response VS pT graphs
@@ -452,28 +1046,113 @@ def make_correction_curves(inputfile, outputfile, ptBins_in, absetamin, absetama
         gr_gen.GetYaxis().SetTitle("1/<p_{T}^{L1}/p_{T}^{Ref}>")
 
     # Save these graphs to file
-    outputfile.WriteTObject(gr)
+    write_output(gr)
     if do_genjet_plots:
-        outputfile.WriteTObject(gr_gen)
+        write_output(gr_gen)
+    if rsp_estimator is not None:
+        gr_width.SetName('rspwidth_eta_%g_%g' % (absetamin, absetamax))
+        gr_width.SetTitle(";<p_{T}^{L1}> [GeV];response width (IQR / 1.349)")
+        write_output(gr_width)
 
     # Fit correction function to response vs pT graph, add params list
     fit_params = []
 
     if do_correction_fit:
-        sub_graph, this_fit = setup_fit(gr, fitfcn, absetamin, absetamax, outputfile)
-        fit_graph, fit_params = fit_correction(sub_graph, this_fit)
-        outputfile.WriteTObject(this_fit)  # function by itself
-        outputfile.WriteTObject(fit_graph)  # has the function stored in it as well
+        sub_graph, this_fit = setup_fit(gr, fitfcn, absetamin, absetamax, outputfile, fit_range)
+        fit_graph, fit_params = fit_correction(sub_graph, this_fit, n_starts=n_fit_starts)
+        write_output(this_fit)  # function by itself
+        write_output(fit_graph)  # has the function stored in it as well
+        if n_bootstrap > 0 and fit_params:
+            band = make_bootstrap_band(gr, this_fit, np.array(replica_x), np.array(replica_y))
+            write_output(band)
 
     return fit_params
 
 
-def setup_fit(graph, function, absetamin, absetamax, outputfile):
+def get_fit_range_table(args):
+    """Get the fit range table to use, from --fit-ranges, or with
+    --redo-correction-fit the one saved with the input file if there is one.
+
+    Returns
+    -------
+    OrderedDict
+        fit_ranges.table_key(eta_min, eta_max) : fit range. Empty if no table.
+    """
+    filename = args.fit_ranges
+    if not filename and args.redo_correction_fit:
+        filename = fr.get_table_filename(args.input)
+        if not os.path.isfile(filename):
+            return OrderedDict()
+    if not filename:
+        return OrderedDict()
+    print "Using fit ranges from", filename
+    return fr.load_table(filename)
+
+
+def make_fit_range_table(calib_file, eta_bins, fit_range_table=None):
+    """Find the correction fit ranges for all eta bins in a runCalibration
+    output file at once, see fit_ranges.find_fit_ranges.
+
+    Parameters
+    ----------
+    calib_file : ROOT.TFile
+    eta_bins : list[float]
+        Eta bin edges. Bins without a graph in calib_file are skipped.
+    fit_range_table : OrderedDict, optional
+        Table from get_fit_range_table. Its ranges are used instead of
+        finding new ones, see fit_ranges.merge_table_row.
+
+    Returns
+    -------
+    list[OrderedDict]
+        Fit range for each eta bin, with eta_min & eta_max added.
+    """
+    fit_range_table = fit_range_table or {}
+    eta_bins_found, xs, ys = [], [], []
+    for eta_min, eta_max in pairwise(eta_bins):
+        graph_name = generate_eta_graph_name(eta_min, eta_max)
+        if not cu.exists_in_file(calib_file, graph_name):
+            continue
+        xarr, yarr = cu.get_xy(calib_file.Get(graph_name))
+        if len(xarr) < 2:
+            continue
+        eta_bins_found.append((eta_min, eta_max))
+        xs.append(xarr)
+        ys.append(yarr)
+    if not xs:
+        return []
+    rows = []
+    for (eta_min, eta_max), xarr, fit_range in zip(eta_bins_found, xs, fr.find_fit_ranges(xs, ys)):
+        fit_range = fr.merge_table_row(fit_range, xarr,
+                                       fit_range_table.get(fr.table_key(eta_min, eta_max)))
+        rows.append(OrderedDict([("eta_min", eta_min), ("eta_max", eta_max)] +
+                                [(k, v) for k, v in fit_range.iteritems()
+                                 if k not in ["eta_min", "eta_max"]]))
+    return rows
+
+
+def write_fit_range_table(calib_filename, eta_bins, fit_range_table=None):
+    """Save the fit ranges used for the correction fits in calib_filename, so
+    they can be reused, e.g. by --redo-correction-fit.
+    See make_fit_range_table."""
+    calib_file = cu.open_root_file(calib_filename, "READ")
+    rows = make_fit_range_table(calib_file, eta_bins, fit_range_table)
+    calib_file.Close()
+    table_filename = fr.get_table_filename(calib_filename)
+    fr.save_table(rows, table_filename)
+    print "Fit ranges saved to", table_filename
+
+
+def setup_fit(graph, function, absetamin, absetamax, outputfile, fit_range=None):
     """Setup for fitting (auto-calculate sensible range).
 
     Returns a sub-graph of only sensible points (chop off turnover at low pT,
     and any high pT tail), along with a corresponding fit function
     whose range has been set to match the sub graph.
+
+    The range is found with fit_ranges.find_fit_ranges, unless fit_range
+    (a row from the fit range table, see get_fit_range_table) sets it all.
+    If fit_range only sets part of it, that overrides the found range.
     """
     print 'Setting up fit'
     xarr, yarr = cu.get_xy(graph)
@@ -482,102 +1161,19 @@ def setup_fit(graph, function, absetamin, absetamax, outputfile):
     if len(xarr) == 0:
         raise RuntimeError("graph in setup_fit() is empty")
 
-    fit_max = max(xarr)  # Maxmimum pt for upper bound of fit
-
-    # fit_min = 10 if absetamin > 2.9 else 10
-    fit_min = min(xarr) # Minimum pt for lower bound of fit
-
-    # For lower bound of fit, use either fit_min or the pt
-    # of the maximum correction value, whichever has the larger pT.
-    # Check to make sure it's not the last point on the graph
-    # (e.g. if no turnover), in which case just use the default fit_min
-    # Then find the index of the closest corresponding value in xarr (since
-    # fit_min could correspond to a pT that isn't in the list of x-points)
-    # Note that we want the maximum in the first half of the graph to avoid
-    # the 'flick' at high pT in HF
-    # JOE EDIT: (un)comment the next 4 lines to (not) have the flick
-    max_corr = max(yarr[:len(yarr) / 2])
-    max_corr_ind = yarr.index(max_corr)
-    max_corr_pt = xarr[max_corr_ind]
-    fit_min = max(fit_min, max_corr_pt) if (max_corr_pt != xarr[-1]) and (max_corr_pt != xarr[-1]) else fit_min
-    min_ind = next(i for i, x in enumerate(xarr) if x >= fit_min)
-
-    # To find upper limit of fit, we need to detect if & where there is a turnover
-    # (i.e. where the gradient goes from -ve to +ve)
-    # This is made difficult by the fact the graph may be 'noisy' and simply
-    # taking the gradient may not be enough (and give multiple points where
-    # the gradient changes). To counter this, we smooth the gradient by
-    # averaging over several points
-    def moving_average(arr, n):
-        """Returns a np.array of moving-averages of array arr, where each
-        point in the rerurned array is the average of the consecutive n points
-        in the original array.
-
-        By definition, this will return an array of length len(arr) + 1 - n
-        """
-        return np.array([np.mean(arr[i:i+n]) for i in range(0, len(arr) - n + 1)])
-
-    def calc_crossing(arr):
-        """Calculate value at which value the array crosses 0.
-
-        Looks at points in groups of 4, and finds the smallest group
-        where the first 2 points < 0, and the next 2 points > 0.
-
-        This ignores values which peak above 0 for 1 point.
-
-        Returns the array (index, value) of the point closest to 0.
-        """
-        for i in range(2, len(arr)):
-            group = np.concatenate((-1 * arr[i-2: i], arr[i: i+2]))
-            if np.all(group > 0):
-                return i - 2 + list(group).index(np.min(group)), np.min(group)
-        return None, None
-
-    grad = np.gradient(yarr, 1)
-    n_sample = 5
-    intercept_ind, intercept = None, None
-    # keep incrementing the smooting value until we get a clean intercept
-    while not intercept_ind and not intercept:
-        x_ave = moving_average(xarr, n_sample)
-        grad_ave = moving_average(grad, n_sample)
-        intercept_ind, intercept = calc_crossing(grad_ave)
-        n_sample += 1
-        # quit if we've got stuck
-        if n_sample == 12:
-            break
-
-    if intercept and intercept_ind:
-        print 'Found minima'
-        print 'Smoothing param:', n_sample
-        # find closest x value to intercept
-        max_ind, fit_max = closest_element(xarr, x_ave[intercept_ind])
-    else:
-        print '! Could not find minima, falling back to just using min()'
-        # Here we assume a failure to find any minima, so fallback and use
-        # the smallest point.
-        max_ind = list(yarr).index(min(yarr))
-        fit_max = xarr[max_ind]
-
-    #############
-    # JOE_HACKs #
-    # 1. to fix the maximum pt for all fits (high pt saturation issue)
-    # helps ease things into the right solution space
-    # if fit_max > 650.0:
-    #     print "*** WARNING: about to apply a JOE_HACK ***"
-    #     print "*** lowers the upper limit of the fits to 650GeV ***"
-    #     fit_max = 650.0
-    # 2. to change the auto settings for a troublesome eta bin 
-    if absetamin == 2.5:
-        print "*** WARNING: about to apply a JOE_HACK ***"
-        print "*** messing with fit limits for 2.500<|eta|<2.964 ***"
-        max_ind = 80
-        fit_max = xarr[max_ind]
-        print max_ind
-        print fit_max
-        fit_min = 40.0
-        min_ind = 0
-    ###############
-    ###############
+    if fit_range is None or not fr.is_complete(fit_range):
+        found_range = fr.find_fit_ranges([xarr], [yarr])[0]
+        if found_range["found_minimum"]:
+            print 'Found minima'
+            print 'Smoothing param:', found_range["n_sample"]
+        else:
+            print '! Could not find minima, falling back to just using min()'
+        if fit_range is not None:
+            print "*** WARNING: using fit range override for %g<|eta|<%g: %s ***" % (
+                absetamin, absetamax, dict(fit_range))
+        fit_range = fr.merge_table_row(found_range, xarr, fit_range)
+    min_ind, max_ind = fit_range["min_ind"], fit_range["max_ind"]
+    fit_min, fit_max = fit_range["fit_min"], fit_range["fit_max"]
 
     if fit_min > fit_max:
         raise RuntimeError('fit_min > fit_max! (%f > %f)' % (fit_min, fit_max))
@@ -601,11 +1197,16 @@ def setup_fit(graph, function, absetamin, absetamax, outputfile):
     return fit_graph, this_fit
 
 
-def fit_correction(graph, function, fit_min=-1, fit_max=-1):
+@PROFILER.timed("correction_fit")
+def fit_correction(graph, function, fit_min=-1, fit_max=-1, n_starts=0):
     """
     Fit response curve with given correction function, within given bounds.
     If fit_min and fit_max are < 0, then use the range of the function supplied.
 
+    If n_starts > 0, each fit is done from n_starts starting points around the
+    function's current parameters at once (see do_multistart_correction_fit),
+    rather than just from the current parameters.
+
     Note that sometime the fit fails - if so, we try raising the lower
     bound of the fit until it suceeds (sometimes it works at e.g. 45, but not 40).
     If that fails, then we lower the upper bound and try fitting, raising
@@ -644,10 +1245,15 @@ def fit_correction(graph, function, fit_min=-1, fit_max=-1):
             fit_max = xarr[fit_max_ind]
             function.SetRange(fit_min, fit_max)
 
-            mode = "QR"
-            if str(function.GetExpFormula()).startswith("pol"):
-                mode += "F"
-            fit_result = int(graph.Fit(function.GetName(), mode, "", fit_min, fit_max))
+            if n_starts > 0:
+                fit_result = do_multistart_correction_fit(graph, function, fit_min, fit_max,
+                                                          n_starts)
+            else:
+                mode = "QR"
+                if str(function.GetExpFormula()).startswith("pol"):
+                    mode += "F"
+                PROFILER.count("correction_fit_attempts")
+                fit_result = int(graph.Fit(function.GetName(), mode, "", fit_min, fit_max))
             if fit_result != 0:
                 fit_min_ind += 1
                 continue
@@ -679,6 +1285,137 @@ def fit_correction(graph, function, fit_min=-1, fit_max=-1):
     return graph, params
 
 
+def do_multistart_correction_fit(graph, function, fit_min, fit_max, n_starts, seed=0,
+                                 n_candidates=3):
+    """Fit the correction function to graph from many starting points at once.
+
+    The starting points are a Latin hypercube around the function's current
+    parameters, all fitted in one vectorised batch with numpy
+    (see correction_fits.fit_multistart). The sensible results with the lowest
+    chi2 are then used, in order, as the starting point of the usual ROOT fit,
+    until one succeeds, so the function & graph end up the same as after
+    a successful graph.Fit().
+
+    Parameters
+    ----------
+    graph : ROOT.TGraphErrors
+    function : ROOT.TF1
+        Its range is used for the fit. Its parameters are left at the fit
+        result if successful, otherwise they are unchanged.
+    fit_min, fit_max : float
+        Fit range.
+    n_starts : int
+        Number of starting points.
+    seed : int, optional
+        Seed for the starting points.
+    n_candidates : int, optional
+        Maximum number of ROOT fits to try.
+
+    Returns
+    -------
+    int
+        0 if successful, otherwise the status of the last ROOT fit tried, or -1
+        if no starting point gave a sensible function.
+    """
+    xarr, yarr = cu.get_xy(graph)
+    _, eyarr = cu.get_exey(graph)
+    xarr, yarr, eyarr = np.array(xarr), np.array(yarr), np.array(eyarr)
+    in_range = (xarr >= fit_min) & (xarr <= fit_max)
+    formula = function.GetTitle() or str(function.GetExpFormula())
+    orig_params = [function.GetParameter(i) for i in range(function.GetNpar())]
+    with PROFILER.stage("correction_fit_batch"):
+        results = cf.fit_multistart(formula, xarr[in_range], yarr[in_range], eyarr[in_range],
+                                    orig_params, n_starts, seed)
+    PROFILER.count("correction_fit_starts", n_starts)
+    good = np.flatnonzero((results["status"] == 0) & results["sensible"])
+    print "Multi-start fit: %d/%d starting points gave a sensible function" % (len(good), n_starts)
+
+    mode = "QR"
+    if str(function.GetExpFormula()).startswith("pol"):
+        mode += "F"
+    fit_result = -1
+    for ind in good[:n_candidates]:
+        set_fit_params(function, results["params"][ind])
+        PROFILER.count("correction_fit_attempts")
+        fit_result = int(graph.Fit(function.GetName(), mode, "", fit_min, fit_max))
+        if fit_result == 0 and check_sensible_function(function):
+            return 0
+    set_fit_params(function, orig_params)
+    return fit_result if fit_result != 0 else -1
+
+
+@PROFILER.timed("bootstrap_fits")
+def make_bootstrap_band(graph, function, replica_x, replica_y, n_points=100,
+                        quantiles=(0.16, 0.84)):
+    """Make an uncertainty band for a fitted correction function,
+    by refitting it to each bootstrap replica of the response graph.
+
+    Each replica is fitted with the same points, errors & starting parameters
+    as the nominal fit, over the same range. Replicas whose fit fails,
+    or gives a non-sensible function, are dropped.
+
+    Parameters
+    ----------
+    graph : ROOT.TGraphErrors
+        Nominal 1/<rsp> Vs <pt L1> graph.
+    function : ROOT.TF1
+        Nominal fitted correction function, with its range set to the fit range.
+    replica_x, replica_y : numpy.ndarray
+        <pt L1> & 1/<rsp> for each replica, shape (number of graph points,
+        number of replicas).
+    n_points : int, optional
+        Number of points in the band.
+    quantiles : (float, float), optional
+        Quantiles of the replica functions used for the band edges.
+
+    Returns
+    -------
+    ROOT.TGraphAsymmErrors
+        Nominal function value at each point, with errors to the band edges.
+    """
+    fit_min, fit_max = ROOT.Double(), ROOT.Double()
+    function.GetRange(fit_min, fit_max)
+    fit_min, fit_max = float(fit_min), float(fit_max)
+    xarr, _ = cu.get_xy(graph)
+    _, eyarr = cu.get_exey(graph)
+    in_range = (np.array(xarr) >= fit_min) & (np.array(xarr) <= fit_max)
+    errors = np.array(eyarr)[in_range]
+
+    band_x = np.linspace(fit_min, fit_max, n_points)
+    mode = "QRN"
+    if str(function.GetExpFormula()).startswith("pol"):
+        mode += "F"
+    replica_fn = function.Clone(function.GetName() + "_replica")
+    replica_values = []
+    for x, y in zip(replica_x[in_range].T, replica_y[in_range].T):
+        ok = np.isfinite(y)
+        if ok.sum() < function.GetNumberFreeParameters():
+            continue
+        replica_graph = ROOT.TGraphErrors(int(ok.sum()), x[ok], y[ok], np.zeros(ok.sum()),
+                                          errors[ok])
+        for j in range(function.GetNpar()):
+            replica_fn.SetParameter(j, function.GetParameter(j))
+        replica_fn.SetRange(x[ok].min(), x[ok].max())
+        if int(replica_graph.Fit(replica_fn, mode)) != 0 or not check_sensible_function(replica_fn):
+            continue
+        replica_values.append(eval_array(replica_fn, band_x))
+
+    nominal = eval_array(function, band_x)
+    if replica_values:
+        low, high = np.percentile(np.array(replica_values), [100. * q for q in quantiles], axis=0)
+    else:
+        print "No successful bootstrap fits"
+        low, high = nominal, nominal
+    print "Bootstrap band from %d/%d replicas" % (len(replica_values), replica_x.shape[1])
+    zeros = np.zeros(n_points)
+    band = ROOT.TGraphAsymmErrors(n_points, band_x, nominal, zeros, zeros,
+                                  np.maximum(nominal - low, 0), np.maximum(high - nominal, 0))
+    band.SetName(graph.GetName() + "_band")
+    band.SetTitle("%d bootstrap replicas;<p_{T}^{L1}> [GeV];1/<p_{T}^{L1}/p_{T}^{Ref}>"
+                  % len(replica_values))
+    return band
+
+
 def closest_element(arr, value):
     """Return (index, element) in array arr that is closest to value"""
     diff_abs = np.abs(arr - value * np.ones_like(len(arr)))
@@ -692,13 +1429,12 @@ def check_sensible_function(function, lim=[3, 1000], spacing=0.05):
 
     lim is a tuple or list of the lower and upper bounds to check over
     """
-    for x in np.linspace(lim[0], lim[1], ((lim[1] - lim[0]) / spacing) + 1):
-        if function.Eval(x) > 10 or function.Eval(x) < 0.5:
-            return False
-    return True
+    values = eval_array(function, np.linspace(lim[0], lim[1], ((lim[1] - lim[0]) / spacing) + 1))
+    return not np.any((values > 10) | (values < 0.5))
 
 
-def redo_correction_fit(inputfile, outputfile, absetamin, absetamax, fitfcn):
+def redo_correction_fit(inputfile, outputfile, absetamin, absetamax, fitfcn, n_fit_starts=0,
+                        fit_range=None):
     """Redo correction fit for a given eta bin.
 
     Get TGraphErrors for the bin, and perform calibration curve fitting
@@ -710,19 +1446,268 @@ def redo_correction_fit(inputfile, outputfile, absetamin, absetamax, fitfcn):
     absetamin: double
     absetamax: double
     fitfcn: TF1
+    n_fit_starts: int. Number of starting points for the correction fit,
+    see fit_correction.
+    fit_range: dict. Correction fit range to use, see setup_fit.
     """
     # Get relevant graph
     gr = cu.get_from_file(inputfile, generate_eta_graph_name(absetamin, absetamax))
     outputfile.WriteTObject(gr, gr.GetName(), 'Overwrite')  # the original graph
 
     # Setup fitting (calculate sensible range, make sub-graph), then do fit!
-    sub_graph, this_fit = setup_fit(gr, fitfcn, absetamin, absetamax, outputfile)
-    fit_graph, fit_params = fit_correction(sub_graph, this_fit)
+    sub_graph, this_fit = setup_fit(gr, fitfcn, absetamin, absetamax, outputfile, fit_range)
+    fit_graph, fit_params = fit_correction(sub_graph, this_fit, n_starts=n_fit_starts)
     outputfile.WriteTObject(this_fit, this_fit.GetName(), 'Overwrite')  # function by itself
     outputfile.WriteTObject(fit_graph, fit_graph.GetName(), 'Overwrite')  # has the function stored in it as well
     return fit_params
 
 
+def get_default_params(args):
+    """Get the default starting parameters for the correction function fit,
+    for the stage (GCT/Stage 1/Stage 2) chosen in args."""
+    if args.stage2:
+        return STAGE2_DEFAULT_PARAMS_SELECT  # this is selected around line 90
+    elif args.stage1:
+        return STAGE1_DEFAULT_PARAMS
+    elif args.gct:
+        return GCT_DEFAULT_PARAMS
+    return []
+
+
+def get_pt_bins(eta_max):
+    """Get the pt bins to use for an eta bin, wider ones for forward region."""
+    # whether we're doing a central or forward bin (.01 is for rounding err)
+    forward_bin = eta_max > 3.01
+    # return binning.pt_bins if not forward_bin else binning.pt_bins_wide
+    return binning.pt_bins_stage2 if not forward_bin else binning.pt_bins_stage2_hf
+
+
+def get_pu_bins(args):
+    """Get the list of (PU min, PU max) to run over, from --PUbins if set,
+    otherwise --PUmin/--PUmax."""
+    if not args.PUbins:
+        return [(args.PUmin, args.PUmax)]
+    pu_bins = []
+    for pu_bin in args.PUbins.split(","):
+        pu_min, pu_max = pu_bin.split(":")
+        pu_bins.append((float(pu_min), float(pu_max)))
+    return pu_bins
+
+
+def get_output_filenames(args):
+    """Get the output filename for each PU bin in get_pu_bins(args).
+    With --PUbins, each gets _PU{min}to{max} added to the output filename."""
+    if not args.PUbins:
+        return [args.output]
+    stem, ext = os.path.splitext(args.output)
+    return ["%s_PU%gto%g%s" % (stem, pu_min, pu_max, ext) for pu_min, pu_max in get_pu_bins(args)]
+
+
+def get_result_cache(args, auto_evict=True):
+    """Get the result cache from args, or None if not using one.
+    See ResultCache for auto_evict."""
+    if not args.result_cache:
+        return None
+    return rcache.ResultCache(args.result_cache, int(args.result_cache_size * 1024**3),
+                              auto_evict)
+
+
+@PROFILER.timed("read_pairs")
+def get_eta_bin_inputs(args, input_file, pairs, summary, result_cache, eta_min, eta_max, pu_bins):
+    """Get the pairs arrays & result cache key for each PU bin, for one eta bin.
+
+    Returns
+    -------
+    list[dict{str : numpy.ndarray}], list[dict]
+        Arrays for each PU bin (None if using summary), and result cache keys
+        (None if not using result_cache).
+    """
+    variables = ["rsp", "pt", "ptRef"]
+    if result_cache is None:
+        if summary is not None:
+            return [None] * len(pu_bins), [None] * len(pu_bins)
+        return (get_pu_bin_arrays(input_file, pairs, variables, eta_min, eta_max, pu_bins),
+                [None] * len(pu_bins))
+
+    base_key = dict(input=rcache.file_fingerprint(args.input), summary=args.summary)
+    if summary is not None:
+        keys = [dict(base_key, stage="summary_eta_bin", eta=[eta_min, eta_max], pu=[pu_min, pu_max])
+                for pu_min, pu_max in pu_bins]
+        return [None] * len(pu_bins), keys
+    return get_cached_pu_bin_arrays(result_cache, base_key, input_file, pairs, variables,
+                                    eta_min, eta_max, pu_bins)
+
+
+def get_quantile_estimator(args):
+    """Get the quantile response estimator from args, or None if fitting"""
+    return args.rsp_estimator if args.rsp_estimator in rf.QUANTILE_ESTIMATORS else None
+
+
+def get_fit_function(args, previous_fit_params=None):
+    """Get the correction fit function, with starting params set from the
+    defaults, or from the previous eta bin if args.inherit_params."""
+    # Load fit function & starting params - important as wrong starting params
+    # can cause fit failures
+    default_params = get_default_params(args)
+
+    # Ignore the genric fit defaults and use the last fit params instead
+    if args.inherit_params and previous_fit_params:
+        print "Inheriting params from last fit"
+        default_params = previous_fit_params[:]
+
+    fitfunc = central_fit_select  # this is selected around line 90
+    set_fit_params(fitfunc, default_params)
+    return fitfunc
+
+
+def get_profile_group(eta_min, eta_max):
+    """Name of an eta bin for --profile"""
+    return "eta_%g_%g" % (eta_min, eta_max)
+
+
+def run_eta_bin_job(job):
+    """Make the correction curves for one eta bin, in its own output file(s).
+
+    This is the worker for --jobs, so it opens its own input & output files
+    rather than sharing any with the parent process.
+
+    Parameters
+    ----------
+    job : tuple
+        (args, eta_min, eta_max, output_filenames, do_correction_fit),
+        where args are the parsed command line args, and output_filenames
+        has one output filename per PU bin.
+
+    Returns
+    -------
+    list[list]
+        Fit parameters for each PU bin, empty if no fit done.
+    """
+    args, eta_min, eta_max, output_filenames, do_correction_fit = job
+    print "Doing eta bin: %g - %g" % (eta_min, eta_max)
+    if args.profile:
+        # don't count anything the parent process did before forking
+        PROFILER.reset()
+    summary = ps.PairsSummary.load(args.input) if args.summary else None
+    input_file = None if args.summary else cu.open_root_file(args.input, "READ")
+    pairs = cu.PairsColumns(args.input) if args.cache else None
+    fit_range = get_fit_range_table(args).get(fr.table_key(eta_min, eta_max))
+    # the parent process evicts once all the workers are done, see run_eta_bins_parallel
+    result_cache = get_result_cache(args, auto_evict=False)
+    pu_bins = get_pu_bins(args)
+    settings = get_curve_settings(args, do_correction_fit)
+    all_fit_params = []
+    with PROFILER.stage("eta_bin", group=get_profile_group(eta_min, eta_max)):
+        pu_bin_arrays, cache_keys = get_eta_bin_inputs(args, input_file, pairs, summary,
+                                                       result_cache, eta_min, eta_max, pu_bins)
+        for (pu_min, pu_max), output_filename, arrays, cache_key in zip(pu_bins, output_filenames,
+                                                                       pu_bin_arrays, cache_keys):
+            output_file = cu.open_root_file(output_filename, "RECREATE")
+            fit_params = make_correction_curves(input_file, output_file, get_pt_bins(eta_max),
+                                                eta_min, eta_max, get_fit_function(args),
+                                                pu_min, pu_max, settings, pairs, summary, arrays,
+                                                result_cache, cache_key, fit_range)
+            with PROFILER.stage("write"):
+                output_file.Close()
+            all_fit_params.append(fit_params)
+    if args.profile:
+        # the parent process merges these, see run_eta_bins_parallel
+        PROFILER.finish()
+        PROFILER.save(profiling.get_profile_filename(output_filenames[0]))
+    if input_file:
+        input_file.Close()
+    return all_fit_params
+
+
+def run_eta_bins_parallel(args, etaBins, do_correction_fit):
+    """Run over eta bins in a pool of args.jobs processes.
+
+    Each eta bin is done in a separate process & file(s), then the files are
+    merged in eta order to give the same layout as running serially.
+
+    If args.inherit_params, each correction fit needs the result of the
+    previous eta bin, so only the hists & graphs are made in parallel,
+    and the fits are then done one eta bin after another on the merged file.
+    """
+    fit_in_workers = do_correction_fit and not args.inherit_params
+    if args.cache:
+        # fill the cache first, so the workers don't all try to make it
+        pairs = cu.PairsColumns(args.input)
+        pairs.preload([col for col in PAIRS_COLUMNS if col in pairs])
+        pairs.close()
+    output_filenames = get_output_filenames(args)
+    tmp_dir = tempfile.mkdtemp(prefix="runCalibration_", dir=cu.get_full_path(args.output))
+    try:
+        jobs = [(args, eta_min, eta_max,
+                 [os.path.join(tmp_dir, "eta_%g_%g_%d.root" % (eta_min, eta_max, pu_ind))
+                  for pu_ind in range(len(output_filenames))],
+                 fit_in_workers)
+                for eta_min, eta_max in pairwise(etaBins)]
+        # maxtasksperchild=1 so each eta bin starts with a fresh ROOT state
+        pool = multiprocessing.Pool(processes=args.jobs, maxtasksperchild=1)
+        try:
+            pool.map(run_eta_bin_job, jobs, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        result_cache = get_result_cache(args)
+        if result_cache:
+            result_cache.evict()
+        for pu_ind, output_filename in enumerate(output_filenames):
+            cu.merge_root_files([job[3][pu_ind] for job in jobs], output_filename)
+        if args.profile:
+            for job in jobs:
+                PROFILER.load(profiling.get_profile_filename(job[3][0]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    fit_range_table = get_fit_range_table(args)
+    if do_correction_fit and not fit_in_workers:
+        for output_filename in output_filenames:
+            output_file = cu.open_root_file(output_filename, "UPDATE")
+            previous_fit_params = []
+            for eta_min, eta_max in pairwise(etaBins):
+                print "Fitting eta bin: %g - %g" % (eta_min, eta_max)
+                fitfunc = get_fit_function(args, previous_fit_params)
+                fit_range = fit_range_table.get(fr.table_key(eta_min, eta_max))
+                fit_params = redo_correction_fit(output_file, output_file, eta_min, eta_max,
+                                                 fitfunc, args.fit_starts, fit_range)
+                if fit_params != []:
+                    previous_fit_params = fit_params[:]
+            output_file.Close()
+    if do_correction_fit:
+        for output_filename in output_filenames:
+            write_fit_range_table(output_filename, etaBins, fit_range_table)
+
+
+def check_args(args):
+    """Check for options that can't be used together, before doing anything.
+
+    Raises
+    ------
+    RuntimeError
+        If any options can't be used together.
+    """
+    if args.summary and (args.cache or args.redo_correction_fit):
+        raise RuntimeError("--summary can't be used with --cache or --redo-correction-fit")
+
+    if args.PUbins and args.redo_correction_fit:
+        raise RuntimeError("--PUbins can't be used with --redo-correction-fit")
+
+    if args.burr and args.rsp_estimator not in [None, "burr"]:
+        raise RuntimeError("--burr can't be used with --rsp-estimator %s" % args.rsp_estimator)
+
+    if args.bootstrap and (args.summary or args.redo_correction_fit or not args.no_correction_fit):
+        raise RuntimeError("--bootstrap needs the pairs & correction fit, so can't be used "
+                           "with --summary, --redo-correction-fit or --no-correction-fit")
+    if args.bootstrap and args.jobs > 1 and args.inherit_params:
+        raise RuntimeError("--bootstrap can't be used with --jobs & --inherit-params, "
+                           "since the correction fits are done after the pairs are gone")
+
+
 def main(in_args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("input", help="input ROOT filename")
@@ -736,8 +1721,30 @@ def main(in_args=sys.argv[1:]):
     parser.add_argument("--inherit-params", action='store_true',
                         help='Use previous eta bins function parameters as starting point. '
                         'Helpful when fits not converging.')
+    parser.add_argument("--fit-starts", type=int, default=0,
+                        help="Number of starting points for each correction function fit, "
+                        "on a Latin hypercube around the usual starting parameters. "
+                        "All are fitted at once with numpy, and the best sensible one "
+                        "is used to start the ROOT fit. "
+                        "Default is 0, to only fit from the usual starting parameters.")
+    parser.add_argument("--fit-ranges",
+                        help="JSON table of correction function fit ranges to use, "
+                        "as saved by a previous run (<output>_fit_ranges.json), for all "
+                        "PU bins. Eta bins not in the table have their range found as usual. "
+                        "Rows with only some of min_ind, max_ind, fit_min & fit_max override "
+                        "that part of the usual range, e.g. fit_range_overrides.json for "
+                        "2.5 < |eta| < 2.964. "
+                        "With --redo-correction-fit, the table saved with the input "
+                        "is used by default.")
     parser.add_argument("--burr", action='store_true',
                         help='Do Burr type 3 fit for response histograms instead of Gaus')
+    parser.add_argument("--rsp-estimator", choices=rf.QUANTILE_ESTIMATORS + ["gaus", "burr"],
+                        help="How to get the response for each pt bin: median or "
+                        "truncated mean of the responses, or a Gaussian or Burr fit "
+                        "to the response hist. Default is gaus, or burr if --burr")
+    parser.add_argument("--fit-backend", choices=["root", "numpy"], default="root",
+                        help="How to fit the response hists: one at a time with ROOT, "
+                        "or all pt bins at once with numpy")
     parser.add_argument("--gct", action='store_true',
                         help="Load legacy GCT specifics e.g. fit defaults.")
     parser.add_argument("--stage1", action='store_true',
@@ -756,15 +1763,62 @@ def main(in_args=sys.argv[1:]):
                         help="Maximum number of PU vertices (refers to *actual* "
                         "number of PU vertices in the event, not the centre "
                         "of of the Poisson distribution)")
+    parser.add_argument("--PUbins",
+                        help="Do several PU bins at once, reading the pairs only once, "
+                        "e.g. 25:35,40:50,55:65 (min:max, inclusive). Each PU bin "
+                        "gets its own output file, with _PU{min}to{max} added to "
+                        "the output filename. Overrides --PUmin/--PUmax.")
     parser.add_argument("--etaInd", nargs="+",
                         help="list of eta bin INDICES to run over - "
                         "if unspecified will do all. "
                         "This overrides --central/--forward. "
                         "Handy for batch mode. "
                         "IMPORTANT: MUST PUT AT VERY END")
+    parser.add_argument("--cache", action='store_true',
+                        help="Use a columnar cache of the pairs tree, stored next to "
+                        "the input file. It is made on the first run, and makes "
+                        "subsequent runs over the same file much faster.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes to run eta bins in parallel. "
+                        "With --inherit-params, only the hists & graphs are "
+                        "made in parallel, the fits are done in eta order. "
+                        "Not used with --redo-correction-fit.")
+    parser.add_argument("--summary", action='store_true',
+                        help="Input is a summary of pairs files (.npz) made by "
+                        "summarizePairs.py, instead of a pairs ROOT file")
+    parser.add_argument("--result-cache",
+                        help="Directory for a persistent cache of the pairs selected for "
+                        "each eta & PU bin, and the response hist fit for each pt bin. "
+                        "Reruns only redo the parts whose input, cuts, binning or fit "
+                        "settings have changed.")
+    parser.add_argument("--result-cache-size", type=float, default=20,
+                        help="Disk budget for --result-cache in GB. The least recently "
+                        "used results are deleted when it is exceeded.")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of Poisson bootstrap replicas, to make an uncertainty "
+                        "band for each correction function (l1corr_eta_*_band). "
+                        "All replicas are made in the same pass over the pairs, "
+                        "only the response & correction fits are redone.")
+    parser.add_argument("--bootstrap-seed", type=int, default=0,
+                        help="Random seed for --bootstrap")
+    parser.add_argument("--store", choices=STORE_OPTIONS, default="full",
+                        help="Which hists to write for each eta bin. minimal: only the "
+                        "graphs & fits, plus a compact summary of the pairs from which "
+                        "the hists can be remade (e.g. by showoffPlots.py --detail). "
+                        "summary: also the response hist for each pt bin. "
+                        "full: all hists")
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the wall & CPU time and bytes read for each stage & "
+                        "eta bin, and the number of fit attempts. Prints a summary at "
+                        "the end, and saves it all to <output>_profile.json")
     args = parser.parse_args(args=in_args)
     print args
 
+    if args.profile:
+        PROFILER.enable()
+
+    check_args(args)
+
     if args.stage2:
         print "Running with Stage2 defaults"
     elif args.stage1:
@@ -786,19 +1840,20 @@ def main(in_args=sys.argv[1:]):
     if not do_correction_fit:
         print "Not fitting correction curves"
 
+    if args.rsp_estimator is None:
+        args.rsp_estimator = "burr" if args.burr else "gaus"
+    args.burr = args.rsp_estimator == "burr"
+
     if args.burr:
         print 'Using Burr Type3 for response hist fits'
+    elif get_quantile_estimator(args):
+        print 'Using %s of response for each pt bin' % args.rsp_estimator
+
+    pu_bins = get_pu_bins(args)
+    output_filenames = get_output_filenames(args)
 
-    # Open input & output files, check
     print "IN:", args.input
-    print "OUT:", args.output
-    if (args.redo_correction_fit and
-        os.path.realpath(args.input) == os.path.realpath(args.output)):
-        input_file = cu.open_root_file(args.input, "UPDATE")
-        output_file = input_file
-    else:
-        input_file = cu.open_root_file(args.input, "READ")
-        output_file = cu.open_root_file(args.output, "RECREATE")
+    print "OUT:", ", ".join(output_filenames)
 
     # Figure out which eta bins the user wants to run over
     etaBins = binning.eta_bins
@@ -811,51 +1866,88 @@ def main(in_args=sys.argv[1:]):
         etaBins = [eta for eta in etaBins if eta > 2.9]
     print "Running over eta bins:", etaBins
 
-    # Store last set of fit params if the user is doing --inherit-param
-    previous_fit_params = []
+    if args.jobs > 1 and not args.redo_correction_fit:
+        print "Running with %d processes" % args.jobs
+        run_eta_bins_parallel(args, etaBins, do_correction_fit)
+        if args.profile:
+            profiling.report(args.output)
+        return 0
+
+    # Open input & output files, check
+    if (args.redo_correction_fit and
+        os.path.realpath(args.input) == os.path.realpath(args.output)):
+        input_file = cu.open_root_file(args.input, "UPDATE")
+        output_files = [input_file]
+    else:
+        input_file = None if args.summary else cu.open_root_file(args.input, "READ")
+        output_files = [cu.open_root_file(f, "RECREATE") for f in output_filenames]
+
+    summary = ps.PairsSummary.load(args.input) if args.summary else None
+
+    pairs = None
+    if args.cache and not args.redo_correction_fit:
+        pairs = cu.PairsColumns(args.input)
+        pairs.preload([col for col in PAIRS_COLUMNS if col in pairs])
+
+    result_cache = get_result_cache(args)
+    settings = get_curve_settings(args, do_correction_fit)
+
+    fit_range_table = get_fit_range_table(args)
+    if args.redo_correction_fit and not fit_range_table:
+        # find them for all eta bins at once
+        fit_range_table = fr.index_table(make_fit_range_table(input_file, etaBins))
+
+    # Store last set of fit params for each PU bin if the user is doing --inherit-param
+    previous_fit_params = [[] for _ in pu_bins]
 
     # Do plots & fitting to get calib consts
     for i, (eta_min, eta_max) in enumerate(pairwise(etaBins)):
         print "Doing eta bin: %g - %g" % (eta_min, eta_max)
+        with PROFILER.stage("eta_bin", group=get_profile_group(eta_min, eta_max)):
+            # setup pt bins, wider ones for forward region
+            ptBins = get_pt_bins(eta_max)
+            fit_range = fit_range_table.get(fr.table_key(eta_min, eta_max))
+
+            # Actually do the graph making and/or fitting!
+            if args.redo_correction_fit:
+                fitfunc = get_fit_function(args, previous_fit_params[0])
+                fit_params = redo_correction_fit(input_file, output_files[0], eta_min, eta_max,
+                                                 fitfunc, args.fit_starts, fit_range)
+                if fit_params != []:
+                    previous_fit_params[0] = fit_params[:]
+                continue
 
-        # whether we're doing a central or forward bin (.01 is for rounding err)
-        forward_bin = eta_max > 3.01
-
-        # setup pt bins, wider ones for forward region
-        # ptBins = binning.pt_bins if not forward_bin else binning.pt_bins_wide
-        ptBins = binning.pt_bins_stage2 if not forward_bin else binning.pt_bins_stage2_hf
-
-        # Load fit function & starting params - important as wrong starting params
-        # can cause fit failures
-        default_params = []
-        if args.stage2:
-            default_params =STAGE2_DEFAULT_PARAMS_SELECT # this is selected around line 90
-        elif args.stage1:
-            default_params = STAGE1_DEFAULT_PARAMS
-        elif args.gct:
-            default_params = GCT_DEFAULT_PARAMS
-
-        # Ignore the genric fit defaults and use the last fit params instead
-        if args.inherit_params and previous_fit_params != []:
-            print "Inheriting params from last fit"
-            default_params = previous_fit_params[:]
-
-        fitfunc = central_fit_select # this is selected around line 90
-        set_fit_params(fitfunc, default_params)
-
-        # Actually do the graph making and/or fitting!
-        if args.redo_correction_fit:
-            fit_params = redo_correction_fit(input_file, output_file, eta_min, eta_max, fitfunc)
-        else:
-            fit_params = make_correction_curves(input_file, output_file, ptBins, eta_min, eta_max,
-                                                fitfunc, do_genjet_plots, do_correction_fit,
-                                                args.PUmin, args.PUmax, args.burr)
-        # Save successful fit params
-        if fit_params != []:
-            previous_fit_params = fit_params[:]
-
-    input_file.Close()
-    output_file.Close()
+            # Get the pairs for all PU bins in one go
+            pu_bin_arrays, cache_keys = get_eta_bin_inputs(args, input_file, pairs, summary,
+                                                           result_cache, eta_min, eta_max,
+                                                           pu_bins)
+
+            for j, ((pu_min, pu_max), output_file) in enumerate(zip(pu_bins, output_files)):
+                fitfunc = get_fit_function(args, previous_fit_params[j])
+                fit_params = make_correction_curves(input_file, output_file, ptBins,
+                                                    eta_min, eta_max, fitfunc, pu_min, pu_max,
+                                                    settings, pairs, summary, pu_bin_arrays[j],
+                                                    result_cache, cache_keys[j], fit_range)
+                # Save successful fit params
+                if fit_params != []:
+                    previous_fit_params[j] = fit_params[:]
+
+    if pairs:
+        pairs.close()
+    if result_cache:
+        result_cache.print_stats()
+    with PROFILER.stage("write"):
+        for output_file in output_files:
+            if output_file is not input_file:
+                output_file.Close()
+    if args.profile:
+        profiling.report(args.output)
+    if input_file:
+        input_file.Close()
+    if do_correction_fit or args.redo_correction_fit:
+        output_filenames = [args.output] if args.redo_correction_fit else output_filenames
+        for output_filename in output_filenames:
+            write_fit_range_table(output_filename, etaBins, fit_range_table)
     return 0
 
 
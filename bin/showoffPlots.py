@@ -20,6 +20,7 @@ $ python /users/jt15104/CMSSW_8_0_9/src/L1Trigger/L1JetEnergyCorrections/bin/sho
 
 import ROOT
 import sys
+import numpy as np
 import binning
 from binning import pairwise
 import argparse
@@ -27,7 +28,7 @@ from itertools import izip, product
 import common_utils as cu
 from array import array
 import os
-from runCalibration import generate_eta_graph_name
+from runCalibration import generate_eta_graph_name, get_calib_hist
 from subprocess import check_output
 from shutil import make_archive
 from distutils.spawn import find_executable
@@ -111,11 +112,33 @@ def generate_legend(x1=0.34, y1=0.7, x2=0.88, y2=0.88):
 # PLOTS USING OUTPUT FROM RunMatcher
 #############################################
 
-def plot_dR(tree, oDir, cut="1", eta_min=0, eta_max=5, oFormat="pdf"):
-    """Plot deltaR(L1 - RefJet)"""
+def fill_from_pairs(hist, pairs, var, eta_min=None, eta_max=None):
+    """Fill hist with var from a columnar pairs cache (common_utils.PairsColumns),
+    for pairs with eta_min < |eta| < eta_max. Equivalent to
+    tree.Draw(var>>hist, "TMath::Abs(eta)>eta_min && TMath::Abs(eta)<eta_max")"""
+    values = np.asarray(pairs[var], dtype=np.float64)
+    if eta_min is not None and eta_max is not None:
+        abs_eta = np.abs(np.asarray(pairs["eta"], dtype=np.float64))
+        values = values[(abs_eta > eta_min) & (abs_eta < eta_max)]
+    cu.fill_hist(hist, values)
+
+
+def plot_dR(tree, oDir, cut="1", eta_min=0, eta_max=5, oFormat="pdf", pairs=None):
+    """Plot deltaR(L1 - RefJet)
+
+    If pairs (a common_utils.PairsColumns) is set, it is used instead of tree,
+    but cut must be "1".
+    """
     c = generate_canvas()
-    tree.Draw("dr>>h_dr(40,0,0.8)", cut + "&& TMath::Abs(eta)>%g && TMath::Abs(eta)<%g" % (eta_min, eta_max), "HISTE")
-    h_dr = ROOT.gROOT.FindObject("h_dr")
+    if pairs is not None and cut == "1":
+        h_dr = ROOT.TH1F("h_dr", "", 40, 0, 0.8)
+        fill_from_pairs(h_dr, pairs, "dr", eta_min, eta_max)
+        h_dr.Draw("HISTE")
+    else:
+        tree.Draw("dr>>h_dr(40,0,0.8)",
+                  cut + "&& TMath::Abs(eta)>%g && TMath::Abs(eta)<%g" % (eta_min, eta_max),
+                  "HISTE")
+        h_dr = ROOT.gROOT.FindObject("h_dr")
     h_dr.SetTitle(cut + "&& TMath::Abs(eta)>%g && TMath::Abs(eta)<%g;%s;N" % (eta_min, eta_max, dr_str))
     c.SaveAs("%s/dr_%g_%g.%s" % (oDir, eta_min, eta_max, oFormat))
 
@@ -156,14 +179,23 @@ def plot_eta_ref(tree, oDir, cut="1", oFormat="pdf"):
     c.SaveAs("%s/eta_ref.%s" % (oDir, oFormat))
 
 
-def plot_pt_both(tree, oDir, cut="1", eta_min=0, eta_max=5, oFormat="pdf"):
-    """Plot pt(Reference) and pt(L1) on same plot"""
+def plot_pt_both(tree, oDir, cut="1", eta_min=0, eta_max=5, oFormat="pdf", pairs=None):
+    """Plot pt(Reference) and pt(L1) on same plot
+
+    If pairs (a common_utils.PairsColumns) is set, it is used instead of tree,
+    but cut must be "1".
+    """
     c = generate_canvas()
     total_cut = cut + " && TMath::Abs(eta) > %g && TMath::Abs(eta) < %g" % (eta_min, eta_max)
     h_pt_l1 = ROOT.TH1D("h_pt_l1", "%s;%s;N" % (total_cut, pt_str), 63, 0, 252)
     h_pt_ref = ROOT.TH1D("h_pt_ref", "%s;%s;N" % (total_cut, pt_str), 63, 0, 252)
-    tree.Draw("pt>>h_pt_l1", cut + " && TMath::Abs(eta) > %g && TMath::Abs(eta) < %g" % (eta_min, eta_max), "HISTE")
-    tree.Draw("ptRef>>h_pt_ref", cut + " && TMath::Abs(eta) > %g && TMath::Abs(eta) < %g" % (eta_min, eta_max), "HISTE")
+    if pairs is not None and cut == "1":
+        fill_from_pairs(h_pt_l1, pairs, "pt", eta_min, eta_max)
+        fill_from_pairs(h_pt_ref, pairs, "ptRef", eta_min, eta_max)
+    else:
+        eta_cut = " && TMath::Abs(eta) > %g && TMath::Abs(eta) < %g" % (eta_min, eta_max)
+        tree.Draw("pt>>h_pt_l1", cut + eta_cut, "HISTE")
+        tree.Draw("ptRef>>h_pt_ref", cut + eta_cut, "HISTE")
     h_pt_ref.SetLineColor(ROOT.kRed)
     stack = ROOT.THStack("st", "")
     stack.Add(h_pt_l1)
@@ -180,15 +212,23 @@ def plot_pt_both(tree, oDir, cut="1", eta_min=0, eta_max=5, oFormat="pdf"):
     c.SaveAs("%s/pt_both_%g_%g.%s" % (oDir, eta_min, eta_max, oFormat))
 
 
-def plot_eta_both(tree, oDir, cut="1", oFormat="pdf"):
-    """Plot eta(Reference) and eta(L1) on same plot"""
+def plot_eta_both(tree, oDir, cut="1", oFormat="pdf", pairs=None):
+    """Plot eta(Reference) and eta(L1) on same plot
+
+    If pairs (a common_utils.PairsColumns) is set, it is used instead of tree,
+    but cut must be "1".
+    """
     c = generate_canvas()
     h_eta_l1 = ROOT.TH1D("h_eta_l1", "%s;%s;N" % (cut, eta_str),
                          len(binning.eta_bins_all) - 1, array('d', binning.eta_bins_all))
     h_eta_ref = ROOT.TH1D("h_eta_ref", "%s;%s;N" % (cut, eta_str),
                           len(binning.eta_bins_all) - 1, array('d', binning.eta_bins_all))
-    tree.Draw("eta>>h_eta_l1", cut, "HISTE")
-    tree.Draw("etaRef>>h_eta_ref", cut, "HISTE")
+    if pairs is not None and cut == "1":
+        fill_from_pairs(h_eta_l1, pairs, "eta")
+        fill_from_pairs(h_eta_ref, pairs, "etaRef")
+    else:
+        tree.Draw("eta>>h_eta_l1", cut, "HISTE")
+        tree.Draw("etaRef>>h_eta_ref", cut, "HISTE")
     h_eta_ref.SetLineColor(ROOT.kRed)
     h_eta_l1.Draw("HISTE")
     h_eta_ref.Draw("HISTE SAME")
@@ -314,7 +354,7 @@ def plot_eta_pt_rsp_2d(calib_file, etaBins, ptBins, oDir, oFormat='pdf'):
 def plot_rsp_eta_bin(calib_file, eta_min, eta_max, oDir, oFormat="pdf"):
     """Plot the response in one eta bin"""
     hname = "eta_%g_%g/Histograms/hrsp_eta_%g_%g" % (eta_min, eta_max, eta_min, eta_max)
-    h_rsp = cu.get_from_file(calib_file, hname)
+    h_rsp = get_calib_hist(calib_file, eta_min, eta_max, "hrsp_eta_%g_%g" % (eta_min, eta_max))
     func = h_rsp.GetListOfFunctions().At(0)
     c = generate_canvas()
     h_rsp.SetTitle(os.path.basename(hname) + ';response (%s)' % rsp_str)
@@ -400,7 +440,7 @@ def plot_rsp_Vs_l1(check_file, eta_min, eta_max, normX, logZ, oDir, oFormat="pdf
     if cu.exists_in_file(check_file, hname):
         h2d_rsp_l1_orig = cu.get_from_file(check_file, hname)
     else:
-        h2d_rsp_l1_orig = cu.get_from_file(check_file, "eta_%g_%g/Histograms/h2d_rsp_l1" % (eta_min, eta_max))
+        h2d_rsp_l1_orig = get_calib_hist(check_file, eta_min, eta_max, "h2d_rsp_l1")
     if normX:
         h2d_rsp_l1_orig = cu.norm_vertical_bins(h2d_rsp_l1_orig, rescale_peaks=True)
     h2d_rsp_l1 = h2d_rsp_l1_orig.Rebin2D(2, 1, "hnew")
@@ -431,7 +471,7 @@ def plot_rsp_Vs_ref(check_file, eta_min, eta_max, normX, logZ, oDir, oFormat="pd
     if cu.exists_in_file(check_file, hname):
         h2d_rsp_ref_orig = cu.get_from_file(check_file, hname)
     else:
-        h2d_rsp_ref_orig = cu.get_from_file(check_file, "eta_%g_%g/Histograms/h2d_rsp_gen" % (eta_min, eta_max))
+        h2d_rsp_ref_orig = get_calib_hist(check_file, eta_min, eta_max, "h2d_rsp_gen")
     if normX:
         h2d_rsp_ref_orig = cu.norm_vertical_bins(h2d_rsp_ref_orig, rescale_peaks=True)
     h2d_rsp_ref = h2d_rsp_ref_orig.Rebin2D(2, 1, "hnew")
@@ -766,7 +806,7 @@ def plot_rsp_eta_pt_bin(calib_file, eta_min, eta_max, pt_min, pt_max, oDir, oFor
     hname = "eta_%g_%g/Histograms/Rsp_genpt_%g_%g" % (eta_min, eta_max, pt_min, pt_max)
     # ignore histogram not found errors... naughty naughty
     try:
-        h_rsp = cu.get_from_file(calib_file, hname)
+        h_rsp = get_calib_hist(calib_file, eta_min, eta_max, "Rsp_genpt_%g_%g" % (pt_min, pt_max))
         c = generate_canvas()
         h_rsp.Draw("HISTE")
         func = h_rsp.GetListOfFunctions().At(0)
@@ -788,7 +828,7 @@ def plot_pt_bin(calib_file, eta_min, eta_max, pt_min, pt_max, oDir, oFormat="pdf
     hname = "eta_%g_%g/Histograms/L1_pt_genpt_%g_%g" % (eta_min, eta_max, pt_min, pt_max)
     # ignore histogram not found errors... naughty naughty
     try:
-        h_pt = cu.get_from_file(calib_file, hname)
+        h_pt = get_calib_hist(calib_file, eta_min, eta_max, "L1_pt_genpt_%g_%g" % (pt_min, pt_max))
         c = generate_canvas()
         h_pt.Draw("HISTE")
         filepath = "%s/%s/L1_pt_%g_%g_%g_%g.%s" % (oDir, sub_dir, eta_min, eta_max, pt_min, pt_max, oFormat)
@@ -854,6 +894,11 @@ def main(in_args=sys.argv[1:]):
     parser.add_argument("--pairs",
                         help="input ROOT file with matched pairs from RunMatcher")
 
+    parser.add_argument("--cache",
+                        help="Use a columnar cache of the --pairs tree, stored next to the "
+                        "pairs file. Much faster after the first time.",
+                        action='store_true')
+
     parser.add_argument("--res",
                         help="input ROOT file with resolution plots from makeResolutionPlots.py")
 
@@ -942,22 +987,31 @@ def main(in_args=sys.argv[1:]):
     if args.pairs:
         pairs_file = cu.open_root_file(args.pairs)
         pairs_tree = cu.get_from_file(pairs_file, "valid")
+        pairs = None
+        if args.cache:
+            pairs = cu.PairsColumns(args.pairs)
+            pairs.preload(["dr", "pt", "ptRef", "eta", "etaRef"])
 
         # eta binned
         for emin, emax in pairwise(binning.eta_bins):
-            plot_dR(pairs_tree, eta_min=emin, eta_max=emax, cut="1", oDir=args.oDir)
-            plot_pt_both(pairs_tree, eta_min=emin, eta_max=emax, cut="1", oDir=args.oDir)
+            plot_dR(pairs_tree, eta_min=emin, eta_max=emax, cut="1", oDir=args.oDir, pairs=pairs)
+            plot_pt_both(pairs_tree, eta_min=emin, eta_max=emax, cut="1", oDir=args.oDir,
+                         pairs=pairs)
 
         # plot_dR(pairs_tree, eta_min=0, eta_max=5, cut="1", oDir=args.oDir)  # all eta
         # plot_pt_both(pairs_tree, eta_min=0, eta_max=5, cut="1", oDir=args.oDir)  # all eta
-        plot_eta_both(pairs_tree, oDir=args.oDir)  # all eta
+        plot_eta_both(pairs_tree, oDir=args.oDir, pairs=pairs)  # all eta
 
-        plot_dR(pairs_tree, eta_min=0, eta_max=3, cut="1", oDir=args.oDir)  # central
-        plot_pt_both(pairs_tree, eta_min=0, eta_max=3, cut="1", oDir=args.oDir)  # central
+        plot_dR(pairs_tree, eta_min=0, eta_max=3, cut="1", oDir=args.oDir, pairs=pairs)  # central
+        # central
+        plot_pt_both(pairs_tree, eta_min=0, eta_max=3, cut="1", oDir=args.oDir, pairs=pairs)
 
-        plot_dR(pairs_tree, eta_min=3, eta_max=5, cut="1", oDir=args.oDir)  # forward
-        plot_pt_both(pairs_tree, eta_min=3, eta_max=5, cut="1", oDir=args.oDir)  # forward
+        plot_dR(pairs_tree, eta_min=3, eta_max=5, cut="1", oDir=args.oDir, pairs=pairs)  # forward
+        # forward
+        plot_pt_both(pairs_tree, eta_min=3, eta_max=5, cut="1", oDir=args.oDir, pairs=pairs)
 
+        if pairs:
+            pairs.close()
         pairs_file.Close()
 
     # Do plots with output from makeResolutionPlots.py
@@ -0,0 +1,428 @@
+"""
+Emulate the Stage 2 jet calibration on arrays of jets in numpy, so a set of
+corrections can be checked on the (uncorrected) pairs in minutes, without
+making a LUT, rerunning the emulator & RunMatcher.
+
+Corrections can come from:
+
+- the LUT files made by correction_LUT_stage2.print_Stage2_lut_files
+  (eta compression, pt compression & addend + multiplier LUTs).
+  These are applied with the same integer arithmetic as the firmware:
+  iet_post = ((iet * multiplier) >> right_shift) + addend,
+  where the multiplier & addend are looked up from the compressed eta & pt.
+
+- the correction functions, either from the ROOT file made by runCalibration.py,
+  or the text file made by correction_LUT_stage2.print_Stage2_func_file.
+  These are applied to the physical pt of each jet, and truncated to a HW pt,
+  as for the 'hw_pt_post_corr_orig' values in print_Stage2_lut_files.
+
+Jet pt are in HW units (0.5 GeV). The L1 jet eta stored in the pairs trees
+is the centre of a trigger tower, so it is converted to calo ieta using
+the tower edges (see the key in binning.py).
+
+It can also be run as a script, to make a pairs tree with the corrected
+L1 jet pt (by default as a friend of the uncorrected one, see
+write_corrected_tree). Usage: see
+python stage2_emulator.py -h
+"""
+
+
+import ROOT
+import os
+import sys
+import argparse
+from array import array
+import numpy as np
+from collections import OrderedDict
+import common_utils as cu
+import binary_lut
+from correction_LUT_stage2 import calo_ieta_to_index, generate_address, generate_add_mult
+from correction_fits import formula_to_numpy
+from multifunc import eval_array
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(1)
+
+
+# |eta| edges of the trigger towers for calo ieta 1 - 28, 30 - 41.
+# There is no ieta 29 tower, as HF starts from ieta 30.
+TOWER_ETA_EDGES = np.array([0.087 * i for i in range(21)] +
+                           [1.83, 1.93, 2.043, 2.172, 2.322, 2.5, 2.65, 2.964,
+                            3.139, 3.314, 3.489, 3.664, 3.839, 4.013, 4.191,
+                            4.363, 4.538, 4.716, 4.889, 5.191])
+TOWER_IETAS = np.array(range(1, 29) + range(30, 42))
+
+# Compressed eta index for each calo |ieta|
+CALO_IETA_INDEX = np.array([calo_ieta_to_index(ieta) for ieta in range(42)])
+
+# Jet HW pt is 16 bits
+MAX_HW_PT = 2**16 - 1
+
+# Correction curve in the text file from print_Stage2_func_file
+# (runCalibration.central_fit_conventional)
+FUNC_FILE_FORMULA = "[0]+[1]/(pow(log10(x),2)+[2])+[3]*exp(-[4]*(log10(x)-[5])*(log10(x)-[5]))"
+
+
+def abs_eta_to_calo_ieta(abs_eta):
+    """Convert |eta| of L1 jets (i.e. tower centres) to calo |ieta|"""
+    ind = np.searchsorted(TOWER_ETA_EDGES, abs_eta, side='right') - 1
+    return TOWER_IETAS[np.clip(ind, 0, len(TOWER_IETAS) - 1)]
+
+
+def calo_ieta_to_mp_ieta(ieta):
+    """Vectorised correction_LUT_stage2.calo_ieta_to_mp_ieta, for |ieta|"""
+    ieta = np.abs(ieta)
+    return np.where(ieta > 29, ieta - 1, ieta)
+
+
+def read_lut(lut_filename):
+    """Read a human-readable LUT, as made by correction_LUT_stage2,
+    into an array of values indexed by address, see binary_lut.read_text_lut"""
+    return binary_lut.read_text_lut(lut_filename)['values']
+
+
+def get_lut_filenames(lut_filename, separate_mult_add=False):
+    """Get the eta, pt & add+mult LUT filenames that correction_LUT_plot.py
+    makes from the base LUT filename, e.g. my_lut.txt -> my_lut_eta.txt.
+    If separate_mult_add, get the separate multiplier & addend LUTs
+    instead of the add+mult one."""
+    lut_base, ext = os.path.splitext(lut_filename)
+    if separate_mult_add:
+        suffixes = ("_eta", "_pt", "_mult", "_add")
+    else:
+        suffixes = ("_eta", "_pt", "_add_mult")
+    return [lut_base + suffix + ext for suffix in suffixes]
+
+
+class LUTCorrections(object):
+    """Stage 2 jet calibration from a set of LUTs, applied as in the firmware.
+
+    The corrected HW pt for every possible (calo |ieta|, HW pt) is worked out
+    once, the first time it is needed, so correcting jets is a single lookup.
+    """
+
+    def __init__(self, eta_lut, pt_lut, add_mult_lut, num_add_bits=8, num_mult_bits=10,
+                 right_shift=9):
+        """
+        Parameters
+        ----------
+        eta_lut : numpy.ndarray
+            MP |ieta| -> compressed eta index.
+        pt_lut : numpy.ndarray
+            HW pt >> 1 -> compressed pt index.
+        add_mult_lut : numpy.ndarray
+            Address (see correction_LUT_stage2.generate_address) ->
+            (addend << num_mult_bits) | multiplier, with a signed addend.
+        num_add_bits, num_mult_bits : int
+            Number of bits for the addend & multiplier.
+        right_shift : int
+            Right shift after multiplying.
+        """
+        self.eta_lut = np.asarray(eta_lut, dtype=np.int64)
+        self.pt_lut = np.asarray(pt_lut, dtype=np.int64)
+        self.multiplier = np.asarray(add_mult_lut, dtype=np.int64) & (2**num_mult_bits - 1)
+        addend = (np.asarray(add_mult_lut, dtype=np.int64) >> num_mult_bits) & (2**num_add_bits - 1)
+        self.addend = np.where(addend >= 2**(num_add_bits - 1), addend - 2**num_add_bits, addend)
+        self.right_shift = right_shift
+        self._lookup_table = None
+
+    @classmethod
+    def from_files(cls, eta_lut_filename, pt_lut_filename, add_mult_lut_filename, **kwargs):
+        """Load LUTs written by correction_LUT_stage2.print_Stage2_lut_files.
+        kwargs are passed to the constructor."""
+        return cls(read_lut(eta_lut_filename), read_lut(pt_lut_filename),
+                   read_lut(add_mult_lut_filename), **kwargs)
+
+    @classmethod
+    def from_mult_add_files(cls, eta_lut_filename, pt_lut_filename,
+                            mult_lut_filename, add_lut_filename,
+                            num_add_bits=8, num_mult_bits=10, **kwargs):
+        """Load LUTs written by correction_LUT_stage2.print_Stage2_lut_files,
+        using the separate multiplier & addend LUTs instead of the add+mult one.
+        kwargs are passed to the constructor."""
+        mult_lut = read_lut(mult_lut_filename)
+        add_lut = read_lut(add_lut_filename)
+        size = max(len(mult_lut), len(add_lut))
+        mult_lut = np.pad(mult_lut, (0, size - len(mult_lut)), 'constant')
+        add_lut = np.pad(add_lut, (0, size - len(add_lut)), 'constant')
+        add_mult_lut = generate_add_mult(add_lut, mult_lut, num_add_bits, num_mult_bits)
+        return cls(read_lut(eta_lut_filename), read_lut(pt_lut_filename), add_mult_lut,
+                   num_add_bits=num_add_bits, num_mult_bits=num_mult_bits, **kwargs)
+
+    @classmethod
+    def from_binary_file(cls, lut_filename, **kwargs):
+        """Load the eta, pt & add_mult tables from a binary LUT file
+        (see binary_lut.py & lut_converter.py pack), without parsing any text.
+        The number of bits & right shift are taken from the file if stored
+        there, unless given in kwargs, which are passed to the constructor."""
+        tables, metadata = binary_lut.read_binary_lut(lut_filename)
+        settings = {k: metadata[k] for k in ['num_add_bits', 'num_mult_bits', 'right_shift']
+                    if k in metadata}
+        settings.update(kwargs)
+        return cls(tables['eta']['values'], tables['pt']['values'], tables['add_mult']['raw'],
+                   **settings)
+
+    def apply_luts(self, hw_pt, calo_ieta):
+        """Get the corrected HW pt for arrays of jet HW pt & calo ieta, going
+        through the eta & pt compression, address, multiplier & addend LUTs"""
+        hw_pt = np.asarray(hw_pt, dtype=np.int64)
+        eta_index = self.eta_lut[calo_ieta_to_mp_ieta(calo_ieta)]
+        pt_index = self.pt_lut[np.minimum(hw_pt >> 1, len(self.pt_lut) - 1)]
+        address = generate_address(pt_index, eta_index)
+        hw_pt_post = ((hw_pt * self.multiplier[address]) >> self.right_shift) + self.addend[address]
+        return np.clip(hw_pt_post, 0, MAX_HW_PT)
+
+    @property
+    def lookup_table(self):
+        """Corrected HW pt for each calo |ieta| (rows) & HW pt (columns),
+        from apply_luts"""
+        if self._lookup_table is None:
+            hw_pt, calo_ieta = np.meshgrid(np.arange(MAX_HW_PT + 1),
+                                           np.arange(len(CALO_IETA_INDEX)))
+            self._lookup_table = self.apply_luts(hw_pt, calo_ieta).astype(np.int32)
+        return self._lookup_table
+
+    def correct_hw_pt(self, hw_pt, calo_ieta):
+        """Get the corrected HW pt for arrays of jet HW pt & calo ieta.
+        HW pt are 16 bits, so are limited to 0 - MAX_HW_PT."""
+        hw_pt = np.clip(hw_pt, 0, MAX_HW_PT).astype(np.int64)
+        flat_index = np.abs(calo_ieta).astype(np.int64) * (MAX_HW_PT + 1) + hw_pt
+        return self.lookup_table.take(flat_index).astype(np.int64)
+
+
+def tf1_to_numpy(func):
+    """Make a function of a numpy array of pt, from a TF1 or MultiFunc,
+    see multifunc.eval_array"""
+    return lambda pt: eval_array(func, pt)
+
+
+def make_func_file_function(curve_params, linear_const, linear_limit):
+    """Make the numpy correction function for one line of a
+    print_Stage2_func_file text file: linear_const below linear_limit,
+    FUNC_FILE_FORMULA above."""
+    curve = formula_to_numpy(FUNC_FILE_FORMULA)
+    params = np.array([curve_params])
+
+    def func(pt):
+        return np.where(pt < linear_limit, linear_const, curve(params, pt)[0])
+    return func
+
+
+class FunctionCorrections(object):
+    """Stage 2 jet calibration from correction functions,
+    one per compressed eta index."""
+
+    def __init__(self, functions):
+        """
+        Parameters
+        ----------
+        functions : list[callable or None]
+            Function of a numpy array of physical pt, returning the correction
+            factors, for each compressed eta index. None means no correction.
+        """
+        self.functions = functions
+
+    @classmethod
+    def from_root_file(cls, root_filename):
+        """Load the correction functions from runCalibration.py output"""
+        from correction_LUT_plot import get_functions_graphs_params_rootfile
+        fits, _, _ = get_functions_graphs_params_rootfile(root_filename)
+        return cls([tf1_to_numpy(fit) if fit else None for fit in fits])
+
+    @classmethod
+    def from_func_file(cls, text_filename):
+        """Load the correction functions from a text file made by
+        correction_LUT_stage2.print_Stage2_func_file
+
+        Raises
+        ------
+        ValueError
+            If a line has the wrong number of columns.
+        """
+        functions = []
+        with open(text_filename) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                cols = [float(x) for x in line.strip().split(',') if x.strip()]
+                if not cols:
+                    functions.append(None)
+                    continue
+                if len(cols) != 8:
+                    raise ValueError("Need 8 columns per line in %s, not %d"
+                                     % (text_filename, len(cols)))
+                functions.append(make_func_file_function(cols[:6], cols[6], cols[7]))
+        return cls(functions)
+
+    def correct_hw_pt(self, hw_pt, calo_ieta):
+        """Get the corrected HW pt for arrays of jet HW pt & calo ieta.
+        The function for each eta bin is only evaluated once per HW pt value."""
+        hw_pt = np.asarray(hw_pt, dtype=np.int64)
+        eta_index = CALO_IETA_INDEX[np.abs(calo_ieta)]
+        hw_pt_post = hw_pt.copy()
+        for ind, func in enumerate(self.functions):
+            mask = (eta_index == ind) & (hw_pt > 0)
+            if func is None or not mask.any():
+                continue
+            hw_pt_unique, inverse = np.unique(hw_pt[mask], return_inverse=True)
+            pt = 0.5 * hw_pt_unique
+            with np.errstate(all='ignore'):
+                hw_pt_post[mask] = (pt * func(pt) * 2.).astype(np.int64)[inverse]
+        return np.clip(hw_pt_post, 0, MAX_HW_PT)
+
+
+def correct_pt(correction, pt, eta):
+    """Apply a LUTCorrections or FunctionCorrections to arrays of
+    physical L1 jet pt & eta, returning the corrected physical pt"""
+    hw_pt = np.round(np.asarray(pt) * 2).astype(np.int64)
+    calo_ieta = abs_eta_to_calo_ieta(np.abs(eta))
+    return 0.5 * correction.correct_hw_pt(hw_pt, calo_ieta)
+
+
+# Branches of the pairs tree that depend on the L1 jet pt, and how to
+# calculate them from the L1 & reference jet pt
+PT_BRANCHES = {
+    "pt": lambda pt, ptRef: pt,
+    "rsp": lambda pt, ptRef: pt / ptRef,
+    "ptDiff": lambda pt, ptRef: pt - ptRef,
+    "resL1": lambda pt, ptRef: (pt - ptRef) / pt,
+    "resRef": lambda pt, ptRef: (pt - ptRef) / ptRef,
+}
+
+
+# Name of the uncorrected pairs tree, when it is a friend of the corrected one
+UNCORRECTED_FRIEND = "uncorrected"
+
+
+def write_corrected_tree(input_file, output_filename, correction, tree_name="valid", friend=True):
+    """Write the pairs tree with the L1 jet pt corrected, and the branches in
+    PT_BRANCHES updated to match. The entry order is the same, so any index
+    tree from indexPairs.py is copied as well.
+
+    By default, the output tree only has the PT_BRANCHES, written from the
+    corrected arrays in chunks (see common_utils.make_tree_from_arrays,
+    fastest with root_numpy), with the input tree as a friend (called
+    UNCORRECTED_FRIEND, stored with the absolute path of the input file).
+    TTree::Draw etc. use the corrected branches, and get the rest from the
+    friend, so the input file must stay where it is.
+
+    With friend=False, the whole tree is copied instead, so the output file
+    stands alone. That reads every branch of every entry with TTree::GetEntry
+    in a python loop, which is far slower for big pairs files.
+
+    Other branches that use the L1 jet pt (e.g. httL1) are left as they are.
+    """
+    tree = cu.get_from_file(input_file, tree_name)
+    arrays = cu.get_tree_arrays(tree, ["pt", "ptRef", "eta"])
+    new_pt = correct_pt(correction, arrays["pt"], arrays["eta"])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_values = OrderedDict((name, calc(new_pt, arrays["ptRef"]))
+                                 for name, calc in PT_BRANCHES.iteritems() if tree.GetBranch(name))
+
+    output_file = cu.open_root_file(output_filename, "RECREATE")
+    output_file.cd()
+    n_pairs = len(new_pt)
+    if friend:
+        print "Writing %d corrected pairs" % n_pairs
+        new_tree = cu.make_tree_from_arrays(tree_name, tree.GetTitle(), new_values)
+        new_tree.AddFriend("%s = %s" % (UNCORRECTED_FRIEND, tree_name),
+                           os.path.abspath(input_file.GetName()))
+    else:
+        new_tree = tree.CloneTree(0)
+        buffers = {name: array('f', [0]) for name in new_values}
+        for name, buff in buffers.iteritems():
+            new_tree.SetBranchAddress(name, buff)
+        for entry in xrange(n_pairs):
+            if entry % 1000000 == 0:
+                print "Copying pair %d / %d" % (entry, n_pairs)
+            tree.GetEntry(entry)
+            for name, buff in buffers.iteritems():
+                buff[0] = new_values[name][entry]
+            new_tree.Fill()
+    new_tree.Write()
+    if cu.exists_in_file(input_file, cu.PAIRS_INDEX_NAME):
+        cu.get_from_file(input_file, cu.PAIRS_INDEX_NAME).CloneTree().Write()
+    output_file.Close()
+
+
+def add_correction_args(parser):
+    """Add the options to choose the corrections to an ArgumentParser,
+    see get_correction"""
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--lut",
+                        help="LUT filename as passed to correction_LUT_plot.py --stage2, "
+                             "e.g. my_lut/my_lut.txt to use my_lut/my_lut_eta.txt, "
+                             "my_lut/my_lut_pt.txt & my_lut/my_lut_add_mult.txt, "
+                             "or a binary LUT file from lut_converter.py pack")
+    source.add_argument("--funcFile",
+                        help="Correction functions text file from "
+                             "correction_LUT_plot.py --stage2Func")
+    source.add_argument("--rootFile",
+                        help="Correction functions from runCalibration.py output")
+    parser.add_argument("--separateMultAdd", action="store_true",
+                        help="With --lut, use the separate multiplier & addend LUTs "
+                             "(e.g. my_lut/my_lut_mult.txt & my_lut/my_lut_add.txt) "
+                             "instead of the add+mult one")
+    parser.add_argument("--numAddBits", type=int,
+                        help="Number of bits for the LUT addend "
+                             "(default: from the binary LUT file, otherwise 8)")
+    parser.add_argument("--numMultBits", type=int,
+                        help="Number of bits for the LUT multiplier "
+                             "(default: from the binary LUT file, otherwise 10)")
+    parser.add_argument("--rightShift", type=int,
+                        help="Right shift after the LUT multiplier "
+                             "(default: from the binary LUT file, otherwise 9)")
+
+
+def get_correction(args):
+    """Load the corrections from whichever source was chosen in args,
+    see add_correction_args"""
+    if args.lut:
+        # only pass on the bits & shift that were set, so the defaults
+        # (or the values stored in a binary LUT file) are used otherwise
+        settings = {k: v for k, v in [('num_add_bits', args.numAddBits),
+                                      ('num_mult_bits', args.numMultBits),
+                                      ('right_shift', args.rightShift)] if v is not None}
+        if os.path.isfile(args.lut) and binary_lut.is_binary_lut(args.lut):
+            print "Using binary LUT:", args.lut
+            return LUTCorrections.from_binary_file(args.lut, **settings)
+        lut_filenames = get_lut_filenames(args.lut, args.separateMultAdd)
+        print "Using LUTs:", ", ".join(lut_filenames)
+        if args.separateMultAdd:
+            return LUTCorrections.from_mult_add_files(*lut_filenames, **settings)
+        return LUTCorrections.from_files(*lut_filenames, **settings)
+    elif args.funcFile:
+        print "Using correction functions from", args.funcFile
+        return FunctionCorrections.from_func_file(args.funcFile)
+    else:
+        print "Using correction functions from", args.rootFile
+        return FunctionCorrections.from_root_file(args.rootFile)
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=cu.CustomFormatter)
+    parser.add_argument("input", help="input ROOT filename, pairs with uncorrected L1 jets")
+    parser.add_argument("output", help="output ROOT filename, for pairs with corrected L1 jets")
+    parser.add_argument("--fullCopy", action="store_true",
+                        help="Copy the whole pairs tree, so the output doesn't need the "
+                             "input file. Much slower than the default, which only writes "
+                             "the corrected branches, with the input tree as a friend")
+    add_correction_args(parser)
+    args = parser.parse_args(args=in_args)
+
+    if os.path.realpath(args.input) == os.path.realpath(args.output):
+        raise RuntimeError("Output file must be different to input file")
+
+    correction = get_correction(args)
+    input_file = cu.open_root_file(args.input, "READ")
+    print "IN:", args.input
+    print "OUT:", args.output
+    write_corrected_tree(input_file, args.output, correction, friend=not args.fullCopy)
+    input_file.Close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Unit tests for the numpy Stage 2 calibration emulator.
+
+Compares against applying the LUT maker's one jet at a time functions.
+"""
+
+
+import correction_LUT_stage2 as cls
+import stage2_emulator as emu
+import lut_converter
+import unittest
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+def conventional(params, pt):
+    """runCalibration.central_fit_conventional written out by hand"""
+    p0, p1, p2, p3, p4, p5 = params
+    return p0 + p1 / (np.log10(pt)**2 + p2) + p3 * np.exp(-p4 * (np.log10(pt) - p5)**2)
+
+
+class TestLUTCorrections(unittest.TestCase):
+    def setUp(self):
+        """Write a set of LUTs with random multipliers & addends for 16 eta bins"""
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(3)
+        self.hw_pt_orig = np.arange(2048)
+        self.pt_index = np.minimum(self.hw_pt_orig // 40, 12)
+        self.mult = rng.randint(0, 2**10, size=(16, 13))
+        self.add = rng.randint(-128, 128, size=(16, 13))
+        mapping_info = {eta_ind: dict(pt_index=self.pt_index,
+                                      hw_corr_compressed=self.mult[eta_ind][self.pt_index],
+                                      hw_corr_compressed_add=self.add[eta_ind][self.pt_index])
+                        for eta_ind in range(16)}
+        self.lut_filename = os.path.join(self.tmp_dir, "lut.txt")
+        eta_lut, pt_lut, add_mult_lut = emu.get_lut_filenames(self.lut_filename)
+        cls.write_eta_compress_lut(eta_lut, nbits_in=6)
+        cls.write_pt_compress_lut(pt_lut, self.hw_pt_orig, self.pt_index)
+        cls.write_stage2_addend_multiplicative_lut(add_mult_lut, mapping_info, 8, 10)
+        _, _, mult_lut, add_lut = emu.get_lut_filenames(self.lut_filename, separate_mult_add=True)
+        cls.write_stage2_multiplier_lut(mult_lut, mapping_info)
+        cls.write_stage2_addition_lut(add_lut, mapping_info)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_matches_loop(self):
+        """Check same corrected HW pt as correct_iet for every (HW pt, ieta)"""
+        correction = emu.LUTCorrections.from_files(*emu.get_lut_filenames(self.lut_filename))
+        hw_pt, ieta = np.meshgrid(np.arange(0, 2200), emu.TOWER_IETAS)
+        hw_pt, ieta = hw_pt.ravel(), ieta.ravel()
+        result = correction.correct_hw_pt(hw_pt, ieta)
+        for iet, calo_ieta, iet_post in zip(hw_pt[::7], ieta[::7], result[::7]):
+            eta_ind = cls.calo_ieta_to_index(calo_ieta)
+            pt_ind = self.pt_index[min(iet, 511) & ~1]
+            expected = cls.correct_iet(iet, self.mult[eta_ind][pt_ind], 9,
+                                       self.add[eta_ind][pt_ind])
+            self.assertEqual(iet_post, max(expected, 0))
+
+    def test_lookup_table(self):
+        """Check the lookup table gives the same as going through the LUTs,
+        including for -ve ieta, and that the separate mult & add LUTs match"""
+        correction = emu.LUTCorrections.from_files(*emu.get_lut_filenames(self.lut_filename))
+        hw_pt, ieta = np.meshgrid(np.arange(0, emu.MAX_HW_PT + 1, 3),
+                                  np.concatenate((emu.TOWER_IETAS, -emu.TOWER_IETAS)))
+        hw_pt, ieta = hw_pt.ravel(), ieta.ravel()
+        result = correction.correct_hw_pt(hw_pt, ieta)
+        np.testing.assert_array_equal(result, correction.apply_luts(hw_pt, ieta))
+        filenames = emu.get_lut_filenames(self.lut_filename, separate_mult_add=True)
+        separate = emu.LUTCorrections.from_mult_add_files(*filenames)
+        np.testing.assert_array_equal(separate.correct_hw_pt(hw_pt, ieta), result)
+
+    def test_binary_file(self):
+        """Check the LUTs packed into a binary file give the same corrections,
+        using the bits & shift stored in the file"""
+        binary_filename = os.path.join(self.tmp_dir, "lut.lut")
+        lut_converter.pack(binary_filename, emu.get_lut_filenames(self.lut_filename),
+                           right_shift=9, num_add_bits=8, num_mult_bits=10)
+        correction = emu.LUTCorrections.from_binary_file(binary_filename)
+        expected = emu.LUTCorrections.from_files(*emu.get_lut_filenames(self.lut_filename))
+        np.testing.assert_array_equal(correction.lookup_table, expected.lookup_table)
+        shifted = emu.LUTCorrections.from_binary_file(binary_filename, right_shift=8)
+        self.assertNotEqual(shifted.right_shift, correction.right_shift)
+
+    def test_tower_centres(self):
+        centres = 0.5 * (emu.TOWER_ETA_EDGES[1:] + emu.TOWER_ETA_EDGES[:-1])
+        np.testing.assert_array_equal(emu.abs_eta_to_calo_ieta(centres), emu.TOWER_IETAS)
+
+
+class TestFunctionCorrections(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.params = [3.18556244, 25.56760298, 2.51677342, -103.26529010, 0.00678420, -18.73657857]
+        self.func_filename = os.path.join(self.tmp_dir, "funcs.txt")
+        with open(self.func_filename, "w") as f:
+            f.write('# linear constant,linear/curve physical pt boundary,curve params\n')
+            f.write(','.join(str(x) for x in self.params + [1.5, 20.]) + '\n')
+            f.write('\n' * 15)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_func_file(self):
+        """Check the first eta bin is corrected as by hand, and the others aren't"""
+        correction = emu.FunctionCorrections.from_func_file(self.func_filename)
+        self.assertEqual(len(correction.functions), 16)
+        hw_pt = np.arange(0, 2048)
+        result = correction.correct_hw_pt(hw_pt, np.full(len(hw_pt), 3))
+        for iet, iet_post in zip(hw_pt[1:], result[1:]):
+            pt = 0.5 * iet
+            corr = 1.5 if pt < 20 else conventional(self.params, pt)
+            self.assertEqual(iet_post, int(pt * corr * 2.))
+        self.assertEqual(result[0], 0)
+        result = correction.correct_hw_pt(hw_pt, np.full(len(hw_pt), 41))
+        np.testing.assert_array_equal(result, hw_pt)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Make & combine compact summaries of pairs files, so the calibration can be
+done map-reduce style, without merging the pairs files themselves:
+
+1) summarize each pairs file (output from RunMatcher), e.g. as batch jobs:
+python summarizePairs.py summarize pairs_1.root summary_1.npz
+
+2) reduce the summaries into one (order doesn't matter, and reduced summaries
+can be reduced again):
+python summarizePairs.py reduce summary_all.npz summary_*.npz
+
+3) run the calibration on the reduced summary:
+python runCalibration.py summary_all.npz output.root --summary --stage2
+
+See pair_summaries.py for what is stored.
+
+Usage: see
+python summarizePairs.py -h
+"""
+
+import ROOT
+import os
+import sys
+import argparse
+import binning
+import common_utils as cu
+import pair_summaries as ps
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(1)
+
+
+def summarize(input_filename, output_filename, tree_name="valid", chunk_size=5000000):
+    """Summarise one pairs file and save it.
+
+    Parameters
+    ----------
+    input_filename : str
+        Pairs file from RunMatcher.
+    output_filename : str
+        Output .npz filename.
+    tree_name : str, optional
+        Name of pairs tree.
+    chunk_size : int, optional
+        Number of entries to read at once.
+    """
+    input_file = cu.open_root_file(input_filename, "READ")
+    tree = cu.get_from_file(input_file, tree_name)
+    summary = ps.PairsSummary.from_tree(tree, binning.eta_bins, chunk_size)
+    input_file.Close()
+    summary.save(output_filename)
+
+
+def reduce_summaries(input_filenames, output_filename):
+    """Add summaries together and save the result.
+
+    Parameters
+    ----------
+    input_filenames : list[str]
+        Summary .npz files.
+    output_filename : str
+        Output .npz filename.
+    """
+    summary = None
+    for filename in input_filenames:
+        print "Adding", filename
+        this_summary = ps.PairsSummary.load(filename)
+        if summary is None:
+            summary = this_summary
+        else:
+            summary = ps.PairsSummary.merge([summary, this_summary])
+    summary.save(output_filename)
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=cu.CustomFormatter)
+    subparsers = parser.add_subparsers(dest="stage")
+
+    summarize_parser = subparsers.add_parser("summarize", help="Summarise a pairs file")
+    summarize_parser.add_argument("input", help="input ROOT filename, from RunMatcher")
+    summarize_parser.add_argument("output", help="output summary filename (.npz)")
+    summarize_parser.add_argument("--chunkSize", type=int, default=5000000,
+                                  help="Number of pairs to read at once")
+
+    reduce_parser = subparsers.add_parser("reduce", help="Add summaries together")
+    reduce_parser.add_argument("output", help="output summary filename (.npz)")
+    reduce_parser.add_argument("input", nargs="+", help="input summary filenames (.npz)")
+
+    args = parser.parse_args(args=in_args)
+
+    if args.stage == "summarize":
+        print "IN:", args.input
+        summarize(args.input, args.output, chunk_size=args.chunkSize)
+    else:
+        if os.path.realpath(args.output) in [os.path.realpath(f) for f in args.input]:
+            raise RuntimeError("Output file must be different to input files")
+        reduce_summaries(args.input, args.output)
+    print "OUT:", args.output
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Check the closure of a set of corrections without rerunning the emulator,
+by applying them to the pairs made with *uncorrected* L1 jets.
+
+The corrections are applied to the L1 jet pt of each pair in numpy
+(see stage2_emulator.py), from either:
+
+- the LUT files made by correction_LUT_plot.py --stage2 (bit-exact, including
+  the eta & pt compression, and the integer multiplier & addend),
+- the correction functions in the ROOT file from runCalibration.py,
+- the correction functions text file made by correction_LUT_plot.py --stage2Func.
+
+The response is then recalculated, and the same hists & graphs as
+checkCalibration.py are made, so the output can be used in the same way
+(e.g. showoffPlots.py). Optionally, a copy of the pairs tree with the
+corrected pt (& pt-dependent branches) can be saved as well.
+
+Usage: see
+python virtualClosure.py -h
+"""
+
+import ROOT
+import os
+import sys
+import argparse
+import numpy as np
+import binning
+import common_utils as cu
+import checkCalibration as cc
+import stage2_emulator as emu
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(1)
+
+
+def correct_pairs(pairs, correction):
+    """Apply correction to the L1 jet pt in pairs (from checkCalibration.get_pu_bin_pairs),
+    and recalculate the response. pairs is modified in place."""
+    pairs["pt"] = emu.correct_pt(correction, pairs["pt"], pairs["eta"])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pairs["rsp"] = emu.PT_BRANCHES["rsp"](pairs["pt"], pairs["ptRef"])
+    return pairs
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=cu.CustomFormatter)
+    parser.add_argument("input", help="input ROOT filename, pairs with uncorrected L1 jets")
+    parser.add_argument("output", help="output ROOT filename, for the checkCalibration.py hists")
+    emu.add_correction_args(parser)
+    parser.add_argument("--tree",
+                        help="Also save the pairs tree with corrected L1 jet pt to this file, "
+                             "as a friend of the input tree (see stage2_emulator.py)")
+    parser.add_argument("--incl", action="store_true", help="Do inclusive eta plots")
+    parser.add_argument("--excl", action="store_true", help="Do exclusive eta plots")
+    parser.add_argument("--central", action='store_true',
+                        help="Do central eta bins only (eta <= 3)")
+    parser.add_argument("--forward", action='store_true',
+                        help="Do forward eta bins only (eta >= 3)")
+    parser.add_argument("--maxPt", default=500, type=float,
+                        help="Maximum pT for L1 Jets")
+    parser.add_argument("--PUmin", default=-99, type=float,
+                        help="Minimum number of PU vertices")
+    parser.add_argument("--PUmax", default=999, type=float,
+                        help="Maximum number of PU vertices")
+    args = parser.parse_args(args=in_args)
+
+    if os.path.realpath(args.input) == os.path.realpath(args.output):
+        raise RuntimeError("Output file must be different to input file")
+
+    correction = emu.get_correction(args)
+
+    input_file = cu.open_root_file(args.input, "READ")
+    print "IN:", args.input
+    print "OUT:", args.output
+
+    if args.tree:
+        print "Writing corrected pairs to", args.tree
+        emu.write_corrected_tree(input_file, args.tree, correction)
+
+    etaBins = binning.eta_bins
+    if args.central:
+        etaBins = binning.eta_bins_central
+    elif args.forward:
+        etaBins = binning.eta_bins_forward
+    print "Running over eta bins:", etaBins
+
+    pairs = cc.get_pu_bin_pairs(input_file, etaBins, [(args.PUmin, args.PUmax)])[0]
+    input_file.Close()
+    correct_pairs(pairs, correction)
+
+    output_file = cu.open_root_file(args.output, "RECREATE")
+    cc.run_checks(None, output_file, args, etaBins, binning.pt_bins_stage2,
+                  args.PUmin, args.PUmax, pairs)
+    output_file.Close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())